@@ -1,5 +1,5 @@
 from fastapi import Request, HTTPException, APIRouter, Response, Query
-from typing import List
+from typing import List, Optional
 
 router = APIRouter()
 
@@ -85,3 +85,53 @@ def get_kandinsky_clip_vector(request: Request,
 
     return clip_vector
 
+
+@router.get("/search-images-by-phrase")
+def search_images_by_phrase(request: Request,
+                            phrase: str,
+                            top_k: int = 20,
+                            bucket: Optional[str] = None,
+                            dataset: Optional[str] = None,
+                            start_date: Optional[str] = None,
+                            end_date: Optional[str] = None):
+    clip_server = request.app.clip_server
+
+    try:
+        images = clip_server.search_images_by_phrase(phrase,
+                                                     top_k,
+                                                     bucket=bucket,
+                                                     dataset=dataset,
+                                                     start_date=start_date,
+                                                     end_date=end_date)
+    except ValueError as e:
+        # start_date or end_date can not be parsed
+        raise HTTPException(status_code=422, detail=str(e))
+
+    return {
+        "images": images
+    }
+
+@router.post("/search-images-by-vector")
+def search_images_by_vector(request: Request,
+                            clip_vector: List[float],
+                            top_k: int = 20,
+                            bucket: Optional[str] = None,
+                            dataset: Optional[str] = None,
+                            start_date: Optional[str] = None,
+                            end_date: Optional[str] = None):
+    clip_server = request.app.clip_server
+
+    try:
+        images = clip_server.search_images(clip_vector,
+                                           top_k,
+                                           bucket=bucket,
+                                           dataset=dataset,
+                                           start_date=start_date,
+                                           end_date=end_date)
+    except ValueError as e:
+        # start_date or end_date can not be parsed
+        raise HTTPException(status_code=422, detail=str(e))
+
+    return {
+        "images": images
+    }
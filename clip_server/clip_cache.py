@@ -6,13 +6,16 @@ import os
 import json
 import msgpack
 import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 base_directory = "./"
 sys.path.insert(0, base_directory)
 
 from utility.clip.clip import ClipModel
 from clip_utils import get_image_clip_from_minio
-from clip_constants import BUCKET_NAME
+from clip_constants import BUCKET_NAME, CLIP_CACHE_DOWNLOAD_WORKERS
+from clip_vector_store import ClipVectorStore
 
 class ClipFile:
     def __init__(self, clip_vector_max_count, clip_vector_list):
@@ -66,28 +69,100 @@ class ClipCache:
         # self.clip_model = ClipModel(device=device)
         self.device = device
         self.clip_cache_directory = clip_cache_directory
-        self.clip_vector_dictionary_lock = threading.Lock()
-        self.clip_vector_dictionary = {}
+        # clip vectors are stored in a memory mapped
+        # matrix file inside the cache directory
+        # so they survive server restarts
+        self.clip_vector_store = ClipVectorStore(clip_cache_directory)
+        self.clip_vector_store.load()
+        # downloads the clip vectors missing from the store,
+        # shared by all the requests
+        self.download_executor = ThreadPoolExecutor(max_workers=CLIP_CACHE_DOWNLOAD_WORKERS)
+
+    @staticmethod
+    def get_cache_key(bucket, image_path):
+        return f'{bucket}/{image_path}'
 
     # the cache has two levels
-    # the first one is the memory
-    # second one is the hard drive
-    def cache_clip_vector(self, image_path, clip_vector):
+    # the first one is the memory mapped vector store
+    # second one is minio
+    def cache_clip_vector(self, bucket, image_path, clip_vector):
         # TODO(): implement ssh cache
-        # TODO(): memory mapped clip vector caching
-        with self.clip_vector_dictionary_lock:
-            if image_path not in self.clip_vector_dictionary:
-                self.clip_vector_dictionary[image_path] = clip_vector
+        key = self.get_cache_key(bucket, image_path)
+        self.clip_vector_store.append(key, clip_vector)
 
     def get_clip_vector(self, bucket, image_path):
         # if its already in the cache just return it
-        with self.clip_vector_dictionary_lock:
-            if image_path in self.clip_vector_dictionary:
-                return self.clip_vector_dictionary[image_path]
+        key = self.get_cache_key(bucket, image_path)
+        image_clip_vector_numpy = self.clip_vector_store.get(key)
+        if image_clip_vector_numpy is not None:
+            return image_clip_vector_numpy
 
         image_clip_vector_numpy = self.get_clip_vector_from_minio(bucket, image_path)
+        if image_clip_vector_numpy is None:
+            return None
 
-        return image_clip_vector_numpy
+        # same shape (1, vector_size) and dtype as the vectors read from the store
+        return np.asarray(image_clip_vector_numpy, dtype=np.float32).reshape(1, -1)
+
+    def get_clip_vector_matrix(self, bucket, image_path_list):
+        # returns a (num_images, vector_size) float32 matrix
+        # and a boolean mask of the images that have a clip vector
+        # rows of images without a clip vector are zero
+        num_images = len(image_path_list)
+        found_mask = np.zeros(num_images, dtype=bool)
+
+        # split the requested images into cached & missing
+        cached_indices = []
+        cached_rows = []
+        missing_indices = []
+        for index, image_path in enumerate(image_path_list):
+            key = self.get_cache_key(bucket, image_path)
+            row = self.clip_vector_store.get_row_index(key)
+            if row is None:
+                missing_indices.append(index)
+            else:
+                cached_indices.append(index)
+                cached_rows.append(row)
+
+        # fetch the missing clip vectors concurrently
+        # they are appended to the store as they arrive
+        missing_vectors = []
+        if len(missing_indices) != 0:
+            missing_vectors = list(self.download_executor.map(
+                lambda index: self.get_clip_vector_from_minio(bucket, image_path_list[index]),
+                missing_indices))
+
+        vector_size = self.clip_vector_store.vector_size
+        if vector_size is None:
+            # nothing has ever been stored
+            return np.zeros((num_images, 0), dtype=np.float32), found_mask
+
+        matrix = np.zeros((num_images, vector_size), dtype=np.float32)
+
+        # a single gather from the memory mapped matrix
+        if len(cached_rows) != 0:
+            matrix[cached_indices] = self.clip_vector_store.get_rows(cached_rows)
+            found_mask[cached_indices] = True
+
+        for index, vector in zip(missing_indices, missing_vectors):
+            if vector is None:
+                continue
+            vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+            if vector.shape[0] != vector_size:
+                continue
+            matrix[index] = vector
+            found_mask[index] = True
+
+        return matrix, found_mask
+
+    def add_alias(self, bucket, image_path, row):
+        # the clip vector of the image is already stored in row under another key
+        key = self.get_cache_key(bucket, image_path)
+        self.clip_vector_store.add_alias(key, row)
+
+    def is_cached(self, bucket, image_path):
+        key = self.get_cache_key(bucket, image_path)
+        return self.clip_vector_store.contains(key)
 
     def get_clip_vector_from_minio(self, bucket, image_path):
         # if its not in the cache
@@ -101,7 +176,7 @@ class ClipCache:
             return None
 
         # the image clip vector was loaded correctly
-        self.cache_clip_vector(image_path, image_clip_vector_numpy)
+        self.cache_clip_vector(bucket, image_path, image_clip_vector_numpy)
 
         return image_clip_vector_numpy
 
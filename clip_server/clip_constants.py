@@ -5,3 +5,28 @@ CLIP_CACHE_DIRECTORY = './clip_cache/'
 
 # bucket name is hard coded to datasets
 BUCKET_NAME = 'datasets'
+
+
+# memory mapped clip vector store files
+# they live inside CLIP_CACHE_DIRECTORY
+CLIP_VECTOR_STORE_MATRIX_FILE_NAME = 'clip_vectors.bin'
+CLIP_VECTOR_STORE_INDEX_FILE_NAME = 'clip_vectors_index.txt'
+CLIP_VECTOR_STORE_ALIAS_FILE_NAME = 'clip_vectors_aliases.txt'
+CLIP_VECTOR_STORE_META_FILE_NAME = 'clip_vectors_meta.json'
+
+# dtype used to store the clip vectors on disk
+# float16 halves the disk & page cache usage
+CLIP_VECTOR_STORE_DTYPE = 'float16'
+
+# number of threads used to fetch
+# missing clip vectors from minio
+CLIP_CACHE_DOWNLOAD_WORKERS = 16
+
+# directory of the metadata of the top-k clip search index
+# the vectors are the ones of the clip cache store
+CLIP_SEARCH_INDEX_DIRECTORY = './clip_cache/search_index/'
+CLIP_SEARCH_INDEX_METADATA_FILE_NAME = 'clip_search_metadata.jsonl'
+CLIP_SEARCH_INDEX_INGESTED_BATCHES_FILE_NAME = 'clip_search_ingested_batches.txt'
+
+# number of rows scored at once when searching the index
+CLIP_SEARCH_BLOCK_SIZE = 65536
@@ -0,0 +1,365 @@
+import os
+import json
+import threading
+from array import array
+import numpy as np
+import torch
+
+from clip_constants import (CLIP_SEARCH_INDEX_METADATA_FILE_NAME,
+                            CLIP_SEARCH_INDEX_INGESTED_BATCHES_FILE_NAME,
+                            CLIP_SEARCH_BLOCK_SIZE,
+                            CLIP_VECTOR_STORE_MATRIX_FILE_NAME,
+                            CLIP_VECTOR_STORE_INDEX_FILE_NAME,
+                            CLIP_VECTOR_STORE_META_FILE_NAME)
+from utility.minio.cmd import get_file_from_minio, get_list_of_objects
+from utility.msgpack_ndarray import unpackb
+
+# marks images without a known date
+UNKNOWN_DATE = -1
+
+
+def date_to_day_number(date):
+    # '2024-02-26T20:08:27.502000' => days since epoch
+    if date is None or len(date) < 10:
+        return UNKNOWN_DATE
+
+    try:
+        return int(np.datetime64(date[:10], 'D').astype(np.int64))
+    except ValueError:
+        return UNKNOWN_DATE
+
+
+def parse_date_filter(date):
+    # day number of a start_date or end_date filter
+    # raises ValueError if the date can not be parsed
+    if date is None:
+        return None
+
+    day_number = date_to_day_number(date)
+    if day_number == UNKNOWN_DATE:
+        raise ValueError(f'invalid date {date}, expected YYYY-MM-DD')
+
+    return day_number
+
+
+# top-k nearest neighbour search over the kandinsky clip vectors
+# of the datasets, external and extracts buckets
+# the vectors are the rows of the clip cache store, the index only
+# keeps the metadata of its rows and the store row of each of them.
+# they are normalized at query time, the similarity of a block is
+# its dot product with the query divided by the row norms
+# the search is exact, the rows are scored block by block on the device
+class ClipSearchIndex:
+    def __init__(self, device, minio_client, directory, vector_store):
+        self.device = device
+        self.minio_client = minio_client
+        self.directory = directory
+        self.metadata_path = os.path.join(directory, CLIP_SEARCH_INDEX_METADATA_FILE_NAME)
+        self.ingested_batches_path = os.path.join(directory, CLIP_SEARCH_INDEX_INGESTED_BATCHES_FILE_NAME)
+
+        # the loaded store of the clip cache
+        self.vector_store = vector_store
+        self.lock = threading.Lock()
+
+        # bucket/image_hash => row
+        self.row_dictionary = {}
+        # store row of every row
+        self.store_rows = array('q')
+
+        # per row metadata
+        self.uuids = []
+        self.image_hashes = []
+        self.file_paths = []
+        self.dates = []
+        # (bucket, dataset) code and date of every row
+        # used to build the filter masks
+        self.source_codes = array('i')
+        self.day_numbers = array('q')
+
+        # (bucket, dataset) => code
+        self.source_dictionary = {}
+        self.source_list = []
+
+        # minio batch file => etag
+        self.ingested_batches = {}
+
+        self.metadata_file = None
+
+    def load(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.remove_legacy_index()
+
+        if os.path.exists(self.metadata_path):
+            with open(self.metadata_path, 'r') as file:
+                for line in file:
+                    record = json.loads(line)
+                    # records of store rows that were truncated are ignored
+                    if record['store_row'] >= self.vector_store.row_count or record['row'] > len(self.uuids):
+                        continue
+                    self.set_row_metadata(record)
+
+        if os.path.exists(self.ingested_batches_path):
+            with open(self.ingested_batches_path, 'r') as file:
+                for line in file:
+                    object_name, etag = line.rstrip('\n').rsplit(' ', 1)
+                    self.ingested_batches[object_name] = etag
+
+        self.metadata_file = open(self.metadata_path, 'a')
+
+        print(f'Loaded clip search index with {len(self.uuids)} images')
+
+    def remove_legacy_index(self):
+        # the index used to keep its own copy of the vectors, the metadata
+        # of those rows has no store_row, it is rebuilt from the store
+        legacy_matrix_path = os.path.join(self.directory, CLIP_VECTOR_STORE_MATRIX_FILE_NAME)
+        if not os.path.exists(legacy_matrix_path):
+            return
+
+        print('Removing the clip search index vectors, the index is rebuilt from the clip cache')
+        for file_name in [CLIP_VECTOR_STORE_MATRIX_FILE_NAME,
+                          CLIP_VECTOR_STORE_INDEX_FILE_NAME,
+                          CLIP_VECTOR_STORE_META_FILE_NAME,
+                          CLIP_SEARCH_INDEX_METADATA_FILE_NAME,
+                          CLIP_SEARCH_INDEX_INGESTED_BATCHES_FILE_NAME]:
+            path = os.path.join(self.directory, file_name)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def get_source_code(self, bucket, dataset):
+        source = (bucket, dataset)
+        if source not in self.source_dictionary:
+            self.source_dictionary[source] = len(self.source_list)
+            self.source_list.append(source)
+
+        return self.source_dictionary[source]
+
+    def set_row_metadata(self, record):
+        row = record['row']
+        source_code = self.get_source_code(record['bucket'], record['dataset'])
+        day_number = date_to_day_number(record['date'])
+
+        if row == len(self.uuids):
+            self.row_dictionary[self.get_key(record['bucket'], record['image_hash'])] = row
+            self.store_rows.append(record['store_row'])
+            self.uuids.append(record['uuid'])
+            self.image_hashes.append(record['image_hash'])
+            self.file_paths.append(record['file_path'])
+            self.dates.append(record['date'])
+            self.source_codes.append(source_code)
+            self.day_numbers.append(day_number)
+        else:
+            self.uuids[row] = record['uuid']
+            self.image_hashes[row] = record['image_hash']
+            self.file_paths[row] = record['file_path']
+            self.dates[row] = record['date']
+            self.source_codes[row] = source_code
+            self.day_numbers[row] = day_number
+
+    def write_row_metadata(self, record):
+        self.metadata_file.write(json.dumps(record) + '\n')
+        self.metadata_file.flush()
+        self.set_row_metadata(record)
+
+    @staticmethod
+    def get_key(bucket, image_hash):
+        return f'{bucket}/{image_hash}'
+
+    def is_complete(self, bucket, image_hash):
+        # true if the image is indexed
+        # and all of its metadata is known
+        row = self.row_dictionary.get(self.get_key(bucket, image_hash))
+        if row is None:
+            return False
+
+        return self.dates[row] is not None and self.file_paths[row] is not None
+
+    def get_store_row(self, bucket, image_hash):
+        # store row of an indexed image, None if it is not indexed
+        row = self.row_dictionary.get(self.get_key(bucket, image_hash))
+        if row is None:
+            return None
+
+        return self.store_rows[row]
+
+    def add_image(self, bucket, dataset, image_hash, uuid, file_path, date, clip_vector=None, store_key=None):
+        # store_key is the key of the vector in the store, the clip cache
+        # key of the image, or bucket/image_hash when its path is not known.
+        # clip_vector can be None for an image that is already indexed
+        key = self.get_key(bucket, image_hash)
+
+        with self.lock:
+            row = self.row_dictionary.get(key)
+            if row is not None:
+                # the image is already indexed
+                # only fill in the metadata that was missing
+                if self.dates[row] is not None and self.file_paths[row] is not None:
+                    return row
+                record = {
+                    'row': row,
+                    'store_row': self.store_rows[row],
+                    'bucket': bucket,
+                    'dataset': dataset,
+                    'image_hash': image_hash,
+                    'uuid': uuid if uuid is not None else self.uuids[row],
+                    'file_path': file_path if file_path is not None else self.file_paths[row],
+                    'date': date if date is not None else self.dates[row]
+                }
+                self.write_row_metadata(record)
+                return row
+
+            if clip_vector is None:
+                return None
+
+            clip_vector = np.asarray(clip_vector, dtype=np.float32).reshape(-1)
+            # a zero vector has no direction to compare
+            if np.linalg.norm(clip_vector) == 0:
+                return None
+
+            # the row of the vector if the store already has it
+            store_row = self.vector_store.append(store_key if store_key is not None else key, clip_vector)
+            if store_row is None:
+                return None
+
+            row = len(self.uuids)
+            record = {
+                'row': row,
+                'store_row': store_row,
+                'bucket': bucket,
+                'dataset': dataset,
+                'image_hash': image_hash,
+                'uuid': uuid,
+                'file_path': file_path,
+                'date': date
+            }
+            self.write_row_metadata(record)
+
+            return row
+
+    def ingest_clip_batch_files(self, bucket):
+        # ingests the {dataset}/clip_vectors/*_clip_data.msgpack batches
+        # written by scripts/image_scorers/clip_batch_calculations.py
+        # batches that did not change since the last run are skipped
+        dataset_list = get_list_of_objects(self.minio_client, bucket)
+
+        for dataset in dataset_list:
+            objects = self.minio_client.list_objects(bucket, prefix=f'{dataset}/clip_vectors/', recursive=True)
+
+            for obj in objects:
+                object_name = obj.object_name
+                if not object_name.endswith('_clip_data.msgpack'):
+                    continue
+
+                batch_id = f'{bucket}/{object_name}'
+                if self.ingested_batches.get(batch_id) == obj.etag:
+                    continue
+
+                data = get_file_from_minio(self.minio_client, bucket, object_name)
+                if data is None:
+                    continue
+
+                try:
+                    clip_batch = unpackb(data.read())
+                finally:
+                    data.close()
+                    data.release_conn()
+
+                print(f'Indexing {len(clip_batch)} clip vectors from {batch_id}')
+                for item in clip_batch:
+                    self.add_image(bucket=bucket,
+                                   dataset=dataset,
+                                   image_hash=item['image_hash'],
+                                   uuid=item['uuid'],
+                                   file_path=None,
+                                   date=None,
+                                   clip_vector=item['clip_vector'])
+
+                with open(self.ingested_batches_path, 'a') as file:
+                    file.write(f'{batch_id} {obj.etag}\n')
+                self.ingested_batches[batch_id] = obj.etag
+
+    def get_filter_mask(self, row_count, bucket=None, dataset=None, start_date=None, end_date=None):
+        # returns None when there is nothing to filter
+        # raises ValueError if a date can not be parsed
+        start_day = parse_date_filter(start_date)
+        end_day = parse_date_filter(end_date)
+        if bucket is None and dataset is None and start_date is None and end_date is None:
+            return None
+
+        mask = np.ones(row_count, dtype=bool)
+
+        if bucket is not None or dataset is not None:
+            allowed_codes = [code for code, (source_bucket, source_dataset) in enumerate(self.source_list)
+                             if (bucket is None or source_bucket == bucket) and
+                             (dataset is None or source_dataset == dataset)]
+            source_codes = np.frombuffer(self.source_codes, dtype=np.int32)[:row_count]
+            mask &= np.isin(source_codes, allowed_codes)
+
+        if start_date is not None or end_date is not None:
+            day_numbers = np.frombuffer(self.day_numbers, dtype=np.int64)[:row_count]
+            mask &= day_numbers != UNKNOWN_DATE
+            if start_day is not None:
+                mask &= day_numbers >= start_day
+            if end_day is not None:
+                mask &= day_numbers <= end_day
+
+        return mask
+
+    def search(self, query_vector, top_k, bucket=None, dataset=None, start_date=None, end_date=None):
+        # raises ValueError if a date can not be parsed
+        with self.lock:
+            row_count = len(self.uuids)
+            mask = self.get_filter_mask(row_count, bucket, dataset, start_date, end_date)
+            if row_count == 0 or top_k <= 0:
+                return []
+            store_rows = np.frombuffer(self.store_rows, dtype=np.int64)[:row_count].copy()
+
+        query = torch.tensor(query_vector, dtype=torch.float32, device=self.device).reshape(-1)
+        query = torch.nn.functional.normalize(query, p=2, dim=0)
+
+        best_scores = torch.empty(0, dtype=torch.float32, device=self.device)
+        best_rows = torch.empty(0, dtype=torch.int64, device=self.device)
+
+        for start in range(0, row_count, CLIP_SEARCH_BLOCK_SIZE):
+            end = min(start + CLIP_SEARCH_BLOCK_SIZE, row_count)
+
+            block_mask = None
+            if mask is not None:
+                block_mask = mask[start:end]
+                if not block_mask.any():
+                    continue
+
+            block = torch.from_numpy(self.vector_store.get_rows(store_rows[start:end])).to(self.device)
+            # cosine similarity, the stored vectors are not normalized
+            scores = torch.mv(block, query) / torch.linalg.vector_norm(block, dim=1).clamp_min(1e-12)
+
+            if block_mask is not None:
+                scores[~torch.from_numpy(block_mask).to(self.device)] = -float('inf')
+
+            block_scores, block_rows = torch.topk(scores, min(top_k, end - start))
+
+            # merge with the best rows of the previous blocks
+            best_scores = torch.cat([best_scores, block_scores])
+            best_rows = torch.cat([best_rows, block_rows + start])
+            best_scores, order = torch.topk(best_scores, min(top_k, best_scores.shape[0]))
+            best_rows = best_rows[order]
+
+            del block
+
+        result = []
+        for score, row in zip(best_scores.tolist(), best_rows.tolist()):
+            # rows removed by the filter
+            if score == -float('inf'):
+                continue
+
+            bucket_name, dataset_name = self.source_list[self.source_codes[row]]
+            result.append({
+                'uuid': self.uuids[row],
+                'image_hash': self.image_hashes[row],
+                'bucket': bucket_name,
+                'dataset': dataset_name,
+                'file_path': self.file_paths[row],
+                'date': self.dates[row],
+                'similarity_score': score
+            })
+
+        return result
@@ -1,10 +1,10 @@
 import sys
-import msgpack
 
 base_directory = "./"
 sys.path.insert(0, base_directory)
 
 from utility.minio.cmd import get_file_from_minio, is_object_exists
+from utility.msgpack_ndarray import unpackb
 
 
 def get_image_clip_from_minio(minio_client, image_path, bucket_name):
@@ -34,7 +34,7 @@ def get_image_clip_from_minio(minio_client, image_path, bucket_name):
 
     try:
         # uncompress the msgpack data
-        clip_vector = msgpack.unpackb(clip_vector_data_msgpack_memory)
+        clip_vector = unpackb(clip_vector_data_msgpack_memory)
         clip_vector = clip_vector["clip-feature-vector"]
 
         return clip_vector
@@ -0,0 +1,203 @@
+import os
+import json
+import threading
+import numpy as np
+
+from clip_constants import (CLIP_VECTOR_STORE_MATRIX_FILE_NAME,
+                            CLIP_VECTOR_STORE_INDEX_FILE_NAME,
+                            CLIP_VECTOR_STORE_ALIAS_FILE_NAME,
+                            CLIP_VECTOR_STORE_META_FILE_NAME,
+                            CLIP_VECTOR_STORE_DTYPE)
+
+
+# persistent clip vector store
+# the vectors are stored as rows of one contiguous matrix file
+# the index file has one key per line, line i is the key of row i
+# the matrix file is memory mapped, so the vectors are paged in
+# by the os on demand instead of living in the python heap
+# new vectors are appended to the end of both files
+# the alias file has 'key row' lines, more keys of rows that are already stored
+class ClipVectorStore:
+    def __init__(self, directory, dtype=CLIP_VECTOR_STORE_DTYPE):
+        self.directory = directory
+        self.matrix_path = os.path.join(directory, CLIP_VECTOR_STORE_MATRIX_FILE_NAME)
+        self.index_path = os.path.join(directory, CLIP_VECTOR_STORE_INDEX_FILE_NAME)
+        self.alias_path = os.path.join(directory, CLIP_VECTOR_STORE_ALIAS_FILE_NAME)
+        self.meta_path = os.path.join(directory, CLIP_VECTOR_STORE_META_FILE_NAME)
+
+        self.dtype = np.dtype(dtype)
+        self.vector_size = None
+        self.lock = threading.Lock()
+
+        # key => row index
+        self.row_dictionary = {}
+        self.row_count = 0
+
+        # memory mapped matrix and the number of rows it covers
+        self.matrix = None
+        self.mapped_row_count = 0
+
+        self.matrix_file = None
+        self.index_file = None
+        self.alias_file = None
+
+    def row_size_in_bytes(self):
+        return self.vector_size * self.dtype.itemsize
+
+    def load(self):
+        os.makedirs(self.directory, exist_ok=True)
+
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r') as file:
+                meta = json.load(file)
+            self.dtype = np.dtype(meta['dtype'])
+            self.vector_size = meta['vector_size']
+
+        keys = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as file:
+                keys = file.read().splitlines()
+
+        row_count = 0
+        if self.vector_size is not None and os.path.exists(self.matrix_path):
+            row_count = os.path.getsize(self.matrix_path) // self.row_size_in_bytes()
+
+        # a crash between the two appends can leave
+        # one of the files longer than the other
+        # we keep only the rows that are complete in both
+        row_count = min(row_count, len(keys))
+        if row_count != len(keys):
+            keys = keys[:row_count]
+            self.rewrite_index_file(keys)
+        self.truncate_matrix_file(row_count)
+
+        self.row_dictionary = {key: row for row, key in enumerate(keys)}
+        self.row_count = row_count
+
+        if os.path.exists(self.alias_path):
+            with open(self.alias_path, 'r') as file:
+                for line in file:
+                    key, row = line.rstrip('\n').rsplit(' ', 1)
+                    # aliases of rows that were truncated are dropped
+                    if int(row) < row_count:
+                        self.row_dictionary.setdefault(key, int(row))
+
+        self.matrix_file = open(self.matrix_path, 'ab')
+        self.index_file = open(self.index_path, 'a')
+        self.alias_file = open(self.alias_path, 'a')
+
+        self.remap()
+
+        print(f'Loaded {self.row_count} clip vectors from {self.matrix_path}')
+
+    def truncate_matrix_file(self, row_count):
+        if self.vector_size is None or not os.path.exists(self.matrix_path):
+            return
+
+        expected_size = row_count * self.row_size_in_bytes()
+        if os.path.getsize(self.matrix_path) != expected_size:
+            os.truncate(self.matrix_path, expected_size)
+
+    def rewrite_index_file(self, keys):
+        with open(self.index_path, 'w') as file:
+            for key in keys:
+                file.write(key + '\n')
+
+    def remap(self):
+        if self.row_count == 0:
+            self.matrix = None
+            self.mapped_row_count = 0
+            return
+
+        self.matrix = np.memmap(self.matrix_path,
+                                dtype=self.dtype,
+                                mode='r',
+                                shape=(self.row_count, self.vector_size))
+        self.mapped_row_count = self.row_count
+
+    def write_meta(self):
+        meta = {
+            'dtype': self.dtype.name,
+            'vector_size': self.vector_size
+        }
+        with open(self.meta_path, 'w') as file:
+            json.dump(meta, file)
+
+    def contains(self, key):
+        return key in self.row_dictionary
+
+    def get_row_index(self, key):
+        return self.row_dictionary.get(key)
+
+    def get_rows(self, row_index_list):
+        # returns a (len(row_index_list), vector_size) float32 matrix
+        if len(row_index_list) == 0:
+            return np.zeros((0, self.vector_size or 0), dtype=np.float32)
+
+        with self.lock:
+            if max(row_index_list) >= self.mapped_row_count:
+                self.remap()
+            matrix = self.matrix
+
+        return np.asarray(matrix[row_index_list], dtype=np.float32)
+
+    def get(self, key):
+        # returns the vector with shape (1, vector_size)
+        # or None if the key is not in the store
+        row = self.get_row_index(key)
+        if row is None:
+            return None
+
+        return self.get_rows([row])
+
+    def append(self, key, vector):
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+
+        with self.lock:
+            if key in self.row_dictionary:
+                return self.row_dictionary[key]
+
+            if self.vector_size is None:
+                self.vector_size = vector.shape[0]
+                self.write_meta()
+
+            if vector.shape[0] != self.vector_size:
+                print(f'clip vector {key} has size {vector.shape[0]}, expected {self.vector_size}')
+                return None
+
+            # write the vector first, then the key
+            # so the index never points to a missing row
+            self.matrix_file.write(vector.astype(self.dtype).tobytes())
+            self.matrix_file.flush()
+            self.index_file.write(key + '\n')
+            self.index_file.flush()
+
+            row = self.row_count
+            self.row_dictionary[key] = row
+            self.row_count = row + 1
+
+            return row
+
+    def add_alias(self, key, row):
+        # key of an already stored row, the vector is not written again
+        with self.lock:
+            if key in self.row_dictionary or row >= self.row_count:
+                return
+
+            self.alias_file.write(f'{key} {row}\n')
+            self.alias_file.flush()
+            self.row_dictionary[key] = row
+
+    def close(self):
+        with self.lock:
+            if self.matrix_file is not None:
+                self.matrix_file.close()
+                self.matrix_file = None
+            if self.index_file is not None:
+                self.index_file.close()
+                self.index_file = None
+            if self.alias_file is not None:
+                self.alias_file.close()
+                self.alias_file = None
+            self.matrix = None
+            self.mapped_row_count = 0
@@ -41,9 +41,9 @@ def check_new_images_and_download(clip_server):
         # TODO(): orchestration must provide an api
         # TODO(): that will take in num_jobs & offset
         # TODO(): so that we dont download millions of jobs each time
-        clip_server.download_all_clip_vectors("external")
-        clip_server.download_all_clip_vectors("extracts")
-        clip_server.download_all_clip_vectors("datasets")
+        clip_server.update_search_index("external")
+        clip_server.update_search_index("extracts")
+        clip_server.update_search_index("datasets")
 
         # Sleep for 2 hours
         sleep_time_in_seconds = 2.0 * 60 * 60
@@ -62,9 +62,10 @@ def startup_db_client():
     app.clip_server.load_clip_model()
 
     # downloads all clip vectors for external, extracts and datasets buckets
-    app.clip_server.download_all_clip_vectors("external")
-    app.clip_server.download_all_clip_vectors("extracts")
-    app.clip_server.download_all_clip_vectors("datasets")
+    # and adds them to the clip search index
+    app.clip_server.update_search_index("external")
+    app.clip_server.update_search_index("extracts")
+    app.clip_server.update_search_index("datasets")
 
     # spawn a thread that will check if there are
     # new images clip_vectors & download them
@@ -1,6 +1,5 @@
 from io import BytesIO
 import sys
-import msgpack
 import time
 import numpy as np
 import torch
@@ -11,11 +10,13 @@ sys.path.insert(0, base_directory)
 
 from kandinsky.models.clip_text_encoder.clip_text_encoder import KandinskyCLIPTextEmbedder
 from utility.clip.clip import ClipModel
+from utility.msgpack_ndarray import unpackb
 from kandinsky.models.clip_image_encoder.clip_image_encoder import KandinskyCLIPImageEncoder
 from utility.minio.cmd import get_file_from_minio, is_object_exists
 from utility.path import separate_bucket_and_file_path
 from clip_cache import ClipCache
-from clip_constants import CLIP_CACHE_DIRECTORY
+from clip_search_index import ClipSearchIndex
+from clip_constants import CLIP_CACHE_DIRECTORY, CLIP_SEARCH_INDEX_DIRECTORY
 from utility.http.request import http_get_list_completed_jobs
 from utility.http.external_images_request import http_get_external_image_list, http_get_extract_image_list
 
@@ -40,6 +41,10 @@ class ClipServer:
         self.kandinsky_clip_model= KandinskyCLIPImageEncoder(device=device)
         self.device = device
         self.clip_cache = ClipCache(device, minio_client, CLIP_CACHE_DIRECTORY)
+        # the search index uses the vectors of the clip cache store
+        self.clip_search_index = ClipSearchIndex(device, minio_client, CLIP_SEARCH_INDEX_DIRECTORY,
+                                                 self.clip_cache.clip_vector_store)
+        self.clip_search_index.load()
 
     def load_clip_model(self):
         self.clip_model.load_submodels()
@@ -145,7 +150,7 @@ class ClipServer:
 
         try:
             # uncompress the msgpack data
-            clip_vector = msgpack.unpackb(clip_vector_data_msgpack_memory)
+            clip_vector = unpackb(clip_vector_data_msgpack_memory)
             clip_vector = clip_vector["clip-feature-vector"]
             # add to chache
             self.image_clip_vector_cache[image_path] = clip_vector
@@ -240,40 +245,34 @@ class ClipServer:
         # from shape (1, 768) => (768)
         normalized_phrase_clip_vector = normalized_phrase_clip_vector.squeeze(0)
 
-        # for each batch do
-        for image_index in range(0, num_images):
-            image_path = image_path_list[image_index]
-            image_clip_vector = self.get_image_clip_vector(bucket, image_path)
-            # if the clip_vector was not found
-            # or couldn't load for some network reason
-            # we must provide an empty vector as replacement
-            if image_clip_vector is None:
-                # this syntax is weird but its just list full of zeros
-                cosine_match_list[image_index] = 0
-                continue
+        # gather all the image clip vectors into one matrix
+        # missing vectors are fetched from minio concurrently
+        image_clip_matrix, found_mask = self.clip_cache.get_clip_vector_matrix(bucket, image_path_list)
 
-            # now that we have the clip vectors we need to construct our tensors
-            image_clip_vector = torch.tensor(image_clip_vector, dtype=torch.float32, device=self.device)
+        # the score is zero if we cant find any image clip vector
+        if image_clip_matrix.shape[1] != normalized_phrase_clip_vector.shape[0]:
+            print('image clip vectors not found')
+            return cosine_match_list
 
-            #check the vector size
-            assert image_clip_vector.size() == (1, 1280), f"Expected size (1, 1280), but got {image_clip_vector.size()}"
+        image_clip_matrix = torch.from_numpy(image_clip_matrix).to(self.device)
 
-            normalized_image_clip_vector = torch.nn.functional.normalize(image_clip_vector, p=2, dim=1)
-            # removing the extra dimension
-            # from shape (1, 768) => (768)
-            normalized_image_clip_vector = normalized_image_clip_vector.squeeze(0)
+        # Normalizing every row of the matrix
+        normalized_image_clip_matrix = torch.nn.functional.normalize(image_clip_matrix, p=2, dim=1)
 
-            # cosine similarity
-            similarity = torch.dot(normalized_phrase_clip_vector, normalized_image_clip_vector)
-            similarity_value = similarity.item()
-            cosine_match_list[image_index] = similarity_value
+        # cosine similarity of every image with the phrase
+        # in a single matrix vector product
+        similarity = torch.mv(normalized_image_clip_matrix, normalized_phrase_clip_vector)
 
-            # cleanup
-            del image_clip_vector
-            del normalized_image_clip_vector
-            del similarity
-            # After your GPU-related operations, clean up the GPU memory
-            torch.cuda.empty_cache()
+        # if the clip_vector was not found
+        # or couldn't load for some network reason
+        # the score is zero
+        similarity = similarity.cpu().numpy()
+        similarity[~found_mask] = 0
+        cosine_match_list = similarity.tolist()
+
+        # cleanup
+        del image_clip_matrix
+        del normalized_image_clip_matrix
 
         del phrase_clip_vector
         del normalized_phrase_clip_vector
@@ -346,12 +345,72 @@ class ClipServer:
 
                 image_path = f'{dataset}/{file_path}'
 
+                output_file_dict = job.get('task_output_file_dict') or {}
+                image_hash = output_file_dict.get('output_file_hash')
+                image_date = job.get('task_creation_time')
+
             elif bucket in ['external', 'extracts']:
                 _ , image_path = separate_bucket_and_file_path(job['file_path'])
 
-            # this will download the clip vector from minio
-            # and will also add it to clip cache
-            self.clip_cache.get_clip_vector(bucket, image_path)
+                dataset = job.get('dataset')
+                image_hash = job.get('image_hash')
+                image_date = job.get('upload_date')
 
+            # images already in the persistent store & search index
+            # dont need to be downloaded again
+            is_indexed = image_hash is None or self.clip_search_index.is_complete(bucket, image_hash)
+            if self.clip_cache.is_cached(bucket, image_path) and is_indexed:
+                continue
+
+            # an image indexed from a clip batch file already has its vector
+            # in the store, the clip cache key of its path is added to that row
+            store_row = None if image_hash is None else self.clip_search_index.get_store_row(bucket, image_hash)
+            if store_row is not None:
+                self.clip_cache.add_alias(bucket, image_path, store_row)
+                clip_vector = None
+            else:
+                # this will download the clip vector from minio
+                # and will also add it to clip cache
+                clip_vector = self.clip_cache.get_clip_vector(bucket, image_path)
+                if clip_vector is None:
+                    continue
 
+            if image_hash is None:
+                continue
 
+            self.clip_search_index.add_image(bucket=bucket,
+                                             dataset=dataset,
+                                             image_hash=image_hash,
+                                             uuid=job.get('uuid'),
+                                             file_path=f'{bucket}/{image_path}',
+                                             date=image_date,
+                                             clip_vector=clip_vector,
+                                             store_key=ClipCache.get_cache_key(bucket, image_path))
+
+    def update_search_index(self, bucket):
+        # the clip batch files are indexed first since they are
+        # a few large reads, the per image listing then
+        # fills in the dates & file paths and the missing images
+        self.clip_search_index.ingest_clip_batch_files(bucket)
+        self.download_all_clip_vectors(bucket)
+
+    def search_images(self, query_vector, top_k, bucket=None, dataset=None, start_date=None, end_date=None):
+        return self.clip_search_index.search(query_vector,
+                                             top_k,
+                                             bucket=bucket,
+                                             dataset=dataset,
+                                             start_date=start_date,
+                                             end_date=end_date)
+
+    def search_images_by_phrase(self, phrase, top_k, bucket=None, dataset=None, start_date=None, end_date=None):
+        phrase_clip_vector_struct = self.get_clip_vector(phrase)
+        if phrase_clip_vector_struct is None:
+            self.add_phrase(phrase)
+            phrase_clip_vector_struct = self.get_clip_vector(phrase)
+
+        return self.search_images(phrase_clip_vector_struct.clip_vector,
+                                  top_k,
+                                  bucket=bucket,
+                                  dataset=dataset,
+                                  start_date=start_date,
+                                  end_date=end_date)
@@ -1,7 +1,8 @@
 import numpy as np
-import msgpack
 import hashlib
 
+from utility.msgpack_ndarray import packb, unpackb
+
 class CLIPTextEmbedderOutput:
     
     def __init__(self, model_name: str, prompts: str, embedding: np.ndarray, pooler_output: np.ndarray, attention_mask: np.ndarray):
@@ -23,27 +24,27 @@ class CLIPTextEmbedderOutput:
             embedding = self.embedding.astype(np.float64)
             pooler_output = self.pooler_output.astype(np.float64)
         
-        msgpack_string = msgpack.packb(dict(
+        msgpack_string = packb(dict(
             model_name=self.model_name,
             prompts=self.prompts,
-            embedding={'__ndarray__': embedding.tolist()},
-            pooler_output={'__ndarray__': pooler_output.tolist()},
-            attention_mask={'__ndarray__': self.attention_mask.tolist()}
-        ), use_bin_type=True)
+            embedding=embedding,
+            pooler_output=pooler_output,
+            attention_mask=self.attention_mask
+        ))
         
         return msgpack_string
     
     @classmethod
     def from_msgpack_string(cls, msgpack_string: str):
             
-        decoded_data = msgpack.unpackb(msgpack_string)
+        decoded_data = unpackb(msgpack_string)
         
         output = cls(
             model_name=decoded_data['model_name'],
             prompts=decoded_data['prompts'],
-            embedding=np.array(decoded_data['embedding']['__ndarray__']),
-            pooler_output=np.array(decoded_data['pooler_output']['__ndarray__']),
-            attention_mask=np.array(decoded_data['attention_mask']['__ndarray__'])
+            embedding=decoded_data['embedding'],
+            pooler_output=decoded_data['pooler_output'],
+            attention_mask=decoded_data['attention_mask']
         )
 
         # assert decoded_data['embedding_hash'] == output.embedding_hash, f'ERROR! hash miss match in {file_path}: stored {decoded_data["embedding_hash"]} != calculated {output.embedding_hash}'
@@ -69,25 +70,25 @@ class PooledCLIPTextEmbedderOutput:
         else:
             pooled_embedding = self.pooled_embedding.astype(np.float64)
         
-        msgpack_string = msgpack.packb(dict(
+        msgpack_string = packb(dict(
             model_name=self.model_name,
             prompts=self.prompts,
-            pooled_embedding={'__ndarray__': pooled_embedding.tolist()},
+            pooled_embedding=pooled_embedding,
             pooling_strategy=self.pooling_strategy,
             # embedding_hash=self.embedding_hash
-        ), use_bin_type=True)
+        ))
         
         return msgpack_string
     
     @classmethod
     def from_msgpack_string(cls, msgpack_string: str):
             
-        decoded_data = msgpack.unpackb(msgpack_string)
+        decoded_data = unpackb(msgpack_string)
         
         output = cls(
             model_name=decoded_data['model_name'],
             prompts=decoded_data['prompts'],
-            pooled_embedding=np.array(decoded_data['pooled_embedding']['__ndarray__']),
+            pooled_embedding=decoded_data['pooled_embedding'],
             pooling_strategy=decoded_data['pooling_strategy']
         )
 
@@ -0,0 +1,351 @@
+import os
+import sys
+import json
+import hashlib
+import threading
+from io import BytesIO
+import numpy as np
+
+base_directory = "./"
+sys.path.insert(0, base_directory)
+
+from utility.minio import cmd
+from utility.msgpack_ndarray import packb, unpackb
+from training_worker.ab_ranking.model import constants
+
+# materialized feature shards of the training datasets
+#
+# the features of one dataset and input type are stored in minio as
+# {dataset}/feature-shards/{shard_name}/{sha256}.msgpack segments
+# each segment has the image hashes and one contiguous
+# (len(image_hashes), vector_size) float32 matrix
+# so the features of a whole dataset are a handful of large reads
+# instead of one read per image
+#
+# segments are content addressed, they are named by the sha256 of their bytes
+# so two trainings building the same shard never overwrite each other
+# and a segment is never downloaded twice
+#
+# locally the segments are appended to one memory mapped matrix file
+# with an image hash => row index, like the clip server vector store
+# rows are flat, get() returns a vector in the shape of the feature files,
+# for example (1, 1280) for clip, stored as feature_shape
+# features that are not in the shard yet are fetched per image by the
+# loaders and written as a new segment, so shards are built incrementally
+FEATURE_SHARDS_DIRECTORY = "output/feature-shards"
+FEATURE_SHARDS_PREFIX = "feature-shards"
+FEATURE_SHARD_VERSION = 2
+
+FEATURE_SHARD_MATRIX_FILE_NAME = "features.bin"
+FEATURE_SHARD_INDEX_FILE_NAME = "image_hashes.txt"
+FEATURE_SHARD_SEGMENTS_FILE_NAME = "segments.txt"
+FEATURE_SHARD_META_FILE_NAME = "meta.json"
+FEATURE_SHARD_DTYPE = np.float32
+
+
+def get_feature_shard_name(input_type, pooling_strategy=constants.AVERAGE_POOLING):
+    # one shard per feature file type
+    # embedding-positive and embedding-negative are views of the
+    # embedding files but are stored as their own shards
+    if input_type == constants.CLIP:
+        return "clip"
+    if input_type == constants.KANDINSKY_CLIP:
+        return "clip-h"
+
+    if input_type in [constants.EMBEDDING, constants.EMBEDDING_POSITIVE, constants.EMBEDDING_NEGATIVE]:
+        if pooling_strategy == constants.AVERAGE_POOLING:
+            return "{}-average-pooled".format(input_type)
+        if pooling_strategy == constants.MAX_POOLING:
+            return "{}-max-pooled".format(input_type)
+        if pooling_strategy == constants.MAX_ABS_POOLING:
+            return "{}-signed-max-pooled".format(input_type)
+        return input_type
+
+    raise Exception("input type has no feature shard: {}".format(input_type))
+
+
+def get_dataset_from_features_path(features_path):
+    # 'environmental/0001/000001_clip.msgpack' => 'environmental'
+    return features_path.split("/")[0]
+
+
+class FeatureShard:
+    def __init__(self, minio_client, bucket, dataset, shard_name, directory=FEATURE_SHARDS_DIRECTORY):
+        self.minio_client = minio_client
+        self.bucket = bucket
+        self.dataset = dataset
+        self.shard_name = shard_name
+        self.prefix = "{}/{}/{}/".format(dataset, FEATURE_SHARDS_PREFIX, shard_name)
+
+        self.directory = os.path.join(directory, bucket, dataset, shard_name)
+        self.matrix_path = os.path.join(self.directory, FEATURE_SHARD_MATRIX_FILE_NAME)
+        self.index_path = os.path.join(self.directory, FEATURE_SHARD_INDEX_FILE_NAME)
+        self.segments_path = os.path.join(self.directory, FEATURE_SHARD_SEGMENTS_FILE_NAME)
+        self.meta_path = os.path.join(self.directory, FEATURE_SHARD_META_FILE_NAME)
+
+        self.dtype = np.dtype(FEATURE_SHARD_DTYPE)
+        self.vector_size = None
+        self.feature_shape = None
+        self.lock = threading.Lock()
+
+        # image hash => row index
+        self.row_dictionary = {}
+        self.row_count = 0
+        self.segments = set()
+
+        self.matrix = None
+        self.mapped_row_count = 0
+
+        # features fetched per image, written by flush()
+        self.pending_image_hashes = []
+        self.pending_vectors = []
+        self.pending_dictionary = {}
+
+    def row_size_in_bytes(self):
+        return self.vector_size * self.dtype.itemsize
+
+    def load(self):
+        os.makedirs(self.directory, exist_ok=True)
+
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, "r") as file:
+                meta = json.load(file)
+            # shards of version 1 have no feature shape, they are rebuilt
+            if "feature_shape" in meta:
+                self.vector_size = meta["vector_size"]
+                self.feature_shape = tuple(meta["feature_shape"])
+
+        image_hashes = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as file:
+                image_hashes = file.read().splitlines()
+
+        if os.path.exists(self.segments_path):
+            with open(self.segments_path, "r") as file:
+                self.segments = set(file.read().splitlines())
+
+        matrix_size = os.path.getsize(self.matrix_path) if os.path.exists(self.matrix_path) else 0
+        expected_matrix_size = len(image_hashes) * self.row_size_in_bytes() if self.vector_size else 0
+
+        # a crash while appending a segment leaves the local files
+        # out of sync, minio has all the segments so the local
+        # copy is dropped and downloaded again
+        if matrix_size != expected_matrix_size:
+            print("Feature shard {} is incomplete, rebuilding it".format(self.directory))
+            for path in [self.matrix_path, self.index_path, self.segments_path, self.meta_path]:
+                if os.path.exists(path):
+                    os.remove(path)
+            self.vector_size = None
+            self.feature_shape = None
+            self.segments = set()
+            image_hashes = []
+
+        self.row_dictionary = {image_hash: row for row, image_hash in enumerate(image_hashes)}
+        self.row_count = len(image_hashes)
+
+        self.sync()
+        self.remap()
+
+        print("Loaded feature shard {}/{} with {} vectors".format(self.bucket, self.prefix, self.row_count))
+
+    def sync(self):
+        # downloads the segments written by other trainings
+        segment_names = cmd.get_list_of_objects_with_prefix(self.minio_client, self.bucket, self.prefix)
+
+        for segment_name in segment_names:
+            if not segment_name.endswith(".msgpack") or segment_name in self.segments:
+                continue
+
+            response = cmd.get_file_from_minio(self.minio_client, self.bucket, segment_name)
+            if response is None:
+                continue
+
+            try:
+                segment = unpackb(response.data)
+            finally:
+                response.close()
+                response.release_conn()
+
+            if segment.get("version") != FEATURE_SHARD_VERSION:
+                print("Skipping feature shard segment {} with version {}".format(segment_name,
+                                                                                 segment.get("version")))
+                continue
+
+            self.append_rows(segment["image_hashes"], segment["features"], segment["feature_shape"], segment_name)
+
+    def remap(self):
+        if self.row_count == 0:
+            self.matrix = None
+            self.mapped_row_count = 0
+            return
+
+        self.matrix = np.memmap(self.matrix_path,
+                                dtype=self.dtype,
+                                mode="r",
+                                shape=(self.row_count, self.vector_size))
+        self.mapped_row_count = self.row_count
+
+    def append_rows(self, image_hashes, features, feature_shape, segment_name):
+        features = np.asarray(features, dtype=self.dtype)
+        feature_shape = tuple(feature_shape)
+        if features.ndim != 2 or features.shape[0] != len(image_hashes) or \
+                features.shape[1] != int(np.prod(feature_shape)):
+            print("Feature shard segment {} has an invalid shape {}".format(segment_name, features.shape))
+            return
+
+        if self.vector_size is None:
+            self.vector_size = features.shape[1]
+            self.feature_shape = feature_shape
+            with open(self.meta_path, "w") as file:
+                json.dump({"dtype": self.dtype.name,
+                           "vector_size": self.vector_size,
+                           "feature_shape": list(self.feature_shape)}, file)
+
+        if feature_shape != self.feature_shape:
+            print("Feature shard segment {} has feature shape {}, expected {}".format(segment_name,
+                                                                                     feature_shape,
+                                                                                     self.feature_shape))
+            return
+
+        # segments can overlap when two trainings built the same images
+        new_rows = [i for i, image_hash in enumerate(image_hashes) if image_hash not in self.row_dictionary]
+
+        # write the rows first, then the hashes and the segment name
+        # so the index never points to a missing row
+        with open(self.matrix_path, "ab") as file:
+            file.write(np.ascontiguousarray(features[new_rows]).tobytes())
+        with open(self.index_path, "a") as file:
+            file.writelines(image_hashes[i] + "\n" for i in new_rows)
+        with open(self.segments_path, "a") as file:
+            file.write(segment_name + "\n")
+
+        for i in new_rows:
+            self.row_dictionary[image_hashes[i]] = self.row_count
+            self.row_count += 1
+        self.segments.add(segment_name)
+
+    def get(self, image_hash):
+        # returns a float32 vector in the feature shape
+        # or None if the image is not in the shard
+        with self.lock:
+            row = self.row_dictionary.get(image_hash)
+            if row is None:
+                vector = self.pending_dictionary.get(image_hash)
+                return None if vector is None else vector.copy()
+
+            if row >= self.mapped_row_count:
+                self.remap()
+            matrix = self.matrix
+            feature_shape = self.feature_shape
+
+        return np.array(matrix[row], dtype=np.float32).reshape(feature_shape)
+
+    def get_rows(self, image_hash_list):
+        # returns the (len(image_hash_list), vector_size) matrix
+        # and the hashes that are not in the shard, in one memmap read
+        with self.lock:
+            rows = [self.row_dictionary.get(image_hash) for image_hash in image_hash_list]
+            missing_image_hashes = [image_hash for image_hash, row in zip(image_hash_list, rows) if row is None]
+            if self.row_count > self.mapped_row_count:
+                self.remap()
+            matrix = self.matrix
+
+        found_rows = [row for row in rows if row is not None]
+        if len(found_rows) == 0:
+            return np.zeros((0, self.vector_size or 0), dtype=np.float32), missing_image_hashes
+
+        return np.asarray(matrix[found_rows], dtype=np.float32), missing_image_hashes
+
+    def add(self, image_hash, vector):
+        # vector is in the shape of the feature file, it is kept to be returned by get()
+        vector = np.array(vector, dtype=np.float32)
+
+        with self.lock:
+            if image_hash in self.row_dictionary or image_hash in self.pending_dictionary:
+                return
+
+            feature_shape = self.feature_shape
+            if feature_shape is None and len(self.pending_vectors) > 0:
+                feature_shape = self.pending_vectors[0].shape
+            if feature_shape is not None and vector.shape != feature_shape:
+                print("Not adding {} to feature shard {}/{}, shape {} expected {}".format(image_hash,
+                                                                                          self.bucket,
+                                                                                          self.prefix,
+                                                                                          vector.shape,
+                                                                                          feature_shape))
+                return
+
+            self.pending_image_hashes.append(image_hash)
+            self.pending_vectors.append(vector)
+            self.pending_dictionary[image_hash] = vector
+
+    def flush(self):
+        # writes the pending features as a new segment
+        with self.lock:
+            if len(self.pending_image_hashes) == 0:
+                return
+
+            image_hashes = self.pending_image_hashes
+            feature_shape = self.pending_vectors[0].shape
+            features = np.stack([vector.reshape(-1) for vector in self.pending_vectors]).astype(self.dtype)
+
+            segment = {
+                "version": FEATURE_SHARD_VERSION,
+                "dataset": self.dataset,
+                "shard_name": self.shard_name,
+                "image_hashes": image_hashes,
+                "feature_shape": list(feature_shape),
+                "features": features
+            }
+            data = packb(segment)
+            segment_name = "{}{}.msgpack".format(self.prefix, hashlib.sha256(data).hexdigest())
+
+            cmd.upload_data(self.minio_client, self.bucket, segment_name, BytesIO(data))
+            self.append_rows(image_hashes, features, feature_shape, segment_name)
+
+            self.pending_image_hashes = []
+            self.pending_vectors = []
+            self.pending_dictionary = {}
+
+            print("Added {} vectors to feature shard {}/{}".format(len(image_hashes), self.bucket, self.prefix))
+
+
+class FeatureShardSet:
+    # the feature shards of one input type, one shard per (bucket, dataset)
+    # the shards are loaded when their dataset is first used
+    def __init__(self, minio_client, input_type, pooling_strategy=constants.AVERAGE_POOLING,
+                 directory=FEATURE_SHARDS_DIRECTORY):
+        self.minio_client = minio_client
+        self.shard_name = get_feature_shard_name(input_type, pooling_strategy)
+        self.directory = directory
+
+        self.lock = threading.Lock()
+        self.shards = {}
+
+    def get_shard(self, bucket, features_path):
+        dataset = get_dataset_from_features_path(features_path)
+        key = (bucket, dataset)
+
+        with self.lock:
+            shard = self.shards.get(key)
+            if shard is None:
+                shard = FeatureShard(self.minio_client, bucket, dataset, self.shard_name, self.directory)
+                shard.load()
+                self.shards[key] = shard
+
+        return shard
+
+    def get(self, bucket, features_path, image_hash):
+        return self.get_shard(bucket, features_path).get(image_hash)
+
+    def add(self, bucket, features_path, image_hash, vector):
+        self.get_shard(bucket, features_path).add(image_hash, vector)
+
+    def flush(self):
+        for shard in list(self.shards.values()):
+            try:
+                shard.flush()
+            except Exception as e:
+                # the shard is a cache of the feature files
+                # the training does not fail if it can not be written
+                print("Failed to write feature shard {}/{}: {}".format(shard.bucket, shard.prefix, e))
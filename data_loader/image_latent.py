@@ -1,5 +1,4 @@
-import msgpack
-import numpy as np
+from utility.msgpack_ndarray import packb, unpackb
 
 class LatentData:
     job_uuid: str
@@ -28,24 +27,14 @@ class LatentData:
 
     def get_msgpack_string(self):
         serialized = self.serialize()
-        return msgpack.packb(serialized, default=encode_ndarray, use_bin_type=True, use_single_float=True)
+        return packb(serialized)
 
     @classmethod
     def from_msgpack_string(cls, msgpack_string):
-        data = msgpack.unpackb(msgpack_string.encode('latin1'), object_hook=decode_ndarray, raw=False)
+        data = unpackb(msgpack_string.encode('latin1'))
         return cls.deserialize(data)
 
     @classmethod
     def from_msgpack_bytes(cls, msgpack_string):
-        data = msgpack.unpackb(msgpack_string, object_hook=decode_ndarray, raw=False)
+        data = unpackb(msgpack_string)
         return cls.deserialize(data)
-
-def encode_ndarray(obj):
-    if isinstance(obj, np.ndarray):
-        return {'__ndarray__': obj.tolist()}
-    return obj
-
-def decode_ndarray(packed_obj):
-    if '__ndarray__' in packed_obj:
-        return np.array(packed_obj['__ndarray__'])
-    return packed_obj
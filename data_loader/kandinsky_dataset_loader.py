@@ -4,7 +4,6 @@ import sys
 import requests
 import json
 import torch
-import msgpack
 from tqdm import tqdm
 import argparse
 
@@ -15,6 +14,7 @@ sys.path.insert(0, os.getcwd())
 from data_loader.utils import get_object
 from kandinsky_worker.dataloaders.image_embedding import ImageEmbedding
 from utility.minio import cmd
+from utility.msgpack_ndarray import unpackb
 from utility.path import separate_bucket_and_file_path
 from training_worker.ab_ranking.model.ab_ranking_elm_v1 import ABRankingELMModel
 from training_worker.classifiers.models.elm_regression import ELMRegression
@@ -146,7 +146,7 @@ class KandinskyDatasetLoader:
 
                 output_clip_path = file_path + "_clip_kandinsky.msgpack"
                 features_data = get_object(self.minio_client, output_clip_path)
-                features_vector = msgpack.unpackb(features_data)["clip-feature-vector"]
+                features_vector = unpackb(features_data)["clip-feature-vector"]
                 output_clip_vector= torch.tensor(features_vector).to(device=self.device)
 
                 output_clip_score = self.ranking_model.predict_clip(output_clip_vector).item()
@@ -184,7 +184,7 @@ class KandinskyDatasetLoader:
 
                 output_clip_path = file_path + "_clip_kandinsky.msgpack"
                 features_data = get_object(self.minio_client, output_clip_path)
-                features_vector = msgpack.unpackb(features_data)["clip-feature-vector"]
+                features_vector = unpackb(features_data)["clip-feature-vector"]
                 output_clip_vector= torch.tensor(features_vector).to(device=self.device)
 
                 input_batch.append(input_clip_vector)
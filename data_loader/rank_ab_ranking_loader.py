@@ -5,7 +5,6 @@ import numpy as np
 import time
 import torch
 from torch.nn.functional import normalize as torch_normalize
-import msgpack
 from random import shuffle, choice, sample
 from tqdm import tqdm
 from concurrent.futures import ThreadPoolExecutor, as_completed
@@ -15,9 +14,11 @@ base_directory = "./"
 sys.path.insert(0, base_directory)
 
 from utility.minio import cmd
+from utility.msgpack_ndarray import unpackb
 from training_worker.ab_ranking.model import constants
 from data_loader.ab_data import ABData
 from data_loader.utils import *
+from data_loader.feature_shards import FeatureShardSet
 
 # import request service for getting rank model list
 from utility.http.request import http_get_rank_list
@@ -35,7 +36,8 @@ class ABRankingDatasetLoader:
                  pooling_strategy=constants.AVERAGE_POOLING,
                  normalize_vectors=True,
                  target_option=constants.TARGET_1_AND_0,
-                 duplicate_flip_option=constants.DUPLICATE_AND_FLIP_ALL):
+                 duplicate_flip_option=constants.DUPLICATE_AND_FLIP_ALL,
+                 use_feature_shards=False):
         self.rank_model_id = rank_model_id
         self.input_type = input_type
 
@@ -85,6 +87,11 @@ class ABRankingDatasetLoader:
         self.image_selected_index_0_count = 0
         self.image_selected_index_1_count = 0
 
+        # read the features from the materialized feature shards
+        # instead of one minio object per image
+        self.use_feature_shards = use_feature_shards
+        self.feature_shards = None
+
     def load_dataset(self, pre_shuffle=True):
         start_time = time.time()
         print("Loading dataset references...")
@@ -132,9 +139,16 @@ class ABRankingDatasetLoader:
         self.training_data_paths_indices = training_data_paths_indices
         self.validation_data_paths_indices = validation_data_paths_indices
 
+        if self.use_feature_shards:
+            self.feature_shards = FeatureShardSet(self.minio_client, self.input_type, self.pooling_strategy)
+
         # always load to ram
         self.load_all_training_data(self.training_ab_data_paths_list, pre_shuffle=pre_shuffle)
         self.load_all_validation_data(self.validation_ab_data_paths_list)
+
+        # write the features that were not in the shards yet
+        if self.feature_shards is not None:
+            self.feature_shards.flush()
         self.total_num_data = self.validation_data_total + self.training_data_total
 
         print("Dataset loaded...")
@@ -155,6 +169,35 @@ class ABRankingDatasetLoader:
 
         return selected_index_0_count, selected_index_1_count, total_count
 
+    def get_features_vector(self, bucket, features_path, image_hash):
+        # read from the dataset's feature shard when it has the image
+        if self.feature_shards is not None:
+            features_vector = self.feature_shards.get(bucket, features_path, image_hash)
+            if features_vector is not None:
+                return features_vector
+
+        features_response = cmd.get_file_from_minio(self.minio_client, bucket, features_path)
+        if features_response is None:
+            return None
+
+        features_data = unpackb(features_response.data)
+        features_vector = []
+
+        if self.input_type in [constants.EMBEDDING, constants.EMBEDDING_POSITIVE]:
+            features_vector.extend(features_data["positive_embedding"])
+        if self.input_type in [constants.EMBEDDING, constants.EMBEDDING_NEGATIVE]:
+            features_vector.extend(features_data["negative_embedding"])
+        if self.input_type in [constants.CLIP, constants.KANDINSKY_CLIP]:
+            features_vector.extend(features_data["clip-feature-vector"])
+
+        features_vector = np.array(features_vector)
+
+        # added to the shard when the dataset is loaded
+        if self.feature_shards is not None and not np.isnan(features_vector).all():
+            self.feature_shards.add(bucket, features_path, image_hash, features_vector)
+
+        return features_vector
+
     def get_selection_datapoint_image_pair(self, dataset, index=0):
         image_pairs = []
         ab_data = dataset
@@ -194,41 +237,13 @@ class ABRankingDatasetLoader:
         features_path_img_2 = file_path_img_2.replace(".jpg", input_type_extension)
         bucket_img_2, features_path_img_2 = separate_bucket_and_file_path(features_path_img_2)
 
-        features_image_1_response = cmd.get_file_from_minio(self.minio_client, bucket_img_1, features_path_img_1)
-        if features_image_1_response is None:
+        features_vector_img_1 = self.get_features_vector(bucket_img_1, features_path_img_1, ab_data.hash_image_1)
+        if features_vector_img_1 is None:
             return None, None, None, None
-        else:
-            features_img_1_data = features_image_1_response.data
-            
-        features_img_1_data = msgpack.unpackb(features_img_1_data)
-        features_vector_img_1 = []
 
-        if self.input_type in [constants.EMBEDDING, constants.EMBEDDING_POSITIVE]:
-            features_vector_img_1.extend(features_img_1_data["positive_embedding"]["__ndarray__"])
-        if self.input_type in [constants.EMBEDDING, constants.EMBEDDING_NEGATIVE]:
-            features_vector_img_1.extend(features_img_1_data["negative_embedding"]["__ndarray__"])
-        if self.input_type in [constants.CLIP, constants.KANDINSKY_CLIP]:
-            features_vector_img_1.extend(features_img_1_data["clip-feature-vector"])
-
-        features_vector_img_1 = np.array(features_vector_img_1)
-        
-        features_image_2_response = cmd.get_file_from_minio(self.minio_client, bucket_img_2, features_path_img_2)
-        if features_image_2_response is None:
+        features_vector_img_2 = self.get_features_vector(bucket_img_2, features_path_img_2, ab_data.hash_image_2)
+        if features_vector_img_2 is None:
             return None, None, None, None
-        else:
-            features_img_2_data = features_image_2_response.data
-        
-        features_img_2_data = msgpack.unpackb(features_img_2_data)
-        features_vector_img_2 = []
-
-        if self.input_type in [constants.EMBEDDING, constants.EMBEDDING_POSITIVE]:
-            features_vector_img_2.extend(features_img_2_data["positive_embedding"]["__ndarray__"])
-        if self.input_type in [constants.EMBEDDING, constants.EMBEDDING_NEGATIVE]:
-            features_vector_img_2.extend(features_img_2_data["negative_embedding"]["__ndarray__"])
-        if self.input_type in [constants.CLIP, constants.KANDINSKY_CLIP]:
-            features_vector_img_2.extend(features_img_2_data["clip-feature-vector"])
-
-        features_vector_img_2 = np.array(features_vector_img_2)
 
         # check if feature is nan
         if np.isnan(features_vector_img_1).all():
@@ -676,26 +691,26 @@ class ABRankingDatasetLoader:
         features_path_img_2 = features_path_img_2.replace("datasets/", "")
 
         features_img_1_data = features_dict[features_path_img_1]
-        features_img_1_data = msgpack.unpackb(features_img_1_data)
+        features_img_1_data = unpackb(features_img_1_data)
 
         features_vector_img_1 = []
         if self.input_type in [constants.EMBEDDING, constants.EMBEDDING_POSITIVE]:
-            features_vector_img_1.extend(features_img_1_data["positive_embedding"]["__ndarray__"])
+            features_vector_img_1.extend(features_img_1_data["positive_embedding"])
         if self.input_type in [constants.EMBEDDING, constants.EMBEDDING_NEGATIVE]:
-            features_vector_img_1.extend(features_img_1_data["negative_embedding"]["__ndarray__"])
+            features_vector_img_1.extend(features_img_1_data["negative_embedding"])
         if self.input_type in [constants.CLIP, constants.KANDINSKY_CLIP]:
             features_vector_img_1.extend(features_img_1_data["clip-feature-vector"])
 
         features_vector_img_1 = np.array(features_vector_img_1)
 
         features_img_2_data = features_dict[features_path_img_2]
-        features_img_2_data = msgpack.unpackb(features_img_2_data)
+        features_img_2_data = unpackb(features_img_2_data)
 
         features_vector_img_2 = []
         if self.input_type in [constants.EMBEDDING, constants.EMBEDDING_POSITIVE]:
-            features_vector_img_2.extend(features_img_2_data["positive_embedding"]["__ndarray__"])
+            features_vector_img_2.extend(features_img_2_data["positive_embedding"])
         if self.input_type in [constants.EMBEDDING, constants.EMBEDDING_NEGATIVE]:
-            features_vector_img_2.extend(features_img_2_data["negative_embedding"]["__ndarray__"])
+            features_vector_img_2.extend(features_img_2_data["negative_embedding"])
         if self.input_type in [constants.CLIP, constants.KANDINSKY_CLIP]:
             features_vector_img_2.extend(features_img_2_data["clip-feature-vector"])
 
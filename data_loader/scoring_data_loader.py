@@ -12,6 +12,7 @@ sys.path.insert(0, os.getcwd())
 
 from data_loader.utils import get_object
 from utility.path import separate_bucket_and_file_path
+from utility.msgpack_ndarray import unpackb
 from utility.http import generation_request
 
 DATA_MINIO_DIRECTORY="data/latent-generator"
@@ -63,7 +64,7 @@ class ScoringDataLoader:
                 clip_path= path.replace('.jpg', '_clip_kandinsky.msgpack')
                 bucket, features_vector_path= separate_bucket_and_file_path(clip_path) 
                 features_data = get_object(self.minio_client, features_vector_path)
-                features_vector = msgpack.unpackb(features_data)["clip-feature-vector"]
+                features_vector = unpackb(features_data)["clip-feature-vector"]
                 features_vector= torch.tensor(features_vector).to(device=self.device, dtype=torch.float32)
                 
                 latents.append(features_vector)
@@ -6,7 +6,6 @@ import numpy as np
 import time
 import torch
 from torch.nn.functional import normalize as torch_normalize
-import msgpack
 from random import shuffle, choice, sample
 from tqdm import tqdm
 from concurrent.futures import ThreadPoolExecutor, as_completed
@@ -15,6 +14,7 @@ base_directory = "./"
 sys.path.insert(0, base_directory)
 
 from utility.path import separate_bucket_and_file_path
+from utility.msgpack_ndarray import unpackb
 from utility.minio import cmd
 from utility.http import request
 from training_worker.ab_ranking.model import constants
@@ -94,13 +94,13 @@ class TaggedDatasetLoader:
         except Exception as e:
             print(f"Error: {e} when loading {file_path}")
         
-        features_data = msgpack.unpackb(features_data)
+        features_data = unpackb(features_data)
         features_vector = []
 
         if self.input_type in [constants.EMBEDDING, constants.EMBEDDING_POSITIVE]:
-            features_vector.extend(features_data["positive_embedding"]["__ndarray__"])
+            features_vector.extend(features_data["positive_embedding"])
         if self.input_type in [constants.EMBEDDING, constants.EMBEDDING_NEGATIVE]:
-            features_vector.extend(features_data["negative_embedding"]["__ndarray__"])
+            features_vector.extend(features_data["negative_embedding"])
         if self.input_type in [constants.CLIP, constants.KANDINSKY_CLIP, 
                                constants.KANDINSKY_CLIP_WITH_LENGTH,
                                constants.CLIP_WITH_LENGTH]:
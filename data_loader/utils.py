@@ -95,26 +95,10 @@ def get_aggregated_selection_datapoints_v1(minio_client, rank_model_id):
 
 
 def get_object(client, file_path):
-    try:
-        response = client.get_object("datasets", file_path)
-        data = response.data
-    finally:
-        if 'response' in locals() and response:
-            response.close()
-            response.release_conn()
-
-    return data
+    return cmd.get_object_data(client, DATASETS_BUCKET, file_path)
 
 def get_object_with_bucket(client, bucket_name, file_path):
-    try:
-        response = client.get_object(bucket_name, file_path)
-        data = response.data
-    finally:
-        if response:
-            response.close()
-            response.release_conn()
-
-    return data
+    return cmd.get_object_data(client, bucket_name, file_path)
 
 
 def index_select(tensor, dim, index):
@@ -25,6 +25,7 @@ from kandinsky.utils_image import  save_image_data_to_minio, save_latent_to_mini
     get_embeddings
 from worker.clip_calculation.clip_calculator import run_clip_calculation_task
 from worker.generation_task.generation_task import GenerationTask
+from worker.upload.upload_executor import upload_data_artifact
 from kandinsky.models.kandisky import KandinskyPipeline
 from data_loader.utils import get_object, get_object_with_bucket
 from kandinsky_worker.dataloaders.image_embedding import ImageEmbedding
@@ -281,28 +282,33 @@ def save_img2img_data_to_minio(minio_client, job_uuid, creation_time, dataset, f
     cmd.upload_data(minio_client, bucket_name, file_path.replace('.jpg', '_data.msgpack'), buffer)
 
 
-def upload_data_and_update_job_status(job, output_file_path, output_file_hash, data, minio_client):
-    start_time = time.time()
+def upload_data_and_update_job_status(worker_state, job, output_file_path, output_file_hash, data, minio_client):
     bucket_name, file_path = separate_bucket_and_file_path(output_file_path)
 
-    cmd.upload_data(minio_client, bucket_name, file_path, data)
-    print("Generated image path", bucket_name, file_path)
+    artifact_list = [
+        ("clip data", upload_data_artifact(minio_client, bucket_name, file_path, data))
+    ]
 
-    info_v2("Upload for job {} completed".format(job["uuid"]))
-    info_v2("Upload time elapsed: {:.4f}s".format(time.time() - start_time))
+    def on_uploaded():
+        # update job info
+        job['task_completion_time'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        job['task_output_file_dict'] = {
+            'output_file_path': output_file_path,
+            'output_file_hash': output_file_hash
+        }
+        info_v2("output file path: " + output_file_path)
+        info_v2("output file hash: " + output_file_hash)
+        info_v2("job completed: " + job["uuid"])
 
-    # update job info
-    job['task_completion_time'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    job['task_output_file_dict'] = {
-        'output_file_path': output_file_path,
-        'output_file_hash': output_file_hash
-    }
-    info_v2("output file path: " + output_file_path)
-    info_v2("output file hash: " + output_file_hash)
-    info_v2("job completed: " + job["uuid"])
+        # update status
+        inpainting_request.http_update_job_completed(job)
 
-    # update status
-    inpainting_request.http_update_job_completed(job)
+    def on_failed(e):
+        job['task_error_str'] = "upload failed: " + str(e)
+        inpainting_request.http_update_job_failed(job)
+
+    # blocks while too many jobs are being uploaded
+    worker_state.upload_executor.submit(job["uuid"], artifact_list, on_uploaded, on_failed)
 
 
 def upload_image_data_and_update_job_status(worker_state,
@@ -318,7 +324,6 @@ def upload_image_data_and_update_job_status(worker_state,
                                             prompt_embedding_average_pooled,
                                             prompt_embedding_max_pooled,
                                             prompt_embedding_signed_max_pooled):
-    start_time = time.time()
     bucket_name, file_path = separate_bucket_and_file_path(output_file_path)
 
     minio_client = worker_state.minio_client
@@ -341,83 +346,87 @@ def upload_image_data_and_update_job_status(worker_state,
     prompt_generation_policy = generation_task.prompt_generation_data["prompt_generation_policy"]
     top_k = generation_task.prompt_generation_data["top_k"]
 
-    cmd.upload_data(minio_client, bucket_name, file_path, data)
-    print("Uploaded image data", bucket_name, file_path)
-
-    # save image meta data
-    save_image_data_to_minio(minio_client,
-                             generation_task.uuid,
-                             job_completion_time,
-                             dataset,
-                             output_file_path,
-                             output_file_hash,
-                             positive_prompts,
-                             negative_prior_prompt,
-                             negative_decoder_prompt,
-                             seed,
-                             image_width,
-                             image_height,
-                             strength,
-                             decoder_steps,
-                             prior_steps,
-                             prior_guidance_scale,
-                             decoder_guidance_scale,
-                             prompt_scoring_model,
-                             prompt_score,
-                             prompt_generation_policy,
-                             top_k)
-
-    save_latent_to_minio(minio_client, 
-                         bucket_name, 
-                         generation_task.uuid, 
-                         output_file_hash, 
-                         latent, 
-                         output_file_path)
-    
-    # save image embedding data
-    save_image_embedding_to_minio(minio_client,
-                                  dataset,
-                                  output_file_path,
-                                  prompt_embedding,
-                                  prompt_embedding_average_pooled,
-                                  prompt_embedding_max_pooled,
-                                  prompt_embedding_signed_max_pooled)
-
-    info_v2("Upload for job {} completed".format(generation_task.uuid))
-    info_v2("Upload time elapsed: {:.4f}s".format(time.time() - start_time))
-
-    # update job info
-    job['task_completion_time'] = job_completion_time
-    job['task_output_file_dict'] = {
-        'output_file_path': output_file_path,
-        'output_file_hash': output_file_hash
-    }
-    info_v2("output file path: " + output_file_path)
-    info_v2("output file hash: " + output_file_hash)
-    info_v2("job completed: " + generation_task.uuid)
-
-    # update status
-    inpainting_request.http_update_job_completed(job)
-
-    # add clip calculation tasks
-    kandinsky_clip_calculation_job = {"uuid": "",
-                            "task_type": "clip_calculation_task_kandinsky",
-                            "task_input_dict": {
-                                "input_file_path": output_file_path,
-                                "input_file_hash": output_file_hash
-                            },
-                            }
-    
-    sd_clip_calculation_job = {"uuid": "",
-                            "task_type": "clip_calculation_task_sd_1_5",
-                            "task_input_dict": {
-                                "input_file_path": output_file_path,
-                                "input_file_hash": output_file_hash
-                            },
-                            }
-
-    inpainting_request.http_add_job(kandinsky_clip_calculation_job)
-    generation_request.http_add_job(sd_clip_calculation_job)
+    # the artifacts are uploaded in parallel by the upload executor
+    artifact_list = [
+        ("image", upload_data_artifact(minio_client, bucket_name, file_path, data)),
+        # save image meta data
+        ("image data", lambda: save_image_data_to_minio(minio_client,
+                                                        generation_task.uuid,
+                                                        job_completion_time,
+                                                        dataset,
+                                                        output_file_path,
+                                                        output_file_hash,
+                                                        positive_prompts,
+                                                        negative_prior_prompt,
+                                                        negative_decoder_prompt,
+                                                        seed,
+                                                        image_width,
+                                                        image_height,
+                                                        strength,
+                                                        decoder_steps,
+                                                        prior_steps,
+                                                        prior_guidance_scale,
+                                                        decoder_guidance_scale,
+                                                        prompt_scoring_model,
+                                                        prompt_score,
+                                                        prompt_generation_policy,
+                                                        top_k)),
+        ("latent", lambda: save_latent_to_minio(minio_client,
+                                                bucket_name,
+                                                generation_task.uuid,
+                                                output_file_hash,
+                                                latent,
+                                                output_file_path)),
+        # save image embedding data
+        ("image embedding", lambda: save_image_embedding_to_minio(minio_client,
+                                                                  dataset,
+                                                                  output_file_path,
+                                                                  prompt_embedding,
+                                                                  prompt_embedding_average_pooled,
+                                                                  prompt_embedding_max_pooled,
+                                                                  prompt_embedding_signed_max_pooled))
+    ]
+
+    def on_uploaded():
+        # update job info
+        job['task_completion_time'] = job_completion_time
+        job['task_output_file_dict'] = {
+            'output_file_path': output_file_path,
+            'output_file_hash': output_file_hash
+        }
+        info_v2("output file path: " + output_file_path)
+        info_v2("output file hash: " + output_file_hash)
+        info_v2("job completed: " + generation_task.uuid)
+
+        # update status
+        inpainting_request.http_update_job_completed(job)
+
+        # add clip calculation tasks
+        kandinsky_clip_calculation_job = {"uuid": "",
+                                "task_type": "clip_calculation_task_kandinsky",
+                                "task_input_dict": {
+                                    "input_file_path": output_file_path,
+                                    "input_file_hash": output_file_hash
+                                },
+                                }
+
+        sd_clip_calculation_job = {"uuid": "",
+                                "task_type": "clip_calculation_task_sd_1_5",
+                                "task_input_dict": {
+                                    "input_file_path": output_file_path,
+                                    "input_file_hash": output_file_hash
+                                },
+                                }
+
+        inpainting_request.http_add_job(kandinsky_clip_calculation_job)
+        generation_request.http_add_job(sd_clip_calculation_job)
+
+    def on_failed(e):
+        job['task_error_str'] = "upload failed: " + str(e)
+        inpainting_request.http_update_job_failed(job)
+
+    # blocks while too many jobs are being uploaded
+    worker_state.upload_executor.submit(generation_task.uuid, artifact_list, on_uploaded, on_failed)
 
 
 def upload_image_data_and_update_job_status_img2img(worker_state,
@@ -429,7 +438,6 @@ def upload_image_data_and_update_job_status_img2img(worker_state,
                                             output_file_hash,
                                             job_completion_time,
                                             data):
-    start_time = time.time()
     bucket_name, file_path = separate_bucket_and_file_path(output_file_path)
 
     minio_client = worker_state.minio_client
@@ -441,65 +449,71 @@ def upload_image_data_and_update_job_status_img2img(worker_state,
     decoder_guidance_scale = generation_task.task_input_dict["decoder_guidance_scale"]
     dataset = generation_task.task_input_dict["dataset"]
 
-    cmd.upload_data(minio_client, bucket_name, file_path, data)
-
-    # save image meta data
-    # Todo(): Implement this function
-    save_img2img_data_to_minio(minio_client,
-                             generation_task.uuid,
-                             job_completion_time,
-                             dataset,
-                             output_file_path,
-                             output_file_hash,
-                             seed,
-                             image_width,
-                             image_height,
-                             strength,
-                             decoder_steps,
-                             decoder_guidance_scale)
-
-    save_latent_to_minio(minio_client, 
-                         bucket_name, 
-                         generation_task.uuid, 
-                         output_file_hash, 
-                         latent, 
-                         output_file_path)
-
-    info_v2("Upload for job {} completed".format(generation_task.uuid))
-    info_v2("Upload time elapsed: {:.4f}s".format(time.time() - start_time))
-
-    # update job info
-    job['task_completion_time'] = job_completion_time
-    job['task_output_file_dict'] = {
-        'output_file_path': output_file_path,
-        'output_file_hash': output_file_hash
-    }
-    info_v2("output file path: " + output_file_path)
-    info_v2("output file hash: " + output_file_hash)
-    info_v2("job completed: " + generation_task.uuid)
-
-    # update status
-    inpainting_request.http_update_job_completed(job)
-
-    # add clip calculation tasks
-    kandinsky_clip_calculation_job = {"uuid": "",
-                            "task_type": "clip_calculation_task_kandinsky",
-                            "task_input_dict": {
-                                "input_file_path": output_file_path,
-                                "input_file_hash": output_file_hash
-                            },
-                            }
-    
-    sd_clip_calculation_job = {"uuid": "",
-                            "task_type": "clip_calculation_task_sd_1_5",
-                            "task_input_dict": {
-                                "input_file_path": output_file_path,
-                                "input_file_hash": output_file_hash
-                            },
-                            }
-
-    inpainting_request.http_add_job(kandinsky_clip_calculation_job)
-    generation_request.http_add_job(sd_clip_calculation_job)
+    # the artifacts are uploaded in parallel by the upload executor
+    artifact_list = [
+        ("image", upload_data_artifact(minio_client, bucket_name, file_path, data)),
+        # save image meta data
+        # Todo(): Implement this function
+        ("image data", lambda: save_img2img_data_to_minio(minio_client,
+                                                          generation_task.uuid,
+                                                          job_completion_time,
+                                                          dataset,
+                                                          output_file_path,
+                                                          output_file_hash,
+                                                          seed,
+                                                          image_width,
+                                                          image_height,
+                                                          strength,
+                                                          decoder_steps,
+                                                          decoder_guidance_scale)),
+        ("latent", lambda: save_latent_to_minio(minio_client,
+                                                bucket_name,
+                                                generation_task.uuid,
+                                                output_file_hash,
+                                                latent,
+                                                output_file_path))
+    ]
+
+    def on_uploaded():
+        # update job info
+        job['task_completion_time'] = job_completion_time
+        job['task_output_file_dict'] = {
+            'output_file_path': output_file_path,
+            'output_file_hash': output_file_hash
+        }
+        info_v2("output file path: " + output_file_path)
+        info_v2("output file hash: " + output_file_hash)
+        info_v2("job completed: " + generation_task.uuid)
+
+        # update status
+        inpainting_request.http_update_job_completed(job)
+
+        # add clip calculation tasks
+        kandinsky_clip_calculation_job = {"uuid": "",
+                                "task_type": "clip_calculation_task_kandinsky",
+                                "task_input_dict": {
+                                    "input_file_path": output_file_path,
+                                    "input_file_hash": output_file_hash
+                                },
+                                }
+
+        sd_clip_calculation_job = {"uuid": "",
+                                "task_type": "clip_calculation_task_sd_1_5",
+                                "task_input_dict": {
+                                    "input_file_path": output_file_path,
+                                    "input_file_hash": output_file_hash
+                                },
+                                }
+
+        inpainting_request.http_add_job(kandinsky_clip_calculation_job)
+        generation_request.http_add_job(sd_clip_calculation_job)
+
+    def on_failed(e):
+        job['task_error_str'] = "upload failed: " + str(e)
+        inpainting_request.http_update_job_failed(job)
+
+    # blocks while too many jobs are being uploaded
+    worker_state.upload_executor.submit(generation_task.uuid, artifact_list, on_uploaded, on_failed)
 
 
 def process_jobs(worker_state):
@@ -543,23 +557,22 @@ def process_jobs(worker_state):
                                                                               "negative_prior_prompt"],
                                                                           generation_task.task_input_dict[
                                                                               "negative_decoder_prompt"],
-                                                                          worker_state.clip_text_embedder)
-                    # spawn upload data and update job thread
-                    thread = threading.Thread(target=upload_image_data_and_update_job_status, args=(
+                                                                          worker_state.clip_text_embedder,
+                                                                          prompt_embedding_cache=worker_state.prompt_embedding_cache)
+                    # queue upload data and update job on the upload executor
+                    upload_image_data_and_update_job_status(
                         worker_state, job, generation_task, seed, inpainting_latent, output_file_path, output_file_hash, job_completion_time,
                         img_data, prompt_embedding, prompt_embedding_average_pooled, prompt_embedding_max_pooled,
-                        prompt_embedding_signed_max_pooled,))
-                    thread.start()
+                        prompt_embedding_signed_max_pooled)
 
                 elif task_type == 'clip_calculation_task_kandinsky':
                     output_file_path, output_file_hash, clip_data = run_clip_calculation_task(worker_state,
                                                                                               generation_task,
                                                                                               model_type="kandinsky")
 
-                    # spawn upload data and update job thread
-                    thread = threading.Thread(target=upload_data_and_update_job_status, args=(
-                        job, output_file_path, output_file_hash, clip_data, worker_state.minio_client,))
-                    thread.start()
+                    # queue upload data and update job on the upload executor
+                    upload_data_and_update_job_status(
+                        worker_state, job, output_file_path, output_file_hash, clip_data, worker_state.minio_client)
 
                 elif task_type == 'kandinsky-2-img-to-img-inpainting':
                     output_file_path, output_file_hash, img_data, latent, seed = run_img2img_generation_task(worker_state,
@@ -568,10 +581,9 @@ def process_jobs(worker_state):
 
                     job_completion_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
-                    # spawn upload data and update job thread
-                    thread = threading.Thread(target=upload_image_data_and_update_job_status_img2img, args=(
-                        worker_state, job, generation_task, seed, latent, output_file_path, output_file_hash, job_completion_time, img_data))
-                    thread.start()
+                    # queue upload data and update job on the upload executor
+                    upload_image_data_and_update_job_status_img2img(
+                        worker_state, job, generation_task, seed, latent, output_file_path, output_file_hash, job_completion_time, img_data)
 
                 else:
                     e = "job with task type '" + task_type + "' is not supported"
@@ -601,27 +613,7 @@ def get_worker_type_list(worker_type: str):
     return worker_type_list
 
 
-def main():
-    args = parse_args()
-
-    thread_state = ThreadState(0, "Job Fetcher")
-    queue_size = args.queue_size
-
-    # get worker type
-    worker_type_list = get_worker_type_list(args.worker_type)
-
-    # Initialize worker state
-    worker_state = WorkerState(args.device, args.minio_access_key, args.minio_secret_key, queue_size)
-    # Loading models
-    worker_state.load_models()
-
-    info(thread_state, "starting worker ! ")
-    info(thread_state, "Worker type: {} ".format(worker_type_list))
-
-    # spawning worker thread
-    thread = threading.Thread(target=process_jobs, args=(worker_state,))
-    thread.start()
-
+def fetch_jobs(worker_state, worker_type_list, thread_state):
     while True:
         # if we have more than n jobs in queue
         # sleep for a while
@@ -645,5 +637,34 @@ def main():
             time.sleep(sleep_time_in_seconds)
 
 
+def main():
+    args = parse_args()
+
+    thread_state = ThreadState(0, "Job Fetcher")
+    queue_size = args.queue_size
+
+    # get worker type
+    worker_type_list = get_worker_type_list(args.worker_type)
+
+    # Initialize worker state
+    worker_state = WorkerState(args.device, args.minio_access_key, args.minio_secret_key, queue_size)
+    # Loading models
+    worker_state.load_models()
+
+    info(thread_state, "starting worker ! ")
+    info(thread_state, "Worker type: {} ".format(worker_type_list))
+
+    # spawning worker thread
+    # daemon, so the worker can exit once the uploads are drained
+    thread = threading.Thread(target=process_jobs, args=(worker_state,), daemon=True)
+    thread.start()
+
+    try:
+        fetch_jobs(worker_state, worker_type_list, thread_state)
+    finally:
+        # drain the pending uploads before exiting
+        worker_state.upload_executor.shutdown()
+
+
 if __name__ == '__main__':
     main()
@@ -16,6 +16,8 @@ from kandinsky.pipelines.kandinsky_inpainting import KandinskyV22InpaintPipeline
 from diffusers.models import UNet2DConditionModel
 from diffusers.models import UNet2DConditionModel
 from kandinsky.models.clip_text_encoder.clip_text_encoder import KandinskyCLIPTextEmbedder
+from worker.upload.upload_executor import UploadExecutor
+from utility.clip.prompt_embedding_cache import PromptEmbeddingCache
 
 class WorkerState:
     def __init__(self, device, minio_access_key, minio_secret_key, queue_size):
@@ -25,9 +27,12 @@ class WorkerState:
         self.prior_model= None
         self.inpainting_decoder_model= None
         self.clip_text_embedder= None
+        self.prompt_embedding_cache = None
         self.minio_client = get_minio_client(minio_access_key, minio_secret_key)
         self.queue_size = queue_size
         self.job_queue = queue.Queue()
+        # uploads the generated artifacts and updates the job status
+        self.upload_executor = UploadExecutor()
 
     def load_models(self, prior_path=PRIOR_MODEL_PATH, decoder_path= DECODER_MODEL_PATH, 
                     inpaint_decoder_path= INPAINT_DECODER_MODEL_PATH):
@@ -37,6 +42,8 @@ class WorkerState:
 
             self.clip_text_embedder= KandinskyCLIPTextEmbedder(device= self.device)
             self.clip_text_embedder.load_submodels()
+            # negative prompts are encoded once and reused across jobs
+            self.prompt_embedding_cache = PromptEmbeddingCache(self.clip_text_embedder.compute_embeddings)
             
             self.unet = UNet2DConditionModel.from_pretrained(inpaint_decoder_path, local_files_only=True, subfolder='unet').to(torch.float16).to(self.device)
             
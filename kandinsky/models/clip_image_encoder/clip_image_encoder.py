@@ -93,6 +93,16 @@ class KandinskyCLIPImageEncoder(nn.Module):
         
         return features.to(torch.float16)
 
+    def compute_feature_vectors(self, opened_images, batch_size):
+        # same return as ClipModel.compute_feature_vectors, there are no penultimate layer features
+        image_features = []
+        for start_idx in range(0, len(opened_images), batch_size):
+            batch_images = opened_images[start_idx:start_idx + batch_size]
+            batch_pixel_values = self.image_processor(batch_images, return_tensors="pt")['pixel_values']
+            image_features.extend(self.get_image_features(batch_pixel_values))
+
+        return image_features, []
+
     @staticmethod
     def compute_sha256(image_data):
         # Compute SHA256
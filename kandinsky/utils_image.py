@@ -104,9 +104,10 @@ def save_image_data_to_minio(minio_client, job_uuid, creation_time, dataset, fil
 
 def save_latent_to_minio(minio_client, bucket_name, job_uuid, file_hash, latent, file_path):
     bucket_name, file_path = separate_bucket_and_file_path(file_path)
-    # Convert the latent Tensor to a list or NumPy array
+    # Convert the latent Tensor to a NumPy array
+    # arrays are stored as raw bytes, see utility/msgpack_ndarray.py
     if isinstance(latent, torch.Tensor):
-        latent = latent.cpu().numpy().tolist()
+        latent = latent.detach().cpu().numpy()
 
     # Create an instance of the LatentData class with the provided latent representation
     latent_data = LatentData(job_uuid, file_hash, latent)
@@ -141,11 +142,19 @@ def get_embeddings(job_uuid,
                   positive_prompt,
                   negative_prior_prompt,
                   negative_decoder_prompt,
-                  text_embedder):
+                  text_embedder,
+                  prompt_embedding_cache=None):
     # calculate new embeddings
-    positive_embedding, _, positive_mask = text_embedder.compute_embeddings(positive_prompt)
-    negative_prior_embedding, _, negative_prior_mask = text_embedder.compute_embeddings(negative_prior_prompt)
-    negative_decoder_embedding, _, negative_decoder_mask = text_embedder.compute_embeddings(negative_decoder_prompt)
+    # the negative prompts are shared by many jobs, they are
+    # taken from the worker prompt embedding cache when there is one
+    if prompt_embedding_cache is not None:
+        positive_embedding, _, positive_mask = prompt_embedding_cache.encode(positive_prompt)
+        negative_prior_embedding, _, negative_prior_mask = prompt_embedding_cache.get(negative_prior_prompt)
+        negative_decoder_embedding, _, negative_decoder_mask = prompt_embedding_cache.get(negative_decoder_prompt)
+    else:
+        positive_embedding, _, positive_mask = text_embedder.compute_embeddings(positive_prompt)
+        negative_prior_embedding, _, negative_prior_mask = text_embedder.compute_embeddings(negative_prior_prompt)
+        negative_decoder_embedding, _, negative_decoder_mask = text_embedder.compute_embeddings(negative_decoder_prompt)
 
     positive_mask_detached = positive_mask.detach().cpu().numpy()
     negative_prior_mask_detached = negative_prior_mask.detach().cpu().numpy()
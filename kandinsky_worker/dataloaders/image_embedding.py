@@ -1,4 +1,4 @@
-import msgpack
+from utility.msgpack_ndarray import packb, unpackb
 import numpy as np
 import torch
 
@@ -30,34 +30,23 @@ class ImageEmbedding:
         # Convert dictionary back to object
         negative_image_embedding= None
         if data["negative_image_embedding"] is not None:
-            negative_image_embedding = torch.tensor([data["negative_image_embedding"]])
+            negative_image_embedding = torch.tensor(np.asarray(data["negative_image_embedding"])).unsqueeze(0)
 
         return cls(data["job_uuid"],
                    data["dataset"],
-                   torch.tensor([data["image_embedding"]]),
+                   torch.tensor(np.asarray(data["image_embedding"])).unsqueeze(0),
                    negative_image_embedding)
 
     def get_msgpack_string(self):
         serialized = self.serialize()
-        return msgpack.packb(serialized, default=encode_ndarray, use_bin_type=True, use_single_float=True)
+        return packb(serialized)
 
     @classmethod
     def from_msgpack_string(cls, msgpack_string):
-        data = msgpack.unpackb(msgpack_string.encode('latin1'), object_hook=decode_ndarray, raw=False)
+        data = unpackb(msgpack_string.encode('latin1'))
         return cls.deserialize(data)
 
     @classmethod
     def from_msgpack_bytes(cls, msgpack_string):
-        data = msgpack.unpackb(msgpack_string, object_hook=decode_ndarray, raw=False)
+        data = unpackb(msgpack_string)
         return cls.deserialize(data)
-
-
-def encode_ndarray(obj):
-    if isinstance(obj, np.ndarray):
-        return {'__ndarray__': obj.tolist()}
-    return obj
-
-def decode_ndarray(packed_obj):
-    if '__ndarray__' in packed_obj:
-        return np.array(packed_obj['__ndarray__'])
-    return packed_obj
\ No newline at end of file
@@ -22,8 +22,10 @@ from utility.path import separate_bucket_and_file_path
 from utility.minio import cmd
 from kandinsky.utils_image import  save_image_data_to_minio, save_latent_to_minio, save_image_embedding_to_minio, \
     get_embeddings, save_img2img_data_to_minio
-from worker.clip_calculation.clip_calculator import run_clip_calculation_task
+from worker.clip_calculation.clip_calculator import run_clip_calculation_tasks, collect_jobs_of_task_type, \
+    CLIP_CALCULATION_BATCH_SIZE
 from worker.generation_task.generation_task import GenerationTask
+from worker.upload.upload_executor import upload_data_artifact
 from kandinsky.models.kandisky import KandinskyPipeline
 from utility.utils_logger import logger
 from data_loader.utils import get_object
@@ -295,6 +297,8 @@ def parse_args():
                         help="The minio secret key to use so worker can upload files to minio server")
     parser.add_argument("--worker-type", type=str, default="",
                         help="The task types the worker will accept and do. If blank then worker will accept all task types.")
+    parser.add_argument("--clip-batch-size", type=int, default=CLIP_CALCULATION_BATCH_SIZE,
+                        help="Max number of clip calculation jobs processed together in one batch")
 
     return parser.parse_args()
 
@@ -314,29 +318,37 @@ def get_job_if_exist(worker_type_list):
 
 
 def upload_data_and_update_job_status(worker_state, job, output_file_path, output_file_hash, data, minio_client):
-    start_time = time.time()
     bucket_name, file_path = separate_bucket_and_file_path(output_file_path)
 
-    cmd.upload_data(minio_client, bucket_name, file_path, data)
+    artifact_list = [
+        ("clip data", upload_data_artifact(minio_client, bucket_name, file_path, data))
+    ]
 
-    info_v2("Upload for job {} completed".format(job["uuid"]))
-    info_v2("Upload time elapsed: {:.4f}s".format(time.time() - start_time))
+    def on_uploaded():
+        # update job info
+        job['task_completion_time'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        job['task_output_file_dict'] = {
+            'output_file_path': output_file_path,
+            'output_file_hash': output_file_hash
+        }
+        info_v2("output file path: " + output_file_path)
+        info_v2("output file hash: " + output_file_hash)
+        info_v2("job completed: " + job["uuid"])
 
-    # update job info
-    job['task_completion_time'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    job['task_output_file_dict'] = {
-        'output_file_path': output_file_path,
-        'output_file_hash': output_file_hash
-    }
-    info_v2("output file path: " + output_file_path)
-    info_v2("output file hash: " + output_file_hash)
-    info_v2("job completed: " + job["uuid"])
+        # update status
+        generation_request.http_update_job_completed(job)
 
-    # update status
-    generation_request.http_update_job_completed(job)
+        if job['task_input_dict']['self_training']:
+            worker_state.calculate_self_training_data(job)
 
-    if job['task_input_dict']['self_training']:
-        worker_state.calculate_self_training_data(job)
+    def on_failed(e):
+        job['task_error_str'] = "upload failed: " + str(e)
+        generation_request.http_update_job_failed(job)
+
+    # the job can wait a while for a free upload slot
+    worker_state.job_leases.renew([job])
+    # blocks while too many jobs are being uploaded
+    worker_state.upload_executor.submit(job["uuid"], artifact_list, on_uploaded, on_failed)
 
 
 def upload_image_data_and_update_job_status_img2img(worker_state,
@@ -348,7 +360,6 @@ def upload_image_data_and_update_job_status_img2img(worker_state,
                                             output_file_hash,
                                             job_completion_time,
                                             data):
-    start_time = time.time()
     bucket_name, file_path = separate_bucket_and_file_path(output_file_path)
 
     minio_client = worker_state.minio_client
@@ -360,65 +371,74 @@ def upload_image_data_and_update_job_status_img2img(worker_state,
     decoder_guidance_scale = generation_task.task_input_dict["decoder_guidance_scale"]
     dataset = generation_task.task_input_dict["dataset"]
 
-    cmd.upload_data(minio_client, bucket_name, file_path, data)
-
-    # save image meta data
-    save_img2img_data_to_minio(minio_client,
-                             generation_task.uuid,
-                             job_completion_time,
-                             dataset,
-                             output_file_path,
-                             output_file_hash,
-                             seed,
-                             image_width,
-                             image_height,
-                             strength,
-                             decoder_steps,
-                             decoder_guidance_scale)
-
-    save_latent_to_minio(minio_client, 
-                         bucket_name, 
-                         generation_task.uuid, 
-                         output_file_hash, 
-                         latent, 
-                         output_file_path)
-
-    info_v2("Upload for job {} completed".format(generation_task.uuid))
-    info_v2("Upload time elapsed: {:.4f}s".format(time.time() - start_time))
-
-    # update job info
-    job['task_completion_time'] = job_completion_time
-    job['task_output_file_dict'] = {
-        'output_file_path': output_file_path,
-        'output_file_hash': output_file_hash
-    }
-    info_v2("output file path: " + output_file_path)
-    info_v2("output file hash: " + output_file_hash)
-    info_v2("job completed: " + generation_task.uuid)
-
-    # update status
-    generation_request.http_update_job_completed(job)
-
-    # add clip calculation tasks
-    kandinsky_clip_calculation_job = {"uuid": "",
-                            "task_type": "clip_calculation_task_kandinsky",
-                            "task_input_dict": {
-                                "input_file_path": output_file_path,
-                                "input_file_hash": output_file_hash,
-                                "self_training": job['task_input_dict']['self_training']
-                            },
-                            }
-    
-    sd_clip_calculation_job = {"uuid": "",
-                            "task_type": "clip_calculation_task_sd_1_5",
-                            "task_input_dict": {
-                                "input_file_path": output_file_path,
-                                "input_file_hash": output_file_hash
-                            },
-                            }
+    # the artifacts are uploaded in parallel by the upload executor
+    artifact_list = [
+        ("image", upload_data_artifact(minio_client, bucket_name, file_path, data)),
+        # save image meta data
+        ("image data", lambda: save_img2img_data_to_minio(minio_client,
+                                                          generation_task.uuid,
+                                                          job_completion_time,
+                                                          dataset,
+                                                          output_file_path,
+                                                          output_file_hash,
+                                                          seed,
+                                                          image_width,
+                                                          image_height,
+                                                          strength,
+                                                          decoder_steps,
+                                                          decoder_guidance_scale)),
+        ("latent", lambda: save_latent_to_minio(minio_client,
+                                                bucket_name,
+                                                generation_task.uuid,
+                                                output_file_hash,
+                                                latent,
+                                                output_file_path))
+    ]
+
+    def on_uploaded():
+        # update job info
+        job['task_completion_time'] = job_completion_time
+        job['task_output_file_dict'] = {
+            'output_file_path': output_file_path,
+            'output_file_hash': output_file_hash
+        }
+        info_v2("output file path: " + output_file_path)
+        info_v2("output file hash: " + output_file_hash)
+        info_v2("job completed: " + generation_task.uuid)
+
+        # update status
+        generation_request.http_update_job_completed(job)
+
+        # add clip calculation tasks
+        kandinsky_clip_calculation_job = {"uuid": "",
+                                "task_type": "clip_calculation_task_kandinsky",
+                                "task_input_dict": {
+                                    "input_file_path": output_file_path,
+                                    "input_file_hash": output_file_hash,
+                                    "self_training": job['task_input_dict']['self_training']
+                                },
+                                }
+
+        sd_clip_calculation_job = {"uuid": "",
+                                "task_type": "clip_calculation_task_sd_1_5",
+                                "task_input_dict": {
+                                    "input_file_path": output_file_path,
+                                    "input_file_hash": output_file_hash
+                                },
+                                }
+
+        generation_request.http_add_job(kandinsky_clip_calculation_job)
+        generation_request.http_add_job(sd_clip_calculation_job)
+
+    def on_failed(e):
+        job['task_error_str'] = "upload failed: " + str(e)
+        generation_request.http_update_job_failed(job)
+
+    # the job can wait a while for a free upload slot
+    worker_state.job_leases.renew([job])
+    # blocks while too many jobs are being uploaded
+    worker_state.upload_executor.submit(generation_task.uuid, artifact_list, on_uploaded, on_failed)
 
-    generation_request.http_add_job(kandinsky_clip_calculation_job)
-    generation_request.http_add_job(sd_clip_calculation_job)
 
 def upload_image_data_and_update_job_status(worker_state,
                                             job,
@@ -433,7 +453,6 @@ def upload_image_data_and_update_job_status(worker_state,
                                             prompt_embedding_average_pooled,
                                             prompt_embedding_max_pooled,
                                             prompt_embedding_signed_max_pooled):
-    start_time = time.time()
     bucket_name, file_path = separate_bucket_and_file_path(output_file_path)
 
     minio_client = worker_state.minio_client
@@ -456,92 +475,129 @@ def upload_image_data_and_update_job_status(worker_state,
     prompt_generation_policy = generation_task.prompt_generation_data["prompt_generation_policy"]
     top_k = generation_task.prompt_generation_data["top_k"]
 
-    cmd.upload_data(minio_client, bucket_name, file_path, data)
-
-    # save image meta data
-    save_image_data_to_minio(minio_client,
-                             generation_task.uuid,
-                             job_completion_time,
-                             dataset,
-                             output_file_path,
-                             output_file_hash,
-                             positive_prompts,
-                             negative_prior_prompt,
-                             negative_decoder_prompt,
-                             seed,
-                             image_width,
-                             image_height,
-                             strength,
-                             decoder_steps,
-                             prior_steps,
-                             prior_guidance_scale,
-                             decoder_guidance_scale,
-                             prompt_scoring_model,
-                             prompt_score,
-                             prompt_generation_policy,
-                             top_k)
-
-    save_latent_to_minio(minio_client, 
-                         bucket_name, 
-                         generation_task.uuid, 
-                         output_file_hash, 
-                         latent, 
-                         output_file_path)
-    
-    # save image embedding data
-    save_image_embedding_to_minio(minio_client,
-                                  dataset,
-                                  output_file_path,
-                                  prompt_embedding,
-                                  prompt_embedding_average_pooled,
-                                  prompt_embedding_max_pooled,
-                                  prompt_embedding_signed_max_pooled)
-
-    info_v2("Upload for job {} completed".format(generation_task.uuid))
-    info_v2("Upload time elapsed: {:.4f}s".format(time.time() - start_time))
-
-    # update job info
-    job['task_completion_time'] = job_completion_time
-    job['task_output_file_dict'] = {
-        'output_file_path': output_file_path,
-        'output_file_hash': output_file_hash
-    }
-    info_v2("output file path: " + output_file_path)
-    info_v2("output file hash: " + output_file_hash)
-    info_v2("job completed: " + generation_task.uuid)
-
-    # update status
-    generation_request.http_update_job_completed(job)
-
-    # add clip calculation tasks
-    kandinsky_clip_calculation_job = {"uuid": "",
-                            "task_type": "clip_calculation_task_kandinsky",
-                            "task_input_dict": {
-                                "input_file_path": output_file_path,
-                                "input_file_hash": output_file_hash
-                            },
-                            }
-    
-    sd_clip_calculation_job = {"uuid": "",
-                            "task_type": "clip_calculation_task_sd_1_5",
-                            "task_input_dict": {
-                                "input_file_path": output_file_path,
-                                "input_file_hash": output_file_hash
-                            },
-                            }
+    # the artifacts are uploaded in parallel by the upload executor
+    artifact_list = [
+        ("image", upload_data_artifact(minio_client, bucket_name, file_path, data)),
+        # save image meta data
+        ("image data", lambda: save_image_data_to_minio(minio_client,
+                                                        generation_task.uuid,
+                                                        job_completion_time,
+                                                        dataset,
+                                                        output_file_path,
+                                                        output_file_hash,
+                                                        positive_prompts,
+                                                        negative_prior_prompt,
+                                                        negative_decoder_prompt,
+                                                        seed,
+                                                        image_width,
+                                                        image_height,
+                                                        strength,
+                                                        decoder_steps,
+                                                        prior_steps,
+                                                        prior_guidance_scale,
+                                                        decoder_guidance_scale,
+                                                        prompt_scoring_model,
+                                                        prompt_score,
+                                                        prompt_generation_policy,
+                                                        top_k)),
+        ("latent", lambda: save_latent_to_minio(minio_client,
+                                                bucket_name,
+                                                generation_task.uuid,
+                                                output_file_hash,
+                                                latent,
+                                                output_file_path)),
+        # save image embedding data
+        ("image embedding", lambda: save_image_embedding_to_minio(minio_client,
+                                                                  dataset,
+                                                                  output_file_path,
+                                                                  prompt_embedding,
+                                                                  prompt_embedding_average_pooled,
+                                                                  prompt_embedding_max_pooled,
+                                                                  prompt_embedding_signed_max_pooled))
+    ]
+
+    def on_uploaded():
+        # update job info
+        job['task_completion_time'] = job_completion_time
+        job['task_output_file_dict'] = {
+            'output_file_path': output_file_path,
+            'output_file_hash': output_file_hash
+        }
+        info_v2("output file path: " + output_file_path)
+        info_v2("output file hash: " + output_file_hash)
+        info_v2("job completed: " + generation_task.uuid)
+
+        # update status
+        generation_request.http_update_job_completed(job)
+
+        # add clip calculation tasks
+        kandinsky_clip_calculation_job = {"uuid": "",
+                                "task_type": "clip_calculation_task_kandinsky",
+                                "task_input_dict": {
+                                    "input_file_path": output_file_path,
+                                    "input_file_hash": output_file_hash
+                                },
+                                }
+
+        sd_clip_calculation_job = {"uuid": "",
+                                "task_type": "clip_calculation_task_sd_1_5",
+                                "task_input_dict": {
+                                    "input_file_path": output_file_path,
+                                    "input_file_hash": output_file_hash
+                                },
+                                }
+
+        generation_request.http_add_job(kandinsky_clip_calculation_job)
+        generation_request.http_add_job(sd_clip_calculation_job)
+
+    def on_failed(e):
+        job['task_error_str'] = "upload failed: " + str(e)
+        generation_request.http_update_job_failed(job)
+
+    # the job can wait a while for a free upload slot
+    worker_state.job_leases.renew([job])
+    # blocks while too many jobs are being uploaded
+    worker_state.upload_executor.submit(generation_task.uuid, artifact_list, on_uploaded, on_failed)
+
+
+def process_clip_calculation_jobs(worker_state, thread_state, jobs, model_type, batch_size):
+    # the jobs whose image could not be read fail alone
+    # if the batch could not be computed all its jobs fail
+    info(thread_state, f"Processing {len(jobs)} clip calculation jobs in a batch")
+    generation_tasks = [GenerationTask.from_dict(job) for job in jobs]
+
+    try:
+        results = run_clip_calculation_tasks(worker_state, generation_tasks, model_type, batch_size)
+    except Exception as e:
+        error(thread_state, f"clip calculation batch failed: {traceback.format_exc()}")
+        results = [e] * len(jobs)
+
+    for job, result in zip(jobs, results):
+        if isinstance(result, Exception):
+            job['task_error_str'] = str(result)
+            generation_request.http_update_job_failed(job)
+            continue
 
-    generation_request.http_add_job(kandinsky_clip_calculation_job)
-    generation_request.http_add_job(sd_clip_calculation_job)
+        output_file_path, output_file_hash, clip_data = result
+        # queue upload data and update job on the upload executor
+        upload_data_and_update_job_status(
+            worker_state, job, output_file_path, output_file_hash, clip_data, worker_state.minio_client)
 
 
-def process_jobs(worker_state):
+def process_jobs(worker_state, clip_batch_size=CLIP_CALCULATION_BATCH_SIZE):
     thread_state = ThreadState(1, "Job Processor")
     last_job_time = time.time()
+    deferred_jobs = worker_state.deferred_jobs
 
     while True:
-        job = worker_state.job_queue.get()
+        if len(deferred_jobs) > 0:
+            job = deferred_jobs.popleft()
+        else:
+            job = worker_state.job_queue.get()
 
         if job is not None:
+            # the job may have waited in the queue since it was claimed
+            worker_state.job_leases.renew([job])
             task_type = job['task_type']
 
             print('\n\n')
@@ -561,10 +617,9 @@ def process_jobs(worker_state):
                     
                     job_completion_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
-                    # spawn upload data and update job thread
-                    thread = threading.Thread(target=upload_image_data_and_update_job_status_img2img, args=(
-                        worker_state, job, generation_task, seed, latent, output_file_path, output_file_hash, job_completion_time, img_data))
-                    thread.start()
+                    # queue upload data and update job on the upload executor
+                    upload_image_data_and_update_job_status_img2img(
+                        worker_state, job, generation_task, seed, latent, output_file_path, output_file_hash, job_completion_time, img_data)
 
                 elif task_type == 'inpainting_kandinsky':
                     output_file_path, output_file_hash, img_data, inpainting_latent, seed = run_inpainting_generation_task(worker_state,
@@ -586,13 +641,13 @@ def process_jobs(worker_state):
                                                                               "negative_prior_prompt"],
                                                                           generation_task.task_input_dict[
                                                                               "negative_decoder_prompt"],
-                                                                          worker_state.clip_text_embedder)
-                    # spawn upload data and update job thread
-                    thread = threading.Thread(target=upload_image_data_and_update_job_status, args=(
+                                                                          worker_state.clip_text_embedder,
+                                                                          prompt_embedding_cache=worker_state.prompt_embedding_cache)
+                    # queue upload data and update job on the upload executor
+                    upload_image_data_and_update_job_status(
                         worker_state, job, generation_task, seed, inpainting_latent, output_file_path, output_file_hash, job_completion_time,
                         img_data, prompt_embedding, prompt_embedding_average_pooled, prompt_embedding_max_pooled,
-                        prompt_embedding_signed_max_pooled,))
-                    thread.start()
+                        prompt_embedding_signed_max_pooled)
 
                 elif task_type == 'image_generation_kandinsky':
                     output_file_path, output_file_hash, img_data, latent, seed = run_image_generation_task(worker_state,
@@ -614,24 +669,22 @@ def process_jobs(worker_state):
                                                                               "negative_prior_prompt"],
                                                                           generation_task.task_input_dict[
                                                                               "negative_decoder_prompt"],
-                                                                          worker_state.clip_text_embedder)
+                                                                          worker_state.clip_text_embedder,
+                                                                          prompt_embedding_cache=worker_state.prompt_embedding_cache)
 
-                    # spawn upload data and update job thread
-                    thread = threading.Thread(target=upload_image_data_and_update_job_status, args=(
+                    # queue upload data and update job on the upload executor
+                    upload_image_data_and_update_job_status(
                         worker_state, job, generation_task, seed, latent, output_file_path, output_file_hash,
                         job_completion_time, img_data, prompt_embedding, prompt_embedding_average_pooled,
-                        prompt_embedding_max_pooled, prompt_embedding_signed_max_pooled,))
-                    thread.start()
+                        prompt_embedding_max_pooled, prompt_embedding_signed_max_pooled)
 
                 elif task_type == 'clip_calculation_task_kandinsky':
-                    output_file_path, output_file_hash, clip_data = run_clip_calculation_task(worker_state,
-                                                                                              generation_task,
-                                                                                              model_type="kandinsky")
+                    jobs = collect_jobs_of_task_type(worker_state.job_queue, job, clip_batch_size, deferred_jobs)
+                    worker_state.job_leases.renew(jobs)
+                    for batch_job in jobs[1:]:
+                        batch_job['task_start_time'] = job['task_start_time']
 
-                    # spawn upload data and update job thread
-                    thread = threading.Thread(target=upload_data_and_update_job_status, args=(
-                        worker_state, job, output_file_path, output_file_hash, clip_data, worker_state.minio_client,))
-                    thread.start()
+                    process_clip_calculation_jobs(worker_state, thread_state, jobs, "kandinsky", clip_batch_size)
 
                 else:
                     e = "job with task type '" + task_type + "' is not supported"
@@ -661,34 +714,14 @@ def get_worker_type_list(worker_type: str):
     return worker_type_list
 
 
-def main():
-    args = parse_args()
-
-    thread_state = ThreadState(0, "Job Fetcher")
-    queue_size = args.queue_size
-
-    # get worker type
-    worker_type_list = get_worker_type_list(args.worker_type)
-
-    # Initialize worker state
-    worker_state = WorkerState(args.device, args.minio_access_key, args.minio_secret_key, queue_size)
-    # Loading models
-    worker_state.load_models()
-
-    info(thread_state, "starting worker ! ")
-    info(thread_state, "Worker type: {} ".format(worker_type_list))
-
-    # spawning worker thread
-    thread = threading.Thread(target=process_jobs, args=(worker_state,))
-    thread.start()
-
+def fetch_jobs(worker_state, worker_type_list, thread_state):
     while True:
         # store self training data
         worker_state.store_self_training_data()
 
         # if we have more than n jobs in queue
         # sleep for a while
-        if worker_state.job_queue.qsize() >= worker_state.queue_size:
+        if worker_state.job_queue.qsize() + len(worker_state.deferred_jobs) >= worker_state.queue_size:
             sleep_time_in_seconds = 0.001
             time.sleep(sleep_time_in_seconds)
             continue
@@ -699,6 +732,7 @@ def main():
         job = get_job_if_exist(worker_type_list)
         if job != None:
             info(thread_state, 'Found job ! ')
+            worker_state.job_leases.add([job])
             worker_state.job_queue.put(job)
             info(thread_state, 'Queue size ' + str(worker_state.job_queue.qsize()))
 
@@ -708,5 +742,39 @@ def main():
             time.sleep(sleep_time_in_seconds)
 
 
+def main():
+    args = parse_args()
+
+    thread_state = ThreadState(0, "Job Fetcher")
+    queue_size = args.queue_size
+
+    # get worker type
+    worker_type_list = get_worker_type_list(args.worker_type)
+
+    # a worker that only does clip calculations fetches enough jobs to fill a batch
+    # other workers would fetch generation jobs that wait in the queue
+    if set(worker_type_list) == {'clip_calculation_task_kandinsky'}:
+        queue_size = max(queue_size, args.clip_batch_size)
+
+    # Initialize worker state
+    worker_state = WorkerState(args.device, args.minio_access_key, args.minio_secret_key, queue_size)
+    # Loading models
+    worker_state.load_models()
+
+    info(thread_state, "starting worker ! ")
+    info(thread_state, "Worker type: {} ".format(worker_type_list))
+
+    # spawning worker thread
+    # daemon, so the worker can exit once the uploads are drained
+    thread = threading.Thread(target=process_jobs, args=(worker_state, args.clip_batch_size), daemon=True)
+    thread.start()
+
+    try:
+        fetch_jobs(worker_state, worker_type_list, thread_state)
+    finally:
+        # drain the pending uploads before exiting
+        worker_state.upload_executor.shutdown()
+
+
 if __name__ == '__main__':
     main()
@@ -1,6 +1,7 @@
 import io
 import queue
 import sys
+from collections import deque
 import torch
 import msgpack
 from torch.nn.functional import cosine_similarity
@@ -9,6 +10,7 @@ base_directory = "./"
 sys.path.insert(0, base_directory)
 
 from utility.minio.cmd import get_minio_client
+from utility.msgpack_ndarray import unpackb
 from configs.model_config import ModelPathConfig
 from kandinsky.model_paths import PRIOR_MODEL_PATH, INPAINT_DECODER_MODEL_PATH, DECODER_MODEL_PATH
 from kandinsky.models.clip_image_encoder.clip_image_encoder import KandinskyCLIPImageEncoder
@@ -26,6 +28,9 @@ from kandinsky_worker.dataloaders.image_embedding import ImageEmbedding
 from worker.generation_task.generation_task import GenerationTask
 from data_loader.utils import get_object
 from utility.path import separate_bucket_and_file_path
+from worker.upload.upload_executor import UploadExecutor
+from worker.job_lease.job_leases import JobLeases
+from utility.clip.prompt_embedding_cache import PromptEmbeddingCache
 
 class WorkerState:
     def __init__(self, device, minio_access_key, minio_secret_key, queue_size):
@@ -35,10 +40,18 @@ class WorkerState:
         self.decoder_model= None
         self.inpainting_decoder_model= None
         self.clip_text_embedder= None
+        self.prompt_embedding_cache = None
         self.scoring_models= {}
         self.minio_client = get_minio_client(minio_access_key, minio_secret_key)
         self.queue_size = queue_size
         self.job_queue = queue.Queue()
+        # jobs taken from the queue while collecting a clip calculation batch
+        # they are processed next, the fetcher counts them in the queued jobs
+        self.deferred_jobs = deque()
+        # uploads the generated artifacts and updates the job status
+        self.upload_executor = UploadExecutor()
+        # renews the leases of the claimed jobs
+        self.job_leases = JobLeases()
         self.self_training_data={}
         self.dataset_list=[]
     
@@ -94,6 +107,8 @@ class WorkerState:
 
             self.clip_text_embedder= KandinskyCLIPTextEmbedder(device= self.device)
             self.clip_text_embedder.load_submodels()
+            # negative prompts are encoded once and reused across jobs
+            self.prompt_embedding_cache = PromptEmbeddingCache(self.clip_text_embedder.compute_embeddings)
             
             unet = UNet2DConditionModel.from_pretrained(decoder_path, local_files_only=True, subfolder='unet').to(torch.float16).to(self.device)
             
@@ -125,7 +140,7 @@ class WorkerState:
 
     def get_output_clip_vector(self, output_file_path):
         features_data = get_object(self.minio_client, output_file_path)
-        features_vector = msgpack.unpackb(features_data)["clip-feature-vector"]
+        features_vector = unpackb(features_data)["clip-feature-vector"]
         features_vector= torch.tensor(features_vector)
 
         return features_vector
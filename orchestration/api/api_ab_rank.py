@@ -9,6 +9,23 @@ import traceback
 from bson import ObjectId
 import numpy as np
 import bisect
+from orchestration.api.utils.random_sampling import sample_documents_async
+
+# samples of classifier scores drawn before giving up on finding a pair
+MAX_IMAGE_PAIR_SAMPLES = 10
+
+
+def get_unique_uuid_documents(documents):
+    # an image has one score per tag, keep the first one of each uuid
+    unique_documents = []
+    uuid_set = set()
+    for document in documents:
+        uuid = document.get('uuid')
+        if uuid not in uuid_set:
+            uuid_set.add(uuid)
+            unique_documents.append(document)
+
+    return unique_documents
 
 
 
@@ -568,30 +585,20 @@ async def get_ab_rank_image_pair_v1(
         elif end_date:
             query["creation_time"] = {"$lte": validated_end_date}
         
-        while True:
-            filtered_classfier_scores = list(request.app.image_classifier_scores_collection.aggregate([
-                {'$sample': {
-                    'size': sample_size
-                }},
-                {'$match': query},
-                {'$project': {
-                    'uuid': 1,
-                    'score': 1
-                }},
-            ]))
+        num_image_pair_within_max_diff = 0
+        for _ in range(MAX_IMAGE_PAIR_SAMPLES):
+            # random range seeks on the indexed random key, the cost does not depend on the collection size
+            filtered_classfier_scores = await sample_documents_async(
+                request.app.async_collections.image_classifier_scores_collection,
+                query,
+                sample_size,
+                projection={'uuid': 1, 'score': 1}
+            )
 
             if len(filtered_classfier_scores) < 2:
-                continue
-
-            unique_filtered_classifier_scores = []
-            uuid_set = set()
+                break
 
-            for document in filtered_classfier_scores:
-                uuid = document.get('uuid')
-                if uuid not in uuid_set:
-                    uuid_set.add(uuid)
-                    unique_filtered_classifier_scores.append(document)
-            filtered_classfier_scores = unique_filtered_classifier_scores
+            filtered_classfier_scores = get_unique_uuid_documents(filtered_classfier_scores)
 
             scores = [classifier_score['score'] for classifier_score in filtered_classfier_scores]
             
@@ -615,6 +622,13 @@ async def get_ab_rank_image_pair_v1(
             if num_image_pair_within_max_diff > 0:
                 break
 
+        if num_image_pair_within_max_diff == 0:
+            return response_handler.create_error_response_v1(
+                error_code=ErrorCode.ELEMENT_NOT_FOUND,
+                error_string="No image pair found.",
+                http_status_code=404
+            )
+
         image_pair = image_pair_list[np.random.randint(0, num_image_pair_within_max_diff)]
 
         image_1 = request.app.completed_jobs_collection.find_one({'uuid': filtered_classfier_scores[image_pair[0]]['uuid']})
@@ -669,29 +683,13 @@ async def get_ab_rank_image_pair(request: Request, rank_model_id:int, min_score:
         classifier_id = rank_model.get("classifier_id")
         # Get all classifier scores for the classifier_id
         # but sample aggregate query select the same columns multiple times so we need to filter
-        filtered_classfier_scores = list(request.app.image_classifier_scores_collection.aggregate([
-            {'$sample': {
-                'size': sample_size
-            }}, 
-            {'$match': {
-                'classifier_id': classifier_id,
-                'score': {'$gte': min_score},
-            }},
-            {
-            '$group': {
-                '_id': '$uuid',
-                'data': {'$first': '$$ROOT'}
-            }
-            },
-            {
-                '$replaceRoot': {
-                    'newRoot': '$data'
-                }
-            },
-            {'$project': {
-                '_id': 0
-            }},
-        ]))
+        filtered_classfier_scores = await sample_documents_async(
+            request.app.async_collections.image_classifier_scores_collection,
+            {'classifier_id': classifier_id, 'score': {'$gte': min_score}},
+            sample_size,
+            projection={'_id': 0}
+        )
+        filtered_classfier_scores = get_unique_uuid_documents(filtered_classfier_scores)
 
         scores = [classifier_score['score'] for classifier_score in filtered_classfier_scores]
         
@@ -800,18 +798,12 @@ async def get_ab_rank_image_pair(request: Request, rank_model_id: int, min_score
         classifier_id = rank_model.get("classifier_id")
 
         # Fetch classifier scores
-        filtered_classifier_scores = list(request.app.image_classifier_scores_collection.aggregate([
-            {'$match': {
-                'classifier_id': classifier_id,
-                'score': {'$gte': min_score},
-            }},
-            {'$sample': {
-                'size': sample_size
-            }},
-            {'$project': {
-                '_id': 0
-            }},
-        ]))
+        filtered_classifier_scores = await sample_documents_async(
+            request.app.async_collections.image_classifier_scores_collection,
+            {'classifier_id': classifier_id, 'score': {'$gte': min_score}},
+            sample_size,
+            projection={'_id': 0}
+        )
 
         if len(filtered_classifier_scores) < 2:
             return response_handler.create_error_response_v1(
@@ -1,6 +1,10 @@
 from fastapi import Request, APIRouter, Query
 from .api_utils import PrettyJSONResponse, ErrorCode, WasPresentResponse, ApiResponseHandlerV1, StandardSuccessResponseV1, CountResponse
-from orchestration.api.mongo_schemas import ClassifierScore, ListClassifierScore, ClassifierScoreRequest, ClassifierScoreV1, ListClassifierScore1, ListClassifierScore2, ListClassifierScore3, BatchClassifierScoreRequest, ListClassifierScore4
+from orchestration.api.mongo_schemas import ClassifierScore, ListClassifierScore, ClassifierScoreRequest, ClassifierScoreV1, ListClassifierScore1, ListClassifierScore2, ListClassifierScore3, BatchClassifierScoreRequest, ListClassifierScore4, ColumnarScoresIngestResponse
+from orchestration.api.utils.columnar_scores import (ColumnarScoresError, is_columnar_scores_request, decode_columnar_scores,
+                                                     bulk_write_in_chunks, iterate_upserts)
+from orchestration.api.utils.keyset_pagination import find_page, get_next_continuation_token, ContinuationTokenError
+from orchestration.api.utils.random_sampling import add_random_key, get_random_key_on_insert
 from fastapi.encoders import jsonable_encoder
 import uuid
 from typing import Optional
@@ -201,7 +205,7 @@ async def set_image_classifier_score(request: Request, classifier_score: Classif
         )
     else:
         # Insert the new ranking score
-        request.app.image_classifier_scores_collection.insert_one(classifier_score.to_dict())
+        request.app.image_classifier_scores_collection.insert_one(add_random_key(classifier_score.to_dict()))
 
     # Using ApiResponseHandler for standardized success response
     return api_response_handler.create_success_response_v1(
@@ -444,7 +448,7 @@ async def set_image_classifier_score(request: Request, classifier_score: Classif
             )
         else:
             # Insert new score
-            insert_result = request.app.image_classifier_scores_collection.insert_one(new_score_data)
+            insert_result = request.app.image_classifier_scores_collection.insert_one(add_random_key(dict(new_score_data)))
             new_score_data['_id'] = str(insert_result.inserted_id)
             new_score_data.pop('_id', None)
 
@@ -497,7 +501,8 @@ async def list_image_scores(
     max_score: Optional[float] = Query(None, description="Maximum score"),
     limit: int = Query(10, description="Limit on the number of results returned"),
     offset: int = Query(0, description="Offset for pagination"),
-    order: str = Query("desc", description="Sort order: 'asc' for ascending, 'desc' for descending")
+    order: str = Query("desc", description="Sort order: 'asc' for ascending, 'desc' for descending"),
+    continuation_token: Optional[str] = Query(None, description="next_continuation_token of the previous page, offset is ignored when it is set"),
 ):
     response_handler = await ApiResponseHandlerV1.createInstance(request)
 
@@ -516,8 +521,17 @@ async def list_image_scores(
     sort_order = 1 if order == "asc" else -1
 
     # Fetch and sort data from MongoDB with pagination
-    cursor = request.app.image_classifier_scores_collection.find(query).sort([("score", sort_order)]).skip(offset).limit(limit)
-    scores_data = list(cursor)
+    try:
+        cursor = find_page(request.app.async_collections.image_classifier_scores_collection, query, "score", sort_order,
+                           limit, offset=offset, continuation_token=continuation_token)
+    except ContinuationTokenError as e:
+        return response_handler.create_error_response_v1(
+            error_code=ErrorCode.INVALID_PARAMS,
+            error_string=str(e),
+            http_status_code=422
+        )
+    scores_data = await cursor.to_list(length=None)
+    next_continuation_token = get_next_continuation_token(scores_data, "score", sort_order, limit)
 
     # Remove _id in response data
     for score in scores_data:
@@ -528,7 +542,7 @@ async def list_image_scores(
 
     # Return the fetched data with a success response
     return response_handler.create_success_response_v1(
-        response_data={"images": images_data}, 
+        response_data={"images": images_data, "next_continuation_token": next_continuation_token}, 
         http_status_code=200
     )
 
@@ -547,7 +561,8 @@ async def list_image_scores(
     limit: int = Query(10, description="Limit on the number of results returned"),
     offset: int = Query(0, description="Offset for pagination"),
     order: str = Query("desc", description="Sort order: 'asc' for ascending, 'desc' for descending"),
-    random_sampling: bool = Query(True, description="Enable random sampling")
+    random_sampling: bool = Query(True, description="Enable random sampling"),
+    continuation_token: Optional[str] = Query(None, description="next_continuation_token of the previous page, offset is ignored when it is set"),
 ):
     response_handler = await ApiResponseHandlerV1.createInstance(request)
 
@@ -563,18 +578,29 @@ async def list_image_scores(
         query["score"] = {"$lte": max_score}
 
     # Modify behavior based on random_sampling parameter
+    sort_order = 1 if order == "asc" else -1
     if random_sampling:
         # Fetch data without sorting when random_sampling is True
-        cursor = request.app.image_classifier_scores_collection.aggregate([
+        cursor = request.app.async_collections.image_classifier_scores_collection.aggregate([
             {"$match": query},
             {"$sample": {"size": limit}}  # Use the MongoDB $sample operator for random sampling
         ])
     else:
-        # Determine sort order and fetch sorted data when random_sampling is False
-        sort_order = 1 if order == "asc" else -1
-        cursor = request.app.image_classifier_scores_collection.find(query).sort([("score", sort_order)]).skip(offset).limit(limit)
+        # fetch sorted data when random_sampling is False
+        try:
+            cursor = find_page(request.app.async_collections.image_classifier_scores_collection, query, "score", sort_order,
+                               limit, offset=offset, continuation_token=continuation_token)
+        except ContinuationTokenError as e:
+            return response_handler.create_error_response_v1(
+                error_code=ErrorCode.INVALID_PARAMS,
+                error_string=str(e),
+                http_status_code=422
+            )
     
-    scores_data = list(cursor)
+    scores_data = await cursor.to_list(length=None)
+    next_continuation_token = None
+    if not random_sampling:
+        next_continuation_token = get_next_continuation_token(scores_data, "score", sort_order, limit)
 
     # Remove _id in response data
     for score in scores_data:
@@ -585,7 +611,7 @@ async def list_image_scores(
 
     # Return the fetched data with a success response
     return response_handler.create_success_response_v1(
-        response_data={"images": images_data}, 
+        response_data={"images": images_data, "next_continuation_token": next_continuation_token}, 
         http_status_code=200
     )
 
@@ -750,7 +776,7 @@ async def set_image_classifier_score_list(request: Request, classifier_score_lis
                 request.app.image_classifier_scores_collection.update_one(query, {"$set": {"score": classifier_score.score, "image_hash": image_hash, "creation_time": current_utc_time}})
             else:
                 # Insert new score
-                insert_result = request.app.image_classifier_scores_collection.insert_one(new_score_data)
+                insert_result = request.app.image_classifier_scores_collection.insert_one(add_random_key(dict(new_score_data)))
                 new_score_data['_id'] = str(insert_result.inserted_id)
                 new_score_data_list.append(new_score_data)
         return api_response_handler.create_success_response_v1(
@@ -783,7 +809,8 @@ async def list_image_scores_v3(
     offset: int = Query(0, description="Offset for pagination"),
     order: str = Query("desc", description="Sort order: 'asc' for ascending, 'desc' for descending"),
     random_sampling: bool = Query(True, description="Enable random sampling"),
-    image_source: Optional[str] = Query(None, regex="^(generated_image|extract_image|external_image)$", description="The source of the image")
+    image_source: Optional[str] = Query(None, regex="^(generated_image|extract_image|external_image)$", description="The source of the image"),
+    continuation_token: Optional[str] = Query(None, description="next_continuation_token of the previous page, offset is ignored when it is set"),
 ):
     response_handler = await ApiResponseHandlerV1.createInstance(request)
     start_time = time.time()  # Start time tracking
@@ -807,6 +834,7 @@ async def list_image_scores_v3(
     print("Query built. Time taken:", time.time() - start_time)
 
     # Modify behavior based on random_sampling parameter
+    sort_order = 1 if order == "asc" else -1
     if random_sampling:
         # Apply some filtering before sampling
         query_filter = {"$match": query}  
@@ -815,16 +843,26 @@ async def list_image_scores_v3(
         # Build the optimized pipeline
         pipeline = [query_filter, sampling_stage]
 
-        cursor = request.app.image_classifier_scores_collection.aggregate(pipeline)
+        cursor = request.app.async_collections.image_classifier_scores_collection.aggregate(pipeline)
 
     else:
         # Determine sort order and fetch sorted data when random_sampling is False
-        sort_order = 1 if order == "asc" else -1
-        cursor = request.app.image_classifier_scores_collection.find(query).sort([("score", sort_order)]).skip(offset).limit(limit)
+        try:
+            cursor = find_page(request.app.async_collections.image_classifier_scores_collection, query, "score", sort_order,
+                               limit, offset=offset, continuation_token=continuation_token)
+        except ContinuationTokenError as e:
+            return response_handler.create_error_response_v1(
+                error_code=ErrorCode.INVALID_PARAMS,
+                error_string=str(e),
+                http_status_code=422
+            )
     
     print("Data fetched. Time taken:", time.time() - start_time)
 
-    scores_data = list(cursor)
+    scores_data = await cursor.to_list(length=None)
+    next_continuation_token = None
+    if not random_sampling:
+        next_continuation_token = get_next_continuation_token(scores_data, "score", sort_order, limit)
 
     # Remove _id in response data
     for score in scores_data:
@@ -832,10 +870,16 @@ async def list_image_scores_v3(
 
     print("Returning response. Total time:", time.time() - start_time)
 
+    # the response is a plain list, so the token is sent in a header
+    headers = {}
+    if next_continuation_token is not None:
+        headers["X-Next-Continuation-Token"] = next_continuation_token
+
     # Return the fetched data with a success response
     return response_handler.create_success_response_v1(
         response_data=scores_data,  # Directly return the fetched data
-        http_status_code=200
+        http_status_code=200,
+        headers=headers
     )
 
 
@@ -854,7 +898,8 @@ async def list_image_scores_v5(
     offset: int = Query(0, description="Offset for pagination"),
     order: str = Query("desc", description="Sort order: 'asc' for ascending, 'desc' for descending"),
     random_sampling: bool = Query(True, description="Enable random sampling"),
-    image_sources: Optional[str] = Query(None, description="The source of the image (comma-separated values: generated_image,extract_image,external_image)")
+    image_sources: Optional[str] = Query(None, description="The source of the image (comma-separated values: generated_image,extract_image,external_image)"),
+    continuation_token: Optional[str] = Query(None, description="next_continuation_token of the previous page, offset is ignored when it is set"),
 ):
     response_handler = await ApiResponseHandlerV1.createInstance(request)
     start_time = time.time()  # Start time tracking
@@ -894,6 +939,7 @@ async def list_image_scores_v5(
     print("Query built. Time taken:", time.time() - start_time)
 
     # Modify behavior based on random_sampling parameter
+    sort_order = 1 if order == "asc" else -1
     if random_sampling:
         # Apply some filtering before sampling
         query_filter = {"$match": query}  
@@ -902,16 +948,26 @@ async def list_image_scores_v5(
         # Build the optimized pipeline
         pipeline = [query_filter, sampling_stage]
 
-        cursor = request.app.image_classifier_scores_collection.aggregate(pipeline)
+        cursor = request.app.async_collections.image_classifier_scores_collection.aggregate(pipeline)
 
     else:
         # Determine sort order and fetch sorted data when random_sampling is False
-        sort_order = 1 if order == "asc" else -1
-        cursor = request.app.image_classifier_scores_collection.find(query).sort([("score", sort_order)]).skip(offset).limit(limit)
+        try:
+            cursor = find_page(request.app.async_collections.image_classifier_scores_collection, query, "score", sort_order,
+                               limit, offset=offset, continuation_token=continuation_token)
+        except ContinuationTokenError as e:
+            return response_handler.create_error_response_v1(
+                error_code=ErrorCode.INVALID_PARAMS,
+                error_string=str(e),
+                http_status_code=422
+            )
     
     print("Data fetched. Time taken:", time.time() - start_time)
 
-    scores_data = list(cursor)
+    scores_data = await cursor.to_list(length=None)
+    next_continuation_token = None
+    if not random_sampling:
+        next_continuation_token = get_next_continuation_token(scores_data, "score", sort_order, limit)
 
     # Remove _id in response data
     for score in scores_data:
@@ -921,7 +977,7 @@ async def list_image_scores_v5(
 
     # Return the fetched data with a success response
     return response_handler.create_success_response_v1(
-        response_data={"images": scores_data},  # Directly return the fetched data
+        response_data={"images": scores_data, "next_continuation_token": next_continuation_token},
         http_status_code=200
     )
 
@@ -1067,7 +1123,7 @@ async def set_image_classifier_score_v1(
             )
         else:
             # Insert new score
-            insert_result = request.app.image_classifier_scores_collection.insert_one(new_score_data)
+            insert_result = request.app.image_classifier_scores_collection.insert_one(add_random_key(dict(new_score_data)))
             new_score_data['_id'] = str(insert_result.inserted_id)
 
         return api_response_handler.create_success_response_v1(
@@ -1118,7 +1174,7 @@ async def set_image_classifier_score_v2(
 
             update_operation = UpdateOne(
                 query,
-                {"$set": new_score_data},
+                {"$set": new_score_data, "$setOnInsert": get_random_key_on_insert()},
                 upsert=True
             )
             bulk_operations.append(update_operation)
@@ -1175,14 +1231,14 @@ async def set_image_classifier_score_bulk(
 
             update_operation = UpdateOne(
                 query,
-                {"$set": new_score_data},
+                {"$set": new_score_data, "$setOnInsert": get_random_key_on_insert()},
                 upsert=True
             )
             bulk_operations.append(update_operation)
             response_data.append(new_score_data)
 
         if bulk_operations:
-            request.app.image_classifier_scores_collection.bulk_write(bulk_operations)
+            await request.app.async_collections.image_classifier_scores_collection.bulk_write(bulk_operations)
 
         return api_response_handler.create_success_response_v1(
             response_data={"scores": response_data},
@@ -1197,6 +1253,78 @@ async def set_image_classifier_score_bulk(
         )    
 
 
+@router.post("/pseudotag-classifier-scores/set-image-classifier-scores-columnar", 
+             status_code=200,
+             response_model=StandardSuccessResponseV1[ColumnarScoresIngestResponse],
+             description="Set the classifier scores of many images and classifiers. The body is a msgpack map with "
+                         "image_source, uuids, image_hashes, classifier_ids, tag_ids and a (classifiers, images) float32 "
+                         "scores array, sent with the application/msgpack content type.",
+             tags=["pseudotag-classifier-scores"], 
+             responses=ApiResponseHandlerV1.listErrors([415, 422, 500]))
+async def set_image_classifier_scores_columnar(request: Request):
+    # the body is msgpack, it is not logged by the response handler
+    api_response_handler = ApiResponseHandlerV1.createInstanceWithBody(request, {})
+
+    if not is_columnar_scores_request(request):
+        return api_response_handler.create_error_response_v1(
+            error_code=ErrorCode.INVALID_PARAMS,
+            error_string="The content type must be application/msgpack.",
+            http_status_code=415
+        )
+
+    try:
+        scores_data = decode_columnar_scores(await request.body(),
+                                             model_column_names=["classifier_ids", "tag_ids"],
+                                             score_matrix_names=["scores"])
+    except ColumnarScoresError as e:
+        return api_response_handler.create_error_response_v1(
+            error_code=ErrorCode.INVALID_PARAMS,
+            error_string=str(e),
+            http_status_code=422
+        )
+
+    try:
+        image_source = scores_data["image_source"]
+        uuids = scores_data["uuids"]
+        image_hashes = scores_data["image_hashes"]
+        creation_time = datetime.utcnow().isoformat()
+
+        def iterate_score_documents():
+            for classifier_id, tag_id, scores in zip(scores_data["classifier_ids"],
+                                                     scores_data["tag_ids"],
+                                                     scores_data["scores"].tolist()):
+                for job_uuid, image_hash, score in zip(uuids, image_hashes, scores):
+                    yield {
+                        "uuid": job_uuid,
+                        "classifier_id": classifier_id,
+                        "tag_id": tag_id,
+                        "score": score,
+                        "image_hash": image_hash,
+                        "creation_time": creation_time,
+                        "image_source": image_source
+                    }
+
+        counts = await bulk_write_in_chunks(
+            request.app.async_collections.image_classifier_scores_collection,
+            iterate_upserts(["classifier_id", "uuid", "image_source"], iterate_score_documents()))
+
+        return api_response_handler.create_success_response_v1(
+            response_data={
+                "num_scores": scores_data["scores"].size,
+                "num_skipped": 0,
+                **counts
+            },
+            http_status_code=200
+        )
+
+    except Exception as e:
+        return api_response_handler.create_error_response_v1(
+            error_code=ErrorCode.OTHER_ERROR, 
+            error_string=str(e),
+            http_status_code=500
+        )
+
+
 @router.post("/pseudotag-classifier-scores/set-image-classifier-score-list-v1", 
              status_code=200,
              response_model=StandardSuccessResponseV1[ListClassifierScore3],
@@ -1216,13 +1344,13 @@ async def set_image_classifier_score_list(
         for classifier_score in classifier_score_list:
             # Determine the appropriate collection based on image_source
             if image_source == "generated_image":
-                collection = request.app.completed_jobs_collection
+                collection = request.app.async_collections.completed_jobs_collection
                 projection = {"task_output_file_dict.output_file_hash": 1, "task_type": 1}
             elif image_source == "extract_image":
-                collection = request.app.extracts_collection
+                collection = request.app.async_collections.extracts_collection
                 projection = {"image_hash": 1}
             elif image_source == "external_image":
-                collection = request.app.external_images_collection
+                collection = request.app.async_collections.external_images_collection
                 projection = {"image_hash": 1}
             else:
                 return api_response_handler.create_error_response_v1(
@@ -1239,7 +1367,7 @@ async def set_image_classifier_score_list(
             }
 
             # Fetch image_hash from the determined collection
-            job_data = collection.find_one(image_query, projection)
+            job_data = await collection.find_one(image_query, projection)
             if not job_data:
                 return api_response_handler.create_error_response_v1(
                     error_code=ErrorCode.INVALID_PARAMS,
@@ -1261,7 +1389,7 @@ async def set_image_classifier_score_list(
                 task_type = None
 
             # Fetch tag_id from classifier_models_collection
-            classifier_data = request.app.classifier_models_collection.find_one(
+            classifier_data = await request.app.async_collections.classifier_models_collection.find_one(
                 {"classifier_id": classifier_score.classifier_id}, 
                 {"tag_id": 1}
             )
@@ -1298,10 +1426,10 @@ async def set_image_classifier_score_list(
             }
 
             # Check for existing score and update or insert accordingly
-            existing_score = request.app.image_classifier_scores_collection.find_one(query)
+            existing_score = await request.app.async_collections.image_classifier_scores_collection.find_one(query)
             if existing_score:
                 # Update existing score
-                request.app.image_classifier_scores_collection.update_one(
+                await request.app.async_collections.image_classifier_scores_collection.update_one(
                     query, 
                     {"$set": {
                         "score": classifier_score.score, 
@@ -1312,7 +1440,7 @@ async def set_image_classifier_score_list(
                 )
             else:
                 # Insert new score
-                insert_result = request.app.image_classifier_scores_collection.insert_one(new_score_data)
+                insert_result = await request.app.async_collections.image_classifier_scores_collection.insert_one(add_random_key(dict(new_score_data)))
                 new_score_data['_id'] = str(insert_result.inserted_id)
                 new_score_data_list.append(new_score_data)
 
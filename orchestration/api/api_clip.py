@@ -1,7 +1,9 @@
 from fastapi import Request, APIRouter, HTTPException, Response, File, UploadFile
+import asyncio
+import functools
 import requests
-from .api_utils import PrettyJSONResponse, ApiResponseHandler, ErrorCode, StandardErrorResponse, StandardErrorResponseV1, StandardSuccessResponse, StandardSuccessResponseV1, RechableResponse, GetClipPhraseResponse, ApiResponseHandlerV1, GetKandinskyClipResponse, UrlResponse
-from orchestration.api.mongo_schemas import  PhraseModel, ListSimilarityScoreTask
+from .api_utils import PrettyJSONResponse, ApiResponseHandler, ErrorCode, StandardErrorResponse, StandardErrorResponseV1, StandardSuccessResponse, StandardSuccessResponseV1, RechableResponse, GetClipPhraseResponse, ApiResponseHandlerV1, GetKandinskyClipResponse, UrlResponse, validate_date_format
+from orchestration.api.mongo_schemas import  PhraseModel, ListSimilarityScoreTask, ListClipSearchImage
 from typing import Optional
 from typing import List
 import json
@@ -11,6 +13,7 @@ from fastapi_cache.decorator import cache
 from pydantic import BaseModel
 import traceback
 from utility.minio import cmd 
+from utility.http import http_client
 from minio import Minio
 from minio.error import S3Error
 from .api_utils import find_or_create_next_folder_and_index
@@ -21,6 +24,8 @@ from PIL import Image
 
 CLIP_SERVER_ADDRESS = 'http://192.168.3.31:8002'
 #CLIP_SERVER_ADDRESS = 'http://127.0.0.1:8002'
+# (connect, read) timeout of the top-k search, it scores every indexed vector
+CLIP_SERVER_SEARCH_TIMEOUT = (10, 120)
 router = APIRouter()
 
 # --------- Http requests -------------
@@ -134,6 +139,39 @@ def http_clip_server_get_cosine_similarity_list(bucket: str, image_path_list: Li
             response.close()
     return None
 
+def http_clip_server_search_images_by_phrase(phrase: str,
+                                             top_k: int,
+                                             bucket: Optional[str] = None,
+                                             dataset: Optional[str] = None,
+                                             start_date: Optional[str] = None,
+                                             end_date: Optional[str] = None):
+    url = f'{CLIP_SERVER_ADDRESS}/search-images-by-phrase'
+    params = {
+        "phrase": phrase,
+        "top_k": top_k,
+        "bucket": bucket,
+        "dataset": dataset,
+        "start_date": start_date,
+        "end_date": end_date
+    }
+    response = None
+    try:
+        # pooled connection with a timeout, this runs in the thread pool of an async endpoint
+        response = http_client.get(url, params=params, timeout=CLIP_SERVER_SEARCH_TIMEOUT)
+
+        if response.status_code == 200:
+            return response.status_code, response.json()
+        else:
+            return response.status_code, None
+
+    except Exception as e:
+        print('request exception ', e)
+        return 500, None
+
+    finally:
+        if response:
+            response.close()
+
 # ----------------------------------------------------------------------------
 
 
@@ -765,3 +803,69 @@ async def get_random_image_similarity_date_range_v1(
             error_string=str(e),
             http_status_code=500
         )
+
+
+@router.get("/clip/search-images-by-phrase",
+            tags=["clip"],
+            description="Returns the top-k images most similar to the 'phrase' param, searched over the clip vectors of the datasets, external and extracts buckets. Unlike /clip/get-random-images-with-clip-search it searches every indexed image instead of a random sample.",
+            response_model=StandardSuccessResponseV1[ListClipSearchImage],
+            responses=ApiResponseHandlerV1.listErrors([400, 422, 500]))
+async def search_images_by_phrase(
+    request: Request,
+    phrase: str = Query(..., description="Phrase to compare similarity with"),
+    top_k: int = Query(20, description="Number of images to return"),
+    bucket: Optional[str] = Query(None, description="Bucket to filter images: datasets, external or extracts"),
+    dataset: Optional[str] = Query(None, description="Dataset to filter images"),
+    start_date: Optional[str] = Query(None, description="Start date for filtering images"),
+    end_date: Optional[str] = Query(None, description="End date for filtering images")
+):
+    response_handler = await ApiResponseHandlerV1.createInstance(request)
+
+    if top_k <= 0:
+        return response_handler.create_error_response_v1(
+            error_code=ErrorCode.INVALID_PARAMS,
+            error_string="top_k must be greater than 0",
+            http_status_code=400
+        )
+
+    for date_name, date in [("start_date", start_date), ("end_date", end_date)]:
+        if date is not None and validate_date_format(date) is None:
+            return response_handler.create_error_response_v1(
+                error_code=ErrorCode.INVALID_PARAMS,
+                error_string=f"Invalid {date_name} format. Expected format: YYYY-MM-DD",
+                http_status_code=422
+            )
+
+    try:
+        # the request is blocking, it runs in the thread pool
+        loop = asyncio.get_running_loop()
+        status_code, search_result = await loop.run_in_executor(None, functools.partial(http_clip_server_search_images_by_phrase,
+                                                                                        phrase,
+                                                                                        top_k,
+                                                                                        bucket=bucket,
+                                                                                        dataset=dataset,
+                                                                                        start_date=start_date,
+                                                                                        end_date=end_date))
+
+        if status_code == 422:
+            return response_handler.create_error_response_v1(
+                error_code=ErrorCode.INVALID_PARAMS,
+                error_string="Invalid start_date or end_date. Expected format: YYYY-MM-DD",
+                http_status_code=422
+            )
+
+        if search_result is None or 'images' not in search_result:
+            return response_handler.create_error_response_v1(
+                error_code=ErrorCode.OTHER_ERROR,
+                error_string="Error searching the clip index",
+                http_status_code=500
+            )
+
+        return response_handler.create_success_response_v1(response_data={"images": search_result['images']}, http_status_code=200)
+
+    except Exception as e:
+        return response_handler.create_error_response_v1(
+            error_code=ErrorCode.OTHER_ERROR,
+            error_string=str(e),
+            http_status_code=500
+        )
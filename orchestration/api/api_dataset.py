@@ -1,7 +1,7 @@
 import os.path
 
 from fastapi import Request, HTTPException, APIRouter, Response, Query
-from orchestration.api.mongo_schemas import SequentialID
+from orchestration.api.utils.sequential_ids import sequential_id_cache, reset_sequential_ids
 from utility.minio import cmd
 import json
 from datetime import datetime
@@ -17,7 +17,8 @@ router = APIRouter()
                tags = ['deprecated3'],
                description="changed with /datasets/clear-all-sequential-id ")
 def clear_dataset_sequential_id_jobs(request: Request):
-    request.app.dataset_sequential_id_collection.delete_many({})
+    reset_sequential_ids(request.app.dataset_sequential_id_collection)
+    sequential_id_cache.clear(request.app.dataset_sequential_id_collection.name)
 
     return True
 
@@ -31,45 +32,23 @@ def get_datasets(request: Request):
 
 @router.get("/dataset/sequential-id/{dataset}",tags = ['deprecated3'], description= "changed with /datasets/get-sequential-ids" )
 def get_sequential_id(request: Request, dataset: str, limit: int = 1):
-    sequential_id_arr = []
-
-    # find
-    sequential_id = request.app.dataset_sequential_id_collection.find_one({"dataset_name": dataset})
-    if sequential_id is None:
-        # create one
-        new_sequential_id = SequentialID(dataset)
-
-        # get the sequential id arr
-        for i in range(limit):
-            sequential_id_arr.append(new_sequential_id.get_sequential_id())
-
-        # add to collection
-        request.app.dataset_sequential_id_collection.insert_one(new_sequential_id.to_dict())
-
-        return sequential_id_arr
-
-    # if found
-    found_sequential_id = SequentialID(sequential_id["dataset_name"], sequential_id["subfolder_count"],
-                                       sequential_id["file_count"])
-    # get the sequential id arr
-    for i in range(limit):
-        sequential_id_arr.append(found_sequential_id.get_sequential_id())
-
-    new_values = {"$set": found_sequential_id.to_dict()}
+    # reserved atomically, see utils/sequential_ids.py
+    return sequential_id_cache.get(request.app.dataset_sequential_id_collection, dataset, limit)
 
-    # # update existing sequential id
-    request.app.dataset_sequential_id_collection.update_one({"dataset_name": dataset}, new_values)
-
-    return sequential_id_arr
+async def get_sequential_id_async(request: Request, dataset: str, limit: int = 1):
+    # same as get_sequential_id, using the async collections
+    return await sequential_id_cache.get_async(request.app.async_collections.dataset_sequential_id_collection, dataset, limit)
 
 @router.delete("/dataset/delete-sequential-id", 
                tags = ['deprecated3'],
                description="delete the sequential id of a dataset")
 def delete_sequential_id(request: Request, dataset_name: str):
 
-    res= request.app.dataset_sequential_id_collection.delete_one({"dataset_name": dataset_name})
+    # reset instead of deleted, so the other api processes see the new generation
+    res= reset_sequential_ids(request.app.dataset_sequential_id_collection, dataset_name)
+    sequential_id_cache.clear(request.app.dataset_sequential_id_collection.name, dataset_name)
 
-    if res.deleted_count == 0:
+    if res.matched_count == 0:
         raise HTTPException(status_code=404, detail="No sequential id was found for that dataset name")
 
     return True
@@ -614,9 +593,11 @@ async def clear_dataset_sequential_id_jobs(request: Request):
     response_handler = await ApiResponseHandlerV1.createInstance(request)
     try:
         # If documents are present, delete them
-        result = request.app.dataset_sequential_id_collection.delete_many({})
-        # Return a standard response with wasPresent set to true if there was a deletion
-        return response_handler.create_success_delete_response_v1(result.deleted_count != 0)
+        # reset instead of deleted, so the other api processes see the new generation
+        result = reset_sequential_ids(request.app.dataset_sequential_id_collection)
+        sequential_id_cache.clear(request.app.dataset_sequential_id_collection.name)
+        # Return a standard response with wasPresent set to true if there was a reset
+        return response_handler.create_success_delete_response_v1(result.matched_count != 0)
     except Exception as e:
         return response_handler.create_error_response_v1(
             error_code=ErrorCode.OTHER_ERROR,
@@ -699,28 +680,8 @@ async def get_sequential_id_1(request: Request, dataset: str = Query(..., descri
             )
 
 
-        sequential_id = request.app.dataset_sequential_id_collection.find_one({"dataset_name": dataset})
-        
-
-        if sequential_id is None:
-            # create one
-            new_sequential_id = SequentialID(dataset)
-            # get the sequential id arr
-            for i in range(amount):
-                sequential_id_arr.append(new_sequential_id.get_sequential_id())
-            # add to collection
-            request.app.dataset_sequential_id_collection.insert_one(new_sequential_id.to_dict())
-
-        else:
-            # if found, use the found sequential id
-            found_sequential_id = SequentialID(sequential_id["dataset_name"], sequential_id.get("subfolder_count", 0),
-                                               sequential_id.get("file_count", 0))
-            for i in range(amount):
-                sequential_id_arr.append(found_sequential_id.get_sequential_id())
-
-            new_values = {"$set": found_sequential_id.to_dict()}
-            # update existing sequential id
-            request.app.dataset_sequential_id_collection.update_one({"dataset_name": dataset}, new_values)
+        # reserved atomically, the amount can be large, it is one round trip
+        sequential_id_arr = await get_sequential_id_async(request, dataset, amount)
 
         # Return the sequential IDs
         return response_handler.create_success_response_v1(
@@ -13,6 +13,7 @@ from typing import List
 from datetime import datetime, timedelta
 import random
 from .api_clip import http_clip_server_get_cosine_similarity_list
+from orchestration.api.utils.random_sampling import sample_documents_async, sample_joined_documents, sample_documents, add_random_key
 import time
 import os
 from utility.minio import cmd
@@ -29,14 +30,13 @@ extracts = "extract_image"
             tags=["extracts"])
 async def get_current_data_batch_sequential_id(request: Request, dataset: str):
 
-    # get batch counter
-    counter = request.app.extract_data_batch_sequential_id.find_one({"dataset": dataset})
-    # create counter if it doesn't exist already
-    if counter is None:
-        # insert the new counter
-        insert_result= request.app.extract_data_batch_sequential_id.insert_one({"dataset": dataset, "sequence_number": 0, "complete": True})
-        # Retrieve the inserted counter using the inserted_id
-        counter = request.app.extract_data_batch_sequential_id.find_one({'_id': insert_result.inserted_id})
+    # get batch counter, created if it doesn't exist already
+    counter = request.app.extract_data_batch_sequential_id.find_one_and_update(
+        {"dataset": dataset},
+        {"$setOnInsert": {"sequence_number": 0, "complete": True}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+        )
     
     # remove _id field
     counter.pop("_id")
@@ -48,28 +48,13 @@ async def get_current_data_batch_sequential_id(request: Request, dataset: str):
             tags=["extracts"])
 async def get_next_data_batch_sequential_id(request: Request, dataset: str, complete: bool):
 
-    # get batch counter
-    counter = request.app.extract_data_batch_sequential_id.find_one({"dataset": dataset})
-    # create counter if it doesn't exist already
-    if counter is None:
-        # insert the new counter
-        insert_result= request.app.extract_data_batch_sequential_id.insert_one({"dataset": dataset, "sequence_number": 0, "complete": True})
-        # Retrieve the inserted counter using the inserted_id
-        counter = request.app.extract_data_batch_sequential_id.find_one({'_id': insert_result.inserted_id})
-
-    # get current last batch count
-    counter_seq = counter["sequence_number"] if counter else 0
-    counter_seq += 1
-
+    # increment the batch counter atomically, it is created if it doesn't exist already
     try:
         counter = request.app.extract_data_batch_sequential_id.find_one_and_update(
             {"dataset": dataset},
-            {"$set": 
-                {
-                    "sequence_number": counter_seq,
-                    "complete": complete
-                }
-            },
+            {"$inc": {"sequence_number": 1},
+             "$set": {"complete": complete}},
+            upsert=True,
             return_document=ReturnDocument.AFTER
             )
     except Exception as e:
@@ -142,7 +127,7 @@ async def add_extract(request: Request, image_data: ExtractImageData):
                 data_to_save['image_uuid'] = image_uuid
 
             # Insert the image data into the extracts collection
-            request.app.extracts_collection.insert_one(data_to_save)
+            request.app.extracts_collection.insert_one(add_random_key(data_to_save))
 
         else:
             return api_response_handler.create_error_response_v1(
@@ -248,7 +233,7 @@ async def add_extract(request: Request, image_data: ExtractImageDataV1):
             image_data_dict['image_uuid'] = image_uuid
 
             # Insert the image data into the extracts collection
-            request.app.extracts_collection.insert_one(image_data_dict)
+            request.app.extracts_collection.insert_one(add_random_key(image_data_dict))
 
         else:
             return api_response_handler.create_error_response_v1(
@@ -1033,11 +1018,7 @@ async def get_random_external_image_similarity(
         elif end_date:
             query['upload_date'] = {'$lte': end_date}
 
-        aggregation_pipeline = [{"$match": query}]
-        if size:
-            aggregation_pipeline.append({"$sample": {"size": size}})
-
-        images = list(request.app.extracts_collection.aggregate(aggregation_pipeline))
+        images = await sample_documents_async(request.app.async_collections.extracts_collection, query, size)
         ExtractsHelpers.clean_extract_list_for_api_response(images)
 
         image_path_list = []
@@ -1107,11 +1088,7 @@ async def get_random_external_image_similarity_v1(
         elif end_date:
             query['upload_date'] = {'$lte': end_date}
 
-        aggregation_pipeline = [{"$match": query}]
-        if size:
-            aggregation_pipeline.append({"$sample": {"size": size}})
-
-        images = list(request.app.extracts_collection.aggregate(aggregation_pipeline))
+        images = await sample_documents_async(request.app.async_collections.extracts_collection, query, size)
         ExtractsHelpers.clean_extract_list_for_api_response(images)
 
         image_path_list = []
@@ -1247,46 +1224,21 @@ def get_random_image_date_range(
         classifier_query = {'classifier_id': classifier_id, 'image_source': 'extract_image'}
         if min_score is not None:
             classifier_query['score'] = {'$gte': min_score}
-            
 
-        # Fetch image hashes from classifier_scores collection that match the criteria
-        classifier_scores = list(request.app.image_classifier_scores_collection.find(classifier_query))
-        if not classifier_scores:
+        if request.app.image_classifier_scores_collection.find_one(classifier_query, {"_id": 1}) is None:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="The relevance classifier model has no scores.")
 
-        # Limit the number of image hashes to the requested size
-        limited_image_hashes = random.sample([score['image_hash'] for score in classifier_scores], min(size, len(classifier_scores)))
-
-        # Break down the image hashes into smaller batches
-        BATCH_SIZE = 1000  # Adjust batch size as needed
-        all_documents = []
+        # random extracts among the images with a classifier score above min_score
+        documents = sample_joined_documents(request.app.image_classifier_scores_collection, classifier_query, 'image_hash',
+                                            request.app.extracts_collection, query, 'image_hash', size)
 
-        for i in range(0, len(limited_image_hashes), BATCH_SIZE):
-            batch_image_hashes = limited_image_hashes[i:i+BATCH_SIZE]
-            batch_query = query.copy()
-            batch_query['image_hash'] = {'$in': batch_image_hashes}
-
-
-            aggregation_pipeline = [{"$match": batch_query}]
-            if size:
-                aggregation_pipeline.append({"$sample": {"size": size}})
-            
-            batch_documents = request.app.extracts_collection.aggregate(aggregation_pipeline)
-            batch_docs_list = list(batch_documents)
-            all_documents.extend(batch_docs_list)
-            if len(all_documents) >= size:
-                break
-
-        documents = all_documents[:size]
+    elif size:
+        documents = sample_documents(request.app.extracts_collection, query, size)
 
     else:
-        aggregation_pipeline = [{"$match": query}]
-        if size:
-            aggregation_pipeline.append({"$sample": {"size": size}})
-
-        documents = list(request.app.extracts_collection.aggregate(aggregation_pipeline))
+        documents = list(request.app.extracts_collection.find(query))
 
     ExtractsHelpers.clean_extract_list_for_api_response(documents)
 
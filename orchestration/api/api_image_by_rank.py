@@ -3,6 +3,7 @@ from datetime import datetime, timedelta
 from .api_utils import PrettyJSONResponse, ApiResponseHandler, ErrorCode, StandardErrorResponse, StandardSuccessResponse, ImageData, StandardSuccessResponseV1, ApiResponseHandlerV1, ModelsAndScoresResponse
 from .mongo_schemas import Task
 from typing import Optional
+from orchestration.api.utils.keyset_pagination import apply_continuation_token, encode_continuation_token, get_keyset_sort, ContinuationTokenError
 
 
 router = APIRouter()
@@ -10,6 +11,100 @@ router = APIRouter()
 
 CACHE = {}
 CACHE_EXPIRATION_DELTA = timedelta(hours=12)
+# sorted scores joined with the completed jobs per query
+RANKED_IMAGES_JOIN_BATCH_SIZE = 500
+
+
+def get_ranked_images_query(dataset, start_date, end_date, threshold_time):
+    imgs_query = {"task_input_dict.dataset": dataset}
+
+    if start_date and end_date:
+        imgs_query['task_creation_time'] = {'$gte': start_date, '$lte': end_date}
+    elif start_date:
+        imgs_query['task_creation_time'] = {'$gte': start_date}
+    elif end_date:
+        imgs_query['task_creation_time'] = {'$lte': end_date}
+    if threshold_time:
+        imgs_query['task_creation_time'] = {'$gte': threshold_time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+    return imgs_query
+
+
+def get_image_paths(request, imgs_query, image_hashes):
+    # image hash => output file path of the completed jobs matching imgs_query
+    query = dict(imgs_query)
+    query["task_output_file_dict.output_file_hash"] = {"$in": image_hashes}
+
+    image_paths = {}
+    for job in request.app.completed_jobs_collection.find(query, {"_id": 0, "task_output_file_dict": 1}):
+        output_file_dict = job['task_output_file_dict']
+        image_paths.setdefault(output_file_dict['output_file_hash'], output_file_dict['output_file_path'])
+
+    return image_paths
+
+
+def list_ranked_images(request, scores_collection, scores_query, sort_field, sort_order, imgs_query,
+                       limit, offset=0, continuation_token=None):
+    # walks the scores sorted by (sort_field, _id) from the continuation token
+    # and joins them with the completed jobs one batch at a time until the page is full
+    # returns (images, next continuation token)
+    # raises ContinuationTokenError if the token is not valid
+    if limit <= 0:
+        return [], None
+
+    scores_query = apply_continuation_token(scores_query, sort_field, sort_order, continuation_token)
+    cursor = scores_collection.find(
+        scores_query,
+        {'_id': 1, 'image_hash': 1, sort_field: 1}
+    ).sort(get_keyset_sort(sort_field, sort_order)).batch_size(RANKED_IMAGES_JOIN_BATCH_SIZE)
+
+    # offset is only used for the first page
+    num_to_skip = offset if continuation_token is None else 0
+    images_data = []
+    batch = []
+    try:
+        for data in cursor:
+            batch.append(data)
+            if len(batch) < RANKED_IMAGES_JOIN_BATCH_SIZE:
+                continue
+
+            last_data, num_to_skip = add_ranked_images(request, batch, sort_field, imgs_query, images_data, limit, num_to_skip)
+            batch = []
+            if last_data is not None:
+                return images_data, encode_continuation_token(last_data[sort_field], last_data['_id'], sort_order)
+
+        last_data, num_to_skip = add_ranked_images(request, batch, sort_field, imgs_query, images_data, limit, num_to_skip)
+        if last_data is not None:
+            return images_data, encode_continuation_token(last_data[sort_field], last_data['_id'], sort_order)
+    finally:
+        cursor.close()
+
+    return images_data, None
+
+
+def add_ranked_images(request, batch, sort_field, imgs_query, images_data, limit, num_to_skip):
+    # returns the score document that filled the page, or None, and the number of images left to skip
+    if len(batch) == 0:
+        return None, num_to_skip
+
+    image_paths = get_image_paths(request, imgs_query, [data['image_hash'] for data in batch])
+    for data in batch:
+        image_path = image_paths.get(data['image_hash'])
+        if image_path is None:
+            continue
+        if num_to_skip > 0:
+            num_to_skip -= 1
+            continue
+
+        images_data.append({
+            'image_path': image_path,
+            'image_hash': data['image_hash'],
+            sort_field: data[sort_field]
+        })
+        if len(images_data) == limit:
+            return data, num_to_skip
+
+    return None, num_to_skip
 
 @router.get("/tasks/attributes", 
          tags = ["deprecated2"],
@@ -527,7 +622,8 @@ def image_list_sorted_by_score(
     min_score: float = None,
     max_score: float = None,
     time_interval: int = Query(None, description="Time interval in minutes or hours"),
-    time_unit: str = Query("minutes", description="Time unit, either 'minutes' or 'hours")
+    time_unit: str = Query("minutes", description="Time unit, either 'minutes' or 'hours"),
+    continuation_token: Optional[str] = Query(None, description="next_continuation_token of the previous page, offset is ignored when it is set")
 ):
     response_handler = ApiResponseHandlerV1(request)
     try:
@@ -547,40 +643,20 @@ def image_list_sorted_by_score(
         elif max_score is not None:
             scores_query['score'] = {'$lte': max_score}
 
-        scores_data = list(request.app.image_rank_scores_collection.find(
-            scores_query,
-            {'_id': 0, 'image_hash': 1, 'score': 1}
-        ).sort("score", sort_order_mongo))
-
-        images_data = []
+        imgs_query = get_ranked_images_query(dataset, start_date, end_date, threshold_time)
+        images_data, next_continuation_token = list_ranked_images(request, request.app.image_rank_scores_collection, scores_query, "score", sort_order_mongo,
+                                                                  imgs_query, limit, offset=offset, continuation_token=continuation_token)
 
-        for data in scores_data:
-            imgs_query = {
-                "task_input_dict.dataset": dataset,
-                "task_output_file_dict.output_file_hash": data['image_hash']
-            }
+        return response_handler.create_success_response_v1(
+            response_data={"images": images_data, "next_continuation_token": next_continuation_token},
+            http_status_code=200)
 
-            if start_date and end_date:
-                imgs_query['task_creation_time'] = {'$gte': start_date, '$lte': end_date}
-            elif start_date:
-                imgs_query['task_creation_time'] = {'$gte': start_date}
-            elif end_date:
-                imgs_query['task_creation_time'] = {'$lte': end_date}
-            if threshold_time:
-                imgs_query['task_creation_time'] = {'$gte': threshold_time.strftime("%Y-%m-%dT%H:%M:%S")}
-
-            img = request.app.completed_jobs_collection.find_one(imgs_query)
-
-            if img:
-                images_data.append({
-                    'image_path': img['task_output_file_dict']['output_file_path'],
-                    'image_hash': data['image_hash'],
-                    'score': data['score']
-                })
-
-        paginated_data = images_data[offset:offset + limit]
-
-        return response_handler.create_success_response_v1(response_data={"images": paginated_data}, http_status_code=200)
+    except ContinuationTokenError as e:
+        return response_handler.create_error_response_v1(
+            error_code=ErrorCode.INVALID_PARAMS,
+            error_string=str(e),
+            http_status_code=422,
+        )
 
     except Exception as e:
         return response_handler.create_error_response_v1(
@@ -748,7 +824,8 @@ def image_list_sorted_by_percentile_v1(
     min_percentile: float = None,
     max_percentile: float = None,
     time_interval: int = Query(None, description="Time interval in minutes or hours"),
-    time_unit: str = Query("minutes", description="Time unit, either 'minutes' or 'hours")
+    time_unit: str = Query("minutes", description="Time unit, either 'minutes' or 'hours"),
+    continuation_token: Optional[str] = Query(None, description="next_continuation_token of the previous page, offset is ignored when it is set")
 ):
     response_handler = ApiResponseHandlerV1(request)
     try:
@@ -768,40 +845,20 @@ def image_list_sorted_by_percentile_v1(
         elif max_percentile is not None:
             percentiles_query['percentile'] = {'$lte': max_percentile}
 
-        percentiles_data = list(request.app.image_percentiles_collection.find(
-            percentiles_query,
-            {'_id': 0, 'image_hash': 1, 'percentile': 1}
-        ).sort("percentile", sort_order_mongo))
-
-        images_data = []
-
-        for data in percentiles_data:
-            imgs_query = {
-                "task_input_dict.dataset": dataset,
-                "task_output_file_dict.output_file_hash": data['image_hash']
-            }
-
-            if start_date and end_date:
-                imgs_query['task_creation_time'] = {'$gte': start_date, '$lte': end_date}
-            elif start_date:
-                imgs_query['task_creation_time'] = {'$gte': start_date}
-            elif end_date:
-                imgs_query['task_creation_time'] = {'$lte': end_date}
-            if threshold_time:
-                imgs_query['task_creation_time'] = {'$gte': threshold_time.strftime("%Y-%m-%dT%H:%M:%S")}
-
-            img = request.app.completed_jobs_collection.find_one(imgs_query)
-
-            if img:
-                images_data.append({
-                    'image_path': img['task_output_file_dict']['output_file_path'],
-                    'image_hash': data['image_hash'],
-                    'percentile': data['percentile']
-                })
+        imgs_query = get_ranked_images_query(dataset, start_date, end_date, threshold_time)
+        images_data, next_continuation_token = list_ranked_images(request, request.app.image_percentiles_collection, percentiles_query, "percentile", sort_order_mongo,
+                                                                  imgs_query, limit, offset=offset, continuation_token=continuation_token)
 
-        paginated_data = images_data[offset:offset + limit]
+        return response_handler.create_success_response_v1(
+            response_data={"images": images_data, "next_continuation_token": next_continuation_token},
+            http_status_code=200)
 
-        return response_handler.create_success_response_v1(response_data={"images": paginated_data}, http_status_code=200)
+    except ContinuationTokenError as e:
+        return response_handler.create_error_response_v1(
+            error_code=ErrorCode.INVALID_PARAMS,
+            error_string=str(e),
+            http_status_code=422,
+        )
 
     except Exception as e:
         return response_handler.create_error_response_v1(
@@ -827,7 +884,8 @@ def image_list_sorted_by_residual(
     min_residual: float = None,
     max_residual: float = None,
     time_interval: int = Query(None, description="Time interval in minutes or hours"),
-    time_unit: str = Query("minutes", description="Time unit, either 'minutes' or 'hours")
+    time_unit: str = Query("minutes", description="Time unit, either 'minutes' or 'hours"),
+    continuation_token: Optional[str] = Query(None, description="next_continuation_token of the previous page, offset is ignored when it is set")
 ):
     response_handler = ApiResponseHandlerV1(request)
     try:
@@ -847,40 +905,20 @@ def image_list_sorted_by_residual(
         elif max_residual is not None:
             residuals_query['residual'] = {'$lte': max_residual}
 
-        residuals_data = list(request.app.image_residuals_collection.find(
-            residuals_query,
-            {'_id': 0, 'image_hash': 1, 'residual': 1}
-        ).sort("residual", sort_order_mongo))
-
-        images_data = []
-
-        for data in residuals_data:
-            imgs_query = {
-                "task_input_dict.dataset": dataset,
-                "task_output_file_dict.output_file_hash": data['image_hash']
-            }
-
-            if start_date and end_date:
-                imgs_query['task_creation_time'] = {'$gte': start_date, '$lte': end_date}
-            elif start_date:
-                imgs_query['task_creation_time'] = {'$gte': start_date}
-            elif end_date:
-                imgs_query['task_creation_time'] = {'$lte': end_date}
-            if threshold_time:
-                imgs_query['task_creation_time'] = {'$gte': threshold_time.strftime("%Y-%m-%dT%H:%M:%S")}
-
-            img = request.app.completed_jobs_collection.find_one(imgs_query)
-
-            if img:
-                images_data.append({
-                    'image_path': img['task_output_file_dict']['output_file_path'],
-                    'image_hash': data['image_hash'],
-                    'residual': data['residual']
-                })
+        imgs_query = get_ranked_images_query(dataset, start_date, end_date, threshold_time)
+        images_data, next_continuation_token = list_ranked_images(request, request.app.image_residuals_collection, residuals_query, "residual", sort_order_mongo,
+                                                                  imgs_query, limit, offset=offset, continuation_token=continuation_token)
 
-        paginated_data = images_data[offset:offset + limit]
+        return response_handler.create_success_response_v1(
+            response_data={"images": images_data, "next_continuation_token": next_continuation_token},
+            http_status_code=200)
 
-        return response_handler.create_success_response_v1(response_data={"images": paginated_data}, http_status_code=200)
+    except ContinuationTokenError as e:
+        return response_handler.create_error_response_v1(
+            error_code=ErrorCode.INVALID_PARAMS,
+            error_string=str(e),
+            http_status_code=422,
+        )
 
     except Exception as e:
         return response_handler.create_error_response_v1(
@@ -5,6 +5,8 @@ from .mongo_schemas import ImageHashRequest, ImageHash, ListImageHash, GlobalId
 from decimal import Decimal
 from typing import List
 from bson.decimal128 import Decimal128
+from fastapi import Query
+from orchestration.api.utils.ndjson_stream import wants_ndjson_stream, NDJSON_CURSOR_BATCH_SIZE
 router = APIRouter()
 
 next_image_global_id = 0
@@ -138,11 +140,20 @@ async def update_all_image_hashes_v1(request: Request):
             description="get all image hash tags",
             response_model=StandardSuccessResponseV1[ImageHash],
             responses=ApiResponseHandlerV1.listErrors([500]))
-async def get_all_image_hashes_with_global_id(request: Request):
+async def get_all_image_hashes_with_global_id(request: Request,
+        stream: bool = Query(False, description="Stream the image hashes as ndjson, one hash per line")):
 
     response_handler = await ApiResponseHandlerV1.createInstance(request)
 
     try:
+        if wants_ndjson_stream(request, stream):
+            cursor = request.app.async_collections.image_hashes_collection.find(
+                {},
+                {"_id": 0, "image_hash": 1, "image_global_id": 1},
+                batch_size=NDJSON_CURSOR_BATCH_SIZE
+            )
+            return response_handler.create_ndjson_stream_response_v1(cursor)
+
         image_hashes_data = list(request.app.image_hashes_collection.find(
             {}, 
             { "_id": 0 }
@@ -168,11 +179,20 @@ async def get_all_image_hashes_with_global_id(request: Request):
             description="Gets all image hashes",
             response_model=StandardSuccessResponseV1[ListImageHash],
             responses=ApiResponseHandlerV1.listErrors([500]))
-async def get_all_image_hashes_with_global_id_v1(request: Request):
+async def get_all_image_hashes_with_global_id_v1(request: Request,
+        stream: bool = Query(False, description="Stream the image hashes as ndjson, one hash per line")):
 
     response_handler = await ApiResponseHandlerV1.createInstance(request)
 
     try:
+        if wants_ndjson_stream(request, stream):
+            cursor = request.app.async_collections.image_hashes_collection.find(
+                {},
+                {"_id": 0, "image_hash": 1, "image_global_id": 1},
+                batch_size=NDJSON_CURSOR_BATCH_SIZE
+            )
+            return response_handler.create_ndjson_stream_response_v1(cursor)
+
         image_hashes_data = list(request.app.image_hashes_collection.find(
             {}, 
             { "_id": 0 }
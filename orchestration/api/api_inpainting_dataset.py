@@ -1,6 +1,6 @@
 from fastapi import Request, HTTPException, APIRouter, Response, Query
 from utility.minio import cmd
-from orchestration.api.mongo_schemas import SequentialID
+from orchestration.api.utils.sequential_ids import sequential_id_cache
 
 router = APIRouter()
 
@@ -13,33 +13,6 @@ def get_datasets_inpainting(request: Request):
 
 @router.get("/datasets-inpainting/sequential-id/{dataset}")
 def get_sequential_id_inpainting(request: Request, dataset: str, limit: int = 1):
-    sequential_id_arr = []
+    # reserved atomically, see utils/sequential_ids.py
+    return sequential_id_cache.get(request.app.inpainting_dataset_sequential_id_collection, dataset, limit)
 
-    # find
-    sequential_id = request.app.inpainting_dataset_sequential_id_collection.find_one({"dataset_name": dataset})
-    if sequential_id is None:
-        # create one
-        new_sequential_id = SequentialID(dataset)
-
-        # get the sequential id arr
-        for i in range(limit):
-            sequential_id_arr.append(new_sequential_id.get_sequential_id())
-
-        # add to collection
-        request.app.inpainting_dataset_sequential_id_collection.insert_one(new_sequential_id.to_dict())
-
-        return sequential_id_arr
-
-    # if found
-    found_sequential_id = SequentialID(sequential_id["dataset_name"], sequential_id["subfolder_count"],
-                                       sequential_id["file_count"])
-    # get the sequential id arr
-    for i in range(limit):
-        sequential_id_arr.append(found_sequential_id.get_sequential_id())
-
-    new_values = {"$set": found_sequential_id.to_dict()}
-
-    # # update existing sequential id
-    request.app.inpainting_dataset_sequential_id_collection.update_one({"dataset_name": dataset}, new_values)
-
-    return sequential_id_arr
@@ -15,6 +15,7 @@ import csv
 from .api_utils import ApiResponseHandlerV1, ErrorCode, StandardSuccessResponseV1, AddJob, WasPresentResponse,CountResponse
 from pymongo import UpdateMany
 from fastapi.encoders import jsonable_encoder
+from orchestration.api.utils.ndjson_stream import wants_ndjson_stream, NDJSON_CURSOR_BATCH_SIZE
 
 router = APIRouter()
 
@@ -333,8 +334,12 @@ async def get_completed_job_count(request: Request):
             tags=["inpainting jobs"],
             response_model=StandardSuccessResponseV1[ListTask],
             responses=ApiResponseHandlerV1.listErrors([500]))
-def get_list_pending_jobs(request: Request):
+def get_list_pending_jobs(request: Request,
+                            stream: bool = Query(False, description="Stream the jobs as ndjson, one job per line")):
     api_response_handler = ApiResponseHandlerV1(request)
+    if wants_ndjson_stream(request, stream):
+        cursor = request.app.pending_inpainting_jobs_collection.find({}, {"_id": 0}, batch_size=NDJSON_CURSOR_BATCH_SIZE)
+        return api_response_handler.create_ndjson_stream_response_v1(cursor)
     
     jobs = list(request.app.pending_inpainting_jobs_collection.find({}))
     for job in jobs:
@@ -351,8 +356,12 @@ def get_list_pending_jobs(request: Request):
             tags=["inpainting jobs"],
             response_model=StandardSuccessResponseV1[ListTask],
             responses=ApiResponseHandlerV1.listErrors([500]))
-def get_list_in_progress_jobs(request: Request):
+def get_list_in_progress_jobs(request: Request,
+                            stream: bool = Query(False, description="Stream the jobs as ndjson, one job per line")):
     api_response_handler = ApiResponseHandlerV1(request)
+    if wants_ndjson_stream(request, stream):
+        cursor = request.app.in_progress_inpainting_jobs_collection.find({}, {"_id": 0}, batch_size=NDJSON_CURSOR_BATCH_SIZE)
+        return api_response_handler.create_ndjson_stream_response_v1(cursor)
     
     jobs = list(request.app.in_progress_inpainting_jobs_collection.find({}))
     for job in jobs:
@@ -371,13 +380,18 @@ def get_list_in_progress_jobs(request: Request):
             responses=ApiResponseHandlerV1.listErrors([500]))
 def get_list_completed_jobs(request: Request, 
                             limit: Optional[int] = Query(10, alias="limit"), 
-                            dataset: Optional[str] = Query(None, alias="dataset")):
+                            dataset: Optional[str] = Query(None, alias="dataset"),
+                            stream: bool = Query(False, description="Stream the jobs as ndjson, one job per line")):
     api_response_handler = ApiResponseHandlerV1(request)
     
     query = {}
     if dataset:
         query["task_input_dict.dataset"] = dataset
 
+    if wants_ndjson_stream(request, stream):
+        cursor = request.app.completed_inpainting_jobs_collection.find(query, {"_id": 0}, batch_size=NDJSON_CURSOR_BATCH_SIZE).limit(limit)
+        return api_response_handler.create_ndjson_stream_response_v1(cursor)
+
     jobs = list(request.app.completed_inpainting_jobs_collection.find(query).limit(limit))
     for job in jobs:
         job.pop('_id', None)
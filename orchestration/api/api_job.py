@@ -2,15 +2,16 @@ import io
 import os
 import sys
 from fastapi import Request, APIRouter, HTTPException, Query, Body
+from fastapi.encoders import jsonable_encoder
 import numpy as np
 import msgpack
-from pymongo import ReplaceOne, UpdateOne, UpdateMany, ASCENDING, DESCENDING
+from pymongo import ReplaceOne, UpdateOne, UpdateMany, ASCENDING, DESCENDING, ReturnDocument
 from utility.path import separate_bucket_and_file_path
 from utility.minio import cmd
 import uuid
 from datetime import datetime, timedelta
 from orchestration.api.mongo_schemas import KandinskyTask, Task, ListSigmaScoreResponse, ListTask, JobInfoResponse, ListTaskV1
-from orchestration.api.api_dataset import get_sequential_id
+from orchestration.api.api_dataset import get_sequential_id, get_sequential_id_async
 import pymongo
 from typing import List
 import json
@@ -20,6 +21,11 @@ import csv
 from .api_utils import ErrorCode, AddJob, WasPresentResponse, ApiResponseHandlerV1, StandardSuccessResponseV1, CountLastHour, CountResponse, insert_into_all_images_for_completed, PrettyJSONResponse, DoneResponse, generate_uuid, check_image_usage, remove_from_additional_collections, delete_files_from_minio
 from bson import ObjectId
 import time
+import asyncio
+from orchestration.api.utils.ndjson_stream import wants_ndjson_stream, NDJSON_CURSOR_BATCH_SIZE
+from orchestration.api.utils.random_sampling import sample_documents_async, add_random_key
+from orchestration.api.utils.api_locks import acquire_lock_async
+from orchestration.api.utils.job_counters import count_job_transition, count_job_transition_async, count_job_scores, get_job_count, get_job_count_async, get_job_counts_by_field_async, get_score_counters_async, sum_counts
 
 
 
@@ -34,33 +40,205 @@ def convert_objectid_to_str(doc):
         doc["_id"] = str(doc["_id"])
     return doc
 
-@router.get("/queue/image-generation/get-job", tags = ['deprecated3'], description= "changed wtih /queue/image-generation/move-job-to-in-progress")
-def get_job(request: Request, task_type=None, model_type="sd_1_5"):
-    # Define the base query
+
+# in-progress jobs must finish or renew their lease before it expires
+# jobs with an expired lease are moved back to the pending queue
+JOB_LEASE_DURATION_SECONDS = 60 * 60
+# how often the expired leases are checked
+JOB_LEASE_CHECK_INTERVAL_SECONDS = 60
+# the leases are checked by one api process, see utils/api_locks.py
+JOB_LEASE_MONITOR_LOCK = "job-lease-monitor"
+JOB_LEASE_MONITOR_LOCK_SECONDS = 5 * JOB_LEASE_CHECK_INTERVAL_SECONDS
+
+# maximum number of jobs a worker can claim in one request
+MAX_CLAIM_JOBS_COUNT = 64
+
+# jobs of these datasets are claimed first
+PRIORITY_DATASETS = ["variants", "test-generations"]
+
+
+def get_job_claim_queries(task_type=None, model_type=None):
     base_query = {}
-    if model_type:
-        base_query["task_type"] = {"$regex": model_type} 
     if task_type:
         base_query["task_type"] = task_type
-    
+    if model_type:
+        base_query["task_type"] = {"$regex": model_type}
+
     # Prioritize jobs where task_input_dict.dataset is "variants"
     priority_query = base_query.copy()
-    priority_query["task_input_dict.dataset"] = {"$in": ["variants", "test-generations"]}
-    
-    job = request.app.pending_jobs_collection.find_one(priority_query, sort=[("task_creation_time", pymongo.ASCENDING)])
-    
-    # If no priority job is found, fallback to the base query
-    if job is None:
-        job = request.app.pending_jobs_collection.find_one(base_query, sort=[("task_creation_time", pymongo.ASCENDING)])
+    priority_query["task_input_dict.dataset"] = {"$in": PRIORITY_DATASETS}
+
+    return [priority_query, base_query]
+
+
+def get_claimable_query(query, now):
+    # pending jobs that are not claimed, or whose claim was interrupted
+    claimable_query = dict(query)
+    claimable_query["$or"] = [{"claim_expiration_time": {"$exists": False}},
+                              {"claim_expiration_time": {"$lt": now}}]
+
+    return claimable_query
+
+
+def prepare_claimed_job(job, now, lease_seconds):
+    job = dict(job)
+    job.pop('_id', None)
+    job.pop('claim_expiration_time', None)
+    job["task_start_time"] = now.isoformat()
+    job["lease_expiration_time"] = now + timedelta(seconds=lease_seconds)
+
+    return job
+
+
+# a claim is one atomic find_one_and_update that sets claim_expiration_time on
+# the pending job, so two workers can never claim the same job. the job is then
+# copied to in-progress by uuid and deleted from pending. if the api stops in
+# between, the pending job is still there and is claimed again once the claim
+# expires, unless its copy already reached in-progress or completed
+def claim_pending_job(request: Request, task_type=None, model_type=None, lease_seconds=JOB_LEASE_DURATION_SECONDS):
+    pending_jobs_collection = request.app.pending_jobs_collection
+    in_progress_jobs_collection = request.app.in_progress_jobs_collection
+
+    for query in get_job_claim_queries(task_type, model_type):
+        while True:
+            now = datetime.now()
+            claim_expiration_time = now + timedelta(seconds=lease_seconds)
+            pending_job = pending_jobs_collection.find_one_and_update(get_claimable_query(query, now),
+                                                                      {"$set": {"claim_expiration_time": claim_expiration_time}},
+                                                                      sort=[("task_creation_time", pymongo.ASCENDING)])
+            if pending_job is None:
+                break
+
+            if "claim_expiration_time" in pending_job and is_job_moved(request.app, pending_job["uuid"]):
+                # an interrupted claim whose job was already moved
+                pending_jobs_collection.delete_one({"_id": pending_job["_id"]})
+                count_job_transition(request.app, pending_job, "pending", "in_progress")
+                continue
+
+            job = prepare_claimed_job(pending_job, now, lease_seconds)
+            in_progress_jobs_collection.replace_one({"uuid": job["uuid"]}, job, upsert=True)
+            pending_jobs_collection.delete_one({"_id": pending_job["_id"]})
+            count_job_transition(request.app, job, "pending", "in_progress")
+            return job
+
+    return None
+
+
+async def claim_pending_job_async(request: Request, task_type=None, model_type=None, lease_seconds=JOB_LEASE_DURATION_SECONDS):
+    # same as claim_pending_job, using the async collections
+    pending_jobs_collection = request.app.async_collections.pending_jobs_collection
+    in_progress_jobs_collection = request.app.async_collections.in_progress_jobs_collection
+
+    for query in get_job_claim_queries(task_type, model_type):
+        while True:
+            now = datetime.now()
+            claim_expiration_time = now + timedelta(seconds=lease_seconds)
+            pending_job = await pending_jobs_collection.find_one_and_update(get_claimable_query(query, now),
+                                                                            {"$set": {"claim_expiration_time": claim_expiration_time}},
+                                                                            sort=[("task_creation_time", pymongo.ASCENDING)])
+            if pending_job is None:
+                break
+
+            if "claim_expiration_time" in pending_job and await is_job_moved_async(request.app, pending_job["uuid"]):
+                await pending_jobs_collection.delete_one({"_id": pending_job["_id"]})
+                await count_job_transition_async(request.app, pending_job, "pending", "in_progress")
+                continue
+
+            job = prepare_claimed_job(pending_job, now, lease_seconds)
+            await in_progress_jobs_collection.replace_one({"uuid": job["uuid"]}, job, upsert=True)
+            await pending_jobs_collection.delete_one({"_id": pending_job["_id"]})
+            await count_job_transition_async(request.app, job, "pending", "in_progress")
+            return job
+
+    return None
+
+
+def is_job_moved(app, job_uuid):
+    # true if the job is in-progress or completed
+    if app.in_progress_jobs_collection.find_one({"uuid": job_uuid}, {"_id": 1}) is not None:
+        return True
+
+    return app.completed_jobs_collection.find_one({"uuid": job_uuid}, {"_id": 1}) is not None
+
+
+async def is_job_moved_async(app, job_uuid):
+    if await app.async_collections.in_progress_jobs_collection.find_one({"uuid": job_uuid}, {"_id": 1}) is not None:
+        return True
+
+    return await app.async_collections.completed_jobs_collection.find_one({"uuid": job_uuid}, {"_id": 1}) is not None
+
+
+async def requeue_expired_job(app, job):
+    # the job is copied to pending before it is deleted from in-progress,
+    # so it is never lost if the api stops in between. the copy is an upsert
+    # by uuid, the next check finishes an interrupted requeue without a duplicate
+    in_progress_jobs_collection = app.async_collections.in_progress_jobs_collection
+    pending_jobs_collection = app.async_collections.pending_jobs_collection
+
+    # an interrupted requeue whose pending copy was claimed again
+    # only the expired in-progress job is left to delete
+    reclaimed_job = await in_progress_jobs_collection.find_one({"uuid": job["uuid"], "_id": {"$ne": job["_id"]}}, {"_id": 1})
+    if reclaimed_job is not None:
+        result = await in_progress_jobs_collection.delete_one({"_id": job["_id"]})
+        if result.deleted_count > 0:
+            await count_job_transition_async(app, job, "in_progress", None)
+        return False
+
+    pending_job = dict(job)
+    pending_job.pop('_id', None)
+    pending_job.pop('lease_expiration_time', None)
+    pending_job.pop('task_start_time', None)
+    pending_job.pop('claim_expiration_time', None)
+    await pending_jobs_collection.replace_one({"uuid": job["uuid"]}, pending_job, upsert=True)
+
+    # only deleted if the lease was not renewed and the job is not completed meanwhile
+    result = await in_progress_jobs_collection.delete_one({"_id": job["_id"],
+                                                           "lease_expiration_time": job["lease_expiration_time"]})
+    if result.deleted_count == 0:
+        await pending_jobs_collection.delete_one({"uuid": job["uuid"]})
+        return False
+
+    await count_job_transition_async(app, job, "in_progress", "pending")
+    return True
+
+
+async def requeue_expired_jobs(app):
+    # moves the in-progress jobs with an expired lease back to pending
+    # jobs claimed before leases existed have no lease and are left alone
+    count = 0
+    now = datetime.now()
+    expired_jobs = app.async_collections.in_progress_jobs_collection.find({"lease_expiration_time": {"$lt": now}})
+    async for job in expired_jobs:
+        if await requeue_expired_job(app, job):
+            count += 1
+
+    return count
+
+
+async def monitor_expired_job_leases(app):
+    while True:
+        try:
+            if await acquire_lock_async(app.async_collections.api_locks_collection,
+                                        JOB_LEASE_MONITOR_LOCK, JOB_LEASE_MONITOR_LOCK_SECONDS):
+                count = await requeue_expired_jobs(app)
+                if count > 0:
+                    print(f"Moved {count} jobs with an expired lease back to pending")
+        except Exception as e:
+            print(f"Error requeuing expired jobs: {e}")
+
+        await asyncio.sleep(JOB_LEASE_CHECK_INTERVAL_SECONDS)
+
+@router.get("/queue/image-generation/get-job", tags = ['deprecated3'], description= "changed wtih /queue/image-generation/move-job-to-in-progress")
+def get_job(request: Request, task_type=None, model_type="sd_1_5"):
+    # task_type takes precedence over model_type in this endpoint
+    if task_type:
+        model_type = None
+
+    job = claim_pending_job(request, task_type=task_type, model_type=model_type)
 
     if job is None:
         raise HTTPException(status_code=204)
 
-    # Proceed with the rest of the endpoint as before
-    request.app.pending_jobs_collection.delete_one({"uuid": job["uuid"]})
-    job.pop('_id', None)
-    job["task_start_time"] = datetime.now().isoformat()
-    request.app.in_progress_jobs_collection.insert_one(job)
     job = convert_objectid_to_str(job)
     
     return job
@@ -86,7 +264,9 @@ def add_job(request: Request, task: Task):
         new_file_path = "{}.jpg".format(sequential_id_arr[0])
         task.task_input_dict["file_path"] = new_file_path
 
-    request.app.pending_jobs_collection.insert_one(task.to_dict())
+    job = task.to_dict()
+    request.app.pending_jobs_collection.insert_one(job)
+    count_job_transition(request.app, job, to_state="pending")
 
     return {"uuid": task.uuid, "creation_time": task.task_creation_time}
 
@@ -130,7 +310,9 @@ def add_job(request: Request, kandinsky_task: KandinskyTask):
 
     cmd.upload_data(request.app.minio_client, "datasets", image_embeddings_path, buffer) 
 
-    request.app.pending_jobs_collection.insert_one(task.to_dict())
+    job = task.to_dict()
+    request.app.pending_jobs_collection.insert_one(job)
+    count_job_transition(request.app, job, to_state="pending")
 
     return {"uuid": task.uuid, "creation_time": task.task_creation_time}
 
@@ -199,25 +381,25 @@ def get_jobs_count_last_n_hour(request: Request, dataset, hours: int):
 # -------------- Get jobs count ----------------------
 @router.get("/queue/image-generation/pending-count", tags = ['deprecated3'], description= "changed with /queue/image-generation/get-pending-jobs-count")
 def get_pending_job_count(request: Request):
-    count = request.app.pending_jobs_collection.count_documents({})
+    count = get_job_count(request.app, "pending")
     return count
 
 
 @router.get("/queue/image-generation/in-progress-count", tags = ['deprecated3'], description= "changed with /queue/image-generation/get-in-progress-jobs-count")
 def get_in_progress_job_count(request: Request):
-    count = request.app.in_progress_jobs_collection.count_documents({})
+    count = get_job_count(request.app, "in_progress")
     return count
 
 
 @router.get("/queue/image-generation/completed-count", tags = ['deprecated3'], description= "changed with /queue/image-generation/get-completed-jobs-count")
 def get_completed_job_count(request: Request):
-    count = request.app.completed_jobs_collection.count_documents({})
+    count = get_job_count(request.app, "completed")
     return count
 
 
 @router.get("/queue/image-generation/failed-count", tags = ['deprecated3'], description= "changed with /queue/image-generation/get-failed-jobs-count")
 def get_failed_job_count(request: Request):
-    count = request.app.failed_jobs_collection.count_documents({})
+    count = get_job_count(request.app, "failed")
     return count
 
 
@@ -227,7 +409,9 @@ def get_failed_job_count(request: Request):
 @router.delete("/queue/image-generation/delete-completed", tags = ['deprecated3'], description= "changed with /queue/image-generation/delete-completed-by-uuid")
 def delete_completed_job(request: Request, uuid):
     query = {"uuid": uuid}
-    request.app.completed_jobs_collection.delete_one(query)
+    job = request.app.completed_jobs_collection.find_one_and_delete(query)
+    if job is not None:
+        count_job_transition(request.app, job, from_state="completed")
 
     return True
 
@@ -296,7 +480,9 @@ async def delete_completed_job(request: Request, uuid: str):
 
         # Finally, delete the image from completed_jobs_collection
         print(f"Removing job with uuid: {uuid} from completed_jobs_collection")
-        request.app.completed_jobs_collection.delete_one({"uuid": uuid})
+        result = request.app.completed_jobs_collection.delete_one({"uuid": uuid})
+        if result.deleted_count > 0:
+            await count_job_transition_async(request.app, job, from_state="completed")
 
         return api_response_handler.create_success_delete_response_v1(
             True,
@@ -494,12 +680,8 @@ def get_list_failed_jobs(request: Request):
 
 @router.get("/queue/image-generation/count-completed", tags = ['deprecated3'], description= "changed with /queue/image-generation/get-completed-jobs-count")
 def count_completed(request: Request, dataset: str = None):
-
-    jobs = list(request.app.completed_jobs_collection.find({
-        'task_input_dict.dataset': dataset
-    }))
-
-    return len(jobs)
+    # without dataset, the count of the jobs that have no dataset
+    return get_job_count(request.app, "completed", dataset=dataset, any_dataset=False)
 
 
 @router.get("/queue/image-generation/count-by-task-type", tags = ['deprecated3'], description= "changed with /queue/image-generation/get-completed-jobs-count")
@@ -507,35 +689,25 @@ def count_by_task_type(request: Request, task_type: str = "image_generation_task
     # Get the completed jobs collection
     completed_jobs_collection = request.app.completed_jobs_collection
 
-    # Define the query to count documents with a specific task_type
-    count = completed_jobs_collection.count_documents({'task_type': task_type})
-
     # Fetch documents with the specified task_type
     documents = completed_jobs_collection.find({'task_type': task_type})
 
     # Convert ObjectId to string for JSON serialization
     documents_list = [{k: str(v) if isinstance(v, ObjectId) else v for k, v in doc.items()} for doc in documents]
 
+    # the documents are all loaded anyway, they give the count
+    count = len(documents_list)
+
     # Return the count and documents
     return PrettyJSONResponse(content={"count": count, "documents": documents_list})
 
 @router.get("/queue/image-generation/count-pending", tags = ['deprecated3'], description= "changed with /queue/image-generation/get-pending-jobs-count")
 def count_completed(request: Request, dataset: str = None):
-
-    jobs = list(request.app.pending_jobs_collection.find({
-        'task_input_dict.dataset': dataset
-    }))
-
-    return len(jobs)
+    return get_job_count(request.app, "pending", dataset=dataset, any_dataset=False)
 
 @router.get("/queue/image-generation/count-in-progress", tags = ['deprecated3'], description= "changed with /queue/image-generation/get-in-progress-jobs-count")
 def count_completed(request: Request, dataset: str = None):
-
-    jobs = list(request.app.in_progress_jobs_collection.find({
-        'task_input_dict.dataset': dataset
-    }))
-
-    return len(jobs)
+    return get_job_count(request.app, "in_progress", dataset=dataset, any_dataset=False)
 
 # ---------------- Update -------------------
 
@@ -588,10 +760,13 @@ def update_job_completed(request: Request, task: Task):
         task_dict["image_uuid"] = image_uuid
 
     # Add the updated task to the completed_jobs_collection
-    request.app.completed_jobs_collection.insert_one(task_dict)
+    request.app.completed_jobs_collection.insert_one(add_random_key(task_dict))
+    count_job_transition(request.app, task_dict, to_state="completed")
 
     # Remove the job from the in-progress collection
-    request.app.in_progress_jobs_collection.delete_one({"uuid": task.uuid})
+    result = request.app.in_progress_jobs_collection.delete_one({"uuid": task.uuid})
+    if result.deleted_count > 0:
+        count_job_transition(request.app, job, from_state="in_progress")
 
     return True
 
@@ -605,10 +780,14 @@ def update_job_failed(request: Request, task: Task):
         return False
 
     # add to failed
-    request.app.failed_jobs_collection.insert_one(task.to_dict())
+    task_dict = task.to_dict()
+    request.app.failed_jobs_collection.insert_one(task_dict)
+    count_job_transition(request.app, task_dict, to_state="failed")
 
     # remove from in progress
-    request.app.in_progress_jobs_collection.delete_one({"uuid": task.uuid})
+    result = request.app.in_progress_jobs_collection.delete_one({"uuid": task.uuid})
+    if result.deleted_count > 0:
+        count_job_transition(request.app, job, from_state="in_progress")
 
     return True
 
@@ -627,7 +806,9 @@ def cleanup_completed_and_orphaned_jobs(request: Request):
 
         if not file_exists:
             # remove from in progress
-            request.app.completed_jobs_collection.delete_one({"uuid": job['uuid']})
+            result = request.app.completed_jobs_collection.delete_one({"uuid": job['uuid']})
+            if result.deleted_count > 0:
+                count_job_transition(request.app, job, from_state="completed")
 
     return True
 
@@ -805,14 +986,22 @@ def add_attributes_job_completed(
         f"task_attributes_dict.{model_type}.delta_sigma_score": delta_sigma_score
     }}
 
-    result = request.app.completed_jobs_collection.update_one(query, update_query)
+    # the job before the update, to move the score counters
+    job = request.app.completed_jobs_collection.find_one_and_update(
+        query, update_query,
+        projection={"task_type": 1, "task_input_dict.dataset": 1, f"task_attributes_dict.{model_type}": 1},
+        return_document=ReturnDocument.BEFORE)
 
-    if result.matched_count == 0:
+    if job is None:
         raise HTTPException(status_code=404, detail="Job not found")
-    
-    if result.modified_count == 0:
+
+    new_attributes = {key.rsplit(".", 1)[1]: value for key, value in update_query["$set"].items()}
+    old_attributes = ((job.get("task_attributes_dict") or {}).get(model_type)) or {}
+    if all(old_attributes.get(key) == value for key, value in new_attributes.items()):
         raise HTTPException(status_code=304, detail="Job not updated, possibly no change in data")
 
+    count_job_scores(request.app, job, model_type, new_attributes)
+
     return {"message": "Job attributes updated successfully."}
 
 
@@ -933,48 +1122,38 @@ def add_attributes_job_completed(
         f"task_attributes_dict.{model_type}.delta_sigma_score": delta_sigma_score
     }}
 
-    result = request.app.completed_jobs_collection.update_one(query, update_query)
+    # the job before the update, to move the score counters
+    job = request.app.completed_jobs_collection.find_one_and_update(
+        query, update_query,
+        projection={"task_type": 1, "task_input_dict.dataset": 1, f"task_attributes_dict.{model_type}": 1},
+        return_document=ReturnDocument.BEFORE)
 
-    if result.matched_count == 0:
+    if job is None:
         raise HTTPException(status_code=404, detail="Job not found")
-    
-    if result.modified_count == 0:
+
+    new_attributes = {key.rsplit(".", 1)[1]: value for key, value in update_query["$set"].items()}
+    old_attributes = ((job.get("task_attributes_dict") or {}).get(model_type)) or {}
+    if all(old_attributes.get(key) == value for key, value in new_attributes.items()):
         raise HTTPException(status_code=304, detail="Job not updated, possibly no change in data")
 
+    count_job_scores(request.app, job, model_type, new_attributes)
+
     return {"message": "Job attributes updated successfully."}
 
 
 @router.get("/queue/image-generation/score-counts", response_class=PrettyJSONResponse)
-def get_image_score_counts(request: Request):
-    # Fetch all jobs
-    jobs = list(request.app.completed_jobs_collection.find({}))
-    
-    # Initialize counts
-    counts = {
-        'linear': {'more_than_0': 0, 'more_than_1': 0, 'more_than_2': 0, 'more_than_3': 0, 'total': 0},
-        'elm-v1': {'more_than_0': 0, 'more_than_1': 0, 'more_than_2': 0, 'more_than_3': 0, 'total': 0}
-    }
-    
-    # Iterate through jobs to count based on image_clip_sigma_score
-    for job in jobs:
-        task_attributes_dict = job.get('task_attributes_dict')
-        # Check if task_attributes_dict is None or if 'linear' or 'elm-v1' keys are missing
-        if task_attributes_dict is None or not ('linear' in task_attributes_dict and 'elm-v1' in task_attributes_dict):
-            continue
-
-        # Now safe to assume 'task_attributes_dict' is not None and contains 'linear' and 'elm-v1'
-        for model_type in ['linear', 'elm-v1']:
-            score = task_attributes_dict[model_type].get("image_clip_sigma_score", None)
-            if score is not None:
-                counts[model_type]['total'] += 1
-                if score > 0:
-                    counts[model_type]['more_than_0'] += 1
-                if score > 1:
-                    counts[model_type]['more_than_1'] += 1
-                if score > 2:
-                    counts[model_type]['more_than_2'] += 1
-                if score > 3:
-                    counts[model_type]['more_than_3'] += 1
+async def get_image_score_counts(request: Request):
+    # read from the job score counters, each model type is counted on its own
+    counts = {}
+    for model_type in ['linear', 'elm-v1']:
+        counters = await get_score_counters_async(request.app, "image_clip_sigma_score", model_type=model_type)
+        counts[model_type] = {
+            'more_than_0': sum_counts(counters, 'more_than_0'),
+            'more_than_1': sum_counts(counters, 'more_than_1'),
+            'more_than_2': sum_counts(counters, 'more_than_2'),
+            'more_than_3': sum_counts(counters, 'more_than_3'),
+            'total': sum_counts(counters)
+        }
     
     # Return the counts
     return {'counts': counts}
@@ -982,31 +1161,11 @@ def get_image_score_counts(request: Request):
 
 @router.get("/queue/image-generation/pending-count-task-type", response_class=PrettyJSONResponse)
 async def get_pending_job_count_task_type(request: Request):
-    # MongoDB aggregation pipeline to group by `task_type` and count occurrences
-    aggregation_pipeline = [
-        {
-            "$group": {
-                "_id": "$task_type",
-                "count": {"$sum": 1}
-            }
-        },
-        {
-            "$project": {
-                "_id": 0,
-                "task_type": "$_id",
-                "count": 1
-            }
-        },
-        {
-            "$sort": {"task_type": 1}
-        }
-    ]
-    
-    cursor = request.app.pending_jobs_collection.aggregate(aggregation_pipeline)
-    results = list(cursor)
-    
-    # Transform the results to match the expected output
-    formatted_results = [{"task_type": result["task_type"], "count": result["count"]} for result in results]
+    # read from the job counters, the counters of task types without pending jobs are 0
+    counts = await get_job_counts_by_field_async(request.app, "pending", "task_type")
+
+    formatted_results = [{"task_type": task_type, "count": count} for task_type, count in counts.items() if count > 0]
+    formatted_results.sort(key=lambda result: str(result["task_type"]))
     
     return formatted_results
 
@@ -1045,26 +1204,13 @@ async def get_dataset_image_clip_h_sigma_score_count(request: Request):
                          "character", "environmental", "external-images",
                            "icons", "mech", "test-generations", "variants" ]  # This needs to be defined, either from a query or a predefined list
 
-    aggregation_pipeline = [
-        {
-            "$match": {
-                "task_type": "img2img_generation_kandinsky",
-                "task_attributes_dict.elm-v1.image_clip_h_sigma_score": {"$exists": True}
-            }
-        },
-        {
-            "$group": {
-                "_id": "$task_input_dict.dataset",
-                "count": {"$sum": 1}
-            }
-        }
-    ]
-
-    cursor = request.app.completed_jobs_collection.aggregate(aggregation_pipeline)
-    results = list(cursor)
+    # read from the job score counters
+    counters = await get_score_counters_async(request.app, "image_clip_h_sigma_score",
+                                              model_type="elm-v1", task_type="img2img_generation_kandinsky")
 
-    # Convert aggregation results into a dictionary for easy lookup
-    results_dict = {result["_id"]: result["count"] for result in results}
+    results_dict = {}
+    for counter in counters:
+        results_dict[counter.get("dataset")] = results_dict.get(counter.get("dataset"), 0) + max(counter.get("count", 0), 0)
 
     # Prepare final results, ensuring all datasets are included with a default count of 0
     formatted_results = [{"dataset": dataset, "count": results_dict.get(dataset, 0)} for dataset in all_datasets_list]
@@ -1178,24 +1324,11 @@ async def find_last_duplicate_uuid(request: Request):
             description="add job in in-progress",
             response_model=StandardSuccessResponseV1[Task],
             responses=ApiResponseHandlerV1.listErrors([400, 422, 500]))
-async def get_job(request: Request, task_type=None, model_type="sd_1_5"):
+async def get_job(request: Request, task_type=None, model_type="sd_1_5",
+                  lease_seconds: int = Query(JOB_LEASE_DURATION_SECONDS, ge=1, description="Seconds until the job is moved back to pending if it is not completed or renewed")):
     api_response_handler = await ApiResponseHandlerV1.createInstance(request)
 
-    base_query = {}
-    if task_type:
-        base_query["task_type"] = task_type
-    if model_type:
-        base_query["task_type"] = {"$regex": model_type} 
-    
-    # Prioritize jobs where task_input_dict.dataset is "variants"
-    priority_query = base_query.copy()
-    priority_query["task_input_dict.dataset"] = {"$in": ["variants", "test-generations"]}
-    
-    job = request.app.pending_jobs_collection.find_one(priority_query, sort=[("task_creation_time", pymongo.ASCENDING)])
-    
-    # If no priority job is found, fallback to the base query
-    if job is None:
-        job = request.app.pending_jobs_collection.find_one(base_query, sort=[("task_creation_time", pymongo.ASCENDING)])
+    job = await claim_pending_job_async(request, task_type=task_type, model_type=model_type, lease_seconds=lease_seconds)
 
     if job is None:
         return api_response_handler.create_error_response_v1(
@@ -1204,12 +1337,8 @@ async def get_job(request: Request, task_type=None, model_type="sd_1_5"):
             http_status_code=404
         )
 
-    # Proceed with the rest of the endpoint as before
-    request.app.pending_jobs_collection.delete_one({"uuid": job["uuid"]})
-    job.pop('_id', None)
-    job["task_start_time"] = datetime.now().isoformat()
-    request.app.in_progress_jobs_collection.insert_one(job)
     job = convert_objectid_to_str(job)
+    job["lease_expiration_time"] = job["lease_expiration_time"].isoformat()
     
     return api_response_handler.create_success_response_v1(
                 response_data=job,
@@ -1217,6 +1346,38 @@ async def get_job(request: Request, task_type=None, model_type="sd_1_5"):
             )
     
 
+@router.get("/queue/image-generation/claim-jobs",
+            status_code=200,
+            tags=["jobs-standardized"],
+            description="Moves up to 'count' pending jobs to in-progress and returns them. Each job is claimed atomically, so a job is never returned to two workers. Returns an empty list if there are no pending jobs.",
+            response_model=StandardSuccessResponseV1[ListTask],
+            responses=ApiResponseHandlerV1.listErrors([400, 422, 500]))
+async def claim_jobs(request: Request, task_type=None, model_type="sd_1_5",
+                     count: int = Query(1, ge=1, le=MAX_CLAIM_JOBS_COUNT, description="Maximum number of jobs to claim"),
+                     lease_seconds: int = Query(JOB_LEASE_DURATION_SECONDS, ge=1, description="Seconds until a job is moved back to pending if it is not completed or renewed")):
+    api_response_handler = await ApiResponseHandlerV1.createInstance(request)
+
+    try:
+        jobs = []
+        for _ in range(count):
+            job = await claim_pending_job_async(request, task_type=task_type, model_type=model_type, lease_seconds=lease_seconds)
+            if job is None:
+                break
+            jobs.append(convert_objectid_to_str(job))
+
+        return api_response_handler.create_success_response_v1(
+                    response_data={"jobs": jsonable_encoder(jobs)},
+                    http_status_code=200
+                )
+
+    except Exception as e:
+        return api_response_handler.create_error_response_v1(
+            error_code=ErrorCode.OTHER_ERROR,
+            error_string=str(e),
+            http_status_code=500
+        )
+
+
 @router.post("/queue/image-generation/add-job",
     description="Adds an image generation job to the pending queue. If no UUID is provided, an UUID is generated automatically. If no file path is provided, or the provided file path is \"\", '[auto]' or '[default]', the file path is generated automatically.",
     status_code=200,
@@ -1250,12 +1411,14 @@ async def add_job(request: Request, task: Task):
         # If dataset is provided, generate the new file path
         if requires_dataset and "dataset" in task.task_input_dict:
             dataset_name = task.task_input_dict["dataset"]
-            sequential_id_arr = get_sequential_id(request, dataset=dataset_name)
+            sequential_id_arr = await get_sequential_id_async(request, dataset=dataset_name)
             new_file_path = "{}.jpg".format(sequential_id_arr[0])
             task.task_input_dict["file_path"] = new_file_path
 
         # Insert task into pending_jobs_collection
-        request.app.pending_jobs_collection.insert_one(task.dict())
+        job = task.dict()
+        await request.app.async_collections.pending_jobs_collection.insert_one(job)
+        await count_job_transition_async(request.app, job, to_state="pending")
 
         # Convert datetime to ISO 8601 formatted string for JSON serialization
         creation_time_iso = task.task_creation_time.isoformat() if task.task_creation_time else None
@@ -1327,7 +1490,9 @@ async def add_job(request: Request, kandinsky_task: KandinskyTask):
 
         cmd.upload_data(request.app.minio_client, "datasets", image_embeddings_path, buffer) 
 
-        request.app.pending_jobs_collection.insert_one(task.to_dict())
+        job = task.to_dict()
+        request.app.pending_jobs_collection.insert_one(job)
+        count_job_transition(request.app, job, to_state="pending")
 
         creation_time_iso = task.task_creation_time.isoformat() if task.task_creation_time else None
 
@@ -1387,27 +1552,38 @@ async def get_jobs_count_last_n_hour(request: Request, dataset: str, hours: int
  
     
 
+def format_job_times(job):
+    job['task_creation_time'] = job['task_creation_time'].isoformat()
+    job['task_start_time'] = (
+        job['task_start_time'].isoformat() 
+        if isinstance(job['task_start_time'], datetime) 
+        else None
+    )
+    job['task_completion_time'] = (
+        job['task_completion_time'].isoformat() 
+        if isinstance(job['task_completion_time'], datetime) 
+        else None
+    )
+    return job
+
+
 @router.get("/queue/image-generation/list-pending-jobs", 
             response_model=StandardSuccessResponseV1[ListTask],
             status_code = 200,
-            tags=["jobs-standardized"])
-async def get_list_pending_jobs(request: Request):
+            tags=["jobs-standardized"],
+            description="List all pending jobs. With stream=true the jobs are streamed as ndjson, one job per line")
+async def get_list_pending_jobs(request: Request,
+                                stream: bool = Query(False, description="Stream the jobs as ndjson")):
     response_handler = await ApiResponseHandlerV1.createInstance(request)
+    if wants_ndjson_stream(request, stream):
+        cursor = request.app.async_collections.pending_jobs_collection.find({}, {"_id": 0}, batch_size=NDJSON_CURSOR_BATCH_SIZE)
+        return response_handler.create_ndjson_stream_response_v1(cursor, transform=format_job_times)
+
     jobs = list(request.app.pending_jobs_collection.find({}))
 
     for job in jobs:
         job.pop('_id', None)
-        job['task_creation_time'] = job['task_creation_time'].isoformat()
-        job['task_start_time'] = (
-            job['task_start_time'].isoformat() 
-            if isinstance(job['task_start_time'], datetime) 
-            else None
-        )
-        job['task_completion_time'] = (
-            job['task_completion_time'].isoformat() 
-            if isinstance(job['task_completion_time'], datetime) 
-            else None
-        )
+        format_job_times(job)
 
     return response_handler.create_success_response_v1(response_data={"jobs": jobs}, http_status_code=200)
 
@@ -1415,24 +1591,20 @@ async def get_list_pending_jobs(request: Request):
 @router.get("/queue/image-generation/list-in-progress-jobs", 
             response_model=StandardSuccessResponseV1[ListTask],
             status_code = 200,
-            tags=["jobs-standardized"])
-async def get_list_in_progress_jobs(request: Request):
+            tags=["jobs-standardized"],
+            description="List all in progress jobs. With stream=true the jobs are streamed as ndjson, one job per line")
+async def get_list_in_progress_jobs(request: Request,
+                                    stream: bool = Query(False, description="Stream the jobs as ndjson")):
     response_handler = await ApiResponseHandlerV1.createInstance(request)
+    if wants_ndjson_stream(request, stream):
+        cursor = request.app.async_collections.in_progress_jobs_collection.find({}, {"_id": 0}, batch_size=NDJSON_CURSOR_BATCH_SIZE)
+        return response_handler.create_ndjson_stream_response_v1(cursor, transform=format_job_times)
+
     jobs = list(request.app.in_progress_jobs_collection.find({}))
 
     for job in jobs:
         job.pop('_id', None)
-        job['task_creation_time'] = job['task_creation_time'].isoformat()
-        job['task_start_time'] = (
-            job['task_start_time'].isoformat() 
-            if isinstance(job['task_start_time'], datetime) 
-            else None
-        )
-        job['task_completion_time'] = (
-            job['task_completion_time'].isoformat() 
-            if isinstance(job['task_completion_time'], datetime) 
-            else None
-        )
+        format_job_times(job)
 
     return response_handler.create_success_response_v1(response_data={"jobs": jobs}, http_status_code=200)
 
@@ -1446,7 +1618,8 @@ async def get_list_completed_jobs(
     request: Request,
     task_type: Optional[str] = Query(None, description="Filter jobs by task type"),
     dataset: Optional[str] = Query(None, description="Filter jobs by dataset"),
-    limit: int = Query(10, description="Limit on the number of results returned", alias="limit")
+    limit: int = Query(10, description="Limit on the number of results returned", alias="limit"),
+    stream: bool = Query(False, description="Stream the jobs as ndjson, one job per line")
 ):
     response_handler = await ApiResponseHandlerV1.createInstance(request)
     
@@ -1457,6 +1630,10 @@ async def get_list_completed_jobs(
     if dataset:
         query["task_input_dict.dataset"] = dataset
 
+    if wants_ndjson_stream(request, stream):
+        cursor = request.app.async_collections.completed_jobs_collection.find(query, {"_id": 0}, batch_size=NDJSON_CURSOR_BATCH_SIZE).limit(limit)
+        return response_handler.create_ndjson_stream_response_v1(cursor)
+
     # Retrieve jobs from the completed jobs collection based on the constructed query and limit
     jobs = list(request.app.completed_jobs_collection.find(query).limit(limit))
 
@@ -1469,9 +1646,15 @@ async def get_list_completed_jobs(
 @router.get("/queue/image-generation/list-failed-jobs", 
             response_model=StandardSuccessResponseV1[ListTask],
             status_code = 200,
-            tags=["jobs-standardized"])
-async def get_list_failed_jobs(request: Request):
+            tags=["jobs-standardized"],
+            description="List all failed jobs. With stream=true the jobs are streamed as ndjson, one job per line")
+async def get_list_failed_jobs(request: Request,
+                               stream: bool = Query(False, description="Stream the jobs as ndjson")):
     response_handler = await ApiResponseHandlerV1.createInstance(request)
+    if wants_ndjson_stream(request, stream):
+        cursor = request.app.async_collections.failed_jobs_collection.find({}, {"_id": 0}, batch_size=NDJSON_CURSOR_BATCH_SIZE)
+        return response_handler.create_ndjson_stream_response_v1(cursor)
+
     jobs = list(request.app.failed_jobs_collection.find({}))
 
     for job in jobs:
@@ -1581,14 +1764,8 @@ async def get_list_completed_jobs_by_dataset(
         if min_clip_sigma_score is not None:
             query[f"task_attributes_dict.{model_type}.image_clip_sigma_score"] = {"$gte": min_clip_sigma_score}
 
-        # Use $match and $sample to filter documents based on query and randomly select a specified sampling_size of documents
-        documents = request.app.completed_jobs_collection.aggregate([
-            {"$match": query},
-            {"$sample": {"size": sampling_size}}
-        ])
-
-        # Convert cursor type to list
-        jobs = list(documents)    
+        # random range seeks on the indexed random key instead of $sample over every matching job
+        jobs = await sample_documents_async(request.app.async_collections.completed_jobs_collection, query, sampling_size)
 
         datasets = []
         for job in jobs:
@@ -1626,8 +1803,7 @@ async def get_list_completed_jobs_by_dataset(
             responses=ApiResponseHandlerV1.listErrors([422]))
 async def count_completed(request: Request, dataset: Optional[str] = None, task_type: Optional[str] = None):
     response_handler = await ApiResponseHandlerV1.createInstance(request)
-    query = {'task_input_dict.dataset': dataset, 'task_type': task_type} if dataset and task_type else {'task_input_dict.dataset': dataset} if dataset else {'task_type': task_type} if task_type else {}
-    count = request.app.completed_jobs_collection.count_documents(query)
+    count = await get_job_count_async(request.app, "completed", dataset=dataset, task_type=task_type)
     
     return response_handler.create_success_response_v1(response_data={"count": count}, http_status_code=200)
 
@@ -1639,8 +1815,7 @@ async def count_completed(request: Request, dataset: Optional[str] = None, task_
             responses=ApiResponseHandlerV1.listErrors([422]))
 async def count_pending(request: Request, dataset: Optional[str] = None):
     response_handler = await ApiResponseHandlerV1.createInstance(request)
-    query = {'task_input_dict.dataset': dataset} if dataset else {}
-    count = request.app.pending_jobs_collection.count_documents(query)
+    count = await get_job_count_async(request.app, "pending", dataset=dataset)
     
     return response_handler.create_success_response_v1(response_data={"count": count}, http_status_code=200)
 
@@ -1653,8 +1828,7 @@ async def count_pending(request: Request, dataset: Optional[str] = None):
             responses=ApiResponseHandlerV1.listErrors([422]))
 async def count_in_progress(request: Request, dataset: Optional[str] = None):
     response_handler = await ApiResponseHandlerV1.createInstance(request)
-    query = {'task_input_dict.dataset': dataset} if dataset else {}
-    count = request.app.in_progress_jobs_collection.count_documents(query)
+    count = await get_job_count_async(request.app, "in_progress", dataset=dataset)
     
     return response_handler.create_success_response_v1(response_data={"count": count}, http_status_code=200)
 
@@ -1665,8 +1839,7 @@ async def count_in_progress(request: Request, dataset: Optional[str] = None):
             tags=["jobs-standardized"])
 async def get_failed_job_count(request: Request,  dataset: Optional[str] = None):
     response_handler = await ApiResponseHandlerV1.createInstance(request)
-    query = {'task_input_dict.dataset': dataset} if dataset else {}
-    count = request.app.failed_jobs_collection.count_documents(query)
+    count = await get_job_count_async(request.app, "failed", dataset=dataset)
 
     return response_handler.create_success_response_v1(response_data={"count": count}, http_status_code=200)
 
@@ -1712,11 +1885,15 @@ async def update_job_completed(request: Request, uuid: str):
         if image_uuid:
             job["image_uuid"] = image_uuid
 
+        job.pop("lease_expiration_time", None)
+
         # Move the job to the completed jobs collection with the new image_uuid
-        request.app.completed_jobs_collection.insert_one(job)
+        request.app.completed_jobs_collection.insert_one(add_random_key(job))
 
         # Remove the job from the in-progress collection
-        request.app.in_progress_jobs_collection.delete_one({"uuid": uuid})
+        result = request.app.in_progress_jobs_collection.delete_one({"uuid": uuid})
+        from_state = "in_progress" if result.deleted_count > 0 else None
+        await count_job_transition_async(request.app, job, from_state, "completed")
 
         return response_handler.create_success_response_v1(
             response_data={"Done": True},
@@ -1751,8 +1928,11 @@ async def update_job_failed(request: Request, uuid: str):
             )
 
         # Move the job to the failed jobs collection and delete it from in-progress
+        job.pop("lease_expiration_time", None)
         request.app.failed_jobs_collection.insert_one(job)  # Save the existing job data
-        request.app.in_progress_jobs_collection.delete_one({"uuid":uuid})
+        result = request.app.in_progress_jobs_collection.delete_one({"uuid":uuid})
+        from_state = "in_progress" if result.deleted_count > 0 else None
+        await count_job_transition_async(request.app, job, from_state, "failed")
 
         # Return a success response indicating the job was marked as failed
         return response_handler.create_success_response_v1(
@@ -1767,6 +1947,40 @@ async def update_job_failed(request: Request, uuid: str):
             http_status_code=500,
         )
 
+@router.put("/queue/image-generation/renew-job-lease",
+            response_model=StandardSuccessResponseV1[DoneResponse],
+            status_code=200,
+            tags=["jobs-standardized"],
+            description="Extends the lease of an in-progress job. Jobs whose lease expires are moved back to the pending queue.",
+            responses=ApiResponseHandlerV1.listErrors([404, 422, 500]))
+async def renew_job_lease(request: Request, uuid: str,
+                          lease_seconds: int = Query(JOB_LEASE_DURATION_SECONDS, ge=1, description="Seconds from now until the lease expires")):
+    response_handler = await ApiResponseHandlerV1.createInstance(request)
+    try:
+        lease_expiration_time = datetime.now() + timedelta(seconds=lease_seconds)
+        result = await request.app.async_collections.in_progress_jobs_collection.update_one(
+            {"uuid": uuid},
+            {"$set": {"lease_expiration_time": lease_expiration_time}})
+
+        if result.matched_count == 0:
+            return response_handler.create_error_response_v1(
+                error_code=ErrorCode.ELEMENT_NOT_FOUND,
+                error_string="Job not found",
+                http_status_code=404,
+            )
+
+        return response_handler.create_success_response_v1(
+            response_data={"Done": True},
+            http_status_code=200,
+        )
+
+    except Exception as e:
+        return response_handler.create_error_response_v1(
+            error_code=ErrorCode.OTHER_ERROR,
+            error_string=f"Failed to renew job lease: {str(e)}",
+            http_status_code=500,
+        )
+
 @router.delete("/queue/image-generation/remove-all-orphaned-completed-jobs", 
                response_model=StandardSuccessResponseV1[CountResponse],
                status_code=200,
@@ -1787,7 +2001,9 @@ async def cleanup_completed_and_orphaned_jobs(request: Request):
                 file_exists = False
 
             if not file_exists:
-                request.app.completed_jobs_collection.delete_one({"uuid": job['uuid']})
+                result = request.app.completed_jobs_collection.delete_one({"uuid": job['uuid']})
+                if result.deleted_count > 0:
+                    await count_job_transition_async(request.app, job, from_state="completed")
                 count_removed += 1  
 
         # Using WasPresentResponse model to indicate if any jobs were removed
@@ -1,38 +1,59 @@
+import asyncio
 from datetime import datetime, timedelta
 from fastapi import Request, APIRouter, Query
 from utility.minio import cmd
 from .api_utils import  ErrorCode, ApiResponseHandlerV1, StandardSuccessResponseV1, JobStatsResponse, ListGenerationsCountPerDayResponse
 from dateutil.parser import parse
+from orchestration.api.utils.job_counters import get_job_counts_async, get_completed_counts_per_day_async
 
 router = APIRouter()
 
+# task types counted as generated images
+GENERATION_TASK_TYPES = [
+    'image_generation_sd_1_5',
+    'inpainting_sd_1_5',
+    'image_generation_kandinsky',
+    'inpainting_kandinsky',
+    'img2img_generation_kandinsky'
+]
+
+
+def get_job_stats(counts):
+    # counts is {state: count} from the job counters
+    return {
+        'total': sum(counts.values()),
+        'pending_count': counts['pending'],
+        'progress_count': counts['in_progress'],
+        'completed_count': counts['completed'],
+        'failed_count': counts['failed']
+    }
+
+
+async def get_generations_count_by_day(request: Request, start_date, end_date):
+    # {day: {dataset: count}} from the completed job counters, every dataset of the bucket is listed
+    # the minio client is blocking, it runs in the thread pool
+    loop = asyncio.get_event_loop()
+    datasets = await loop.run_in_executor(None, cmd.get_list_of_objects, request.app.minio_client, "datasets")
+    counts = await get_completed_counts_per_day_async(request.app, start_date.strftime("%Y-%m-%d"),
+                                                      end_date.strftime("%Y-%m-%d"), GENERATION_TASK_TYPES)
+
+    num_by_dataset_and_day = {}
+    current_date = start_date
+    while current_date <= end_date:
+        day = current_date.strftime("%Y-%m-%d")
+        num_by_dataset_and_day[day] = {dataset: counts.get(day, {}).get(dataset, 0) for dataset in datasets}
+        current_date += timedelta(days=1)
+
+    return num_by_dataset_and_day
+
+
 # get job stats by job type
 @router.get("/job_stats/stats_by_job_type",
             tags=['deprecated3'],
             description="changed with /queue/image-generation/get-job-counts-by-type")
-def get_job_stats_by_job_type(request: Request, job_type: str = Query(...)):
-    pending_count = request.app.pending_jobs_collection.count_documents({
-        'task_type': job_type
-    })
-    
-    progress_count = request.app.in_progress_jobs_collection.count_documents({
-        'task_type': job_type
-    })
-
-    completed_count = request.app.completed_jobs_collection.count_documents({
-        'task_type': job_type
-    })
-
-    failed_count = request.app.failed_jobs_collection.count_documents({
-        'task_type': job_type
-    })
-    return {
-            'total': pending_count +  progress_count + completed_count + failed_count,
-            'pending_count': pending_count,
-            'progress_count': progress_count,
-            'completed_count': completed_count,
-            'failed_count': failed_count
-    }
+async def get_job_stats_by_job_type(request: Request, job_type: str = Query(...)):
+    counts = await get_job_counts_async(request.app, task_type=job_type)
+    return get_job_stats(counts)
 
 
 @router.get("/queue/image-generation/get-job-counts-by-type",
@@ -43,20 +64,8 @@ def get_job_stats_by_job_type(request: Request, job_type: str = Query(...)):
 async def get_job_stats_by_job_type(request: Request, job_type: str = Query(..., description="Type of job to get statistics for")):
     response_handler = await ApiResponseHandlerV1.createInstance(request)
     try:
-        pending_count = request.app.pending_jobs_collection.count_documents({'task_type': job_type})
-        progress_count = request.app.in_progress_jobs_collection.count_documents({'task_type': job_type})
-        completed_count = request.app.completed_jobs_collection.count_documents({'task_type': job_type})
-        failed_count = request.app.failed_jobs_collection.count_documents({'task_type': job_type})
-
-        total_count = pending_count + progress_count + completed_count + failed_count
-        
-        stats = {
-            'total': total_count,
-            'pending_count': pending_count,
-            'progress_count': progress_count,
-            'completed_count': completed_count,
-            'failed_count': failed_count
-        }
+        counts = await get_job_counts_async(request.app, task_type=job_type)
+        stats = get_job_stats(counts)
         
         return response_handler.create_success_response_v1(response_data=stats, http_status_code=200)
     except Exception as e:
@@ -68,29 +77,9 @@ async def get_job_stats_by_job_type(request: Request, job_type: str = Query(...,
 
 # get job stats by dataset
 @router.get("/job_stats/stats_by_dataset", tags = ['deprecated3'], description="changed with /queue/image-generation/get-job-counts-by-dataset")
-def get_job_stats_by_job_type(request: Request, dataset: str = Query(...)):
-    pending_count = request.app.pending_jobs_collection.count_documents({
-        "task_input_dict.dataset": dataset
-    })
-    
-    progress_count = request.app.in_progress_jobs_collection.count_documents({
-        "task_input_dict.dataset": dataset
-    })
-
-    completed_count = request.app.completed_jobs_collection.count_documents({
-        "task_input_dict.dataset": dataset
-    })
-
-    failed_count = request.app.failed_jobs_collection.count_documents({
-        "task_input_dict.dataset": dataset
-    })
-    return {
-            'total': pending_count +  progress_count + completed_count + failed_count,
-            'pending_count': pending_count,
-            'progress_count': progress_count,
-            'completed_count': completed_count,
-            'failed_count': failed_count
-    }
+async def get_job_stats_by_job_type(request: Request, dataset: str = Query(...)):
+    counts = await get_job_counts_async(request.app, dataset=dataset)
+    return get_job_stats(counts)
 
 @router.get("/queue/image-generation/get-job-counts-by-dataset",
             description="Get job counts by dataset",
@@ -100,31 +89,8 @@ def get_job_stats_by_job_type(request: Request, dataset: str = Query(...)):
 async def get_job_counts_by_dataset(request: Request, dataset: str = Query(..., description="Dataset to get job counts for")):
     response_handler = await ApiResponseHandlerV1.createInstance(request)
     try:
-        pending_count = request.app.pending_jobs_collection.count_documents({
-            "task_input_dict.dataset": dataset
-        })
-
-        progress_count = request.app.in_progress_jobs_collection.count_documents({
-            "task_input_dict.dataset": dataset
-        })
-
-        completed_count = request.app.completed_jobs_collection.count_documents({
-            "task_input_dict.dataset": dataset
-        })
-
-        failed_count = request.app.failed_jobs_collection.count_documents({
-            "task_input_dict.dataset": dataset
-        })
-
-        total_count = pending_count + progress_count + completed_count + failed_count
-
-        stats = {
-            'total': total_count,
-            'pending_count': pending_count,
-            'progress_count': progress_count,
-            'completed_count': completed_count,
-            'failed_count': failed_count
-        }
+        counts = await get_job_counts_async(request.app, dataset=dataset)
+        stats = get_job_stats(counts)
 
         return response_handler.create_success_response_v1(response_data=stats, http_status_code=200)
     except Exception as e:
@@ -136,47 +102,12 @@ async def get_job_counts_by_dataset(request: Request, dataset: str = Query(...,
 
 
 @router.get("/job_stats/get_generated_images_per_day", tags = ['deprecated3'], description="changed with /queue/image-generation/get-generations-count-per-day")
-def get_number_generated_images_per_day(request: Request, start_date: str = Query(...), end_date: str = Query(...)):
+async def get_number_generated_images_per_day(request: Request, start_date: str = Query(...), end_date: str = Query(...)):
     # Convert the date strings to datetime objects
     start_date = parse(start_date)
     end_date = parse(end_date)
 
-    # Initialize the result dictionary
-    num_by_dataset_and_day = {}
-
-    # Iterate through each day within the date range
-    current_date = start_date
-    while current_date <= end_date:
-        print(current_date + timedelta(days=1))
-        # Construct the query for the current day
-        query = {
-            '$or': [
-                {'task_type': 'image_generation_sd_1_5'},
-                {'task_type': 'inpainting_sd_1_5'},
-                {'task_type': 'image_generation_kandinsky'},
-                {'task_type': 'inpainting_kandinsky'},
-                {'task_type': 'img2img_generation_kandinsky'}
-            ],
-            'task_completion_time': {
-                '$gte': current_date.strftime("%Y-%m-%d %H:%M:%S"),
-                '$lte': (current_date + timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S")
-            }
-        }
-        
-        num_by_dataset = {}
-        datasets = cmd.get_list_of_objects(request.app.minio_client, "datasets")
-        for dataset in datasets:
-            query['task_input_dict.dataset'] = dataset
-            num_images = request.app.completed_jobs_collection.count_documents(query)
-            num_by_dataset[dataset] = num_images
-
-        # Store the result for the current day in the dictionary
-        num_by_dataset_and_day[current_date.strftime("%Y-%m-%d")] = num_by_dataset
-
-        # Move to the next day
-        current_date += timedelta(days=1)
-
-    return num_by_dataset_and_day
+    return await get_generations_count_by_day(request, start_date, end_date)
 
 
 @router.get("/queue/image-generation/get-generations-count-per-day",
@@ -195,39 +126,8 @@ async def get_generations_count_per_day(
         start_date_dt = parse(start_date)
         end_date_dt = parse(end_date)
 
-        # Initialize the result dictionary
-        num_by_dataset_and_day = {}
-
-        # Iterate through each day within the date range
-        current_date = start_date_dt
-        while current_date <= end_date_dt:
-            # Construct the query for the current day
-            query = {
-                '$or': [
-                    {'task_type': 'image_generation_sd_1_5'},
-                    {'task_type': 'inpainting_sd_1_5'},
-                    {'task_type': 'image_generation_kandinsky'},
-                    {'task_type': 'inpainting_kandinsky'},
-                    {'task_type': 'img2img_generation_kandinsky'}
-                ],
-                'task_completion_time': {
-                    '$gte': current_date.strftime("%Y-%m-%d %H:%M:%S"),
-                    '$lte': (current_date + timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S")
-                }
-            }
-
-            num_by_dataset = {}
-            datasets = cmd.get_list_of_objects(request.app.minio_client, "datasets")
-            for dataset in datasets:
-                query['task_input_dict.dataset'] = dataset
-                num_images = request.app.completed_jobs_collection.count_documents(query)
-                num_by_dataset[dataset] = num_images
-
-            # Store the result for the current day in the dictionary
-            num_by_dataset_and_day[current_date.strftime("%Y-%m-%d")] = num_by_dataset
-
-            # Move to the next day
-            current_date += timedelta(days=1)
+        # read from the completed job counters
+        num_by_dataset_and_day = await get_generations_count_by_day(request, start_date_dt, end_date_dt)
 
         return response_handler.create_success_response_v1(
             response_data={"results": num_by_dataset_and_day},
@@ -20,6 +20,8 @@ import io
 import random
 import time
 from orchestration.api.api_utils import get_bucket_id
+from orchestration.api.utils.random_sampling import sample_documents, sample_joined_documents
+from orchestration.api.utils.delta_scores import start_delta_score_task, get_delta_score_progress
 
 
 router = APIRouter()
@@ -1337,7 +1339,7 @@ def get_random_image_date_range(
 
     # If rank_id is provided, adjust the query to consider classifier scores
     classifier_id = None
-    uuids = []
+    classifier_query = None
     if rank_id is not None:
         rank = request.app.rank_collection.find_one({'rank_model_id': rank_id})
         if rank is None:
@@ -1359,39 +1361,27 @@ def get_random_image_date_range(
         if min_score is not None:
             classifier_query['score'] = {'$gte': min_score}
 
-        classifier_scores = request.app.image_classifier_scores_collection.find(classifier_query, {"uuid": 1})
-        for score in classifier_scores:
-            uuids.append(score['uuid'])
-
-        if not uuids:
+        if request.app.image_classifier_scores_collection.find_one(classifier_query, {"_id": 1}) is None:
             return api_response_handler.create_error_response_v1(
                 error_code=ErrorCode.ELEMENT_NOT_FOUND,
                 error_string="The relevance classifier model has no scores",
                 http_status_code=404
             )
 
-    # Shuffle the UUIDs array
-    random.shuffle(uuids)
-
-    # Pagination for handling large number of UUIDs
-    batch_size = 5000  # Adjust as needed to fit within the document size limit
-    all_documents = []
-    total_docs_added = 0  # Track the number of documents added
-    for i in range(0, len(uuids), batch_size):
-        batch_uuids = uuids[i:i + batch_size]
-        batch_query = query.copy()
-        batch_query['uuid'] = {'$in': batch_uuids}
-        aggregation_pipeline = [{"$match": batch_query}]
-        if size:
-            remaining_size = size - total_docs_added
-            aggregation_pipeline.append({"$sample": {"size": remaining_size}})
-        
-        documents = list(request.app.completed_jobs_collection.aggregate(aggregation_pipeline))
-        all_documents.extend(documents)
-        total_docs_added += len(documents)
+    if size is None:
+        return api_response_handler.create_error_response_v1(
+            error_code=ErrorCode.INVALID_PARAMS,
+            error_string="size is required",
+            http_status_code=422
+        )
 
-        if total_docs_added >= size:
-            break
+    # random range seeks on the indexed random keys instead of
+    # loading and shuffling every uuid above min_score
+    if classifier_query is not None:
+        all_documents = sample_joined_documents(request.app.image_classifier_scores_collection, classifier_query, 'uuid',
+                                                request.app.completed_jobs_collection, query, 'uuid', size)
+    else:
+        all_documents = sample_documents(request.app.completed_jobs_collection, query, size)
 
     # Retrieve the UUIDs of the selected documents
     document_uuids = [doc['uuid'] for doc in all_documents]
@@ -1425,69 +1415,22 @@ def get_random_image_date_range(
 
 @router.post("/rank-training/calculate-delta-scores", 
              status_code=200,
-             description="Calculate and update delta scores for ranking datapoints, only calculates the scores that are missing in the datapoint and skips the ones that have already been calculated. ",
-             response_model=StandardSuccessResponseV1[str],
+             description="Calculate and update delta scores for ranking datapoints, only calculates the scores that are missing in the datapoint and skips the ones that have already been calculated. The calculation runs in the background, its progress is returned by /rank-training/get-delta-scores-progress",
+             response_model=StandardSuccessResponseV1[dict],
              tags=["Rank Training"],
              responses=ApiResponseHandlerV1.listErrors([400, 422, 500]))
 async def calculate_delta_scores(request: Request):
     response_handler = await ApiResponseHandlerV1.createInstance(request)
 
     try:
-        start_time = time.time()
-
-        # Define the model types for which you want to calculate delta_scores
-        model_types = ["linear", "elm-v1"]
-
-        # Access collections
-        ranking_collection = request.app.ranking_datapoints_collection
-        jobs_collection = request.app.completed_jobs_collection
-
-        processed_count = 0
-        skipped_count = 0
-
-        # Fetch all documents from ranking_collection
-        for doc in ranking_collection.find({}):
-
-            # Skip documents where delta_score already exists for all model_types
-            if all(f"{model_type}" in doc.get("delta_score", {}) for model_type in model_types):
-                skipped_count += 1
-                continue
-
-            selected_image_index = doc["selected_image_index"]
-            selected_image_hash = doc["selected_image_hash"]
-            unselected_image_hash = doc["image_2_metadata"]["file_hash"] if selected_image_index == 0 else doc["image_1_metadata"]["file_hash"]
-
-            for model_type in model_types:
-                # Proceed only if the delta_score for this model_type does not exist
-                if f"delta_score.{model_type}" not in doc:
-                    selected_image_job = jobs_collection.find_one({"task_output_file_dict.output_file_hash": selected_image_hash})
-                    unselected_image_job = jobs_collection.find_one({"task_output_file_dict.output_file_hash": unselected_image_hash})
-
-                    if selected_image_job and unselected_image_job and "task_attributes_dict" in selected_image_job and "task_attributes_dict" in unselected_image_job:
-                        if model_type in selected_image_job["task_attributes_dict"] and model_type in unselected_image_job["task_attributes_dict"]:
-                            selected_image_scores = selected_image_job["task_attributes_dict"][model_type]
-                            unselected_image_scores = unselected_image_job["task_attributes_dict"][model_type]
-
-                            if "image_clip_sigma_score" in selected_image_scores and "image_clip_sigma_score" in unselected_image_scores:
-                                delta_score = selected_image_scores["image_clip_sigma_score"] - unselected_image_scores["image_clip_sigma_score"]
-
-                                # Update the document in ranking_collection with the new delta_score under the specific model_type
-                                update_field = f"delta_score.{model_type}"
-                                ranking_collection.update_one(
-                                    {"_id": doc["_id"]},
-                                    {"$set": {update_field: delta_score}}
-                                )
-                                processed_count += 1
-
-        end_time = time.time()
-        total_time = end_time - start_time
+        # runs in the background, the progress is returned by /rank-training/get-delta-scores-progress
+        progress, started = await start_delta_score_task(request.app, "ranking_datapoints_collection")
+        message = "Delta scores calculation started." if started else "Delta scores calculation already running."
 
         return response_handler.create_success_response_v1(
             response_data={
-                "message": "Delta scores calculation and update complete.",
-                "processed_count": processed_count,
-                "skipped_count": skipped_count,
-                "total_time": f"{total_time:.2f} seconds"
+                "message": message,
+                "progress": progress.to_dict()
             },
             http_status_code=200
         )
@@ -1498,7 +1441,27 @@ async def calculate_delta_scores(request: Request):
             error_string=f"An error occurred: {str(e)}",
             http_status_code=500
         )
-         
+
+
+@router.get("/rank-training/get-delta-scores-progress",
+            status_code=200,
+            description="Returns the progress of the last delta scores calculation of the ranking datapoints, or of the image pair rankings with datapoints=image_pair_ranking",
+            response_model=StandardSuccessResponseV1[dict],
+            tags=["Rank Training"],
+            responses=ApiResponseHandlerV1.listErrors([404, 422, 500]))
+async def get_delta_scores_progress(request: Request,
+                                    datapoints: str = Query("ranking_datapoints", regex="^(ranking_datapoints|image_pair_ranking)$")):
+    response_handler = await ApiResponseHandlerV1.createInstance(request)
+
+    progress = await get_delta_score_progress(request.app, f"{datapoints}_collection")
+    if progress is None:
+        return response_handler.create_error_response_v1(
+            error_code=ErrorCode.ELEMENT_NOT_FOUND,
+            error_string="No delta scores calculation was started.",
+            http_status_code=404
+        )
+
+    return response_handler.create_success_response_v1(response_data=progress, http_status_code=200)
 
 
 @router.get("/rank-training/get-if-image-is-irrelevant",
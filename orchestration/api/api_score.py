@@ -5,8 +5,11 @@ from typing import List, Optional
 
 from pymongo import UpdateOne
 from orchestration.api.mongo_schema.score_schemas import ScoreHelpers
-from orchestration.api.mongo_schemas import OldRankingScoreListForBatchInsertion, RankingScore, RankingScoreListForBatchInsertion, ResponseRankingScore, ListRankingScore, ListOnlyRankingScore
+from orchestration.api.mongo_schemas import OldRankingScoreListForBatchInsertion, RankingScore, RankingScoreListForBatchInsertion, ResponseRankingScore, ListRankingScore, ListOnlyRankingScore, ColumnarScoresIngestResponse
+from orchestration.api.utils.columnar_scores import (ColumnarScoresError, is_columnar_scores_request, decode_columnar_scores,
+                                                     bulk_write_in_chunks, iterate_upserts)
 from orchestration.api.utils.uuid64 import Uuid64
+from orchestration.api.utils.keyset_pagination import find_page, get_next_continuation_token, ContinuationTokenError
 from .api_utils import ApiResponseHandler, ErrorCode, StandardSuccessResponse, WasPresentResponse, ApiResponseHandlerV1, StandardSuccessResponseV1, get_bucket_id_for_image_source
 
 router = APIRouter()
@@ -335,6 +338,107 @@ async def set_image_rank_score_batch(
         )
 
 
+# all_images lookups of the columnar endpoint, image hashes per $in query
+RANK_SCORES_IMAGE_LOOKUP_CHUNK_SIZE = 10000
+
+@router.post("/image-scores/scores/set-rank-scores-columnar", 
+             status_code=200,
+             response_model=StandardSuccessResponseV1[ColumnarScoresIngestResponse],
+             description="Set the rank scores of many images and ranking models. The body is a msgpack map with "
+                         "image_source, uuids, image_hashes, rank_model_ids, rank_ids and (models, images) float32 "
+                         "scores and sigma_scores arrays, sent with the application/msgpack content type. "
+                         "Images that are not in all_images are skipped.",
+             tags=["image scores"], 
+             responses=ApiResponseHandlerV1.listErrors([415, 422, 500]))
+async def set_image_rank_scores_columnar(request: Request):
+    # the body is msgpack, it is not logged by the response handler
+    api_response_handler = ApiResponseHandlerV1.createInstanceWithBody(request, {})
+
+    if not is_columnar_scores_request(request):
+        return api_response_handler.create_error_response_v1(
+            error_code=ErrorCode.INVALID_PARAMS,
+            error_string="The content type must be application/msgpack.",
+            http_status_code=415
+        )
+
+    try:
+        scores_data = decode_columnar_scores(await request.body(),
+                                             model_column_names=["rank_model_ids", "rank_ids"],
+                                             score_matrix_names=["scores", "sigma_scores"])
+    except ColumnarScoresError as e:
+        return api_response_handler.create_error_response_v1(
+            error_code=ErrorCode.INVALID_PARAMS,
+            error_string=str(e),
+            http_status_code=422
+        )
+
+    try:
+        image_source = scores_data["image_source"]
+        bucket_id = get_bucket_id_for_image_source(image_source)
+        uuids = scores_data["uuids"]
+        image_hashes = scores_data["image_hashes"]
+        creation_time = datetime.utcnow().isoformat()
+
+        # dataset_id and image_uuid of the images, one query per chunk of hashes
+        image_data_map = {}
+        unique_image_hashes = list(set(image_hashes))
+        for start in range(0, len(unique_image_hashes), RANK_SCORES_IMAGE_LOOKUP_CHUNK_SIZE):
+            query = {
+                "bucket_id": bucket_id,
+                "image_hash": {"$in": unique_image_hashes[start:start + RANK_SCORES_IMAGE_LOOKUP_CHUNK_SIZE]}
+            }
+            cursor = request.app.async_collections.all_image_collection.find(query, {"uuid": 1, "image_hash": 1, "dataset_id": 1})
+            async for image_data in cursor:
+                image_data_map[image_data["image_hash"]] = image_data
+
+        # the column of each image is kept, the score matrices are indexed by it
+        found_images = [(column_index, job_uuid, image_hash, image_data_map[image_hash])
+                        for column_index, (job_uuid, image_hash) in enumerate(zip(uuids, image_hashes))
+                        if image_hash in image_data_map]
+        num_models = len(scores_data["rank_model_ids"])
+        num_skipped = (len(uuids) - len(found_images)) * num_models
+
+        def iterate_score_documents():
+            for rank_model_id, rank_id, scores, sigma_scores in zip(scores_data["rank_model_ids"],
+                                                                   scores_data["rank_ids"],
+                                                                   scores_data["scores"].tolist(),
+                                                                   scores_data["sigma_scores"].tolist()):
+                for column_index, job_uuid, image_hash, image_data in found_images:
+                    yield {
+                        "uuid": job_uuid,
+                        "rank_model_id": rank_model_id,
+                        "rank_id": rank_id,
+                        "score": scores[column_index],
+                        "sigma_score": sigma_scores[column_index],
+                        "image_hash": image_hash,
+                        "creation_time": creation_time,
+                        "image_source": image_source,
+                        "bucket_id": bucket_id,
+                        "dataset_id": image_data.get("dataset_id"),
+                        "image_uuid": image_data.get("uuid")
+                    }
+
+        counts = await bulk_write_in_chunks(
+            request.app.async_collections.image_rank_scores_collection,
+            iterate_upserts(["uuid", "rank_model_id"], iterate_score_documents()))
+
+        return api_response_handler.create_success_response_v1(
+            response_data={
+                "num_scores": scores_data["scores"].size,
+                "num_skipped": num_skipped,
+                **counts
+            },
+            http_status_code=200
+        )
+
+    except Exception as e:
+        return api_response_handler.create_error_response_v1(
+            error_code=ErrorCode.OTHER_ERROR, 
+            error_string=str(e),
+            http_status_code=500
+        )
+
+
 @router.get("/image-scores/scores/get-image-rank-score", 
             description="Get image rank score by hash",
             status_code=200,
@@ -439,9 +543,17 @@ def list_rank_scores(
     max_score: float = Query(None, description="Maximum score for filtering"),
     time_interval: int = Query(None, description="Time interval in minutes or hours for filtering"),
     time_unit: str = Query("minutes", description="Time unit, either 'minutes' or 'hours'"),
-    random_sampling: bool = Query(False, description="Enable random sampling")
+    random_sampling: bool = Query(False, description="Enable random sampling"),
+    continuation_token: Optional[str] = Query(None, description="next_continuation_token of the previous page, offset is ignored when it is set")
 ):
     api_response_handler = ApiResponseHandlerV1(request)
+    if score_field not in ["score", "sigma_score"]:
+        return api_response_handler.create_error_response_v1(
+            error_code=ErrorCode.INVALID_PARAMS,
+            error_string="score_field must be score or sigma_score",
+            http_status_code=422
+        )
+
     try:
         # Calculate the time threshold based on the current time and the specified interval
         threshold_time = None
@@ -475,25 +587,33 @@ def list_rank_scores(
             query['score'] = { '$lte': max_score }
 
         # Modify behavior based on random_sampling parameter
+        next_continuation_token = None
         if random_sampling:
             query_filter = {"$match": query}
             sampling_stage = {"$sample": {"size": limit}}
             pipeline = [query_filter, sampling_stage]
             items = list(request.app.image_rank_scores_collection.aggregate(pipeline))
         else:
-            items = list(request.app.image_rank_scores_collection\
-                .find(query)\
-                .sort(score_field, 1 if sort_order == 'asc' else -1)\
-                .skip(offset).limit(limit))
+            sort_order_mongo = 1 if sort_order == 'asc' else -1
+            items = list(find_page(request.app.image_rank_scores_collection, query, score_field, sort_order_mongo,
+                                   limit, offset=offset, continuation_token=continuation_token))
+            next_continuation_token = get_next_continuation_token(items, score_field, sort_order_mongo, limit)
         
         score_data = list(items)
         ScoreHelpers.clean_rank_score_list_for_api_response(score_data)
         
         # Return a standardized success response with the score data
         return api_response_handler.create_success_response_v1(
-            response_data={'scores': score_data},
+            response_data={'scores': score_data, 'next_continuation_token': next_continuation_token},
             http_status_code=200
         )
+
+    except ContinuationTokenError as e:
+        return api_response_handler.create_error_response_v1(
+            error_code=ErrorCode.INVALID_PARAMS,
+            error_string=str(e),
+            http_status_code=422
+        )
         
     except Exception as e:
         return api_response_handler.create_error_response_v1(
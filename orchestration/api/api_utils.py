@@ -1,5 +1,9 @@
 from starlette.responses import Response
 import json, typing
+try:
+    import orjson
+except ImportError:
+    orjson = None
 import time
 from fastapi import HTTPException
 from fastapi.responses import JSONResponse
@@ -11,6 +15,8 @@ from pydantic import BaseModel
 from orchestration.api.mongo_schema.tag_schemas import TagDefinition, TagCategory, ImageTag
 from orchestration.api.mongo_schema.pseudo_tag_schemas import ImagePseudoTag
 from orchestration.api.mongo_schemas import VideoMetaData
+from orchestration.api.utils.ndjson_stream import create_ndjson_stream_response
+from orchestration.api.utils.random_sampling import strip_random_keys
 from datetime import datetime
 from minio import Minio
 from dateutil import parser
@@ -20,6 +26,7 @@ from typing import List, Union
 from urllib.parse import urlparse, parse_qs
 import random
 from minio.error import S3Error
+from pymongo import ReturnDocument
 
 
 
@@ -290,10 +297,19 @@ def validate_date_format(date_str: Optional[str]):
         return None
 
 
+# the json responses remove the random key of the sampler from the documents,
+# see utils/random_sampling.py
+class ApiJSONResponse(JSONResponse):
+    # default response class of the app, for the endpoints that return the documents
+    def render(self, content: typing.Any) -> bytes:
+        return super().render(strip_random_keys(content))
+
+
 class PrettyJSONResponse(Response):
     media_type = "application/json"
 
     def render(self, content: typing.Any) -> bytes:
+        content = strip_random_keys(content)
         return json.dumps(
             content,
             ensure_ascii=False,
@@ -303,6 +319,25 @@ class PrettyJSONResponse(Response):
         ).encode("utf-8")
 
 
+# compact response used for the success responses
+# orjson is several times faster than json.dumps with indent
+# on the large lists returned by the list endpoints
+class FastJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content: typing.Any) -> bytes:
+        content = strip_random_keys(content)
+        if orjson is not None:
+            return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+        return json.dumps(
+            content,
+            ensure_ascii=False,
+            allow_nan=False,
+            separators=(",", ":"),
+        ).encode("utf-8")
+
+
 class ErrorCode(Enum):
     SUCCESS = 0
     OTHER_ERROR = 1
@@ -395,7 +430,7 @@ class StandardErrorResponseV1(BaseStandardResponseV1):
 
      
 class ApiResponseHandlerV1:
-    def __init__(self, request: Request, body_data: Optional[Dict[str, Any]] = None, _created_with_helper=False):
+    def __init__(self, request: Request, body_data: Optional[Dict[str, Any]] = None, _created_with_helper=False, raw_body: Optional[bytes] = None):
         self.request = request
         self.url = str(request.url)
         self.start_time = datetime.now() 
@@ -409,26 +444,42 @@ class ApiResponseHandlerV1:
         parsed_url = urlparse(self.url)
         self.url_path = parsed_url.path  # Store the path part of the URL
 
-        self.request_data = {
-            "body": body_data or {},  # Set from the provided body data
-            "query": dict(request.query_params)  # Extracted from request
+        # the body is only decoded when an error response echoes it
+        # fastapi already parsed it into the endpoint models
+        self.body_data = body_data
+        self.raw_body = raw_body
+
+    @property
+    def request_data(self):
+        return {
+            "body": self._get_body_data(),
+            "query": self.query_params
         }
 
+    def _get_body_data(self):
+        if self.body_data is None:
+            self.body_data = {}
+            if self.raw_body:
+                try:
+                    self.body_data = json.loads(self.raw_body)
+                except ValueError:
+                    # not a json body, for example a msgpack or multipart upload
+                    pass
+
+        return self.body_data
+
     @staticmethod
     async def createInstance(request: Request):
-        body = await request.body()
-        body_dictionary = {}
-        if (len(body) > 0):
-            body_string = body.decode('utf-8')
-            body_dictionary = json.loads(body_string)
+        # starlette caches the body, this is the bytes fastapi already read
+        raw_body = await request.body()
 
-        instance = ApiResponseHandlerV1(request, body_dictionary, _created_with_helper=True)
+        instance = ApiResponseHandlerV1(request, _created_with_helper=True, raw_body=raw_body)
         return instance
     
     # In middlewares, this must be called instead of "createInstance", as "createInstance" may hang trying to get the request body.
     @staticmethod
     def createInstanceWithBody(request: Request, body_data: Dict[str, Any]):
-        instance = ApiResponseHandlerV1(request, body_data, _created_with_helper=True)
+        instance = ApiResponseHandlerV1(request, body_data or {}, _created_with_helper=True)
         return instance
 
     
@@ -446,6 +497,7 @@ class ApiResponseHandlerV1:
         self,
         http_status_code: int,
         headers: dict,
+        include_body: bool = False,
     ):
         if headers.get("Cache-Control") is None:
             headers["Cache-Control"] = "no-store, no-cache, must-revalidate, proxy-revalidate, max-age=0"
@@ -454,7 +506,8 @@ class ApiResponseHandlerV1:
             "request_error_string": '',
             "request_error_code": 0,
             "request_url": self.url_path,
-            "request_dictionary": self.request_data,
+            # success responses only echo the query, so the body is not decoded
+            "request_dictionary": self.request_data if include_body else {"body": {}, "query": self.query_params},
             "request_method": self.request.method,
             "request_complete_time": str(self._elapsed_time()),
             "request_time_start": self.start_time.isoformat(),
@@ -475,7 +528,7 @@ class ApiResponseHandlerV1:
         response_content = self._create_metadata_and_process_headers(http_status_code, headers)
         response_content["response"] = response_data
 
-        return PrettyJSONResponse(status_code=http_status_code, content=response_content, headers=headers)
+        return FastJSONResponse(status_code=http_status_code, content=response_content, headers=headers)
 
 
     def create_success_delete_response_v1(
@@ -487,7 +540,21 @@ class ApiResponseHandlerV1:
         response_content = self._create_metadata_and_process_headers(http_status_code, headers)
         response_content["response"] = {"wasPresent": wasPresent}
 
-        return PrettyJSONResponse(status_code=http_status_code, content=response_content, headers=headers)
+        return FastJSONResponse(status_code=http_status_code, content=response_content, headers=headers)
+
+    def create_ndjson_stream_response_v1(
+        self,
+        cursor,
+        transform=None,
+        headers: dict = {},
+    ):
+        # streams the documents of the cursor as ndjson, one document per line
+        # there is no metadata, the lines are the elements of the list
+        headers = dict(headers)
+        if headers.get("Cache-Control") is None:
+            headers["Cache-Control"] = "no-store, no-cache, must-revalidate, proxy-revalidate, max-age=0"
+
+        return create_ndjson_stream_response(cursor, transform=transform, headers=headers)
 
     def create_error_response_v1(
         self,
@@ -500,7 +567,7 @@ class ApiResponseHandlerV1:
             if not 400 <= http_status_code < 599:
                 raise ValueError("Invalid HTTP status code for a success response. Must be between 400 and 599.")
             
-            response_content = self._create_metadata_and_process_headers(http_status_code, headers)
+            response_content = self._create_metadata_and_process_headers(http_status_code, headers, include_body=True)
             response_content["request_error_string"] = error_string
             response_content["request_error_code"] = error_code.value
             
@@ -573,24 +640,22 @@ def get_minio_file_path(seq_id, bucket_name, dataset_name, format, sample_size =
     return f'{path}.{format}'
     
 def get_next_external_dataset_seq_id(request: Request, bucket:str, dataset: str):
-    counter = \
-        request.app.external_dataset_sequential_id.find_one({"bucket": bucket, 
-                                                            "dataset": dataset})
-    if counter is None:
-        request.app.external_dataset_sequential_id.insert_one({"bucket": bucket,
-                                                   "dataset": dataset,
-                                                   "count": 0})
-    counter_seq = counter["count"] if counter else 0 
-    counter_seq += 1
-    
-    return counter_seq
+    # reserved atomically, two concurrent uploads never get the same id
+    counter = request.app.external_dataset_sequential_id.find_one_and_update(
+        {"bucket": bucket, "dataset": dataset},
+        {"$inc": {"count": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER)
 
-def update_external_dataset_seq_id(request: Request, bucket:str, dataset: str, seq_id = 0):
+    return counter["count"]
 
+def update_external_dataset_seq_id(request: Request, bucket:str, dataset: str, seq_id = 0):
+    # the id is already reserved by get_next_external_dataset_seq_id,
+    # $max keeps a slower request from moving the counter back
     try:
         ret = request.app.external_dataset_sequential_id.update_one(
             {"bucket": bucket, "dataset": dataset},
-            {"$set": {"count": seq_id}})
+            {"$max": {"count": seq_id}})
     except Exception as e:
         raise Exception("Updating of external image sequential id failed: {}".format(e))
     
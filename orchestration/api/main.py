@@ -1,10 +1,11 @@
 import json
+import asyncio
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 import pymongo
 from bson.objectid import ObjectId
 from fastapi.responses import JSONResponse
-from .api_utils import ApiResponseHandlerV1, PrettyJSONResponse, ApiResponseHandler, ErrorCode,  StandardErrorResponseV1, StandardSuccessResponse
+from .api_utils import ApiResponseHandlerV1, ApiJSONResponse, PrettyJSONResponse, ApiResponseHandler, ErrorCode,  StandardErrorResponseV1, StandardSuccessResponse
 from fastapi.exceptions import RequestValidationError
 from fastapi import status, Request
 from dotenv import dotenv_values
@@ -14,7 +15,7 @@ from orchestration.api.api_dataset import router as dataset_router
 from orchestration.api.api_inpainting_dataset import router as inpainting_dataset_router
 from orchestration.api.api_image import router as image_router
 from orchestration.api.api_job_stats import router as job_stats_router
-from orchestration.api.api_job import router as job_router
+from orchestration.api.api_job import router as job_router, monitor_expired_job_leases
 from orchestration.api.api_ranking import router as ranking_router
 from orchestration.api.api_training import router as training_router
 from orchestration.api.api_model import router as model_router
@@ -48,10 +49,14 @@ from orchestration.api.api_all_images import router as all_images
 from orchestration.api.api_video_game import router as video_game_router
 from orchestration.api.api_clustered_image import router as image_clustered_router
 from orchestration.api.api_cluster_model import router as cluster_model_router
+from orchestration.api.utils.async_db import attach_async_collections, close_async_client
+from orchestration.api.utils.job_counters import monitor_job_counters
+from orchestration.api.utils.random_sampling import get_random_key_index, backfill_random_keys_in_background, RANDOM_KEY_BACKFILL_LOCK, RANDOM_KEY_BACKFILL_LOCK_SECONDS
+from orchestration.api.utils.api_locks import acquire_lock
 from utility.minio import cmd
 
 config = dotenv_values("./orchestration/api/.env")
-app = FastAPI(title="Orchestration API")
+app = FastAPI(title="Orchestration API", default_response_class=ApiJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -205,6 +210,35 @@ def startup_db_client():
     ]
     create_index_if_not_exists(app.completed_jobs_collection ,completed_jobs_uuid_index, 'completed_jobs_uuid_index')
 
+    in_progress_jobs_lease_index=[
+    ('lease_expiration_time', pymongo.ASCENDING)
+    ]
+    create_index_if_not_exists(app.in_progress_jobs_collection ,in_progress_jobs_lease_index, 'in_progress_jobs_lease_index')
+
+    # the lease renewals and the expired lease requeues find the jobs by uuid
+    in_progress_jobs_uuid_index=[
+    ('uuid', pymongo.ASCENDING)
+    ]
+    create_index_if_not_exists(app.in_progress_jobs_collection ,in_progress_jobs_uuid_index, 'in_progress_jobs_uuid_index')
+
+    pending_jobs_uuid_index=[
+    ('uuid', pymongo.ASCENDING)
+    ]
+    create_index_if_not_exists(app.pending_jobs_collection ,pending_jobs_uuid_index, 'pending_jobs_uuid_index')
+
+    # locks of the background tasks that run in one api process, see utils/api_locks.py
+    app.api_locks_collection = app.mongodb_db["api-locks"]
+
+    # incrementally maintained job and score counters, see utils/job_counters.py
+    app.job_counters_collection = app.mongodb_db["job-counters"]
+    app.job_score_counters_collection = app.mongodb_db["job-score-counters"]
+
+    job_counters_state_day_index=[
+    ('state', pymongo.ASCENDING),
+    ('day', pymongo.ASCENDING)
+    ]
+    create_index_if_not_exists(app.job_counters_collection ,job_counters_state_day_index, 'job_counters_state_day_index')
+
 
     app.failed_jobs_collection = app.mongodb_db["failed-jobs"]
 
@@ -354,6 +388,8 @@ def startup_db_client():
 
     # delta score
     app.datapoints_delta_score_collection = app.mongodb_db["datapoints_delta_score"]
+    # state of the delta score calculations, see utils/delta_scores.py
+    app.delta_score_tasks_collection = app.mongodb_db["delta-score-tasks"]
 
     # workers
     app.workers_collection = app.mongodb_db["workers"]
@@ -384,6 +420,15 @@ def startup_db_client():
     ]
     create_index_if_not_exists(app.image_rank_scores_collection , rank_scores_index, "rank_scores_index")
 
+    # keyset pagination of list-rank-scores, sorted on (score, _id) or (sigma_score, _id)
+    for score_field in ["score", "sigma_score"]:
+        rank_scores_keyset_index=[
+        ("rank_model_id", pymongo.ASCENDING),
+        (score_field, pymongo.ASCENDING),
+        ("_id", pymongo.ASCENDING)
+        ]
+        create_index_if_not_exists(app.image_rank_scores_collection , rank_scores_keyset_index, f"rank_scores_{score_field}_keyset_index")
+
     # scores for image classfier
     app.image_classifier_scores_collection = app.mongodb_db["image_classifier_scores"]
 
@@ -478,6 +523,13 @@ def startup_db_client():
     ]
     create_index_if_not_exists(app.image_classifier_scores_collection , classifier_image_uuid_index, 'classifier_image_uuid_index')
 
+    # upsert key of the score ingest endpoints
+    classifier_image_uuid_classifier_index=[
+    ('uuid', pymongo.ASCENDING),
+    ('classifier_id', pymongo.ASCENDING)
+    ]
+    create_index_if_not_exists(app.image_classifier_scores_collection , classifier_image_uuid_classifier_index, 'classifier_image_uuid_classifier_index')
+
     classifier_task_score_index = [
     ('classifier_id', pymongo.ASCENDING),
     ('task_type', pymongo.ASCENDING),
@@ -491,6 +543,22 @@ def startup_db_client():
     ]
     create_index_if_not_exists(app.image_classifier_scores_collection, classifier_score_index, 'classifier_score_index')
 
+    # keyset pagination of the score sorted listings, sorted on (score, _id)
+    classifier_score_keyset_index = [
+    ('classifier_id', pymongo.ASCENDING),
+    ('score', pymongo.ASCENDING),
+    ('_id', pymongo.ASCENDING)
+    ]
+    create_index_if_not_exists(app.image_classifier_scores_collection, classifier_score_keyset_index, 'classifier_score_keyset_index')
+
+    classifier_task_score_keyset_index = [
+    ('classifier_id', pymongo.ASCENDING),
+    ('task_type', pymongo.ASCENDING),
+    ('score', pymongo.ASCENDING),
+    ('_id', pymongo.ASCENDING)
+    ]
+    create_index_if_not_exists(app.image_classifier_scores_collection, classifier_task_score_keyset_index, 'classifier_task_score_keyset_index')
+
     # sigma scores
     app.image_sigma_scores_collection = app.mongodb_db["image-sigma-scores"]
 
@@ -516,6 +584,13 @@ def startup_db_client():
     create_index_if_not_exists(app.image_residuals_collection ,residuals_index, 'residuals_index')
     create_index_if_not_exists(app.image_residuals_collection ,hash_index, 'residual_hash_index')
 
+    residuals_keyset_index=[
+    ('model_id', pymongo.ASCENDING), 
+    ('residual', pymongo.ASCENDING),
+    ('_id', pymongo.ASCENDING)
+    ]
+    create_index_if_not_exists(app.image_residuals_collection ,residuals_keyset_index, 'residuals_keyset_index')
+
     image_hash_index = [
         ('image_hash', pymongo.ASCENDING)
     ]
@@ -531,6 +606,13 @@ def startup_db_client():
     create_index_if_not_exists(app.image_percentiles_collection ,percentiles_index, 'percentiles_index')
     create_index_if_not_exists(app.image_percentiles_collection ,hash_index, 'percentile_hash_index')
 
+    percentiles_keyset_index=[
+    ('model_id', pymongo.ASCENDING), 
+    ('percentile', pymongo.ASCENDING),
+    ('_id', pymongo.ASCENDING)
+    ]
+    create_index_if_not_exists(app.image_percentiles_collection ,percentiles_keyset_index, 'percentiles_keyset_index')
+
     # residual percentiles
     app.image_residual_percentiles_collection = app.mongodb_db["image-residual-percentiles"]
 
@@ -566,6 +648,25 @@ def startup_db_client():
     create_index_if_not_exists(app.ingress_video_collection, ingress_video_hash_index,
     'ingress_video_hash_index')
 
+    # random keys of the indexed random sampling
+    create_index_if_not_exists(app.completed_jobs_collection, get_random_key_index(["task_input_dict.dataset"]),
+    'completed_jobs_dataset_random_key_index')
+    create_index_if_not_exists(app.completed_jobs_collection, get_random_key_index([]),
+    'completed_jobs_random_key_index')
+    create_index_if_not_exists(app.image_classifier_scores_collection, get_random_key_index(["classifier_id"]),
+    'classifier_score_random_key_index')
+    create_index_if_not_exists(app.extracts_collection, get_random_key_index(["dataset"]),
+    'extracts_dataset_random_key_index')
+    create_index_if_not_exists(app.extracts_collection, get_random_key_index([]),
+    'extracts_random_key_index')
+    if acquire_lock(app.api_locks_collection, RANDOM_KEY_BACKFILL_LOCK, RANDOM_KEY_BACKFILL_LOCK_SECONDS):
+        backfill_random_keys_in_background([app.completed_jobs_collection,
+                                            app.image_classifier_scores_collection,
+                                            app.extracts_collection])
+
+
+    # async driver with the same collections for the async endpoints
+    attach_async_collections(app, config["DB_URL"], "orchestration-job-db")
 
     print("Connected to the MongoDB database!")
 
@@ -575,6 +676,21 @@ def startup_db_client():
                                         minio_secret_key=config["MINIO_SECRET_KEY"])
 
 
+@app.on_event("startup")
+async def start_job_lease_monitor():
+    # moves jobs with an expired lease back to pending
+    # every api process starts it, only the one holding the lock does the work
+    app.job_lease_monitor_task = asyncio.create_task(monitor_expired_job_leases(app))
+
+
+@app.on_event("startup")
+async def start_job_counters_monitor():
+    # recomputes the job and score counters from the job collections
+    # every api process starts it, only the one holding the lock does the work
+    app.job_counters_monitor_task = asyncio.create_task(monitor_job_counters(app))
+
+
 @app.on_event("shutdown")
 def shutdown_db_client():
-    app.mongodb_client.close()
\ No newline at end of file
+    app.mongodb_client.close()
+    close_async_client(app)
\ No newline at end of file
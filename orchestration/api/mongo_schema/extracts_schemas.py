@@ -8,6 +8,7 @@ class ExtractsHelpers():
     @staticmethod
     def clean_extract_for_api_response(data: dict):
         data.pop('_id', None)
+        data.pop('random_key', None)
         if "uuid" in data:
             if isinstance(data['uuid'], uuid.UUID):
                     data['uuid'] = str(data['uuid'])
@@ -615,6 +615,13 @@ class ClassifierScoreRequestV1(BaseModel):
 class BatchClassifierScoreRequest(BaseModel):
     scores: List[ClassifierScoreRequestV1]
 
+class ColumnarScoresIngestResponse(BaseModel):
+    num_scores: int
+    num_skipped: int
+    matched: int
+    modified: int
+    upserted: int
+
 
 class RankingSigmaScore(BaseModel):
     model_id: int
@@ -859,6 +866,18 @@ class SimilarityScoreTask(BaseModel):
 class ListSimilarityScoreTask(BaseModel):
     images: List[SimilarityScoreTask]
 
+class ClipSearchImage(BaseModel):
+    uuid: Union[str, None] = None
+    image_hash: str
+    bucket: str
+    dataset: str
+    file_path: Union[str, None] = None
+    date: Union[str, None] = None
+    similarity_score: float
+
+class ListClipSearchImage(BaseModel):
+    images: List[ClipSearchImage]
+
 
 
 class VideoMetaData(BaseModel):
@@ -0,0 +1,48 @@
+import os
+import socket
+from datetime import datetime, timedelta
+from pymongo.errors import DuplicateKeyError
+
+# locks of the api background tasks
+#
+# the api runs in several uvicorn worker processes and each of them runs the
+# startup hooks. the background tasks (expired job leases, job counters,
+# random key backfill) only need to run in one of them, so they are guarded
+# by a lock document {"_id": name, "owner", "expiration_time"} in api-locks
+#
+# a process runs the task only while it holds the lock. the periodic tasks
+# take or renew it before every run, with a duration of a few intervals, so
+# when the owner stops another process takes the lock once it expires
+API_LOCK_OWNER = "{}:{}".format(socket.gethostname(), os.getpid())
+
+
+def get_lock_query(name, owner, now):
+    # free, expired or already held by owner
+    return {"_id": name, "$or": [{"owner": owner}, {"expiration_time": {"$lt": now}}]}
+
+
+def get_lock_update(owner, now, lock_seconds):
+    return {"$set": {"owner": owner, "expiration_time": now + timedelta(seconds=lock_seconds)}}
+
+
+def acquire_lock(collection, name, lock_seconds, owner=API_LOCK_OWNER):
+    # takes or renews the lock, True if owner holds it
+    # the upsert fails with a duplicate key when another owner holds it
+    now = datetime.now()
+    try:
+        collection.update_one(get_lock_query(name, owner, now), get_lock_update(owner, now, lock_seconds), upsert=True)
+    except DuplicateKeyError:
+        return False
+
+    return True
+
+
+async def acquire_lock_async(collection, name, lock_seconds, owner=API_LOCK_OWNER):
+    # motor version of acquire_lock
+    now = datetime.now()
+    try:
+        await collection.update_one(get_lock_query(name, owner, now), get_lock_update(owner, now, lock_seconds), upsert=True)
+    except DuplicateKeyError:
+        return False
+
+    return True
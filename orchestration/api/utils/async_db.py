@@ -0,0 +1,30 @@
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.collection import Collection
+
+
+class AsyncCollections:
+    # motor counterparts of the pymongo collections attached to the app
+    # request.app.async_collections.pending_jobs_collection is the
+    # async version of request.app.pending_jobs_collection
+    # async endpoints must use these so mongo round trips
+    # dont block the event loop
+    pass
+
+
+def attach_async_collections(app, db_url, db_name):
+    app.mongodb_async_client = AsyncIOMotorClient(db_url, uuidRepresentation='standard')
+    app.mongodb_async_db = app.mongodb_async_client[db_name]
+
+    async_collections = AsyncCollections()
+    for attribute_name, value in list(vars(app).items()):
+        if attribute_name.endswith('_collection') and isinstance(value, Collection):
+            setattr(async_collections, attribute_name, app.mongodb_async_db[value.name])
+
+    app.async_collections = async_collections
+
+    return async_collections
+
+
+def close_async_client(app):
+    if getattr(app, 'mongodb_async_client', None) is not None:
+        app.mongodb_async_client.close()
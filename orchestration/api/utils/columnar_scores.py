@@ -0,0 +1,107 @@
+import numpy as np
+from pymongo import UpdateOne
+
+from utility.msgpack_ndarray import unpackb
+from orchestration.api.utils.random_sampling import get_random_key_on_insert
+
+# columnar score ingest
+#
+# the scorers send the scores of many models for the same images in one
+# msgpack request instead of a json list with one dict per score:
+#
+#   {
+#       "image_source": "generated_image",
+#       "uuids": [str] * images,
+#       "image_hashes": [str] * images,
+#       "<model id key>": [int] * models,
+#       ...other per model columns, [int] * models,
+#       "scores": float32 ndarray (models, images),
+#       ...other score matrices, float32 ndarray (models, images)
+#   }
+#
+# the body is decoded once with numpy, there is no pydantic model per row
+# and the upserts are written in unordered chunks with bulk_write
+COLUMNAR_SCORES_CONTENT_TYPES = ["application/msgpack", "application/x-msgpack"]
+COLUMNAR_SCORES_BULK_WRITE_CHUNK_SIZE = 10000
+IMAGE_SOURCES = ["generated_image", "extract_image", "external_image"]
+
+
+class ColumnarScoresError(ValueError):
+    pass
+
+
+def is_columnar_scores_request(request):
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    return content_type in COLUMNAR_SCORES_CONTENT_TYPES
+
+
+def decode_columnar_scores(body, model_column_names, score_matrix_names):
+    # returns the decoded dict with the score matrices as (models, images) float64 arrays
+    # raises ColumnarScoresError if the columns do not match
+    try:
+        data = unpackb(body)
+    except Exception as e:
+        raise ColumnarScoresError(f"The body is not valid msgpack: {e}")
+
+    if not isinstance(data, dict):
+        raise ColumnarScoresError("The body must be a msgpack map.")
+
+    if data.get("image_source") not in IMAGE_SOURCES:
+        raise ColumnarScoresError(f"image_source must be one of {IMAGE_SOURCES}.")
+
+    for name in ["uuids", "image_hashes"] + model_column_names + score_matrix_names:
+        if name not in data:
+            raise ColumnarScoresError(f"The column {name} is missing.")
+
+    num_images = len(data["uuids"])
+    if len(data["image_hashes"]) != num_images:
+        raise ColumnarScoresError("uuids and image_hashes must have the same length.")
+
+    num_models = len(data[model_column_names[0]])
+    for name in model_column_names:
+        data[name] = [int(value) for value in data[name]]
+        if len(data[name]) != num_models:
+            raise ColumnarScoresError(f"{name} must have {num_models} values.")
+
+    for name in score_matrix_names:
+        matrix = np.asarray(data[name], dtype=np.float64)
+        if matrix.shape != (num_models, num_images):
+            raise ColumnarScoresError(f"{name} must have the shape ({num_models}, {num_images}), got {matrix.shape}.")
+        if not np.isfinite(matrix).all():
+            raise ColumnarScoresError(f"{name} must only have finite values.")
+        data[name] = matrix
+
+    return data
+
+
+async def bulk_write_in_chunks(collection, operations, chunk_size=COLUMNAR_SCORES_BULK_WRITE_CHUNK_SIZE):
+    # operations can be a generator, only one chunk is built at a time
+    # returns the number of matched, modified and upserted documents
+    counts = {"matched": 0, "modified": 0, "upserted": 0}
+
+    chunk = []
+    for operation in operations:
+        chunk.append(operation)
+        if len(chunk) == chunk_size:
+            await write_chunk(collection, chunk, counts)
+            chunk = []
+
+    if len(chunk) > 0:
+        await write_chunk(collection, chunk, counts)
+
+    return counts
+
+
+async def write_chunk(collection, chunk, counts):
+    result = await collection.bulk_write(chunk, ordered=False)
+    counts["matched"] += result.matched_count
+    counts["modified"] += result.modified_count
+    counts["upserted"] += result.upserted_count
+
+
+def iterate_upserts(query_keys, documents):
+    # one upsert per document, matched on query_keys
+    # new documents get the random key of the sampler
+    for document in documents:
+        query = {key: document[key] for key in query_keys}
+        yield UpdateOne(query, {"$set": document, "$setOnInsert": get_random_key_on_insert()}, upsert=True)
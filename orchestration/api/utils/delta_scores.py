@@ -0,0 +1,244 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+import numpy as np
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+# delta scores of the ranking datapoints
+#
+# the delta score of a datapoint is the image_clip_sigma_score of the selected
+# image minus the one of the unselected image, for each model type, stored in
+# delta_score.{model type}
+#
+# the datapoints missing a delta score are read in chunks, the scores of all
+# the images of a chunk are read with one $in query on the completed jobs,
+# the deltas are computed with numpy and written with one unordered bulk_write
+# per chunk. the calculation runs as a background task
+#
+# the api runs in several processes, so the state of the calculation of a
+# datapoints collection is a document of delta-score-tasks, with the collection
+# attribute name as _id. a calculation is started only if the document is not
+# running, and the progress is read from it by any process. a running
+# calculation writes its progress after every chunk, one that did not write it
+# for DELTA_SCORE_TASK_TIMEOUT_SECONDS stopped with its process and can be started again
+DELTA_SCORE_MODEL_TYPES = ["linear", "elm-v1"]
+DELTA_SCORE_CHUNK_SIZE = 5000
+DELTA_SCORE_TASK_TIMEOUT_SECONDS = 10 * 60
+JOB_HASH_FIELD = "task_output_file_dict.output_file_hash"
+
+# the background tasks of this process, asyncio only keeps weak references to them
+running_tasks = set()
+
+
+def get_missing_delta_score_query(model_types=DELTA_SCORE_MODEL_TYPES):
+    return {"$or": [{f"delta_score.{model_type}": {"$exists": False}} for model_type in model_types]}
+
+
+def get_datapoint_projection():
+    return {"selected_image_index": 1, "selected_image_hash": 1, "delta_score": 1,
+            "image_1_metadata.file_hash": 1, "image_2_metadata.file_hash": 1}
+
+
+def get_job_score_projection(model_types=DELTA_SCORE_MODEL_TYPES):
+    projection = {"_id": 0, JOB_HASH_FIELD: 1}
+    for model_type in model_types:
+        projection[f"task_attributes_dict.{model_type}.image_clip_sigma_score"] = 1
+
+    return projection
+
+
+def get_image_hashes(datapoint):
+    # (selected, unselected) image hashes, None if the datapoint does not have it
+    if datapoint.get("selected_image_index") == 0:
+        unselected_image_hash = (datapoint.get("image_2_metadata") or {}).get("file_hash")
+    else:
+        unselected_image_hash = (datapoint.get("image_1_metadata") or {}).get("file_hash")
+
+    return datapoint.get("selected_image_hash"), unselected_image_hash
+
+
+def get_job_scores(jobs, model_types=DELTA_SCORE_MODEL_TYPES):
+    # {image hash: [score of each model type]}, nan for a missing score
+    # the first job of a hash is used, like a find_one
+    scores = {}
+    for job in jobs:
+        image_hash = (job.get("task_output_file_dict") or {}).get("output_file_hash")
+        if image_hash is None or image_hash in scores:
+            continue
+
+        attributes = job.get("task_attributes_dict") or {}
+        job_scores = []
+        for model_type in model_types:
+            score = (attributes.get(model_type) or {}).get("image_clip_sigma_score")
+            job_scores.append(float(score) if isinstance(score, (int, float)) and not isinstance(score, bool) else np.nan)
+        scores[image_hash] = job_scores
+
+    return scores
+
+
+def compute_delta_score_updates(datapoints, scores, model_types=DELTA_SCORE_MODEL_TYPES):
+    # returns the update operations and the number of delta scores they set
+    missing_scores = [np.nan] * len(model_types)
+    selected_scores = np.empty((len(datapoints), len(model_types)))
+    unselected_scores = np.empty((len(datapoints), len(model_types)))
+    has_delta_score = np.zeros((len(datapoints), len(model_types)), dtype=bool)
+
+    for row, datapoint in enumerate(datapoints):
+        selected_image_hash, unselected_image_hash = get_image_hashes(datapoint)
+        selected_scores[row] = scores.get(selected_image_hash, missing_scores)
+        unselected_scores[row] = scores.get(unselected_image_hash, missing_scores)
+        existing_delta_scores = datapoint.get("delta_score") or {}
+        has_delta_score[row] = [model_type in existing_delta_scores for model_type in model_types]
+
+    delta_scores = selected_scores - unselected_scores
+    # nan when one of the scores is missing, those are left for a next run
+    is_new = ~np.isnan(delta_scores) & ~has_delta_score
+
+    updates = []
+    for row in np.flatnonzero(is_new.any(axis=1)):
+        values = {f"delta_score.{model_types[column]}": float(delta_scores[row, column])
+                  for column in np.flatnonzero(is_new[row])}
+        updates.append(UpdateOne({"_id": datapoints[row]["_id"]}, {"$set": values}))
+
+    return updates, int(is_new.sum())
+
+
+class DeltaScoreProgress:
+    def __init__(self, collection_name):
+        self.collection_name = collection_name
+        self.status = "running"
+        self.total_count = 0
+        self.scanned_count = 0
+        self.processed_count = 0
+        self.skipped_count = 0
+        self.error = None
+        self.start_time = time.time()
+        self.end_time = None
+
+    @classmethod
+    def from_document(cls, collection_name, document):
+        progress = cls(collection_name)
+        for field in ["status", "total_count", "scanned_count", "processed_count", "skipped_count",
+                      "error", "start_time", "end_time"]:
+            setattr(progress, field, document.get(field))
+
+        return progress
+
+    def to_document(self):
+        return {
+            "status": self.status,
+            "total_count": self.total_count,
+            "scanned_count": self.scanned_count,
+            "processed_count": self.processed_count,
+            "skipped_count": self.skipped_count,
+            "error": self.error,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "heartbeat_time": datetime.now()
+        }
+
+    async def save(self, tasks_collection):
+        # a calculation that timed out does not overwrite the state of the one that replaced it
+        await tasks_collection.update_one({"_id": self.collection_name, "start_time": self.start_time},
+                                          {"$set": self.to_document()})
+
+    def to_dict(self):
+        end_time = self.end_time if self.end_time is not None else time.time()
+        return {
+            "datapoints": self.collection_name,
+            "status": self.status,
+            "total_count": self.total_count,
+            "scanned_count": self.scanned_count,
+            "processed_count": self.processed_count,
+            "skipped_count": self.skipped_count,
+            "progress": self.scanned_count / self.total_count if self.total_count > 0 else 1.0,
+            "total_time": f"{end_time - self.start_time:.2f} seconds",
+            "error": self.error
+        }
+
+
+async def calculate_delta_scores(datapoints_collection, jobs_collection, tasks_collection, progress,
+                                 chunk_size=DELTA_SCORE_CHUNK_SIZE):
+    # motor collections, progress is saved after every chunk
+    query = get_missing_delta_score_query()
+    progress.total_count = await datapoints_collection.count_documents(query)
+    progress.skipped_count = await datapoints_collection.estimated_document_count() - progress.total_count
+    await progress.save(tasks_collection)
+
+    cursor = datapoints_collection.find(query, get_datapoint_projection(), batch_size=chunk_size)
+    try:
+        while True:
+            datapoints = await cursor.to_list(length=chunk_size)
+            if len(datapoints) == 0:
+                break
+
+            image_hashes = set()
+            for datapoint in datapoints:
+                image_hashes.update(get_image_hashes(datapoint))
+            image_hashes.discard(None)
+
+            jobs = await jobs_collection.find({JOB_HASH_FIELD: {"$in": list(image_hashes)}},
+                                              get_job_score_projection()).to_list(length=None)
+            updates, num_delta_scores = compute_delta_score_updates(datapoints, get_job_scores(jobs))
+            if len(updates) > 0:
+                await datapoints_collection.bulk_write(updates, ordered=False)
+
+            progress.scanned_count += len(datapoints)
+            progress.processed_count += num_delta_scores
+            await progress.save(tasks_collection)
+    finally:
+        await cursor.close()
+
+
+async def run_delta_score_task(datapoints_collection, jobs_collection, tasks_collection, progress):
+    try:
+        await calculate_delta_scores(datapoints_collection, jobs_collection, tasks_collection, progress)
+        progress.status = "completed"
+    except Exception as e:
+        print(f"Error calculating the delta scores of '{progress.collection_name}': {e}")
+        progress.status = "failed"
+        progress.error = str(e)
+
+    progress.end_time = time.time()
+    try:
+        await progress.save(tasks_collection)
+    except Exception as e:
+        print(f"Error saving the delta scores progress of '{progress.collection_name}': {e}")
+
+
+async def start_delta_score_task(app, collection_name):
+    # collection_name is the app attribute of the datapoints collection
+    # returns the progress of the calculation, a running one is not started again
+    tasks_collection = app.async_collections.delta_score_tasks_collection
+    progress = DeltaScoreProgress(collection_name)
+    timeout_time = datetime.now() - timedelta(seconds=DELTA_SCORE_TASK_TIMEOUT_SECONDS)
+
+    # the upsert fails with a duplicate key while a calculation is running
+    try:
+        await tasks_collection.update_one(
+            {"_id": collection_name,
+             "$or": [{"status": {"$ne": "running"}}, {"heartbeat_time": {"$lt": timeout_time}}]},
+            {"$set": progress.to_document()},
+            upsert=True)
+    except DuplicateKeyError:
+        document = await tasks_collection.find_one({"_id": collection_name})
+        return DeltaScoreProgress.from_document(collection_name, document), False
+
+    datapoints_collection = getattr(app.async_collections, collection_name)
+    task = asyncio.create_task(run_delta_score_task(datapoints_collection,
+                                                    app.async_collections.completed_jobs_collection,
+                                                    tasks_collection,
+                                                    progress))
+    running_tasks.add(task)
+    task.add_done_callback(running_tasks.discard)
+
+    return progress, True
+
+
+async def get_delta_score_progress(app, collection_name):
+    document = await app.async_collections.delta_score_tasks_collection.find_one({"_id": collection_name})
+    if document is None:
+        return None
+
+    return DeltaScoreProgress.from_document(collection_name, document).to_dict()
@@ -0,0 +1,531 @@
+import asyncio
+from datetime import datetime
+from pymongo import UpdateOne
+from orchestration.api.utils.api_locks import acquire_lock_async
+
+# incrementally maintained job and score counters
+#
+# the count endpoints used to scan the job collections on every call,
+# and the prompt job generator polls them all the time. instead every job
+# state transition and every score write does an atomic $inc on small
+# counter documents, so a count is read from a few documents whatever
+# the number of jobs
+#
+# job-counters has one document per (state, dataset, task type) with
+# day None, and for the completed jobs one more per completion day:
+#   {"_id": "completed|waifu|img2img_generation_kandinsky|2024-05-01",
+#    "state": "completed", "dataset": "waifu",
+#    "task_type": "img2img_generation_kandinsky", "day": "2024-05-01", "count": 12}
+#
+# job-score-counters has one document per (dataset, task type, model type, score attribute)
+# with the number of completed jobs that have the score, and how many are above each threshold:
+#   {"_id": "waifu|img2img_generation_kandinsky|elm-v1|image_clip_sigma_score",
+#    ..., "count": 10, "more_than_0": 6, "more_than_1": 2, "more_than_2": 1, "more_than_3": 0}
+#
+# the _id is built from the key fields, so two concurrent upserts of the
+# same counter can not create two documents
+#
+# writes that do not go through the helpers below (scripts, bulk renames)
+# make the counters drift, so they are recomputed from the job
+# collections by a periodic reconciliation
+#
+# every $inc is also added to the same field under "changes", which is never
+# reset. the reconciliation reads the changes before its aggregation and sets
+# each counter to the recomputed count plus the changes made since, so the
+# transitions that land while it runs are not overwritten
+#
+# until the first reconciliation of a deployment has seeded the counters,
+# the counts are read from the job collections
+JOB_STATES = ["pending", "in_progress", "completed", "failed"]
+SCORE_COUNTER_ATTRIBUTES = ["image_clip_sigma_score", "image_clip_h_sigma_score"]
+SCORE_COUNTER_THRESHOLDS = [0, 1, 2, 3]
+JOB_COUNTERS_RECONCILE_INTERVAL_SECONDS = 60 * 60
+# the reconciliation runs in one api process, see utils/api_locks.py
+JOB_COUNTERS_LOCK = "job-counters-reconciliation"
+JOB_COUNTERS_LOCK_SECONDS = 2 * JOB_COUNTERS_RECONCILE_INTERVAL_SECONDS
+COUNTER_CHANGES_FIELD = "changes"
+# document of job-counters written once the counters are seeded
+JOB_COUNTERS_SEEDED_ID = "seeded"
+JOB_COUNT_FIELDS = ["count"]
+SCORE_COUNT_FIELDS = ["count"] + [f"more_than_{threshold}" for threshold in SCORE_COUNTER_THRESHOLDS]
+
+
+def get_job_state_collection_name(state):
+    # the app attribute of the job collection of a state
+    return f"{state}_jobs_collection"
+
+
+def get_completion_day(job):
+    # task_completion_time is an iso string or a datetime, the day is the first 10 characters
+    completion_time = job.get("task_completion_time")
+    if completion_time is None:
+        return None
+    if not isinstance(completion_time, str):
+        completion_time = completion_time.isoformat()
+    if len(completion_time) < 10:
+        return None
+
+    return completion_time[:10]
+
+
+def get_job_counter_key(state, dataset, task_type, day=None):
+    return {"_id": f"{state}|{dataset}|{task_type}|{day}"}
+
+
+def get_job_counter_fields(state, dataset, task_type, day=None):
+    return {"state": state, "dataset": dataset, "task_type": task_type, "day": day}
+
+
+def with_changes(increments):
+    # the $inc of the counter fields and of their changes
+    return {**increments, **{f"{COUNTER_CHANGES_FIELD}.{field}": value for field, value in increments.items()}}
+
+
+def get_job_counter_updates(job, state, delta):
+    # $inc of the counters of one job entering (delta 1) or leaving (delta -1) a state
+    dataset = (job.get("task_input_dict") or {}).get("dataset")
+    task_type = job.get("task_type")
+
+    days = [None]
+    if state == "completed":
+        day = get_completion_day(job)
+        if day is not None:
+            days.append(day)
+
+    updates = []
+    for day in days:
+        updates.append(UpdateOne(
+            get_job_counter_key(state, dataset, task_type, day),
+            {"$inc": with_changes({"count": delta}),
+             "$set": get_job_counter_fields(state, dataset, task_type, day)},
+            upsert=True))
+
+    return updates
+
+
+def get_job_transition_updates(job, from_state=None, to_state=None):
+    # from_state None for a new job, to_state None for a deleted job
+    updates = []
+    if from_state is not None:
+        updates += get_job_counter_updates(job, from_state, -1)
+    if to_state is not None:
+        updates += get_job_counter_updates(job, to_state, 1)
+
+    return updates
+
+
+def get_score_counter_key(dataset, task_type, model_type, attribute):
+    return {"_id": f"{dataset}|{task_type}|{model_type}|{attribute}"}
+
+
+def get_score_counter_increments(score, delta):
+    increments = {"count": delta}
+    for threshold in SCORE_COUNTER_THRESHOLDS:
+        increments[f"more_than_{threshold}"] = delta if score > threshold else 0
+
+    return increments
+
+
+def is_counted_score(score):
+    return isinstance(score, (int, float)) and not isinstance(score, bool)
+
+
+def get_score_counter_updates(job, model_type, new_attributes):
+    # job is the completed job before the update, with its task_attributes_dict
+    # only the scores that were added or changed move the counters
+    dataset = (job.get("task_input_dict") or {}).get("dataset")
+    task_type = job.get("task_type")
+    old_attributes = ((job.get("task_attributes_dict") or {}).get(model_type)) or {}
+
+    updates = []
+    for attribute in SCORE_COUNTER_ATTRIBUTES:
+        if attribute not in new_attributes:
+            continue
+        old_score = old_attributes.get(attribute)
+        new_score = new_attributes[attribute]
+        if old_score == new_score:
+            continue
+
+        increments = {}
+        for score, delta in [(old_score, -1), (new_score, 1)]:
+            if not is_counted_score(score):
+                continue
+            for field, value in get_score_counter_increments(score, delta).items():
+                increments[field] = increments.get(field, 0) + value
+
+        if len(increments) == 0:
+            continue
+
+        updates.append(UpdateOne(
+            get_score_counter_key(dataset, task_type, model_type, attribute),
+            {"$inc": with_changes(increments),
+             "$set": {"dataset": dataset, "task_type": task_type,
+                      "model_type": model_type, "attribute": attribute}},
+            upsert=True))
+
+    return updates
+
+
+def get_job_score_updates(job, delta):
+    # $inc of the score counters of every score of a job
+    # entering (delta 1) or leaving (delta -1) the completed jobs
+    dataset = (job.get("task_input_dict") or {}).get("dataset")
+    task_type = job.get("task_type")
+
+    updates = []
+    for model_type, attributes in (job.get("task_attributes_dict") or {}).items():
+        if not isinstance(attributes, dict):
+            continue
+        for attribute in SCORE_COUNTER_ATTRIBUTES:
+            score = attributes.get(attribute)
+            if not is_counted_score(score):
+                continue
+
+            updates.append(UpdateOne(
+                get_score_counter_key(dataset, task_type, model_type, attribute),
+                {"$inc": with_changes(get_score_counter_increments(score, delta)),
+                 "$set": {"dataset": dataset, "task_type": task_type,
+                          "model_type": model_type, "attribute": attribute}},
+                upsert=True))
+
+    return updates
+
+
+def get_job_transition_score_updates(job, from_state=None, to_state=None):
+    # only the completed jobs are in the score counters
+    updates = []
+    if from_state == "completed":
+        updates += get_job_score_updates(job, -1)
+    if to_state == "completed":
+        updates += get_job_score_updates(job, 1)
+
+    return updates
+
+
+def write_counter_updates(collection, updates):
+    # a failed counter update must not fail the job transition, the reconciliation fixes it
+    if len(updates) == 0:
+        return
+    try:
+        collection.bulk_write(updates, ordered=False)
+    except Exception as e:
+        print(f"Error updating the counters of '{collection.name}': {e}")
+
+
+async def write_counter_updates_async(collection, updates):
+    # motor version of write_counter_updates
+    if len(updates) == 0:
+        return
+    try:
+        await collection.bulk_write(updates, ordered=False)
+    except Exception as e:
+        print(f"Error updating the counters of '{collection.name}': {e}")
+
+
+def count_job_transition(app, job, from_state=None, to_state=None):
+    write_counter_updates(app.job_counters_collection, get_job_transition_updates(job, from_state, to_state))
+    write_counter_updates(app.job_score_counters_collection, get_job_transition_score_updates(job, from_state, to_state))
+
+
+async def count_job_transition_async(app, job, from_state=None, to_state=None):
+    await write_counter_updates_async(app.async_collections.job_counters_collection,
+                                      get_job_transition_updates(job, from_state, to_state))
+    await write_counter_updates_async(app.async_collections.job_score_counters_collection,
+                                      get_job_transition_score_updates(job, from_state, to_state))
+
+
+def count_job_scores(app, job, model_type, new_attributes):
+    write_counter_updates(app.job_score_counters_collection, get_score_counter_updates(job, model_type, new_attributes))
+
+
+# ------------------ reads ------------------
+
+def is_seeded(app):
+    # the seeded state is cached once true, the counters stay seeded
+    if not getattr(app, "job_counters_seeded", False):
+        app.job_counters_seeded = app.job_counters_collection.find_one({"_id": JOB_COUNTERS_SEEDED_ID}, {"_id": 1}) is not None
+
+    return app.job_counters_seeded
+
+
+async def is_seeded_async(app):
+    if not getattr(app, "job_counters_seeded", False):
+        seeded = await app.async_collections.job_counters_collection.find_one({"_id": JOB_COUNTERS_SEEDED_ID}, {"_id": 1})
+        app.job_counters_seeded = seeded is not None
+
+    return app.job_counters_seeded
+
+
+# any_dataset False counts only the jobs of dataset, with None the jobs without a dataset
+def get_job_counter_query(state, dataset=None, task_type=None, day=None, any_dataset=True):
+    query = {"state": state, "day": day}
+    if dataset is not None or not any_dataset:
+        query["dataset"] = dataset
+    if task_type is not None:
+        query["task_type"] = task_type
+
+    return query
+
+
+def get_job_query(dataset=None, task_type=None, any_dataset=True):
+    # query of the job collections, for the counts before the counters are seeded
+    query = {}
+    if dataset is not None or not any_dataset:
+        query["task_input_dict.dataset"] = dataset
+    if task_type is not None:
+        query["task_type"] = task_type
+
+    return query
+
+
+def sum_counts(counters, field="count"):
+    return sum(max(counter.get(field, 0), 0) for counter in counters)
+
+
+def get_job_count(app, state, dataset=None, task_type=None, any_dataset=True):
+    if not is_seeded(app):
+        job_collection = getattr(app, get_job_state_collection_name(state))
+        return job_collection.count_documents(get_job_query(dataset, task_type, any_dataset))
+
+    counters = app.job_counters_collection.find(get_job_counter_query(state, dataset, task_type, any_dataset=any_dataset), {"count": 1})
+    return sum_counts(counters)
+
+
+async def get_job_count_async(app, state, dataset=None, task_type=None):
+    if not await is_seeded_async(app):
+        job_collection = getattr(app.async_collections, get_job_state_collection_name(state))
+        return await job_collection.count_documents(get_job_query(dataset, task_type))
+
+    counters = await app.async_collections.job_counters_collection.find(
+        get_job_counter_query(state, dataset, task_type), {"count": 1}).to_list(length=None)
+    return sum_counts(counters)
+
+
+async def get_job_counts_async(app, dataset=None, task_type=None):
+    # {state: count} for every state, with one query
+    if not await is_seeded_async(app):
+        return {state: await get_job_count_async(app, state, dataset, task_type) for state in JOB_STATES}
+
+    query = {"day": None}
+    if dataset is not None:
+        query["dataset"] = dataset
+    if task_type is not None:
+        query["task_type"] = task_type
+
+    counts = {state: 0 for state in JOB_STATES}
+    async for counter in app.async_collections.job_counters_collection.find(query, {"state": 1, "count": 1}):
+        if counter.get("state") in counts:
+            counts[counter["state"]] += max(counter.get("count", 0), 0)
+
+    return counts
+
+
+async def get_job_counts_by_field_async(app, state, field):
+    # {value of field: count} of the jobs in a state, field is dataset or task_type
+    counts = {}
+    if not await is_seeded_async(app):
+        job_collection = getattr(app.async_collections, get_job_state_collection_name(state))
+        job_field = "task_input_dict.dataset" if field == "dataset" else field
+        async for group in job_collection.aggregate([{"$group": {"_id": f"${job_field}", "count": {"$sum": 1}}}], allowDiskUse=True):
+            counts[group["_id"]] = group["count"]
+        return counts
+
+    async for counter in app.async_collections.job_counters_collection.find({"state": state, "day": None}, {field: 1, "count": 1}):
+        value = counter.get(field)
+        counts[value] = counts.get(value, 0) + max(counter.get("count", 0), 0)
+
+    return counts
+
+
+async def get_completed_counts_per_day_async(app, start_day, end_day, task_types=None):
+    # {day: {dataset: count}} of the completed jobs, days are YYYY-MM-DD strings
+    if not await is_seeded_async(app):
+        return await get_completed_counts_per_day_from_jobs_async(app, start_day, end_day, task_types)
+
+    query = {"state": "completed", "day": {"$gte": start_day, "$lte": end_day}}
+    if task_types is not None:
+        query["task_type"] = {"$in": task_types}
+
+    counts = {}
+    async for counter in app.async_collections.job_counters_collection.find(query, {"day": 1, "dataset": 1, "count": 1}):
+        by_dataset = counts.setdefault(counter["day"], {})
+        by_dataset[counter.get("dataset")] = by_dataset.get(counter.get("dataset"), 0) + max(counter.get("count", 0), 0)
+
+    return counts
+
+
+async def get_completed_counts_per_day_from_jobs_async(app, start_day, end_day, task_types=None):
+    pipeline = []
+    if task_types is not None:
+        pipeline.append({"$match": {"task_type": {"$in": task_types}}})
+    pipeline += [
+        {"$project": {"_id": 0, "dataset": "$task_input_dict.dataset", "day": get_completion_day_expression()}},
+        {"$match": {"day": {"$gte": start_day, "$lte": end_day}}},
+        {"$group": {"_id": {"day": "$day", "dataset": "$dataset"}, "count": {"$sum": 1}}}
+    ]
+
+    counts = {}
+    async for group in app.async_collections.completed_jobs_collection.aggregate(pipeline, allowDiskUse=True):
+        counts.setdefault(group["_id"]["day"], {})[group["_id"].get("dataset")] = group["count"]
+
+    return counts
+
+
+async def get_score_counters_async(app, attribute, model_type=None, task_type=None):
+    query = {"attribute": attribute}
+    if model_type is not None:
+        query["model_type"] = model_type
+    if task_type is not None:
+        query["task_type"] = task_type
+
+    if not await is_seeded_async(app):
+        # the same documents, counted from the completed jobs
+        pipeline = get_score_counts_pipeline(attribute, model_type, task_type)
+        counters = []
+        async for group in app.async_collections.completed_jobs_collection.aggregate(pipeline, allowDiskUse=True):
+            key = group.pop("_id")
+            counters.append({"dataset": key.get("dataset"), "task_type": key.get("task_type"),
+                             "model_type": key.get("model_type"), "attribute": attribute, **group})
+        return counters
+
+    return await app.async_collections.job_score_counters_collection.find(query).to_list(length=None)
+
+
+# ------------------ reconciliation ------------------
+
+def get_completion_day_expression():
+    # same day as get_completion_day, in the aggregation language
+    return {"$cond": [
+        {"$eq": [{"$type": "$task_completion_time"}, "date"]},
+        {"$dateToString": {"format": "%Y-%m-%d", "date": "$task_completion_time"}},
+        {"$cond": [
+            {"$eq": [{"$type": "$task_completion_time"}, "string"]},
+            {"$substrCP": ["$task_completion_time", 0, 10]},
+            None
+        ]}
+    ]}
+
+
+def get_job_counts_pipeline(per_day):
+    group_id = {"dataset": "$task_input_dict.dataset", "task_type": "$task_type"}
+    if per_day:
+        group_id["day"] = get_completion_day_expression()
+
+    return [{"$group": {"_id": group_id, "count": {"$sum": 1}}}]
+
+
+def get_score_counts_pipeline(attribute, model_type=None, task_type=None):
+    score_counts = {"count": {"$sum": 1}}
+    for threshold in SCORE_COUNTER_THRESHOLDS:
+        score_counts[f"more_than_{threshold}"] = {"$sum": {"$cond": [{"$gt": ["$score", threshold]}, 1, 0]}}
+
+    job_query = {"task_attributes_dict": {"$type": "object"}}
+    if task_type is not None:
+        job_query["task_type"] = task_type
+    score_query = {"score": {"$type": "number"}}
+    if model_type is not None:
+        score_query["model_type"] = model_type
+
+    return [
+        {"$match": job_query},
+        {"$project": {"_id": 0, "task_type": 1, "dataset": "$task_input_dict.dataset",
+                      "models": {"$objectToArray": "$task_attributes_dict"}}},
+        {"$unwind": "$models"},
+        {"$project": {"task_type": 1, "dataset": 1, "model_type": "$models.k",
+                      "score": f"$models.v.{attribute}"}},
+        {"$match": score_query},
+        {"$group": {"_id": {"dataset": "$dataset", "task_type": "$task_type", "model_type": "$model_type"},
+                    **score_counts}}
+    ]
+
+
+async def read_counter_changes(collection, query, count_fields):
+    # {counter id: {field: changes}}, read before the recount
+    snapshot = {}
+    async for counter in collection.find(query, {COUNTER_CHANGES_FIELD: 1}):
+        changes = counter.get(COUNTER_CHANGES_FIELD) or {}
+        snapshot[counter["_id"]] = {field: changes.get(field, 0) for field in count_fields}
+
+    return snapshot
+
+
+def get_recount_update(fields, counts, changes, count_fields):
+    # update pipeline that sets a counter to its recomputed counts plus the
+    # changes made since the snapshot, in one atomic write
+    values = {name: {"$literal": value} for name, value in fields.items()}
+    for field in count_fields:
+        changes_since = {"$subtract": [{"$ifNull": [f"${COUNTER_CHANGES_FIELD}.{field}", 0]}, changes.get(field, 0)]}
+        values[field] = {"$add": [counts.get(field, 0), changes_since]}
+
+    return [{"$set": values}]
+
+
+async def replace_counters(collection, counters, snapshot, query, count_fields):
+    # counters is {counter id: (fields, counts)} of the recount. the counters of
+    # the snapshot that were not recounted have no job left, they keep only the
+    # changes made since, and the ones left at 0 are removed
+    updates = []
+    for counter_id, (fields, counts) in counters.items():
+        updates.append(UpdateOne({"_id": counter_id},
+                                 get_recount_update(fields, counts, snapshot.get(counter_id, {}), count_fields),
+                                 upsert=True))
+    for counter_id, changes in snapshot.items():
+        if counter_id not in counters:
+            updates.append(UpdateOne({"_id": counter_id}, get_recount_update({}, {}, changes, count_fields)))
+
+    if len(updates) > 0:
+        await collection.bulk_write(updates, ordered=False)
+
+    await collection.delete_many({**query, **{field: 0 for field in count_fields}})
+
+
+async def reconcile_job_counters(app):
+    # recomputes every counter from the job collections
+    # a transition can still be counted twice, or not at all, if its job is
+    # moved between the aggregations of two states while they run
+    collections = app.async_collections
+
+    for state in JOB_STATES:
+        job_collection = getattr(collections, get_job_state_collection_name(state))
+        snapshot = await read_counter_changes(collections.job_counters_collection, {"state": state}, JOB_COUNT_FIELDS)
+        counters = {}
+        for per_day in ([False, True] if state == "completed" else [False]):
+            async for group in job_collection.aggregate(get_job_counts_pipeline(per_day), allowDiskUse=True):
+                key = group["_id"]
+                day = key.get("day")
+                if per_day and day is None:
+                    continue
+                fields = get_job_counter_fields(state, key.get("dataset"), key.get("task_type"), day)
+                counter_id = get_job_counter_key(state, fields["dataset"], fields["task_type"], day)["_id"]
+                counters[counter_id] = (fields, {"count": group["count"]})
+
+        await replace_counters(collections.job_counters_collection, counters, snapshot, {"state": state}, JOB_COUNT_FIELDS)
+
+    for attribute in SCORE_COUNTER_ATTRIBUTES:
+        snapshot = await read_counter_changes(collections.job_score_counters_collection, {"attribute": attribute}, SCORE_COUNT_FIELDS)
+        counters = {}
+        async for group in collections.completed_jobs_collection.aggregate(get_score_counts_pipeline(attribute), allowDiskUse=True):
+            key = group.pop("_id")
+            counter_id = get_score_counter_key(key.get("dataset"), key.get("task_type"), key.get("model_type"), attribute)["_id"]
+            fields = {"dataset": key.get("dataset"), "task_type": key.get("task_type"),
+                      "model_type": key.get("model_type"), "attribute": attribute}
+            counters[counter_id] = (fields, group)
+
+        await replace_counters(collections.job_score_counters_collection, counters, snapshot, {"attribute": attribute}, SCORE_COUNT_FIELDS)
+
+    await collections.job_counters_collection.update_one({"_id": JOB_COUNTERS_SEEDED_ID},
+                                                         {"$set": {"seeded_time": datetime.now()}}, upsert=True)
+
+
+async def monitor_job_counters(app):
+    # the first reconciliation also fills the counters of a new deployment
+    while True:
+        try:
+            if await acquire_lock_async(app.async_collections.api_locks_collection,
+                                        JOB_COUNTERS_LOCK, JOB_COUNTERS_LOCK_SECONDS):
+                await reconcile_job_counters(app)
+                print("Reconciled the job counters")
+        except Exception as e:
+            print(f"Error reconciling the job counters: {e}")
+
+        await asyncio.sleep(JOB_COUNTERS_RECONCILE_INTERVAL_SECONDS)
@@ -0,0 +1,94 @@
+import base64
+import json
+from bson import ObjectId
+
+# keyset pagination of score sorted listings
+#
+# skip(offset) makes mongo walk and discard offset index entries, so deep
+# pages get slower and slower. instead the listings sort on (score, _id)
+# and return a continuation token with the (score, _id) of the last row,
+# the next page starts right after it with an index range scan, so every
+# page costs the same
+#
+# the token is opaque for the clients, it is the urlsafe base64 of
+# {"v": sort value, "i": _id, "o": sort order}
+
+
+class ContinuationTokenError(ValueError):
+    pass
+
+
+def encode_continuation_token(sort_value, document_id, sort_order):
+    if isinstance(document_id, ObjectId):
+        token_id = {"$oid": str(document_id)}
+    else:
+        token_id = document_id
+
+    data = json.dumps({"v": sort_value, "i": token_id, "o": sort_order}, separators=(",", ":"))
+
+    return base64.urlsafe_b64encode(data.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_continuation_token(token, sort_order):
+    # returns (sort value, _id), raises ContinuationTokenError if the token is not valid
+    try:
+        padding = "=" * (-len(token) % 4)
+        data = json.loads(base64.urlsafe_b64decode(token + padding))
+        sort_value = data["v"]
+        document_id = data["i"]
+        token_sort_order = data["o"]
+        if isinstance(document_id, dict):
+            document_id = ObjectId(document_id["$oid"])
+    except Exception:
+        raise ContinuationTokenError("The continuation token is not valid.")
+
+    if token_sort_order != sort_order:
+        raise ContinuationTokenError("The continuation token was created with another sort order.")
+
+    return sort_value, document_id
+
+
+def get_keyset_sort(sort_field, sort_order):
+    # _id breaks the ties between equal scores, so the order is total
+    return [(sort_field, sort_order), ("_id", sort_order)]
+
+
+def apply_continuation_token(query, sort_field, sort_order, continuation_token):
+    # returns the query restricted to the rows after the token
+    if continuation_token is None:
+        return query
+
+    sort_value, document_id = decode_continuation_token(continuation_token, sort_order)
+    operator = "$gt" if sort_order == 1 else "$lt"
+    after_token = {"$or": [
+        {sort_field: {operator: sort_value}},
+        {sort_field: sort_value, "_id": {operator: document_id}}
+    ]}
+
+    if len(query) == 0:
+        return after_token
+
+    return {"$and": [query, after_token]}
+
+
+def get_next_continuation_token(documents, sort_field, sort_order, limit):
+    # documents must still have their _id
+    # there is no next page if the page is not full
+    if limit <= 0 or len(documents) < limit:
+        return None
+
+    last_document = documents[-1]
+
+    return encode_continuation_token(last_document[sort_field], last_document["_id"], sort_order)
+
+
+def find_page(collection, query, sort_field, sort_order, limit, offset=0, continuation_token=None, projection=None):
+    # returns the cursor of one page, works with pymongo and motor collections
+    # offset is only used for the first page, the next ones use the token
+    # raises ContinuationTokenError if the token is not valid
+    query = apply_continuation_token(query, sort_field, sort_order, continuation_token)
+    cursor = collection.find(query, projection).sort(get_keyset_sort(sort_field, sort_order))
+    if continuation_token is None and offset > 0:
+        cursor = cursor.skip(offset)
+
+    return cursor.limit(limit)
@@ -0,0 +1,94 @@
+import json
+from datetime import datetime
+from starlette.responses import StreamingResponse
+from orchestration.api.utils.random_sampling import RANDOM_KEY_FIELD
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# streamed list responses
+#
+# the list endpoints that can return a whole collection accept stream=true
+# the documents are then sent as newline delimited json, one per line,
+# straight from a server side cursor, so the server memory does not grow
+# with the size of the collection and the client gets the first rows
+# as soon as the first cursor batch is read
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+# documents read from mongo per cursor round trip
+NDJSON_CURSOR_BATCH_SIZE = 1000
+# encoded lines sent to the client per chunk
+NDJSON_LINES_PER_CHUNK = 500
+
+
+def wants_ndjson_stream(request, stream=False):
+    # streaming is opt-in, with ?stream=true or an ndjson accept header
+    if stream:
+        return True
+
+    return NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+def default_encoder(value):
+    # same output as the json responses, datetimes in iso format
+    if isinstance(value, datetime):
+        return value.isoformat()
+
+    return str(value)
+
+
+def encode_ndjson_line(document):
+    document.pop(RANDOM_KEY_FIELD, None)
+    if orjson is not None:
+        return orjson.dumps(document, default=default_encoder,
+                            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE)
+
+    return (json.dumps(document, default=default_encoder, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+async def iterate_async_cursor(cursor, transform=None):
+    # motor cursor, the cursor is closed if the client disconnects
+    lines = []
+    try:
+        async for document in cursor:
+            if transform is not None:
+                document = transform(document)
+            lines.append(encode_ndjson_line(document))
+
+            if len(lines) == NDJSON_LINES_PER_CHUNK:
+                yield b"".join(lines)
+                lines = []
+
+        if len(lines) > 0:
+            yield b"".join(lines)
+    finally:
+        await cursor.close()
+
+
+def iterate_cursor(cursor, transform=None):
+    # pymongo cursor, starlette runs it in the thread pool
+    lines = []
+    try:
+        for document in cursor:
+            if transform is not None:
+                document = transform(document)
+            lines.append(encode_ndjson_line(document))
+
+            if len(lines) == NDJSON_LINES_PER_CHUNK:
+                yield b"".join(lines)
+                lines = []
+
+        if len(lines) > 0:
+            yield b"".join(lines)
+    finally:
+        cursor.close()
+
+
+def create_ndjson_stream_response(cursor, transform=None, headers=None):
+    # cursor is a motor or a pymongo cursor, transform is applied to every document
+    if hasattr(cursor, "__aiter__"):
+        content = iterate_async_cursor(cursor, transform)
+    else:
+        content = iterate_cursor(cursor, transform)
+
+    return StreamingResponse(content, status_code=200, media_type=NDJSON_MEDIA_TYPE, headers=headers)
@@ -0,0 +1,238 @@
+import math
+import random
+import threading
+
+# indexed random sampling
+#
+# $sample on a filtered collection reads every matching document, and
+# shuffling the matching ids in python loads all of them in the server.
+# instead every sampled document stores a uniform random key, indexed
+# after the filter fields, and a sample is drawn with range seeks:
+# pick r in [0, 1), read the documents with the smallest keys >= r
+# (wrapping around to 0 at the end). each seek is one index range read,
+# so the cost does not depend on the size of the collection
+#
+# the samples are without replacement, documents are deduplicated by _id.
+# small samples use one seek per document, large ones use runs of
+# consecutive keys, see MAX_SEEKS_PER_SAMPLE
+RANDOM_KEY_FIELD = "random_key"
+# above this many documents the sample is made of runs of consecutive
+# keys instead of one seek per document
+MAX_SEEKS_PER_SAMPLE = 64
+# the seeks that only return already sampled documents are retried
+# up to this many times the planned number of seeks
+MAX_SEEK_ATTEMPTS_FACTOR = 3
+# scores sampled per wanted document by sample_joined_documents
+# some sampled scores have no document matching the query
+JOIN_OVERSAMPLING_FACTOR = 2
+MAX_JOIN_ROUNDS = 8
+# the backfill runs in one api process at most once per lock duration, see utils/api_locks.py
+RANDOM_KEY_BACKFILL_LOCK = "random-key-backfill"
+RANDOM_KEY_BACKFILL_LOCK_SECONDS = 60 * 60
+# levels of a response searched for documents with a random key
+MAX_RANDOM_KEY_STRIP_DEPTH = 4
+
+
+def get_random_key():
+    return random.random()
+
+
+def add_random_key(document):
+    # for documents that are inserted
+    document[RANDOM_KEY_FIELD] = get_random_key()
+    return document
+
+
+def strip_random_keys(content, depth=0):
+    # the random key is internal to the sampler, the shared json responses
+    # remove it from the documents they return, in place. documents are the
+    # content, items of a list or values of a wrapper dict, so only a few
+    # levels are visited, and lists of numbers are not walked
+    if depth > MAX_RANDOM_KEY_STRIP_DEPTH:
+        return content
+
+    if isinstance(content, dict):
+        content.pop(RANDOM_KEY_FIELD, None)
+        for value in content.values():
+            if isinstance(value, (dict, list)):
+                strip_random_keys(value, depth + 1)
+    elif isinstance(content, list) and len(content) > 0 and isinstance(content[0], (dict, list)):
+        for item in content:
+            strip_random_keys(item, depth + 1)
+
+    return content
+
+
+def get_random_key_on_insert():
+    # for upserts, {"$setOnInsert": get_random_key_on_insert()}
+    return {RANDOM_KEY_FIELD: get_random_key()}
+
+
+def get_random_key_index(filter_fields):
+    # equality filter fields first, then the random key
+    return [(field, 1) for field in filter_fields] + [(RANDOM_KEY_FIELD, 1)]
+
+
+def backfill_random_keys(collection):
+    # gives a random key to the documents inserted before the sampler
+    # or by a path that does not set it, runs on the server with $rand
+    result = collection.update_many(
+        {RANDOM_KEY_FIELD: {"$exists": False}},
+        [{"$set": {RANDOM_KEY_FIELD: {"$rand": {}}}}]
+    )
+    if result.modified_count > 0:
+        print(f"Added random keys to {result.modified_count} documents of '{collection.name}'.")
+
+
+def backfill_random_keys_in_background(collections):
+    # the first backfill of a big collection is long, so it does not block the startup
+    def run():
+        for collection in collections:
+            try:
+                backfill_random_keys(collection)
+            except Exception as e:
+                print(f"Could not add random keys to '{collection.name}': {e}")
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+
+    return thread
+
+
+def get_seek_queries(query, random_key):
+    # documents with keys >= random_key, then the ones before it for the wrap around
+    after_query = {RANDOM_KEY_FIELD: {"$gte": random_key}}
+    before_query = {RANDOM_KEY_FIELD: {"$lt": random_key}}
+    if len(query) > 0:
+        after_query = {"$and": [query, after_query]}
+        before_query = {"$and": [query, before_query]}
+
+    return after_query, before_query
+
+
+def get_sampling_projection(projection):
+    # _id is needed to deduplicate, it is removed after if the caller excluded it
+    if projection is None or projection.get("_id", 1) != 0:
+        return projection, False
+
+    projection = {key: value for key, value in projection.items() if key != "_id"}
+    if len(projection) == 0:
+        projection = None
+
+    return projection, True
+
+
+class RandomSample:
+    # the state of one sample, shared by the sync and the async versions
+    def __init__(self, size, projection=None):
+        self.size = size
+        self.projection, self.remove_id = get_sampling_projection(projection)
+
+        num_seeks = min(size, MAX_SEEKS_PER_SAMPLE)
+        self.run_length = math.ceil(size / num_seeks) if num_seeks > 0 else 0
+        self.max_attempts = num_seeks * MAX_SEEK_ATTEMPTS_FACTOR
+
+        self.num_attempts = 0
+        self.exhausted = False
+        self.seen_ids = set()
+        self.documents = []
+
+    def wants_more(self):
+        return len(self.documents) < self.size and self.num_attempts < self.max_attempts and not self.exhausted
+
+    def get_seek_length(self):
+        self.num_attempts += 1
+        return min(self.run_length, self.size - len(self.documents))
+
+    def add_documents(self, documents, seek_length):
+        # a seek that wrapped around and still got less than it asked
+        # has read every matching document
+        if len(documents) < seek_length:
+            self.exhausted = True
+
+        for document in documents:
+            if document["_id"] in self.seen_ids:
+                continue
+            self.seen_ids.add(document["_id"])
+            self.documents.append(document)
+
+    def get_documents(self):
+        documents = self.documents[:self.size]
+        for document in documents:
+            document.pop(RANDOM_KEY_FIELD, None)
+            if self.remove_id:
+                document.pop("_id", None)
+
+        return documents
+
+
+def sample_documents(collection, query, size, projection=None):
+    # pymongo version, returns up to size random documents matching query
+    sample = RandomSample(size, projection)
+
+    while sample.wants_more():
+        seek_length = sample.get_seek_length()
+        after_query, before_query = get_seek_queries(query, get_random_key())
+
+        documents = list(collection.find(after_query, sample.projection).sort(RANDOM_KEY_FIELD, 1).limit(seek_length))
+        if len(documents) < seek_length:
+            documents += list(collection.find(before_query, sample.projection).sort(RANDOM_KEY_FIELD, 1).limit(seek_length - len(documents)))
+
+        sample.add_documents(documents, seek_length)
+
+    return sample.get_documents()
+
+
+async def sample_documents_async(collection, query, size, projection=None):
+    # motor version of sample_documents
+    sample = RandomSample(size, projection)
+
+    while sample.wants_more():
+        seek_length = sample.get_seek_length()
+        after_query, before_query = get_seek_queries(query, get_random_key())
+
+        documents = await collection.find(after_query, sample.projection).sort(RANDOM_KEY_FIELD, 1).limit(seek_length).to_list(length=None)
+        if len(documents) < seek_length:
+            documents += await collection.find(before_query, sample.projection).sort(RANDOM_KEY_FIELD, 1).limit(seek_length - len(documents)).to_list(length=None)
+
+        sample.add_documents(documents, seek_length)
+
+    return sample.get_documents()
+
+
+def sample_joined_documents(score_collection, score_query, score_field, collection, query, field, size, projection=None):
+    # samples documents of collection matching query, whose field is the
+    # score_field of random documents of score_collection matching score_query
+    # for example the completed jobs of random images with a classifier score above a threshold
+    # the scores are sampled in rounds until size documents are found
+    documents = []
+    seen_values = set()
+
+    for _ in range(MAX_JOIN_ROUNDS):
+        num_scores = JOIN_OVERSAMPLING_FACTOR * (size - len(documents))
+        scores = sample_documents(score_collection, score_query, num_scores, projection={"_id": 0, score_field: 1})
+
+        values = []
+        for score in scores:
+            value = score.get(score_field)
+            if value is not None and value not in seen_values:
+                seen_values.add(value)
+                values.append(value)
+
+        if len(values) > 0:
+            batch_query = {field: {"$in": values}}
+            if len(query) > 0:
+                batch_query = {"$and": [query, batch_query]}
+            documents += list(collection.find(batch_query, projection).limit(size - len(documents)))
+
+        # fewer scores than asked means every matching score was sampled
+        if len(documents) >= size or len(scores) < num_scores:
+            break
+
+    for document in documents:
+        document.pop(RANDOM_KEY_FIELD, None)
+
+    # the $in order is not random
+    random.shuffle(documents)
+
+    return documents[:size]
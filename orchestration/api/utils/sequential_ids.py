@@ -0,0 +1,189 @@
+import threading
+from pymongo import ReturnDocument
+
+# atomic sequential file ids of the datasets
+#
+# the sequential id documents are {"dataset_name", "subfolder_count", "file_count", "generation"},
+# file_count is the last file id given and subfolder_count its subfolder,
+# the subfolder changes every FILES_PER_SUBFOLDER files. ids are "{subfolder:04}/{file:06}"
+#
+# reading the document, advancing it in python and writing it back gave the
+# same ids to concurrent requests. instead a range of ids is reserved with a
+# single update pipeline that adds the amount to file_count and the number of
+# subfolder changes to subfolder_count, and the ids of the range are computed
+# back from the updated document
+#
+# the api processes also lease blocks of SEQUENTIAL_ID_LEASE_SIZE ids and
+# give them out from memory, so most jobs get their file path without a round trip.
+# the ids of a block that is not used before the process stops are skipped
+#
+# a reset puts the counts back to their initial values and increments the
+# generation instead of deleting the document. every api process keeps the
+# generation of its blocks and reads the generation of the document before
+# giving ids from a block, the blocks of an older generation are dropped.
+# the read is cheaper than a lease, the leases all update the same document
+FILES_PER_SUBFOLDER = 1000
+# values of a new sequential id, same as mongo_schemas.SequentialID
+INITIAL_SUBFOLDER_COUNT = 1
+INITIAL_FILE_COUNT = -1
+INITIAL_GENERATION = 0
+SEQUENTIAL_ID_LEASE_SIZE = 32
+
+
+def format_sequential_id(subfolder_count, file_count):
+    return "{0:04}/{1:06}".format(subfolder_count, file_count)
+
+
+def get_subfolder_changes_expression(file_count, amount):
+    # number of multiples of FILES_PER_SUBFOLDER in (file_count, file_count + amount],
+    # 0 is not a change, the first file is in the initial subfolder
+    return {"$subtract": [
+        {"$floor": {"$divide": [{"$add": [file_count, amount]}, FILES_PER_SUBFOLDER]}},
+        {"$floor": {"$divide": [{"$max": [file_count, 0]}, FILES_PER_SUBFOLDER]}}
+    ]}
+
+
+def get_lease_update(amount):
+    # update pipeline reserving amount ids, the document is created if needed
+    file_count = {"$ifNull": ["$file_count", INITIAL_FILE_COUNT]}
+    subfolder_count = {"$ifNull": ["$subfolder_count", INITIAL_SUBFOLDER_COUNT]}
+
+    return [{"$set": {
+        "subfolder_count": {"$add": [subfolder_count, get_subfolder_changes_expression(file_count, amount)]},
+        "file_count": {"$add": [file_count, amount]},
+        "generation": {"$ifNull": ["$generation", INITIAL_GENERATION]}
+    }}]
+
+
+def get_reset_update():
+    # the ids given after a reset start again from the initial values
+    return {"$set": {"subfolder_count": INITIAL_SUBFOLDER_COUNT, "file_count": INITIAL_FILE_COUNT},
+            "$inc": {"generation": 1}}
+
+
+def reset_sequential_ids(collection, dataset=None):
+    # resets one dataset or all of them, returns the pymongo UpdateResult
+    query = {} if dataset is None else {"dataset_name": dataset}
+    return collection.update_many(query, get_reset_update())
+
+
+def get_generation(document):
+    if document is None:
+        return None
+
+    return document.get("generation", INITIAL_GENERATION)
+
+
+def get_leased_sequential_ids(document, amount):
+    # the ids of the range ending at the updated document
+    last_file_count = int(document["file_count"])
+    last_subfolder_count = int(document["subfolder_count"])
+
+    sequential_ids = []
+    for file_count in range(last_file_count - amount + 1, last_file_count + 1):
+        # subfolder changes between this file and the last one
+        changes = last_file_count // FILES_PER_SUBFOLDER - max(file_count, 0) // FILES_PER_SUBFOLDER
+        sequential_ids.append(format_sequential_id(last_subfolder_count - changes, file_count))
+
+    return sequential_ids
+
+
+def lease_sequential_ids(collection, dataset, amount):
+    # reserves amount ids with one round trip
+    # returns the ids and the generation of the document
+    document = collection.find_one_and_update({"dataset_name": dataset}, get_lease_update(amount),
+                                              upsert=True, return_document=ReturnDocument.AFTER)
+
+    return get_leased_sequential_ids(document, amount), get_generation(document)
+
+
+async def lease_sequential_ids_async(collection, dataset, amount):
+    # motor version of lease_sequential_ids
+    document = await collection.find_one_and_update({"dataset_name": dataset}, get_lease_update(amount),
+                                                    upsert=True, return_document=ReturnDocument.AFTER)
+
+    return get_leased_sequential_ids(document, amount), get_generation(document)
+
+
+def read_generation(collection, dataset):
+    # None if the document does not exist
+    return get_generation(collection.find_one({"dataset_name": dataset}, {"generation": 1}))
+
+
+async def read_generation_async(collection, dataset):
+    return get_generation(await collection.find_one({"dataset_name": dataset}, {"generation": 1}))
+
+
+class SequentialIdCache:
+    # ids leased by this process and not given yet, by collection and dataset
+    # sync endpoints run in the thread pool, so the blocks are guarded by a lock
+    def __init__(self, lease_size=SEQUENTIAL_ID_LEASE_SIZE):
+        self.lease_size = lease_size
+        self.lock = threading.Lock()
+        # key => (generation, sequential ids)
+        self.blocks = {}
+
+    def has_block(self, key):
+        with self.lock:
+            return len(self.blocks.get(key, (None, []))[1]) > 0
+
+    def take(self, key, amount, generation):
+        # the block is dropped if the sequential id was reset since it was leased
+        with self.lock:
+            block_generation, block = self.blocks.get(key, (None, []))
+            if block_generation != generation:
+                self.blocks.pop(key, None)
+                return []
+
+            taken = block[:amount]
+            self.blocks[key] = (block_generation, block[amount:])
+
+        return taken
+
+    def get_lease_amount(self, amount):
+        # big requests are leased exactly, small ones lease a whole block
+        return amount if amount >= self.lease_size else self.lease_size
+
+    def keep(self, key, generation, sequential_ids):
+        with self.lock:
+            block_generation, block = self.blocks.get(key, (None, []))
+            if block_generation != generation:
+                block = []
+            self.blocks[key] = (generation, block + sequential_ids)
+
+    def get(self, collection, dataset, amount):
+        key = (collection.name, dataset)
+        sequential_ids = []
+        if self.has_block(key):
+            sequential_ids = self.take(key, amount, read_generation(collection, dataset))
+        missing = amount - len(sequential_ids)
+        if missing > 0:
+            leased, generation = lease_sequential_ids(collection, dataset, self.get_lease_amount(missing))
+            sequential_ids += leased[:missing]
+            self.keep(key, generation, leased[missing:])
+
+        return sequential_ids
+
+    async def get_async(self, collection, dataset, amount):
+        key = (collection.name, dataset)
+        sequential_ids = []
+        if self.has_block(key):
+            sequential_ids = self.take(key, amount, await read_generation_async(collection, dataset))
+        missing = amount - len(sequential_ids)
+        if missing > 0:
+            leased, generation = await lease_sequential_ids_async(collection, dataset, self.get_lease_amount(missing))
+            sequential_ids += leased[:missing]
+            self.keep(key, generation, leased[missing:])
+
+        return sequential_ids
+
+    def clear(self, collection_name, dataset=None):
+        # after a sequential id is reset the leased ids are not valid
+        # the other processes drop their blocks when they read the new generation
+        with self.lock:
+            for key in list(self.blocks.keys()):
+                if key[0] == collection_name and (dataset is None or key[1] == dataset):
+                    del self.blocks[key]
+
+
+sequential_id_cache = SequentialIdCache()
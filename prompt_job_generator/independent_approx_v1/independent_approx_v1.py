@@ -8,7 +8,8 @@ sys.path.insert(0, base_directory)
 
 from utility.boltzman.boltzman_phrase_scores_loader import BoltzmanPhraseScoresLoader
 from utility.boltzman.boltzman import (get_cumulative_probability_arr_without_upload,
-                                        generate_prompts_array)
+                                        get_phrase_sampler,
+                                        generate_prompts_with_samplers)
 
 
 # Helper class that generates prompts using
@@ -24,6 +25,8 @@ class IndependentApproxV1:
         self.negative_phrase_scores_csv = None
 
         self.csv_loaded = False
+        # (positive sampler, negative sampler) by (boltzman temperature, boltzman k)
+        self.phrase_samplers = {}
 
     def load_csv(self, minio_client, positive_phrase_scores_csv, negative_phrase_scores_csv):
         print(f'loading independent approx csvs using {positive_phrase_scores_csv} and {negative_phrase_scores_csv}')
@@ -48,12 +51,15 @@ class IndependentApproxV1:
 
         self.positive_phrase_scores_loader = positive_phrase_scores_loader
         self.negative_phrase_scores_loader = negative_phrase_scores_loader
+        self.phrase_samplers = {}
         self.csv_loaded = True
 
-    def generate_prompts(self, prompt_count, boltzman_temperature, boltzman_k):
-        # making sure the csv was loaded from minio
-        if self.csv_loaded is False:
-            return []
+    def get_phrase_samplers(self, boltzman_temperature, boltzman_k):
+        # the probabilities only change with the temperature and k,
+        # so the samplers are built once for each
+        key = (boltzman_temperature, boltzman_k)
+        if key in self.phrase_samplers:
+            return self.phrase_samplers[key]
 
         positive_phrase_origin_indexes, positive_cumulative_probability_arr = get_cumulative_probability_arr_without_upload(
             index_phrase_score_data=self.positive_phrase_scores_loader.index_phrase_score_data,
@@ -65,13 +71,26 @@ class IndependentApproxV1:
             boltzman_temperature=boltzman_temperature,
             boltzman_k=boltzman_k)
 
-        prompt_list = generate_prompts_array(positive_phrase_scores_loader=self.positive_phrase_scores_loader,
-                                             positive_phrase_origin_indexes=positive_phrase_origin_indexes,
-                                             positive_cumulative_probability_arr=positive_cumulative_probability_arr,
-                                             negative_phrase_scores_loader=self.negative_phrase_scores_loader,
-                                             negative_phrase_origin_indexes=negative_phrase_origin_indexes,
-                                             negative_cumulative_probability_arr=negative_cumulative_probability_arr,
-                                             prompt_count=prompt_count)
+        phrase_samplers = (get_phrase_sampler(self.positive_phrase_scores_loader,
+                                              positive_phrase_origin_indexes,
+                                              positive_cumulative_probability_arr),
+                           get_phrase_sampler(self.negative_phrase_scores_loader,
+                                              negative_phrase_origin_indexes,
+                                              negative_cumulative_probability_arr))
+        self.phrase_samplers[key] = phrase_samplers
+
+        return phrase_samplers
+
+    def generate_prompts(self, prompt_count, boltzman_temperature, boltzman_k):
+        # making sure the csv was loaded from minio
+        if self.csv_loaded is False:
+            return []
+
+        positive_sampler, negative_sampler = self.get_phrase_samplers(boltzman_temperature, boltzman_k)
+        prompts = generate_prompts_with_samplers(positive_sampler, negative_sampler, prompt_count)
+
+        prompt_list = [{"positive_prompt": positive_prompt, "negative_prompt": negative_prompt}
+                       for positive_prompt, negative_prompt in prompts]
 
         # prompt list item is a dictionary type
         # {
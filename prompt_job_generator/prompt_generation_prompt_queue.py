@@ -4,12 +4,15 @@ import math
 import random
 import threading
 import time
+import torch
 
 base_directory = "./"
 sys.path.insert(0, base_directory)
 
 from worker.prompt_generation.prompt_generator import generate_prompts_proportional_selection, generate_base_prompts, load_base_prompts
 from independent_approx_v1.independent_approx_v1 import IndependentApproxV1
+from utility.clip.clip_text_embedder import tensor_attention_pooling
+from prompt_job_generator_constants import PROMPT_SCORING_BATCH_SIZE
 
 class PromptGenerationPromptQueue:
     def __init__(self, queue_size):
@@ -131,7 +134,8 @@ class PromptGenerationPromptQueue:
                                                               prompt_job_generator_state.positive_count_list,
                                                               prompt_job_generator_state.negative_count_list,
                                                               total_prompt_count,
-                                                              '')
+                                                              '',
+                                                              phrase_samplers=prompt_job_generator_state.phrase_samplers)
             prompt_list = []
             for prompt in prompts:
                 # N Base Prompt Phrases
@@ -200,7 +204,8 @@ class PromptGenerationPromptQueue:
                                                               prompt_job_generator_state.positive_count_list,
                                                               prompt_job_generator_state.negative_count_list,
                                                               number_of_positive_prompts_to_generate,
-                                                              '')
+                                                              '',
+                                                              phrase_samplers=prompt_job_generator_state.phrase_samplers)
             positive_prompts = []
             negative_prompts = []
 
@@ -253,32 +258,20 @@ class PromptGenerationPromptQueue:
             if scoring_model != None:
                 print(scoring_model.model_type)
             print('---------------')
-        for prompt in prompts:
+        prompt_scores = [None] * len(prompts)
+        if scoring_model is not None and clip_text_embedder is not None:
+            prompt_scores = self.score_prompts(clip_text_embedder, scoring_model, prompts)
 
-            positive_text_prompt = prompt.positive_prompt
-            negative_text_prompt = prompt.negative_prompt
-
-            prompt_score = 0
-            model_type = 'N/A'
-            if scoring_model is not None and clip_text_embedder is not None:
-
-                positive_prompt_length = clip_text_embedder.compute_token_length(positive_text_prompt)
-                negative_prompt_length = clip_text_embedder.compute_token_length(negative_text_prompt)
-
-                if positive_prompt_length <= clip_text_embedder.max_length and negative_prompt_length <= clip_text_embedder.max_length:
-                    # calculate new embeddings
-                    positive_embedding, _, positive_attention_mask = clip_text_embedder.forward_return_all(positive_text_prompt)
-                    negative_embedding, _, negative_attention_mask = clip_text_embedder.forward_return_all(negative_text_prompt)
-
-                    model_type = model_name
-                    prompt_score = scoring_model.predict_average_pooling(positive_embedding,
-                                                                   negative_embedding,
-                                                         positive_attention_mask,
-                                                         negative_attention_mask).item()
+        for prompt, prompt_score in zip(prompts, prompt_scores):
+            model_type = model_name
+            if prompt_score is None:
+                # not scored or too long for the text embedder
+                prompt_score = 0
+                model_type = 'N/A'
 
             scored_prompt = ScoredPrompt(prompt_score,
-                                         positive_text_prompt,
-                                         negative_text_prompt,
+                                         prompt.positive_prompt,
+                                         prompt.negative_prompt,
                                          model_type,
                                          generation_policy,
                                          top_k,
@@ -293,6 +286,65 @@ class PromptGenerationPromptQueue:
 
         return chosen_scored_prompts
 
+    def score_prompts(self, clip_text_embedder, scoring_model, prompts):
+        # scores all the prompts in batches
+        # returns the list of scores, None for the prompts
+        # that are longer than the text embedder max length
+        prompt_scores = [None] * len(prompts)
+        if len(prompts) == 0:
+            return prompt_scores
+
+        # tokenize all the prompts at once
+        # and drop the ones that are too long
+        positive_prompts = [prompt.positive_prompt for prompt in prompts]
+        negative_prompts = [prompt.negative_prompt for prompt in prompts]
+        token_lengths = clip_text_embedder.compute_token_lengths(positive_prompts + negative_prompts)
+        positive_token_lengths = token_lengths[:len(prompts)]
+        negative_token_lengths = token_lengths[len(prompts):]
+
+        valid_indices = [i for i in range(len(prompts))
+                         if positive_token_lengths[i] <= clip_text_embedder.max_length and
+                         negative_token_lengths[i] <= clip_text_embedder.max_length]
+        if len(valid_indices) == 0:
+            return prompt_scores
+
+        if not hasattr(scoring_model, 'predict_pooled_batch'):
+            # models without a batched predict are scored one prompt at a time
+            for i in valid_indices:
+                with torch.no_grad():
+                    positive_embedding, _, positive_attention_mask = clip_text_embedder.forward_return_all(positive_prompts[i])
+                    negative_embedding, _, negative_attention_mask = clip_text_embedder.forward_return_all(negative_prompts[i])
+                prompt_scores[i] = scoring_model.predict_average_pooling(positive_embedding,
+                                                                         negative_embedding,
+                                                                         positive_attention_mask,
+                                                                         negative_attention_mask).item()
+            return prompt_scores
+
+        # embed the prompts in padded mini batches
+        # only the pooled embeddings are kept
+        positive_pooled_list = []
+        negative_pooled_list = []
+        for start in range(0, len(valid_indices), PROMPT_SCORING_BATCH_SIZE):
+            batch_indices = valid_indices[start:start + PROMPT_SCORING_BATCH_SIZE]
+            # positive and negative prompts share one text embedder call
+            batch_prompts = [positive_prompts[i] for i in batch_indices] + [negative_prompts[i] for i in batch_indices]
+
+            with torch.no_grad():
+                embeddings, _, attention_masks = clip_text_embedder.forward_return_all(batch_prompts)
+                pooled_embeddings = tensor_attention_pooling(embeddings, attention_masks)
+
+            positive_pooled_list.append(pooled_embeddings[:len(batch_indices)])
+            negative_pooled_list.append(pooled_embeddings[len(batch_indices):])
+
+        # score the whole matrix in one model call
+        scores = scoring_model.predict_pooled_batch(torch.cat(positive_pooled_list),
+                                                    torch.cat(negative_pooled_list))
+        for i, score in zip(valid_indices, scores.tolist()):
+            prompt_scores[i] = score
+
+        return prompt_scores
+
+
 class ScoredPrompt:
     def __init__(self, score,
                  positive_prompt,
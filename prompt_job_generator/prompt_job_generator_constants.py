@@ -7,4 +7,7 @@ DEFAULT_TOP_K_VALUE = 0.1
 DEFAULT_DATASET_RATE = 1
 DEFAULT_HOURLY_LIMIT = 9999999
 JOB_PER_SECOND_SAMPLE_SIZE = 50
-PROMPT_QUEUE_SIZE = 32
\ No newline at end of file
+PROMPT_QUEUE_SIZE = 32
+# number of prompts embedded per clip text embedder call
+# when scoring the generated prompts
+PROMPT_SCORING_BATCH_SIZE = 64
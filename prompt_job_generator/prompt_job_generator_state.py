@@ -13,7 +13,8 @@ from utility.minio import cmd
 from training_worker.ab_ranking.model.ab_ranking_efficient_net import ABRankingEfficientNetModel
 from training_worker.ab_ranking.model.ab_ranking_linear import ABRankingModel
 from training_worker.ab_ranking.model.ab_ranking_elm_v1 import ABRankingELMModel
-from worker.prompt_generation.prompt_generator import (initialize_prompt_list_from_csv)
+from worker.prompt_generation.prompt_generator import (initialize_prompt_list_from_csv,
+                                                       get_proportional_phrase_samplers)
 from prompt_generation_prompt_queue import PromptGenerationPromptQueue
 from prompt_job_generator_constants import (PROMPT_QUEUE_SIZE, DEFAULT_PROMPT_GENERATION_POLICY,
                                             DEFAULT_TOP_K_VALUE, DEFAULT_DATASET_RATE, DEFAULT_HOURLY_LIMIT)
@@ -54,6 +55,8 @@ class PromptJobGeneratorState:
         self.phrases_token_size = None
         self.positive_count_list = None
         self.negative_count_list = None
+        # samplers of the proportional selection, built once with the phrase list
+        self.phrase_samplers = None
         self.device = device
         self.config = ModelPathConfig()
         self.clip_text_embedder = CLIPTextEmbedder(device=self.device)
@@ -174,6 +177,10 @@ class PromptJobGeneratorState:
         self.phrases_token_size = phrases_token_size
         self.positive_count_list = positive_count_list
         self.negative_count_list = negative_count_list
+        self.phrase_samplers = get_proportional_phrase_samplers(phrases,
+                                                                phrases_token_size,
+                                                                positive_count_list,
+                                                                negative_count_list)
 
     def register_callback(self, dataset, callback):
         self.dataset_callbacks[dataset] = callback
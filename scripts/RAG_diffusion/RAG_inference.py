@@ -8,7 +8,6 @@ import random
 import sys
 import time
 from matplotlib import pyplot as plt
-import msgpack
 import requests
 import torch
 from tqdm import tqdm
@@ -23,6 +22,7 @@ sys.path.insert(0, os.getcwd())
 from kandinsky.models.clip_image_encoder.clip_image_encoder import KandinskyCLIPImageEncoder
 from kandinsky.models.kandisky import KandinskyPipeline
 from utility.minio import cmd
+from utility.msgpack_ndarray import unpackb
 from utility.path import separate_bucket_and_file_path
 
 
@@ -52,8 +52,8 @@ def load_image_latents(minio_client, file_path:str):
     try:
         vae_data = minio_client.get_object(bucket, vae_latent_path).data
         clip_data = minio_client.get_object(bucket, clip_path).data
-        vae_latent_msgpack = msgpack.unpackb(vae_data)
-        clip_latent_msgpack = msgpack.unpackb(clip_data)
+        vae_latent_msgpack = unpackb(vae_data)
+        clip_latent_msgpack = unpackb(clip_data)
 
         vae_latent = torch.tensor(vae_latent_msgpack["latent_vector"])
         clip_vector = torch.tensor(clip_latent_msgpack["clip-feature-vector"])
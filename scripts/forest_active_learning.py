@@ -7,7 +7,6 @@ import os
 import requests
 from tqdm.auto import tqdm
 import argparse
-import msgpack
 import numpy as np
 import torch
 
@@ -18,6 +17,7 @@ sys.path.insert(0, os.getcwd())
 
 from training_worker.ab_ranking.model.ab_ranking_elm_v1 import ABRankingELMModel
 from utility.minio import cmd
+from utility.msgpack_ndarray import unpackb
 from utility.minio.cmd import connect_to_minio_client
 from utility.clip.clip import ClipModel
 
@@ -193,7 +193,7 @@ class ForestActiveLearningPipeline:
             try:
                 # get clip embedding    
                 data = self.client.get_object(self.bucket_name, object_name).data
-                decoded_data = msgpack.unpackb(data)
+                decoded_data = unpackb(data)
                 embedding= np.array(decoded_data['clip-feature-vector']).astype('float32')
                 
                 
@@ -7,7 +7,7 @@ base_directory = "./"
 sys.path.insert(0, base_directory)
 
 
-from worker.prompt_generation.prompt_generator import (initialize_prompt_list_from_csv)
+from worker.prompt_generation.prompt_generator import (initialize_prompt_list_from_csv, get_proportional_phrase_samplers)
 from worker.prompt_generation.prompt_generator import generate_prompts_proportional_selection, generate_base_prompts, load_base_prompts
 from utility.minio import cmd
 
@@ -44,6 +44,8 @@ def main():
 
     phrases, phrases_token_size, positive_count_list, negative_count_list = initialize_prompt_list_from_csv(
         csv_dataset_path, 0)
+    # shared by all the batches
+    phrase_samplers = get_proportional_phrase_samplers(phrases, phrases_token_size, positive_count_list, negative_count_list)
 
     batch_size = 1000
 
@@ -68,7 +70,8 @@ def main():
                                                               positive_count_list,
                                                               negative_count_list,
                                                               batch_size,
-                                                              '')
+                                                              '',
+                                                              phrase_samplers=phrase_samplers)
 
             prompt_list = []
             for index in range(0, batch_size):
@@ -6,7 +6,6 @@ import argparse
 import numpy as np
 import torch
 import time
-import msgpack
 from io import BytesIO
 import matplotlib.pyplot as plt
 from concurrent.futures import ThreadPoolExecutor, as_completed
@@ -21,6 +20,7 @@ from training_worker.classifiers.models.elm_regression import ELMRegression
 from training_worker.classifiers.models.linear_regression import LinearRegression
 from training_worker.classifiers.models.logistic_regression import LogisticRegression
 from utility.http import model_training_request
+from utility.msgpack_ndarray import unpackb
 from utility.http import request
 from utility.minio import cmd
 from utility.path import separate_bucket_and_file_path
@@ -197,7 +197,7 @@ class ImageScorer:
             print(f"No msgpack file found at path: {path}")
             return None, None, None, None, index
 
-        data = msgpack.unpackb(msgpack_data.data)
+        data = unpackb(msgpack_data.data)
 
         image_hash = None
         image_path = None
@@ -205,18 +205,18 @@ class ImageScorer:
         second_feature = None
 
         if self.model_input_type == "embedding":
-            positive_embedding = list(data['positive_embedding'].values())
+            positive_embedding = [data['positive_embedding']]
             first_feature = torch.tensor(np.array(positive_embedding)).float()
 
-            negative_embedding = list(data['negative_embedding'].values())
+            negative_embedding = [data['negative_embedding']]
             second_feature = torch.tensor(np.array(negative_embedding)).float()
 
         elif self.model_input_type == "embedding-positive":
-            positive_embedding = list(data['positive_embedding'].values())
+            positive_embedding = [data['positive_embedding']]
             first_feature = torch.tensor(np.array(positive_embedding)).float()
 
         elif self.model_input_type == "embedding-negative":
-            negative_embedding = list(data['negative_embedding'].values())
+            negative_embedding = [data['negative_embedding']]
             first_feature = torch.tensor(np.array(negative_embedding)).float()
 
         elif self.model_input_type == "clip":
@@ -230,7 +230,7 @@ class ImageScorer:
                 print("No msgpack file found at path: {}".format(path.replace("clip.msgpack", "data.msgpack")))
                 return None
 
-            data = msgpack.unpackb(data_msgpack.data)
+            data = unpackb(data_msgpack.data)
         
         elif self.model_input_type == "clip-h":
             clip_feature = data['clip-feature-vector']
@@ -243,7 +243,7 @@ class ImageScorer:
                 print("No msgpack file found at path: {}".format(path.replace("clip_kandinsky.msgpack", "data.msgpack")))
                 return None
 
-            data = msgpack.unpackb(data_msgpack.data)
+            data = unpackb(data_msgpack.data)
 
         image_hash = data['file_hash']
         job_uuid = data['job_uuid']
@@ -1,6 +1,7 @@
 import os
 import sys
 import argparse
+import asyncio
 import io
 import csv
 import time
@@ -14,10 +15,13 @@ base_directory = "./"
 sys.path.insert(0, base_directory)
 
 from scripts.image_scorer import ImageScorer
-from utility.http import model_training_request
+from utility.http import http_client, model_training_request
 from utility.http import request
 from utility.minio import cmd
 
+# the delta scores of the ranking data are calculated in the background by the api
+DELTA_SCORES_PROGRESS_POLL_INTERVAL_SECONDS = 10
+
 
 # delta score = text embedding sigma score - clip embedding sigma score
 def get_delta_score(clip_hash_sigma_score_dict,
@@ -45,45 +49,48 @@ def upload_scores_attributes_to_completed_jobs(model_type,
                                                clip_h_hash_percentile_dict
                                                ):
     print("Uploading scores, sigma scores, and delta scores to mongodb...")
-    with ThreadPoolExecutor(max_workers=50) as executor:
-        futures = []
-        for img_hash, clip_score in clip_hash_score_dict.items():
-            clip_percentile = clip_hash_percentile_dict[img_hash]
-            clip_sigma_score = clip_hash_sigma_score_dict[img_hash]
+    uploads = []
+    for img_hash, clip_score in clip_hash_score_dict.items():
+        clip_percentile = clip_hash_percentile_dict[img_hash]
+        clip_sigma_score = clip_hash_sigma_score_dict[img_hash]
 
-            if img_hash not in embedding_hash_score_dict:
-                continue
-            embedding_score = embedding_hash_score_dict[img_hash]
-            embedding_percentile = embedding_hash_percentile_dict[img_hash]
-            embedding_sigma_score = embedding_hash_sigma_score_dict[img_hash]
+        if img_hash not in embedding_hash_score_dict:
+            continue
+        embedding_score = embedding_hash_score_dict[img_hash]
+        embedding_percentile = embedding_hash_percentile_dict[img_hash]
+        embedding_sigma_score = embedding_hash_sigma_score_dict[img_hash]
 
-            if img_hash not in clip_h_hash_score_dict:
-                continue
-            clip_h_score = clip_h_hash_score_dict[img_hash]
-            clip_h_percentile = clip_h_hash_percentile_dict[img_hash]
-            clip_h_sigma_score = clip_h_hash_sigma_score_dict[img_hash]
+        if img_hash not in clip_h_hash_score_dict:
+            continue
+        clip_h_score = clip_h_hash_score_dict[img_hash]
+        clip_h_percentile = clip_h_hash_percentile_dict[img_hash]
+        clip_h_sigma_score = clip_h_hash_sigma_score_dict[img_hash]
 
-            if img_hash not in hash_delta_score_dict:
-                continue
+        if img_hash not in hash_delta_score_dict:
+            continue
 
-            delta_score = hash_delta_score_dict[img_hash]
+        delta_score = hash_delta_score_dict[img_hash]
 
-            futures.append(executor.submit(request.http_add_score_attributes_v1,
-                                           model_type=model_type,
-                                           img_hash=img_hash,
-                                           image_clip_score=clip_score,
-                                           image_clip_percentile=clip_percentile,
-                                           image_clip_sigma_score=clip_sigma_score,
-                                           text_embedding_score=embedding_score,
-                                           text_embedding_percentile=embedding_percentile,
-                                           text_embedding_sigma_score=embedding_sigma_score,
-                                           image_clip_h_score=clip_h_score,
-                                           image_clip_h_percentile=clip_h_percentile,
-                                           image_clip_h_sigma_score=clip_h_sigma_score,
-                                           delta_sigma_score=delta_score,))
-
-        for _ in tqdm(as_completed(futures), total=len(futures)):
-            continue
+        uploads.append(dict(model_type=model_type,
+                            img_hash=img_hash,
+                            image_clip_score=clip_score,
+                            image_clip_percentile=clip_percentile,
+                            image_clip_sigma_score=clip_sigma_score,
+                            text_embedding_score=embedding_score,
+                            text_embedding_percentile=embedding_percentile,
+                            text_embedding_sigma_score=embedding_sigma_score,
+                            image_clip_h_score=clip_h_score,
+                            image_clip_h_percentile=clip_h_percentile,
+                            image_clip_h_sigma_score=clip_h_sigma_score,
+                            delta_sigma_score=delta_score))
+
+    # one request per image, sent on the pooled connections of the http client
+    asyncio.run(http_client.map_requests_async(upload_score_attributes, uploads))
+    print(f"Uploaded the scores of {len(uploads)} images")
+
+
+def upload_score_attributes(upload):
+    return request.http_add_score_attributes_v1(**upload)
 
 
 def convert_pairs_to_dict(hash_score_pairs):
@@ -457,6 +464,26 @@ def parse_args():
     return args
 
 
+def wait_for_delta_scores(poll_interval_seconds=DELTA_SCORES_PROGRESS_POLL_INTERVAL_SECONDS):
+    # polls the progress of the delta scores calculation until it is done
+    while True:
+        progress = request.http_get_delta_scores_progress()
+        if progress is None:
+            print("Could not get the delta scores progress")
+            return None
+
+        print("Delta scores: {} {}/{} datapoints scanned, {} delta scores set".format(progress["status"],
+                                                                                     progress["scanned_count"],
+                                                                                     progress["total_count"],
+                                                                                     progress["processed_count"]))
+        if progress["status"] != "running":
+            if progress["status"] == "failed":
+                print("Delta scores calculation failed: {}".format(progress["error"]))
+            return progress
+
+        time.sleep(poll_interval_seconds)
+
+
 def main():
     args = parse_args()
 
@@ -487,6 +514,7 @@ def main():
     
     # update ranking data with new delta scores
     request.http_update_ranking_delta_scores()
+    wait_for_delta_scores()
 
 
 if __name__ == "__main__":
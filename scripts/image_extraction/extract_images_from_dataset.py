@@ -11,7 +11,6 @@ import numpy as np
 import torch
 from diffusers import VQModel
 from tqdm import tqdm
-import msgpack
 
 base_dir = "./"
 sys.path.insert(0, base_dir)
@@ -19,6 +18,7 @@ sys.path.insert(0, os.getcwd())
 
 from training_worker.ab_ranking.model.ab_ranking_elm_v1 import ABRankingELMModel
 from utility.minio import cmd
+from utility.msgpack_ndarray import unpackb
 from utility.http import request
 from utility.http import external_images_request
 from kandinsky.models.clip_image_encoder.clip_image_encoder import KandinskyCLIPImageEncoder
@@ -332,7 +332,7 @@ class ImageExtractionPipeline:
 
         clip_path = file_path + "_clip_kandinsky.msgpack"
         features_data = cmd.get_file_from_minio(self.minio_client, bucket_name, clip_path)
-        clip_vector = msgpack.unpackb(features_data.data)["clip-feature-vector"]
+        clip_vector = unpackb(features_data.data)["clip-feature-vector"]
         clip_vector = torch.tensor(clip_vector).squeeze()
 
         return image_data, clip_vector
@@ -4,13 +4,13 @@ import io
 import os
 import sys
 import torch
-import msgpack
 from tqdm import tqdm
 
 base_dir = "./"
 sys.path.insert(0, base_dir)
 sys.path.insert(0, os.getcwd())
 from utility.http import request
+from utility.msgpack_ndarray import unpackb
 from utility.minio import cmd
 from utility.path import separate_bucket_and_file_path
 from training_worker.classifiers.models.elm_regression import ELMRegression
@@ -51,7 +51,7 @@ def load_clip_vector(minio_client, file_path, device):
     
     output_clip_path = file_path + "_clip_kandinsky.msgpack"
     features_data = cmd.get_file_from_minio(minio_client, bucket_name, output_clip_path)
-    features_vector = msgpack.unpackb(features_data.data)["clip-feature-vector"]
+    features_vector = unpackb(features_data.data)["clip-feature-vector"]
     clip_vector= torch.tensor(features_vector).to(device)
      
     return clip_vector
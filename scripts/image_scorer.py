@@ -6,7 +6,6 @@ import argparse
 import numpy as np
 import torch
 import time
-import msgpack
 from io import BytesIO
 import matplotlib.pyplot as plt
 from concurrent.futures import ThreadPoolExecutor, as_completed
@@ -19,6 +18,7 @@ sys.path.insert(0, base_directory)
 from training_worker.ab_ranking.model.ab_ranking_elm_v1 import ABRankingELMModel
 from training_worker.ab_ranking.model.ab_ranking_linear import ABRankingModel as ABRankingLinearModel
 from utility.http import model_training_request
+from utility.msgpack_ndarray import unpackb
 from utility.http import request
 from utility.minio import cmd
 
@@ -153,7 +153,7 @@ class ImageScorer:
             print(f"No msgpack file found at path: {path}")
             return None, None, None, None, index
 
-        data = msgpack.unpackb(msgpack_data.data)
+        data = unpackb(msgpack_data.data)
 
         image_hash = None
         image_path = None
@@ -161,18 +161,18 @@ class ImageScorer:
         second_feature = None
 
         if self.model_input_type == "embedding":
-            positive_embedding = list(data['positive_embedding'].values())
+            positive_embedding = [data['positive_embedding']]
             first_feature = torch.tensor(np.array(positive_embedding)).float()
 
-            negative_embedding = list(data['negative_embedding'].values())
+            negative_embedding = [data['negative_embedding']]
             second_feature = torch.tensor(np.array(negative_embedding)).float()
 
         elif self.model_input_type == "embedding-positive":
-            positive_embedding = list(data['positive_embedding'].values())
+            positive_embedding = [data['positive_embedding']]
             first_feature = torch.tensor(np.array(positive_embedding)).float()
 
         elif self.model_input_type == "embedding-negative":
-            negative_embedding = list(data['negative_embedding'].values())
+            negative_embedding = [data['negative_embedding']]
             first_feature = torch.tensor(np.array(negative_embedding)).float()
 
         elif self.model_input_type == "clip" or self.model_input_type == "clip-h":
@@ -189,7 +189,7 @@ class ImageScorer:
                 print("No msgpack file found at path: {}".format(data_msgpack_path))
                 return None
 
-            data = msgpack.unpackb(data_msgpack.data)
+            data = unpackb(data_msgpack.data)
 
         image_hash = data['file_hash']
         job_uuid = data['job_uuid']
@@ -1,5 +1,5 @@
 import argparse
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import as_completed
 import threading
 import time
 import os
@@ -8,16 +8,19 @@ import torch
 import torch.distributed as dist
 import torch.multiprocessing as mp
 from multiprocessing import Value
-from torch.utils.data import DataLoader, Dataset, DistributedSampler
 from tqdm import tqdm
 
 base_directory = "./"
 sys.path.insert(0, base_directory)
 from scripts.image_scorers.dataloader.image_dataset_loader import ImageDatasetLoader
+from scripts.image_scorers.scoring_engine import FusedScoringEngine, DEFAULT_SCORING_BATCH_SIZE
+from scripts.image_scorers.scoring_shards import (DEFAULT_NUM_SHARDS, DEFAULT_CHECKPOINT_DIRECTORY, CPU_THREADS_PER_PROCESS,
+                                                  get_node_shard_rows, get_scoring_device, get_backend, get_num_processes,
+                                                  get_run_id, get_checkpoint_path, ShardCheckpoint, ShardUploadTracker)
 from training_worker.classifiers.models.elm_regression import ELMRegression
 from training_worker.classifiers.models.linear_regression import LinearRegression
 from training_worker.classifiers.models.logistic_regression import LogisticRegression
-from utility.http import request
+from utility.http import http_client, request
 from utility.http.external_images_request import http_get_extract_dataset_list
 from utility.minio import cmd
 
@@ -29,7 +32,15 @@ def parse_args():
     parser.add_argument('--bucket', required=True, help='name of bucket')
     parser.add_argument('--dataset', required=True, help='name of dataset')
     parser.add_argument('--model-type', required=True, help='type of model elm, linear or logistic', default="all")
-    parser.add_argument('--batch-size', required=False, default=10000, type=int, help='batch size of the classifier models')
+    parser.add_argument('--batch-size', required=False, default=200000, type=int, help='maximum number of scores per upload request')
+    parser.add_argument('--scoring-batch-size', required=False, default=DEFAULT_SCORING_BATCH_SIZE, type=int, help='number of images scored per forward pass')
+    parser.add_argument('--device', required=False, default="cuda" if torch.cuda.is_available() else "cpu", choices=["cuda", "cpu"], help='device of the scoring processes')
+    parser.add_argument('--num-processes', required=False, default=None, type=int, help='scoring processes on this node, defaults to one per gpu or one per 4 cpu cores')
+    parser.add_argument('--num-nodes', required=False, default=1, type=int, help='number of nodes scoring the dataset')
+    parser.add_argument('--node-rank', required=False, default=0, type=int, help='index of this node, from 0 to num-nodes - 1')
+    parser.add_argument('--num-shards', required=False, default=DEFAULT_NUM_SHARDS, type=int, help='number of image hash range shards of a dataset')
+    parser.add_argument('--checkpoint-directory', required=False, default=DEFAULT_CHECKPOINT_DIRECTORY, help='directory of the finished shards files')
+    parser.add_argument('--run-id', required=False, default=get_run_id(), help='runs with the same id resume from the finished shards, defaults to the date')
 
     args = parser.parse_args()
     return args
@@ -40,7 +51,7 @@ def get_rank():
 
 def print_in_rank(msg: str):
     rank= get_rank()
-    print(f"gpu {rank}: {msg}")
+    print(f"process {rank}: {msg}")
 
 def get_dataset_list(bucket: str):
     datasets=[]
@@ -55,34 +66,22 @@ def get_dataset_list(bucket: str):
     return dataset_list
 
 # Initialize the distributed environment
-def initialize_dist_env(rank, world_size):
+# the process group is local to the node, nccl on gpus and gloo on cpus
+def initialize_dist_env(rank, world_size, backend="nccl"):
     os.environ['MASTER_ADDR'] = 'localhost'
     os.environ['MASTER_PORT'] = '12357'
-    dist.init_process_group("nccl", rank=rank, world_size=world_size)
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
 
 # Cleanup the distributed environment
 def cleanup():
     dist.destroy_process_group()
 
-class ClipDataset(Dataset):
-    def __init__(self, data):
-        self.data = data
+def load_image_data(dataset_loader):
+    uuids, image_hashes, clip_matrix = dataset_loader.load_clip_matrix()
+    # shared memory tensor, the spawned processes do not get a copy of the matrix
+    clip_matrix = torch.from_numpy(clip_matrix).share_memory_()
 
-    def __len__(self):
-        return len(self.data)
-
-    def __getitem__(self, idx):
-        return {
-            'clip_vector': torch.tensor(self.data[idx]["clip_vector"]).squeeze(),
-            'uuid': self.data[idx]["uuid"],
-            'image_hash': self.data[idx]["image_hash"]
-        }
-    
-def collate_fn(batch):
-    clip_vectors = torch.stack([item['clip_vector'] for item in batch])
-    uuids = [item['uuid'] for item in batch]
-    image_hashes = [item['image_hash'] for item in batch]
-    return {'uuids': uuids, 'image_hashes':image_hashes , 'clip_vectors': clip_vectors}
+    return uuids, image_hashes, clip_matrix
 
 def load_model(minio_client, classifier_model_info, device):
     classifier_name = classifier_model_info["classifier_name"]
@@ -120,88 +119,132 @@ def load_model(minio_client, classifier_model_info, device):
     
     return loaded_model
 
-def calculate_and_upload_scores(rank, world_size, image_dataset, image_source, classifier_models, batch_size):
-    initialize_dist_env(rank, world_size)
-    rank_device = torch.device(f'cuda:{rank}')
-
-    dataset = ClipDataset(image_dataset)
-    sampler = DistributedSampler(dataset, num_replicas=world_size, rank=rank)
-    dataloader = DataLoader(dataset, batch_size=batch_size, sampler=sampler, collate_fn=collate_fn)
+def calculate_and_upload_scores(rank, world_size, image_data, image_source, classifier_models, batch_size, scoring_batch_size,
+                                device_type, shards, checkpoint_path):
+    initialize_dist_env(rank, world_size, get_backend(device_type))
+    rank_device = get_scoring_device(device_type, rank)
+    if device_type == "cpu":
+        torch.set_num_threads(CPU_THREADS_PER_PROCESS)
+
+    uuids, image_hashes, clip_matrix = image_data
+
+    # the shards of this node are split between its processes
+    rank_shards = shards[rank::world_size]
+
+    # all classifier models are scored in one forward pass
+    scoring_engine = FusedScoringEngine(rank_device)
+    tag_ids = {}
+    for classifier_id, classifier_data in classifier_models.items():
+        if scoring_engine.add_classifier_model(classifier_id, classifier_data["model"]):
+            tag_ids[classifier_id] = classifier_data["tag_id"]
+    scoring_engine.build()
+
+    num_images = sum(len(rows) for _, rows in rank_shards)
+    print_in_rank(f"calculating scores of {num_images} images in {len(rank_shards)} shards for {len(scoring_engine.model_ids)} classifiers")
+
+    checkpoint = ShardCheckpoint(checkpoint_path)
+    upload_tracker = ShardUploadTracker(checkpoint)
+
+    model_tag_ids = [tag_ids[classifier_id] for classifier_id in scoring_engine.model_ids]
+    num_models = len(scoring_engine.model_ids)
+    # the scores of all models for an image are in the same upload
+    # an upload request has at most batch_size scores
+    images_per_upload = max(1, batch_size // max(1, num_models))
+    if num_models == 0:
+        # nothing to score, the shards are left unfinished
+        rank_shards = []
 
     start_time = time.time()
     total_uploaded = 0
+    upload_sizes = {}
     futures = []
 
-    with ThreadPoolExecutor(max_workers=50) as executor:
-        for classifier_id, classifier_data in classifier_models.items():
-            tag_id = classifier_data["tag_id"]
-            classifier_model = classifier_data["model"]
-            classifier_model.set_device(rank_device)
-
-            print_in_rank(f"calculating scores for classifier id {classifier_id}")
-
-            try:
-                for batch_idx, image_data in enumerate(tqdm(dataloader)):
-                    clip_vectors = image_data["clip_vectors"]
-                    uuids = image_data["uuids"]
-                    image_hashes = image_data["image_hashes"]
-
-                    clip_vectors = clip_vectors.to(rank_device)
-
-                    with torch.no_grad():
-                        scores = classifier_model.classify(clip_vectors)
-
-                    scores_batch = {"scores": []}
-                    for score, uuid, image_hash in zip(scores, uuids, image_hashes):
-                        score_data = {
-                            "job_uuid": uuid,
-                            "image_hash": image_hash,
-                            "classifier_id": classifier_id,
-                            "tag_id": tag_id,
-                            "score": score.item(),
-                            "image_source": image_source
-                        }
-                        scores_batch["scores"].append(score_data)
-
-                    futures.append(executor.submit(request.http_add_classifier_score_batch, scores_batch=scores_batch))
-
-                classifier_model.set_device(torch.device('cpu'))
-
-            except Exception as e:
-                print_in_rank(f"exception occurred when uploading scores {e}")
+    try:
+        for shard_id, shard_rows in tqdm(rank_shards):
+            # uploads never mix the scores of two shards
+            # so a shard is finished when its own uploads are
+            shard_futures = []
+
+            for batch_start in range(0, len(shard_rows), scoring_batch_size):
+                batch_rows = shard_rows[batch_start:batch_start + scoring_batch_size]
+
+                # (classifiers, images), the layout of the columnar upload
+                scores = scoring_engine.score(clip_matrix[batch_rows]).t().cpu().numpy()
+                batch_rows = batch_rows.tolist()
+
+                upload_start = 0
+                for upload_rows in http_client.iterate_batches(batch_rows, images_per_upload):
+                    upload_end = upload_start + len(upload_rows)
+
+                    # the uploads run in the thread pool of the http client,
+                    # no more at a time than pooled connections
+                    future = http_client.submit(request.http_add_classifier_scores_columnar,
+                                                image_source=image_source,
+                                                uuids=[uuids[row] for row in upload_rows],
+                                                image_hashes=[image_hashes[row] for row in upload_rows],
+                                                classifier_ids=scoring_engine.model_ids,
+                                                tag_ids=model_tag_ids,
+                                                scores=scores[:, upload_start:upload_end])
+                    upload_sizes[future] = len(upload_rows) * num_models
+                    shard_futures.append(future)
+                    upload_start = upload_end
+
+            upload_tracker.add(shard_id, shard_futures)
+            futures.extend(shard_futures)
+
+    except Exception as e:
+        print_in_rank(f"exception occurred when uploading scores {e}")
 
     last_report_time = time.time()
-    while futures:
-        for future in as_completed(futures):
-            try:
-                future.result()  # Ensure any exceptions are raised
-                total_uploaded += batch_size
-            except Exception as e:
-                print_in_rank(f"Exception in future: {e}")
-            futures.remove(future)
+    for future in as_completed(futures):
+        try:
+            if future.result():
+                total_uploaded += upload_sizes[future]
+        except Exception as e:
+            print_in_rank(f"Exception in future: {e}")
 
         current_time = time.time()
         if current_time - last_report_time >= 10:
             last_report_time = current_time
-            total_uploaded_tensor = torch.tensor(total_uploaded, device=rank_device)
-            dist.all_reduce(total_uploaded_tensor, op=dist.ReduceOp.SUM)
-            total_uploaded_all_ranks = total_uploaded_tensor.item()
-
-            elapsed_time = time.time() - start_time
-            speed = total_uploaded_all_ranks / elapsed_time
-            print(f"Uploaded {total_uploaded_all_ranks} scores at {speed:.2f} scores/sec")
+            elapsed_time = current_time - start_time
+            speed = total_uploaded / elapsed_time
+            print_in_rank(f"Uploaded {total_uploaded} scores at {speed:.2f} scores/sec")
 
     dist.barrier()
 
     cleanup()
 
+def score_dataset(args, minio_client, dataset_name, image_source, classifier_models):
+    device_type = args.device
+    world_size = get_num_processes(device_type, args.num_processes)
+
+    print(f"Loading the {dataset_name} dataset")
+    dataset_loader = ImageDatasetLoader(minio_client, args.bucket, dataset_name)
+    uuids, image_hashes, clip_matrix = load_image_data(dataset_loader)
+
+    checkpoint_path = get_checkpoint_path(args.checkpoint_directory, "classifier-image-scorer", args.run_id,
+                                          args.bucket, dataset_name, classifier_models.keys(), args.num_shards)
+    finished_shards = ShardCheckpoint(checkpoint_path).load()
+
+    shard_rows = get_node_shard_rows(image_hashes, args.num_shards, args.node_rank, args.num_nodes)
+    shards = [(shard_id, torch.tensor(rows, dtype=torch.long))
+              for shard_id, rows in sorted(shard_rows.items()) if shard_id not in finished_shards]
+
+    print(f"{len(shards)} of {len(shard_rows)} shards of node {args.node_rank} left to score, checkpoint {checkpoint_path}")
+    if len(shards) == 0:
+        return
+
+    mp.spawn(calculate_and_upload_scores,
+             args=(world_size, (uuids, image_hashes, clip_matrix), image_source, classifier_models, args.batch_size,
+                   args.scoring_batch_size, device_type, shards, checkpoint_path),
+             nprocs=world_size,
+             join=True)
+
 def main():
     args = parse_args()
 
     bucket_name = args.bucket
     model_type = args.model_type
-    batch_size = args.batch_size
-    world_size = torch.cuda.device_count()
 
     # set image source
     if args.bucket=="external":
@@ -238,19 +281,13 @@ def main():
         if classifier_model is not None:
             classifier_models[classifier_id] = { "model": classifier_model, "tag_id": tag_id}
 
-    datasets = []
     if args.dataset == "all":
         dataset_names = get_dataset_list(bucket_name)
 
         for dataset in dataset_names:
-            print(f"Loading the {dataset} dataset")
-            dataset_loader = ImageDatasetLoader(minio_client, bucket_name, dataset)
-            image_dataset = dataset_loader.load_dataset()
-            mp.spawn(calculate_and_upload_scores, args=(world_size, image_dataset, image_source, classifier_models, batch_size), nprocs=world_size, join=True)
+            score_dataset(args, minio_client, dataset, image_source, classifier_models)
     else:
-        dataset_loader = ImageDatasetLoader(minio_client, bucket_name, args.dataset)
-        image_dataset = dataset_loader.load_dataset()
-        mp.spawn(calculate_and_upload_scores, args=(world_size, image_dataset, image_source, classifier_models, batch_size), nprocs=world_size, join=True)
+        score_dataset(args, minio_client, args.dataset, image_source, classifier_models)
 
 if __name__ == "__main__":
     main()
@@ -2,7 +2,6 @@ import argparse
 from io import BytesIO
 import os
 import sys
-import msgpack
 import torch
 from tqdm import tqdm
 
@@ -10,6 +9,7 @@ base_dir = "./"
 sys.path.insert(0, base_dir)
 sys.path.insert(0, os.getcwd())
 from utility.http import external_images_request
+from utility.msgpack_ndarray import packb, unpackb
 from utility.minio import cmd
 from utility.path import separate_bucket_and_file_path
 from kandinsky.models.clip_image_encoder.clip_image_encoder import KandinskyCLIPImageEncoder
@@ -29,7 +29,7 @@ def parse_args():
 
 def save_data_to_minio(minio_client, bucket, data_path, data):
     data_buffer = BytesIO()
-    packed_data = msgpack.packb(data, use_bin_type=True)
+    packed_data = packb(data)
     data_buffer.write(packed_data)
     data_buffer.seek(0)
     minio_client.put_object(bucket, data_path, data_buffer, len(data_buffer.getvalue()))
@@ -91,7 +91,7 @@ class ClipBatchCaculation:
                 output_clip_path = file_path + "_clip_kandinsky.msgpack"
                     
                 features_data = cmd.get_file_from_minio(self.minio_client, self.bucket, output_clip_path)
-                features_vector = msgpack.unpackb(features_data.data)["clip-feature-vector"]
+                features_vector = unpackb(features_data.data)["clip-feature-vector"]
 
                 clip_batch.append({"uuid": uuid, "image_hash": image_hash, "clip_vector": features_vector})
 
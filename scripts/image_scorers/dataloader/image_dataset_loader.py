@@ -1,13 +1,14 @@
 from io import BytesIO
 import os
 import sys
+import numpy as np
 from minio import Minio
-import msgpack
 from tqdm import tqdm
 
 base_dir = "./"
 sys.path.insert(0, base_dir)
 sys.path.insert(0, os.getcwd())
+from utility.msgpack_ndarray import unpackb
 
 class ImageDatasetLoader:
     def __init__(self,
@@ -32,9 +33,25 @@ class ImageDatasetLoader:
             try:
                 response = self.minio_client.get_object(self.bucket, batch.object_name)
                 data = BytesIO(response.read())
-                data= msgpack.unpackb(data.getvalue(), raw=False)
+                data= unpackb(data.getvalue())
                 image_features.extend(data)
             except Exception as e:
                 print(f"Failed to retrieve or parse the file: {e}")
 
-        return image_features
\ No newline at end of file
+        return image_features
+
+    # loads all clip vectors of the dataset as one (images, vector size) float32 matrix
+    # returns the uuids, the image hashes and the matrix, in the same order
+    def load_clip_matrix(self):
+        image_features = self.load_dataset()
+
+        uuids = [feature["uuid"] for feature in image_features]
+        image_hashes = [feature["image_hash"] for feature in image_features]
+
+        if len(image_features) == 0:
+            return uuids, image_hashes, np.zeros((0, 0), dtype=np.float32)
+
+        clip_matrix = np.stack([np.asarray(feature["clip_vector"], dtype=np.float32).reshape(-1)
+                                for feature in image_features])
+
+        return uuids, image_hashes, clip_matrix
@@ -0,0 +1,225 @@
+import sys
+import torch
+import torch.nn as nn
+
+base_directory = "./"
+sys.path.insert(0, base_directory)
+from training_worker.ab_ranking.model.ab_ranking_elm_v1 import ABRankingELMBaseModel, ABRankingELMBaseModelDeprecate
+from training_worker.classifiers.models.elm_regression import ELMRegression
+from training_worker.classifiers.models.linear_regression import LinearRegression
+from training_worker.classifiers.models.logistic_regression import LogisticRegression
+
+# rows of clip vectors scored per forward pass
+DEFAULT_SCORING_BATCH_SIZE = 4096
+# hidden units of the classifier elm models computed in one matmul
+# bounds the size of the (batch, hidden units) activation matrix
+ELM_HIDDEN_UNITS_PER_PASS = 32768
+
+
+# single output linear models with the same activations
+# stacked into one (vector size, models) matrix
+class FusedLinearGroup:
+    def __init__(self, input_activation, output_activation):
+        self.input_activation = input_activation
+        self.output_activation = output_activation
+        self.model_ids = []
+        self.weights = []
+        self.biases = []
+        self.scaling_factors = []
+
+        self.weight = None
+        self.bias = None
+        self.scaling_factor = None
+
+    def add(self, model_id, weight, bias, scaling_factor):
+        self.model_ids.append(model_id)
+        self.weights.append(weight.detach().float().reshape(-1).cpu())
+        self.biases.append(float(bias))
+        self.scaling_factors.append(float(scaling_factor))
+
+    def build(self, device):
+        # (vector size, models)
+        self.weight = torch.stack(self.weights, dim=1).to(device)
+        self.bias = torch.tensor(self.biases, dtype=torch.float32, device=device)
+        self.scaling_factor = torch.tensor(self.scaling_factors, dtype=torch.float32, device=device)
+
+    def score(self, clip_vectors):
+        if self.input_activation is not None:
+            clip_vectors = self.input_activation(clip_vectors)
+
+        scores = torch.addmm(self.bias, clip_vectors, self.weight) * self.scaling_factor
+
+        if self.output_activation is not None:
+            scores = self.output_activation(scores)
+
+        return scores
+
+
+# classifier elm models with the same activation and hidden size
+# the hidden layers are stacked into one (vector size, models * hidden size) matrix
+class FusedELMGroup:
+    def __init__(self, activation, hidden_size):
+        self.activation = activation
+        self.hidden_size = hidden_size
+        self.model_ids = []
+        self.weights = []
+        self.biases = []
+        self.betas = []
+
+        # one (weight, bias, beta) per pass
+        self.passes = []
+
+    def add(self, model_id, weight, bias, beta):
+        self.model_ids.append(model_id)
+        self.weights.append(weight.detach().float().cpu())
+        self.biases.append(bias.detach().float().reshape(-1).cpu())
+        self.betas.append(beta.detach().float().reshape(-1).cpu())
+
+    def build(self, device):
+        models_per_pass = max(1, ELM_HIDDEN_UNITS_PER_PASS // self.hidden_size)
+
+        self.passes = []
+        for start in range(0, len(self.model_ids), models_per_pass):
+            end = start + models_per_pass
+            # (vector size, models * hidden size)
+            weight = torch.cat(self.weights[start:end], dim=1).to(device)
+            bias = torch.cat(self.biases[start:end]).to(device)
+            # (models, hidden size)
+            beta = torch.stack(self.betas[start:end]).to(device)
+            self.passes.append((weight, bias, beta))
+
+    def score(self, clip_vectors):
+        scores = []
+        for weight, bias, beta in self.passes:
+            hidden = self.activation(torch.addmm(bias, clip_vectors, weight))
+            hidden = hidden.view(clip_vectors.shape[0], beta.shape[0], self.hidden_size)
+            scores.append(torch.einsum('nmh,mh->nm', hidden, beta))
+
+        return torch.cat(scores, dim=1)
+
+
+# scores a batch of clip vectors with many models at once
+#
+# every ranking model (linear, elm-v1) and every linear or logistic
+# classifier is a single output linear layer on the clip vector,
+# possibly behind a relu and followed by a scaling factor or a sigmoid
+# their weights are stacked into one (vector size, models) matrix per
+# kind of model, so all of them are a single matmul
+#
+# the classifier elm models have a hidden layer, the hidden layers of the
+# models with the same activation and size are stacked the same way
+#
+# score() returns a (images, models) matrix, the columns
+# are in the order of self.model_ids
+class FusedScoringEngine:
+    def __init__(self, device, input_size=1280):
+        self.device = device
+        self.input_size = input_size
+
+        self.groups = {}
+        self.model_ids = []
+        self.means = {}
+        self.standard_deviations = {}
+
+        self.mean = None
+        self.standard_deviation = None
+
+    def get_linear_group(self, input_activation_name, output_activation_name):
+        key = ("linear", input_activation_name, output_activation_name)
+        if key not in self.groups:
+            input_activation = nn.ReLU() if input_activation_name == "relu" else None
+            output_activation = nn.Sigmoid() if output_activation_name == "sigmoid" else None
+            self.groups[key] = FusedLinearGroup(input_activation, output_activation)
+
+        return self.groups[key]
+
+    def add_ranking_model(self, model_id, ranking_model):
+        # ranking_model is an ABRankingModel or an ABRankingELMModel
+        module = ranking_model.model
+        score_std = float(ranking_model.standard_deviation)
+        if score_std == 0:
+            print(f"ranking model {model_id} has no standard deviation, skipping it")
+            return False
+
+        if isinstance(module, (ABRankingELMBaseModel, ABRankingELMBaseModelDeprecate)):
+            # the random layers of the elm are relu layers
+            # so the input is relu(x) when there is at least one
+            input_activation_name = "relu" if module.num_random_layers > 0 else None
+            linear = module.linear_last_layer
+        else:
+            input_activation_name = None
+            linear = module.linear
+
+        if linear.in_features != self.input_size:
+            print(f"ranking model {model_id} has input size {linear.in_features}, expected {self.input_size}")
+            return False
+
+        # deprecated models have no scaling factor
+        scaling_factor = module.scaling_factor.item() if hasattr(module, "scaling_factor") else 1.0
+
+        group = self.get_linear_group(input_activation_name, None)
+        group.add(model_id, linear.weight, linear.bias.item(), scaling_factor)
+
+        self.means[model_id] = float(ranking_model.mean)
+        self.standard_deviations[model_id] = score_std
+
+        return True
+
+    def add_classifier_model(self, model_id, classifier_model):
+        if isinstance(classifier_model, ELMRegression):
+            weight = classifier_model._weight
+            if weight.shape[0] != self.input_size or classifier_model._beta.shape[1] != 1:
+                print(f"classifier model {model_id} has an unsupported shape")
+                return False
+
+            hidden_size = weight.shape[1]
+            key = ("elm", classifier_model.activation_func_name, hidden_size)
+            if key not in self.groups:
+                self.groups[key] = FusedELMGroup(classifier_model._activation, hidden_size)
+            self.groups[key].add(model_id, weight, classifier_model._bias, classifier_model._beta)
+
+        elif isinstance(classifier_model, (LinearRegression, LogisticRegression)):
+            linear = classifier_model.model[0]
+            if linear.in_features != self.input_size or linear.out_features != 1:
+                print(f"classifier model {model_id} has an unsupported shape")
+                return False
+
+            output_activation_name = "sigmoid" if isinstance(classifier_model.model[1], nn.Sigmoid) else None
+            group = self.get_linear_group(None, output_activation_name)
+            group.add(model_id, linear.weight, linear.bias.item(), 1.0)
+
+        else:
+            print(f"classifier model {model_id} can not be fused")
+            return False
+
+        self.means[model_id] = 0.0
+        self.standard_deviations[model_id] = 1.0
+
+        return True
+
+    def build(self):
+        # moves the stacked weights to the device
+        # must be called after the models are added
+        self.model_ids = []
+        for group in self.groups.values():
+            group.build(self.device)
+            self.model_ids.extend(group.model_ids)
+
+        self.mean = torch.tensor([self.means[model_id] for model_id in self.model_ids],
+                                 dtype=torch.float32, device=self.device)
+        self.standard_deviation = torch.tensor([self.standard_deviations[model_id] for model_id in self.model_ids],
+                                               dtype=torch.float32, device=self.device)
+
+    def score(self, clip_vectors):
+        # clip_vectors is a (images, vector size) tensor
+        clip_vectors = clip_vectors.to(self.device, dtype=torch.float32)
+        if len(self.groups) == 0:
+            return torch.zeros((clip_vectors.shape[0], 0), dtype=torch.float32, device=self.device)
+
+        with torch.no_grad():
+            scores = [group.score(clip_vectors) for group in self.groups.values()]
+
+        return torch.cat(scores, dim=1)
+
+    def get_sigma_scores(self, scores):
+        return (scores - self.mean) / self.standard_deviation
@@ -0,0 +1,160 @@
+import os
+import string
+import hashlib
+import threading
+from datetime import datetime
+import torch
+
+DEFAULT_NUM_SHARDS = 256
+DEFAULT_CHECKPOINT_DIRECTORY = "output/image-scorer-checkpoints"
+# torch threads of each scoring process on cpu nodes
+CPU_THREADS_PER_PROCESS = 4
+
+
+# the images of a dataset are split in num_shards shards by image hash range
+# image hashes are sha256 hex strings, so the shards have about the same size
+# and an image is always in the same shard, whatever node loaded it
+#
+# the shards are assigned to the nodes round robin, then to the
+# scoring processes of the node round robin
+# every node scores its shards on its own, there is no cross node process group
+#
+# a shard is written to the checkpoint file once all of its scores
+# are uploaded, a restarted run skips the finished shards
+HEX_DIGITS = set(string.hexdigits)
+
+
+def is_valid_image_hash(image_hash):
+    return isinstance(image_hash, str) and len(image_hash) >= 8 and all(c in HEX_DIGITS for c in image_hash[:8])
+
+
+def get_shard_id(image_hash, num_shards):
+    # first 32 bits of the hash scaled to [0, num_shards)
+    # a malformed or empty hash is sharded by the sha256 of its text,
+    # so its image is still scored, on the same node whatever node loaded it
+    if not is_valid_image_hash(image_hash):
+        image_hash = hashlib.sha256(str(image_hash).encode()).hexdigest()
+
+    return (int(image_hash[:8], 16) * num_shards) >> 32
+
+
+def get_node_shard_rows(image_hashes, num_shards, node_rank, num_nodes):
+    # returns {shard id: row indices} for the shards of this node
+    shard_rows = {}
+    num_invalid_hashes = 0
+    for row, image_hash in enumerate(image_hashes):
+        if not is_valid_image_hash(image_hash):
+            num_invalid_hashes += 1
+        shard_id = get_shard_id(image_hash, num_shards)
+        if shard_id % num_nodes != node_rank:
+            continue
+        shard_rows.setdefault(shard_id, []).append(row)
+
+    if num_invalid_hashes > 0:
+        print(f"{num_invalid_hashes} images have a malformed hash, they are sharded by the sha256 of the hash")
+
+    return shard_rows
+
+
+def get_scoring_device(device_type, rank):
+    if device_type == "cuda":
+        return torch.device(f'cuda:{rank}')
+
+    return torch.device('cpu')
+
+
+def get_backend(device_type):
+    return "nccl" if device_type == "cuda" else "gloo"
+
+
+def get_num_processes(device_type, num_processes=None):
+    if num_processes is not None:
+        return num_processes
+
+    if device_type == "cuda":
+        return torch.cuda.device_count()
+
+    return max(1, (os.cpu_count() or 1) // CPU_THREADS_PER_PROCESS)
+
+
+def get_run_id():
+    # one run per day, the nightly re-scoring starts from zero
+    return datetime.now().strftime("%Y-%m-%d")
+
+
+def get_checkpoint_path(checkpoint_directory, scorer_name, run_id, bucket, dataset, model_ids, num_shards):
+    # the checkpoint is only valid for the same models and shard count
+    models_hash = hashlib.sha256(",".join(sorted(str(model_id) for model_id in model_ids)).encode()).hexdigest()[:12]
+    file_name = f"{dataset}-{num_shards}-{models_hash}.txt"
+
+    return os.path.join(checkpoint_directory, scorer_name, run_id, bucket, file_name)
+
+
+class ShardCheckpoint:
+    # one finished shard id per line
+    # the processes of a node append to the same file
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.finished_shards = set()
+
+    def load(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        if os.path.exists(self.path):
+            with open(self.path, "r") as file:
+                for line in file:
+                    line = line.strip()
+                    # a crash can leave a partial last line
+                    if line.isdigit():
+                        self.finished_shards.add(int(line))
+
+        return self.finished_shards
+
+    def is_finished(self, shard_id):
+        return shard_id in self.finished_shards
+
+    def mark_finished(self, shard_id):
+        with self.lock:
+            with open(self.path, "a") as file:
+                file.write(f"{shard_id}\n")
+                file.flush()
+                os.fsync(file.fileno())
+            self.finished_shards.add(shard_id)
+
+
+class ShardUploadTracker:
+    # marks a shard finished when all of its upload futures succeeded
+    def __init__(self, checkpoint):
+        self.checkpoint = checkpoint
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.failed_shards = set()
+
+    def add(self, shard_id, futures):
+        if len(futures) == 0:
+            self.checkpoint.mark_finished(shard_id)
+            return
+
+        with self.lock:
+            self.pending[shard_id] = len(futures)
+
+        for future in futures:
+            future.add_done_callback(lambda done_future, shard_id=shard_id: self.on_done(shard_id, done_future))
+
+    def on_done(self, shard_id, future):
+        with self.lock:
+            # the upload requests return false when the server refused the scores
+            if future.cancelled() or future.exception() is not None or future.result() is False:
+                self.failed_shards.add(shard_id)
+
+            self.pending[shard_id] -= 1
+            if self.pending[shard_id] > 0:
+                return
+            del self.pending[shard_id]
+
+            if shard_id in self.failed_shards:
+                print(f"uploads of shard {shard_id} failed, it will be scored again by the next run")
+                return
+
+        self.checkpoint.mark_finished(shard_id)
@@ -20,6 +20,7 @@ from data_loader.utils import get_object
 from training_worker.scoring.models.clip_to_clip_fc import CliptoClipFCNetwork
 from kandinsky.models.clip_image_encoder.clip_image_encoder import KandinskyCLIPImageEncoder
 from utility.minio import cmd
+from utility.msgpack_ndarray import unpackb
 from utility.http import request
 from utility.path import separate_bucket_and_file_path
 from kandinsky.models.kandisky import KandinskyPipeline
@@ -103,7 +104,7 @@ class InversionPipeline:
                 
                 output_clip_path = file_path + "_clip_kandinsky.msgpack"
                 features_data = cmd.get_file_from_minio(self.minio_client, bucket_name, output_clip_path)
-                features_vector = msgpack.unpackb(features_data.data)["clip-feature-vector"]
+                features_vector = unpackb(features_data.data)["clip-feature-vector"]
                 output_clip_vector= torch.tensor(features_vector)
                 clip_vectors.append(output_clip_vector)
 
@@ -19,6 +19,7 @@ sys.path.insert(0, os.getcwd())
 from kandinsky_worker.image_generation.img2img_generator import generate_img2img_generation_jobs_with_kandinsky
 from training_worker.scoring.models.scoring_fc import ScoringFCNetwork
 from utility.minio import cmd
+from utility.msgpack_ndarray import unpackb
 from utility.http import request
 from data_loader.utils import get_object
 from utility.path import separate_bucket_and_file_path
@@ -168,7 +169,7 @@ class KandinskyImageGenerator:
                 bucket, features_vector_path = separate_bucket_and_file_path(clip_path)
 
                 features_data = get_object(self.minio_client, features_vector_path)
-                features = msgpack.unpackb(features_data)["clip-feature-vector"]
+                features = unpackb(features_data)["clip-feature-vector"]
                 features = torch.tensor(features).to(self.device)
                 clip_vectors.append(features)
             except Exception as e:
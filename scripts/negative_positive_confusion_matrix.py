@@ -5,7 +5,6 @@ import sys
 import argparse
 from matplotlib import pyplot as plt
 from matplotlib.colors import LinearSegmentedColormap
-import msgpack
 import numpy as np
 import torch
 import seaborn as sb
@@ -14,6 +13,7 @@ sys.path.insert(0, base_directory)
 
 from training_worker.ab_ranking.model.ab_ranking_elm_v1 import ABRankingELMModel
 from utility.minio import cmd
+from utility.msgpack_ndarray import unpackb
  
 
 #
@@ -97,11 +97,11 @@ class EmbeddingConfusionMatrix:
                 data_bytes = file.read()
 
             # Load the data from the bytes using msgpack
-            data = msgpack.unpackb(data_bytes, raw=False)
-            positive_embedding= list(data['positive_embedding'].values())
+            data = unpackb(data_bytes)
+            positive_embedding= [data['positive_embedding']]
             positive_embedding_array = torch.tensor(np.array(positive_embedding)).float()
 
-            negative_embedding= list(data['negative_embedding'].values())
+            negative_embedding= [data['negative_embedding']]
             negative_embedding_array =torch.tensor(np.array(negative_embedding)).float()
 
             positive_scores.append(self.embedding_score_model_positive.predict_positive_or_negative_only(positive_embedding_array))
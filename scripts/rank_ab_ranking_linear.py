@@ -45,7 +45,8 @@ def train_ranking(rank_model_info: dict, # rank_model_info must have rank_model_
                   target_option=constants.TARGET_1_AND_0,
                   duplicate_flip_option=constants.DUPLICATE_AND_FLIP_ALL,
                   randomize_data_per_epoch=True,
-                  penalty_range = 5.0
+                  penalty_range = 5.0,
+                  use_feature_shards=False
                   ):
     date_now = datetime.now(tz=timezone("Asia/Hong_Kong")).strftime('%Y-%m-%d')
     print("Current datetime: {}".format(datetime.now(tz=timezone("Asia/Hong_Kong"))))
@@ -77,7 +78,8 @@ def train_ranking(rank_model_info: dict, # rank_model_info must have rank_model_
                                             pooling_strategy=pooling_strategy,
                                             normalize_vectors=normalize_vectors,
                                             target_option=target_option,
-                                            duplicate_flip_option=duplicate_flip_option)
+                                            duplicate_flip_option=duplicate_flip_option,
+                                            use_feature_shards=use_feature_shards)
     loaded = dataset_loader.load_dataset()
 
     # if dataset is not loaded, ranking will be cancelled
@@ -358,6 +360,7 @@ def parse_args():
     parser.add_argument('--duplicate-flip-option', type=str, default=constants.DUPLICATE_AND_FLIP_ALL, help='Duplicate and flip option')
     parser.add_argument('--randomize-data-per-epoch', action='store_true', help='Randomize data per epoch')
     parser.add_argument('--penalty-range', type=float, default=5.0, help='Penalty range')
+    parser.add_argument('--use-feature-shards', action='store_true', help='Load the features from the dataset feature shards')
 
     # more paramter for elm ranking model
     parser.add_argument('--num-random-layers', type=int, default=1, help='Number of random layers')
@@ -401,6 +404,7 @@ def main():
             duplicate_flip_option=args.duplicate_flip_option,
             randomize_data_per_epoch=args.randomize_data_per_epoch,
             penalty_range=args.penalty_range,
+            use_feature_shards=args.use_feature_shards,
         )
     
 if __name__ == '__main__':
@@ -4,10 +4,10 @@ import sys
 base_directory = os.getcwd()
 sys.path.insert(0, base_directory)
 from utility.minio import cmd
+from utility.msgpack_ndarray import unpackb
 from training_worker.classifiers.models.elm_regression import ELMRegression
 from minio import Minio
 import torch
-import msgpack
 import csv
 
 
@@ -53,7 +53,7 @@ def get_clip_vectors(minio_client, base_path, num_samples=10):
     for clip_obj in selected_clip_objects:
         obj_data = minio_client.get_object('datasets', clip_obj.object_name)
         obj_content = obj_data.read()
-        unpacked_data = msgpack.unpackb(obj_content, raw=False)
+        unpacked_data = unpackb(obj_content)
         vector = unpacked_data['clip-feature-vector'][0]
         vector_tensor = torch.tensor(vector).to(device)
         clip_vectors_and_paths.append((vector_tensor, clip_obj.object_name))  # Store both tensor and path
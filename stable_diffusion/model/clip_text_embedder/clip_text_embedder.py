@@ -151,6 +151,13 @@ class CLIPTextEmbedder(nn.Module):
 
         return num_tokens
 
+    def compute_token_lengths(self, prompts: List[str]):
+        # number of tokens of each prompt, without padding
+        # tokenizes the whole list in one call
+        batch_encoding = self.tokenizer(prompts, truncation=False, padding=False, return_length=True)
+
+        return batch_encoding['length']
+
     def tokenize(self, prompts: List[str], max_token_length : int):
         # Tokenize the prompts
         batch_encoding = self.tokenizer(prompts, truncation=False, max_length=self.max_length, return_length=True,
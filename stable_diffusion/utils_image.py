@@ -86,9 +86,10 @@ def save_image_data_to_minio(minio_client, job_uuid, creation_time, dataset, fil
 
 def save_latent_to_minio(minio_client, bucket_name, job_uuid, file_hash, latent, file_path):
     bucket_name, file_path = separate_bucket_and_file_path(file_path)
-    # Convert the latent Tensor to a list or NumPy array
+    # Convert the latent Tensor to a NumPy array
+    # arrays are stored as raw bytes, see utility/msgpack_ndarray.py
     if isinstance(latent, torch.Tensor):
-        latent = latent.cpu().numpy().tolist()
+        latent = latent.detach().cpu().numpy()
 
     # Create an instance of the LatentData class with the provided latent representation
     latent_data = LatentData(job_uuid, file_hash, latent)
@@ -122,10 +123,20 @@ def get_embeddings(job_uuid,
                   file_hash,
                   positive_prompt,
                   negative_prompt,
-                  text_embedder):
-    # calculate new embeddings
-    positive_embedding, _, positive_attention_mask = text_embedder.forward_return_all(positive_prompt)
-    negative_embedding, _, negative_attention_mask = text_embedder.forward_return_all(negative_prompt)
+                  text_embedder,
+                  text_conditioning=None,
+                  prompt_embedding_cache=None):
+    if text_conditioning is not None:
+        # reuse the embeddings computed for the generation
+        # (positive_embedding, positive_attention_mask, negative_embedding, negative_attention_mask)
+        positive_embedding, positive_attention_mask, negative_embedding, negative_attention_mask = text_conditioning
+    elif prompt_embedding_cache is not None:
+        positive_embedding, _, positive_attention_mask = prompt_embedding_cache.encode(positive_prompt)
+        negative_embedding, _, negative_attention_mask = prompt_embedding_cache.get(negative_prompt)
+    else:
+        # calculate new embeddings
+        positive_embedding, _, positive_attention_mask = text_embedder.forward_return_all(positive_prompt)
+        negative_embedding, _, negative_attention_mask = text_embedder.forward_return_all(negative_prompt)
 
     positive_attention_mask_detached = positive_attention_mask.detach().cpu().numpy()
     negative_attention_mask_detached = negative_attention_mask.detach().cpu().numpy()
@@ -52,6 +52,19 @@ class ABRankingELMBaseModel(nn.Module):
         assert scaled_output.shape == (1,1)
         return scaled_output
 
+    # same as forward for a (n, self.inputs_shape) batch
+    def forward_batch(self, x):
+        assert x.dim() == 2 and x.shape[1] == self.inputs_shape
+
+        for i in range(self.num_random_layers):
+            x = self.random_layers[i](x)
+
+        output = self.linear_last_layer(x)
+        scaled_output = torch.multiply(output, self.scaling_factor)
+
+        assert scaled_output.shape == (len(x), 1)
+        return scaled_output
+
     # TODO: add bias for the layers too
     def random_layers_init(self, elm_sparsity=0.0):
         for _ in range(self.num_random_layers):
@@ -100,6 +113,18 @@ class ABRankingELMBaseModelDeprecate(nn.Module):
         assert output.shape == (1,1)
         return output
 
+    # same as forward for a (n, self.inputs_shape) batch
+    def forward_batch(self, x):
+        assert x.dim() == 2 and x.shape[1] == self.inputs_shape
+
+        for i in range(self.num_random_layers):
+            x = self.random_layers[i](x)
+
+        output = self.linear_last_layer(x)
+
+        assert output.shape == (len(x), 1)
+        return output
+
     # TODO: add bias for the layers too
     def random_layers_init(self, elm_sparsity=0.0):
         for _ in range(self.num_random_layers):
@@ -651,6 +676,17 @@ class ABRankingELMModel:
 
             return outputs
 
+    # accepts attention pooled positive and negative embeddings, [n, 768] each
+    # scores all of them in one forward pass, returns [n] scores
+    def predict_pooled_batch(self, positive_inputs, negative_inputs):
+        # same layout as predict_average_pooling, positive then negative
+        inputs = torch.cat((positive_inputs, negative_inputs), dim=-1)
+
+        with torch.no_grad():
+            outputs = self.model.forward_batch(inputs).reshape(-1)
+
+            return outputs
+
     # accepts only pooled embeddings
     def predict_positive_or_negative_only_pooled(self, inputs):
         # then concatenate
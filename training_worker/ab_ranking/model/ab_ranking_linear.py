@@ -47,6 +47,16 @@ class ABRankingLinearModel(nn.Module):
         assert scaled_output.shape == (1,1)
         return scaled_output
 
+    # same as forward for a (n, self.inputs_shape) batch
+    def forward_batch(self, input):
+        assert input.dim() == 2 and input.shape[1] == self.inputs_shape
+
+        output = self.linear(input)
+        scaled_output = torch.multiply(output, self.scaling_factor)
+
+        assert scaled_output.shape == (len(input), 1)
+        return scaled_output
+
 class ABRankingLinearModelDeprecate(nn.Module):
     def __init__(self, inputs_shape):
         super(ABRankingLinearModelDeprecate, self).__init__()
@@ -68,6 +78,15 @@ class ABRankingLinearModelDeprecate(nn.Module):
         assert output.shape == (1,1)
         return output
 
+    # same as forward for a (n, self.inputs_shape) batch
+    def forward_batch(self, input):
+        assert input.dim() == 2 and input.shape[1] == self.inputs_shape
+
+        output = self.linear(input)
+
+        assert output.shape == (len(input), 1)
+        return output
+
 class ABRankingModel:
     def __init__(self, inputs_shape, device = None):
         if device is not None:
@@ -586,6 +605,17 @@ class ABRankingModel:
 
             return outputs
 
+    # accepts attention pooled positive and negative embeddings, [n, 768] each
+    # scores all of them in one forward pass, returns [n] scores
+    def predict_pooled_batch(self, positive_inputs, negative_inputs):
+        # same layout as predict_average_pooling, positive then negative
+        inputs = torch.cat((positive_inputs, negative_inputs), dim=-1)
+
+        with torch.no_grad():
+            outputs = self.model.forward_batch(inputs).reshape(-1)
+
+            return outputs
+
     # accepts only pooled embeddings
     def predict_positive_or_negative_only_pooled(self, inputs):
         # then concatenate
@@ -1,5 +1,4 @@
 import numpy as np
-import msgpack
 import torch
 import gc
 
@@ -8,6 +7,7 @@ import hashlib
 from transformers import CLIPTextModel, CLIPTokenizer, CLIPModel
 
 from stable_diffusion.utils_backend import get_device
+from utility.msgpack_ndarray import packb, unpackb
 
 
 class PooledClipTextEembedder:
@@ -101,13 +101,13 @@ class PooledClipTextEembedderOutput:
         
     def save(self, file_path: str):
         
-        decoded_data = msgpack.packb(dict(
+        decoded_data = packb(dict(
             model_type=self.model_type,
             prompts=self.prompts,
-            embedding={'__ndarray__': self.embedding.tolist()},
+            embedding=self.embedding,
             pooling_strategy=self.pooling_strategy,
             embedding_hash=self.embedding_hash
-        ), use_bin_type=True)
+        ))
         
         with open(file_path, 'wb') as f:
             f.write(decoded_data)
@@ -118,12 +118,12 @@ class PooledClipTextEembedderOutput:
         with open(file_path, 'rb') as f:
             data = f.read()
             
-        decoded_data = msgpack.unpackb(data)
+        decoded_data = unpackb(data)
         
         output = PooledClipTextEembedderOutput(
             model_type=decoded_data['model_type'],
             prompts=decoded_data['prompts'],
-            embedding=np.array(decoded_data['embedding']['__ndarray__']),
+            embedding=decoded_data['embedding'],
             pooling_strategy=decoded_data['pooling_strategy']
         )
 
@@ -46,13 +46,13 @@ base_directory = os.getcwd()
 sys.path.insert(0, base_directory)
 from data_loader.ab_ranking_dataset_loader import ABRankingDatasetLoader
 from utility.minio import cmd
+from utility.msgpack_ndarray import unpackb
 from utility.clip.clip_text_embedder import tensor_attention_pooling
 import urllib.request
 from urllib.error import HTTPError
 from torch.utils.data import random_split, DataLoader
 from PIL import Image
 import requests
-import msgpack 
 from kandinsky.models.clip_image_encoder.clip_image_encoder import KandinskyCLIPImageEncoder
 import tempfile
 import csv
@@ -766,7 +766,7 @@ def get_clip_vectors(file_paths):
             bucket, features_vector_path = separate_bucket_and_file_path(clip_path)
 
             features_data = get_object(minio_client, features_vector_path)
-            features = msgpack.unpackb(features_data)["clip-feature-vector"]
+            features = unpackb(features_data)["clip-feature-vector"]
             features = torch.tensor(features)
             clip_vectors.append(features)
         except Exception as e:
@@ -19,6 +19,7 @@ from training_worker.prompt_mutator.binary_prompt_mutator import BinaryPromptMut
 from training_worker.ab_ranking.model.ab_ranking_elm_v1 import ABRankingELMModel
 from stable_diffusion.model.clip_text_embedder.clip_text_embedder import CLIPTextEmbedder
 from utility.ensemble.ensemble_helpers import Binning, SigmaScoresWithEntropy
+from utility.msgpack_ndarray import unpackb
 from utility.minio import cmd
 
 DATA_MINIO_DIRECTORY="environmental/data/prompt-generator/entropy/"
@@ -238,7 +239,7 @@ class EntropyDatasetLoader:
             content = data.read()
 
             # Deserialize the content using msgpack
-            msgpack_data = msgpack.loads(content)
+            msgpack_data = unpackb(content)
 
             # get prompt embedding 
             prompt_str=msgpack_data[f'{self.embedding_type}_prompt']
@@ -247,7 +248,7 @@ class EntropyDatasetLoader:
             if prompt_token_length > 77:
                 continue
 
-            prompt_embedding= list(msgpack_data[f'{self.embedding_type}_embedding'].values())
+            prompt_embedding= [msgpack_data[f'{self.embedding_type}_embedding']]
             prompt_embedding = torch.tensor(np.array(prompt_embedding)).float()
             prompt_embedding=prompt_embedding.to(self.device)
             
@@ -20,6 +20,7 @@ from training_worker.ab_ranking.model.ab_ranking_elm_v1 import ABRankingELMModel
 from training_worker.ab_ranking.model.ab_ranking_linear import ABRankingModel
 from stable_diffusion.model.clip_text_embedder.clip_text_embedder import CLIPTextEmbedder
 from utility.minio import cmd
+from utility.msgpack_ndarray import unpackb
 
 DATA_MINIO_DIRECTORY="data/prompt-generator/"
 MAX_LENGTH=77
@@ -215,11 +216,11 @@ def create_permutation_dataset(minio_client, device, embedding_type):
         content = data.read()
 
         # Deserialize the content using msgpack
-        msgpack_data = msgpack.loads(content)
+        msgpack_data = unpackb(content)
 
         # get prompt embedding 
         prompt_str=msgpack_data[f'{embedding_type}_prompt']
-        prompt_embedding= list(msgpack_data[f'{embedding_type}_embedding'].values())
+        prompt_embedding= [msgpack_data[f'{embedding_type}_embedding']]
         prompt_embedding = torch.tensor(np.array(prompt_embedding)).float()
         prompt_embedding=prompt_embedding.to(device)
 
@@ -345,7 +346,7 @@ def create_substitution_dataset(minio_client, device, csv_path, embedding_type,
         content = data.read()
 
         # Deserialize the content using msgpack
-        msgpack_data = msgpack.loads(content)
+        msgpack_data = unpackb(content)
 
         # get prompt embedding 
         prompt_str=msgpack_data[f'{embedding_type}_prompt']
@@ -354,7 +355,7 @@ def create_substitution_dataset(minio_client, device, csv_path, embedding_type,
         if prompt_token_length > 77:
             continue
 
-        prompt_embedding= list(msgpack_data[f'{embedding_type}_embedding'].values())
+        prompt_embedding= [msgpack_data[f'{embedding_type}_embedding']]
         prompt_embedding = torch.tensor(np.array(prompt_embedding)).float()
         prompt_embedding=prompt_embedding.to(device)
         
@@ -467,11 +468,11 @@ def create_addition_dataset(minio_client, device, csv_path, embedding_type):
         content = data.read()
 
         # Deserialize the content using msgpack
-        msgpack_data = msgpack.loads(content)
+        msgpack_data = unpackb(content)
 
         # get prompt embedding 
         prompt_str=msgpack_data[f'{embedding_type}_prompt']
-        prompt_embedding= list(msgpack_data[f'{embedding_type}_embedding'].values())
+        prompt_embedding= [msgpack_data[f'{embedding_type}_embedding']]
         prompt_embedding = torch.tensor(np.array(prompt_embedding)).float()
         prompt_embedding=prompt_embedding.to(device)
 
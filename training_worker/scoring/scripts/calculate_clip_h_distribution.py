@@ -11,6 +11,7 @@ from tqdm import tqdm
 base_directory = "./"
 sys.path.insert(0, base_directory)
 from utility.path import separate_bucket_and_file_path
+from utility.msgpack_ndarray import unpackb
 from kandinsky.models.clip_image_encoder.clip_image_encoder import KandinskyCLIPImageEncoder
 from utility.minio import cmd
 from data_loader.utils import get_object
@@ -57,7 +58,7 @@ def main():
 
                 clip_path = file_path + "_clip_kandinsky.msgpack"
                 clip_data = get_object(minio_client, clip_path)
-                clip_vector = msgpack.unpackb(clip_data)['clip-feature-vector']
+                clip_vector = unpackb(clip_data)['clip-feature-vector']
                 clip_vectors.append(clip_vector[0])
             except Exception as e:
                 print(f"an error occured: {e}")
@@ -6,7 +6,6 @@ import os
 import requests
 from tqdm.auto import tqdm
 import argparse
-import msgpack
 import numpy as np
 import torch
 from sklearn.metrics.pairwise import cosine_similarity
@@ -17,6 +16,7 @@ sys.path.insert(0, os.getcwd())
 
 from training_worker.ab_ranking.model.ab_ranking_elm_v1 import ABRankingELMModel
 from utility.minio import cmd
+from utility.msgpack_ndarray import unpackb
 from utility.minio.cmd import connect_to_minio_client
 from utility.active_learning.pairs import get_candidate_pairs_by_score, get_candidate_pairs_within_category
 
@@ -146,7 +146,7 @@ class ActiveLearningPipeline:
     
             # get clip embedding    
             data = self.client.get_object(self.bucket_name, object_name).data
-            decoded_data = msgpack.unpackb(data)
+            decoded_data = unpackb(data)
             embedding= np.array(decoded_data['clip-feature-vector']).astype('float32')
 
             # calculate score and variance
@@ -3,7 +3,6 @@ import sys
 import io
 import csv
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 import numpy as np
 import random
@@ -15,6 +14,7 @@ base_directory = "./"
 sys.path.insert(0, base_directory)
 
 from utility.minio import cmd
+from utility.weighted_phrase_sampler import WeightedPhraseSampler
 from worker.prompt_generation.prompt_generator import generate_image_generation_jobs_with_temperature, generate_inpainting_job_with_temperature
 
 
@@ -54,74 +54,19 @@ def find_first_element_binary_search(cumulative_prob_arr, random_float):
     return -1
 
 
-def generate_prompt(positive_phrase_scores_loader,
-                    positive_phrase_origin_indexes,
-                    positive_cumulative_probability_arr,
-                    negative_phrase_scores_loader,
-                    negative_phrase_origin_indexes,
-                    negative_cumulative_probability_arr,
-                    ):
-    max_token_size = 75
-    comma_token_size = 1
-
-    positive_prompt_total_token_size = 0
-    negative_prompt_total_token_size = 0
-    positive_prompt = []
-    negative_prompt = []
-    positive_used_phrase_dict = {}
-    negative_used_phrase_dict = {}
-
-    positive_cumulative_probability_arr_min = positive_cumulative_probability_arr.min()
-    positive_cumulative_probability_arr_max = positive_cumulative_probability_arr.max()
-    # positive prompt
-    while positive_prompt_total_token_size < max_token_size:
-        random_float = random.uniform(positive_cumulative_probability_arr_min,
-                                      positive_cumulative_probability_arr_max)
-        x_rand = random_float
-        random_index = find_first_element_binary_search(positive_cumulative_probability_arr, random_float)
-        while random_index in positive_used_phrase_dict:
-            y_rand = random.uniform(0.0, (1.0 - x_rand))
-            x_rand = x_rand + y_rand
-            random_index = find_first_element_binary_search(positive_cumulative_probability_arr, x_rand)
-
-        prompt_index = positive_phrase_origin_indexes[random_index]
-        random_phrase = positive_phrase_scores_loader.get_phrase(prompt_index)
-
-        chosen_phrase_size = positive_phrase_scores_loader.get_token_size(prompt_index)
-        sum_token_size = positive_prompt_total_token_size + chosen_phrase_size + comma_token_size
-        if sum_token_size < max_token_size:
-            # update used array
-            positive_used_phrase_dict[random_index] = 1
-            positive_prompt.append(random_phrase)
-            positive_prompt_total_token_size = sum_token_size
-        else:
-            break
+def get_phrase_sampler(phrase_scores_loader, phrase_origin_indexes, cumulative_probability_arr):
+    # sampler of the phrases in the sorted order of the cumulative probability arr
+    token_sizes = [phrase_scores_loader.get_token_size(index) for index in phrase_origin_indexes]
+    phrases = [phrase_scores_loader.get_phrase(index) for index in phrase_origin_indexes]
+
+    return WeightedPhraseSampler.from_cumulative_weights(cumulative_probability_arr, token_sizes, phrases)
 
-    negative_cumulative_probability_arr_min = negative_cumulative_probability_arr.min()
-    negative_cumulative_probability_arr_max = negative_cumulative_probability_arr.max()
-    # negative prompt
-    while negative_prompt_total_token_size < max_token_size:
-        random_float = random.uniform(negative_cumulative_probability_arr_min,
-                                      negative_cumulative_probability_arr_max)
-        x_rand = random_float
-        random_index = find_first_element_binary_search(negative_cumulative_probability_arr, random_float)
-        while random_index in negative_used_phrase_dict:
-            y_rand = random.uniform(0.0, (1.0 - x_rand))
-            x_rand = x_rand + y_rand
-            random_index = find_first_element_binary_search(negative_cumulative_probability_arr, x_rand)
-
-        prompt_index = negative_phrase_origin_indexes[random_index]
-        random_phrase = negative_phrase_scores_loader.get_phrase(prompt_index)
-
-        chosen_phrase_size = negative_phrase_scores_loader.get_token_size(prompt_index)
-        sum_token_size = negative_prompt_total_token_size + chosen_phrase_size + comma_token_size
-        if sum_token_size < max_token_size:
-            # update used array
-            negative_used_phrase_dict[random_index] = 1
-            negative_prompt.append(random_phrase)
-            negative_prompt_total_token_size = sum_token_size
-        else:
-            break
+
+def generate_prompt(positive_sampler, negative_sampler, positive_draws, negative_draws):
+    # the positive and negative phrases come from different phrase lists,
+    # so they have separate used phrases
+    positive_prompt = positive_sampler.get_phrases(positive_sampler.pack(positive_draws, set()))
+    negative_prompt = negative_sampler.get_phrases(negative_sampler.pack(negative_draws, set()))
 
     positive_prompt_str = ', '.join([prompt for prompt in positive_prompt])
     negative_prompt_str = ', '.join([prompt for prompt in negative_prompt])
@@ -131,6 +76,15 @@ def generate_prompt(positive_phrase_scores_loader,
     return prompt
 
 
+def generate_prompts_with_samplers(positive_sampler, negative_sampler, prompt_count):
+    # returns a list of (positive prompt, negative prompt)
+    positive_draws = positive_sampler.get_draws()
+    negative_draws = negative_sampler.get_draws()
+
+    return [generate_prompt(positive_sampler, negative_sampler, positive_draws, negative_draws)
+            for _ in range(prompt_count)]
+
+
 def generate_prompts(minio_client,
                      dataset_name,
                      positive_phrase_scores_loader,
@@ -144,70 +98,65 @@ def generate_prompts(minio_client,
                      boltzman_k):
     generated_prompts = []
 
+    positive_sampler = get_phrase_sampler(positive_phrase_scores_loader, positive_phrase_origin_indexes,
+                                          positive_cumulative_probability_arr)
+    negative_sampler = get_phrase_sampler(negative_phrase_scores_loader, negative_phrase_origin_indexes,
+                                          negative_cumulative_probability_arr)
+
     print("Generating {} prompts...".format(prompt_count))
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        futures = []
-        for i in range(prompt_count):
-            futures.append(executor.submit(generate_prompt,
-                                           positive_phrase_scores_loader=positive_phrase_scores_loader,
-                                           positive_phrase_origin_indexes=positive_phrase_origin_indexes,
-                                           positive_cumulative_probability_arr=positive_cumulative_probability_arr,
-                                           negative_phrase_scores_loader=negative_phrase_scores_loader,
-                                           negative_phrase_origin_indexes=negative_phrase_origin_indexes,
-                                           negative_cumulative_probability_arr=negative_cumulative_probability_arr))
-
-        for future in tqdm(as_completed(futures), total=len(futures)):
-            prompt = future.result()
-            positive_prompt = prompt[0]
-            negative_prompt = prompt[1]
-            print("positive prompt=", positive_prompt)
-            print("negative prompt=", negative_prompt)
-            print("---------------------------------------------------------------")
-            if dataset_name in ["environmental", "propaganda-poster", "waifu", "test-generations"]:
-                response = generate_image_generation_jobs_with_temperature(positive_prompt=positive_prompt,
-                                                                           negative_prompt=negative_prompt,
-                                                                           prompt_scoring_model="n/a",
-                                                                           prompt_score=0.0,
-                                                                           prompt_generation_policy="independent_approx_v1",
-                                                                           top_k=0.0,
-                                                                           dataset_name=dataset_name,
-                                                                           boltzman_temperature=boltzman_temperature,
-                                                                           boltzman_k=boltzman_k)
-            elif dataset_name in ["character", "mech", "icons"]:
-                mask_path = "./test/test_inpainting/icon_mask.png"
-                if dataset_name == "character":
-                    mask_path = "./test/test_inpainting/character_mask.png"
-                elif dataset_name == "mech":
-                    sizes = ["1x1", "1x2", "2x1", "2x2", "2x3", "3x2", "3x3"]
-                    chosen_size = random.randint(0, len(sizes)-1)
-                    size_str = sizes[chosen_size]
-                    mask_path = "./input/mask/mech/mech_mask_{}.png".format(size_str)
-
-                response = generate_inpainting_job_with_temperature(positive_prompt=positive_prompt,
-                                                                    negative_prompt=negative_prompt,
-                                                                    prompt_scoring_model="n/a",
-                                                                    prompt_score=0.0,
-                                                                    prompt_generation_policy="independent_approx_v1",
-                                                                    top_k=0.0,
-                                                                    dataset_name=dataset_name,
-                                                                    boltzman_temperature=boltzman_temperature,
-                                                                    boltzman_k=boltzman_k,
-                                                                    init_img_path="./test/test_inpainting/white_512x512.jpg",
-                                                                    mask_path=mask_path)
-            else:
-                raise Exception("dataset unsupported")
-
-            job_uuid = response['uuid']
-            data = {"job_uuid": job_uuid,
-                    "positive_prompt": positive_prompt,
-                    "negative_prompt": negative_prompt}
-            generated_prompts.append(data)
-
-        upload_prompt_generation_data_to_csv(minio_client=minio_client,
-                                             dataset_name=dataset_name,
-                                             prompt_generation_data=generated_prompts,
-                                             boltzman_temperature=boltzman_temperature,
-                                             boltzman_k=boltzman_k)
+    prompts = generate_prompts_with_samplers(positive_sampler, negative_sampler, prompt_count)
+
+    for prompt in tqdm(prompts):
+        positive_prompt = prompt[0]
+        negative_prompt = prompt[1]
+        print("positive prompt=", positive_prompt)
+        print("negative prompt=", negative_prompt)
+        print("---------------------------------------------------------------")
+        if dataset_name in ["environmental", "propaganda-poster", "waifu", "test-generations"]:
+            response = generate_image_generation_jobs_with_temperature(positive_prompt=positive_prompt,
+                                                                       negative_prompt=negative_prompt,
+                                                                       prompt_scoring_model="n/a",
+                                                                       prompt_score=0.0,
+                                                                       prompt_generation_policy="independent_approx_v1",
+                                                                       top_k=0.0,
+                                                                       dataset_name=dataset_name,
+                                                                       boltzman_temperature=boltzman_temperature,
+                                                                       boltzman_k=boltzman_k)
+        elif dataset_name in ["character", "mech", "icons"]:
+            mask_path = "./test/test_inpainting/icon_mask.png"
+            if dataset_name == "character":
+                mask_path = "./test/test_inpainting/character_mask.png"
+            elif dataset_name == "mech":
+                sizes = ["1x1", "1x2", "2x1", "2x2", "2x3", "3x2", "3x3"]
+                chosen_size = random.randint(0, len(sizes)-1)
+                size_str = sizes[chosen_size]
+                mask_path = "./input/mask/mech/mech_mask_{}.png".format(size_str)
+
+            response = generate_inpainting_job_with_temperature(positive_prompt=positive_prompt,
+                                                                negative_prompt=negative_prompt,
+                                                                prompt_scoring_model="n/a",
+                                                                prompt_score=0.0,
+                                                                prompt_generation_policy="independent_approx_v1",
+                                                                top_k=0.0,
+                                                                dataset_name=dataset_name,
+                                                                boltzman_temperature=boltzman_temperature,
+                                                                boltzman_k=boltzman_k,
+                                                                init_img_path="./test/test_inpainting/white_512x512.jpg",
+                                                                mask_path=mask_path)
+        else:
+            raise Exception("dataset unsupported")
+
+        job_uuid = response['uuid']
+        data = {"job_uuid": job_uuid,
+                "positive_prompt": positive_prompt,
+                "negative_prompt": negative_prompt}
+        generated_prompts.append(data)
+
+    upload_prompt_generation_data_to_csv(minio_client=minio_client,
+                                         dataset_name=dataset_name,
+                                         prompt_generation_data=generated_prompts,
+                                         boltzman_temperature=boltzman_temperature,
+                                         boltzman_k=boltzman_k)
 
 
 def generate_prompts_array(positive_phrase_scores_loader,
@@ -219,31 +168,26 @@ def generate_prompts_array(positive_phrase_scores_loader,
                      prompt_count):
     generated_prompts = []
 
+    positive_sampler = get_phrase_sampler(positive_phrase_scores_loader, positive_phrase_origin_indexes,
+                                          positive_cumulative_probability_arr)
+    negative_sampler = get_phrase_sampler(negative_phrase_scores_loader, negative_phrase_origin_indexes,
+                                          negative_cumulative_probability_arr)
+
     print("Generating {} prompts...".format(prompt_count))
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        futures = []
-        for i in range(prompt_count):
-            futures.append(executor.submit(generate_prompt,
-                                           positive_phrase_scores_loader=positive_phrase_scores_loader,
-                                           positive_phrase_origin_indexes=positive_phrase_origin_indexes,
-                                           positive_cumulative_probability_arr=positive_cumulative_probability_arr,
-                                           negative_phrase_scores_loader=negative_phrase_scores_loader,
-                                           negative_phrase_origin_indexes=negative_phrase_origin_indexes,
-                                           negative_cumulative_probability_arr=negative_cumulative_probability_arr))
-
-        for future in tqdm(as_completed(futures), total=len(futures)):
-            prompt = future.result()
-            positive_prompt = prompt[0]
-            negative_prompt = prompt[1]
-
-            data = {
-                "positive_prompt": positive_prompt,
-                "negative_prompt": negative_prompt
-            }
+    prompts = generate_prompts_with_samplers(positive_sampler, negative_sampler, prompt_count)
+
+    for prompt in tqdm(prompts):
+        positive_prompt = prompt[0]
+        negative_prompt = prompt[1]
+
+        data = {
+            "positive_prompt": positive_prompt,
+            "negative_prompt": negative_prompt
+        }
 
-            generated_prompts.append(data)
+        generated_prompts.append(data)
 
-        return generated_prompts
+    return generated_prompts
 
 
 def get_cumulative_probability_arr(minio_client,
@@ -268,13 +212,10 @@ def get_cumulative_probability_arr(minio_client,
     normalized_probability_arr = probability_arr / np.sum(probability_arr)
     assert round(np.sum(normalized_probability_arr), 4) == 1.0, "sum={}".format(np.sum(normalized_probability_arr))
 
-    # cumulative
-    sorted_probability_arr = []
-    sorted_indexes = sorted(range(len(normalized_probability_arr)), key=lambda x: normalized_probability_arr[x],
-                            reverse=True)
-    for i in sorted_indexes:
-        sorted_probability_arr.append(normalized_probability_arr[i])
-    sorted_probability_arr = np.array(sorted_probability_arr)
+    # cumulative, by decreasing probability
+    # a stable sort keeps the order of equal probabilities like sorted(reverse=True)
+    sorted_indexes = np.argsort(-normalized_probability_arr, kind="stable").tolist()
+    sorted_probability_arr = normalized_probability_arr[sorted_indexes]
 
     cumulative_probability_arr = sorted_probability_arr.cumsum()
 
@@ -317,13 +258,10 @@ def get_cumulative_probability_arr_without_upload(
     normalized_probability_arr = probability_arr/np.sum(probability_arr)
     assert round(np.sum(normalized_probability_arr), 4) == 1.0, "sum={}".format(np.sum(normalized_probability_arr))
 
-    # cumulative
-    sorted_probability_arr = []
-    sorted_indexes = sorted(range(len(normalized_probability_arr)), key=lambda x: normalized_probability_arr[x],
-                                   reverse=True)
-    for i in sorted_indexes:
-        sorted_probability_arr.append(normalized_probability_arr[i])
-    sorted_probability_arr = np.array(sorted_probability_arr)
+    # cumulative, by decreasing probability
+    # a stable sort keeps the order of equal probabilities like sorted(reverse=True)
+    sorted_indexes = np.argsort(-normalized_probability_arr, kind="stable").tolist()
+    sorted_probability_arr = normalized_probability_arr[sorted_indexes]
 
     cumulative_probability_arr = sorted_probability_arr.cumsum()
     return sorted_indexes, cumulative_probability_arr
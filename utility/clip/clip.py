@@ -91,6 +91,7 @@ class ClipModel:
 
         return text_features
 
+    @torch.no_grad()
     def compute_feature_vectors(self, opened_images, batch_size):
         start_time = time.time()
 
@@ -108,6 +109,7 @@ class ClipModel:
             if self.verbose: print("Computing CLIP features for batch of size: " + str(len(batch_images)))
 
             batch_inputs = self.preprocess(images=batch_images, return_tensors="pt")
+            batch_inputs = batch_inputs.to(device=self.device)
 
             if self._clip_skip:
                 # ref https://github.com/huggingface/transformers/blob/41aef33758ae166291d72bc381477f2db84159cf/src/transformers/models/clip/modeling_clip.py#L1086
@@ -0,0 +1,50 @@
+import threading
+from collections import OrderedDict
+import torch
+
+PROMPT_EMBEDDING_CACHE_SIZE = 64
+
+
+# small lru cache of text embedder outputs, keyed by prompt
+# the jobs of a dataset share a few negative prompts
+# so they are encoded once instead of once per image
+# encode_function is the embedder method, for example
+# CLIPTextEmbedder.forward_return_all or KandinskyCLIPTextEmbedder.compute_embeddings
+# the cached tensors are shared, callers must not modify them in place
+class PromptEmbeddingCache:
+    def __init__(self, encode_function, max_size=PROMPT_EMBEDDING_CACHE_SIZE):
+        self.encode_function = encode_function
+        self.max_size = max_size
+
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def encode(self, prompt):
+        # not cached, used for the positive prompts
+        # which are different for every job
+        with torch.no_grad():
+            return self.encode_function(prompt)
+
+    def get(self, prompt):
+        with self.lock:
+            output = self.cache.get(prompt)
+            if output is not None:
+                self.cache.move_to_end(prompt)
+                self.num_hits += 1
+                return output
+            self.num_misses += 1
+
+        output = self.encode(prompt)
+        self.put(prompt, output)
+
+        return output
+
+    def put(self, prompt, output):
+        with self.lock:
+            self.cache[prompt] = output
+            self.cache.move_to_end(prompt)
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
@@ -1,4 +1,4 @@
-import requests
+from utility.http import http_client
 
 SERVER_ADDRESS = 'http://192.168.3.1:8111'
 
@@ -8,7 +8,7 @@ def http_add_external_image(image_data):
     response = None
 
     try:
-        response = requests.post(url, json=image_data, headers=headers)
+        response = http_client.post(url, json=image_data, headers=headers)
 
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}: {str(response.content)}")
@@ -29,7 +29,7 @@ def http_get_external_image_list(dataset= None, size=None):
 
     url = SERVER_ADDRESS + endpoint_url
     try:
-        response = requests.get(url)
+        response = http_client.get(url, timeout=http_client.NO_READ_TIMEOUT)
         
         if response.status_code == 200:
             data_json = response.json()
@@ -49,7 +49,7 @@ def http_get_external_dataset_in_batches(dataset: str, batch_size: int):
 
         url = SERVER_ADDRESS + endpoint_url
         try:
-            response = requests.get(url)
+            response = http_client.get(url)
             
             if response.status_code == 200:
                 data_json = response.json()
@@ -85,7 +85,7 @@ def http_get_external_dataset_in_batches_without_extracts(dataset: str, batch_si
 
         url = SERVER_ADDRESS + endpoint_url
         try:
-            response = requests.get(url)
+            response = http_client.get(url)
             
             if response.status_code == 200:
                 data_json = response.json()
@@ -119,7 +119,7 @@ def http_get_external_image_list_without_extracts(dataset, size=None):
 
     url = SERVER_ADDRESS + endpoint_url
     try:
-        response = requests.get(url)
+        response = http_client.get(url, timeout=http_client.NO_READ_TIMEOUT)
         
         if response.status_code == 200:
             data_json = response.json()
@@ -135,7 +135,7 @@ def http_add_extract(image_data):
     response = None
 
     try:
-        response = requests.post(url, json=image_data, headers=headers)
+        response = http_client.post(url, json=image_data, headers=headers)
 
         if response.status_code == 200:
             data_json = response.json()
@@ -159,7 +159,7 @@ def http_get_extract_image_list(dataset= None, size=None):
 
     url = SERVER_ADDRESS + endpoint_url
     try:
-        response = requests.get(url)
+        response = http_client.get(url, timeout=http_client.NO_READ_TIMEOUT)
         
         if response.status_code == 200:
             data_json = response.json()
@@ -174,7 +174,7 @@ def http_get_current_extract_batch_sequential_id(dataset: str):
 
     url = SERVER_ADDRESS + endpoint_url
     try:
-        response = requests.get(url)
+        response = http_client.get(url)
         
         if response.status_code == 200:
             data_json = response.json()
@@ -188,7 +188,7 @@ def http_get_next_extract_batch_sequential_id(dataset: str, is_complete: bool =
 
     url = SERVER_ADDRESS + endpoint_url
     try:
-        response = requests.get(url)
+        response = http_client.get(url)
         
         if response.status_code == 200:
             data_json = response.json()
@@ -203,7 +203,7 @@ def http_get_external_dataset_list():
     response = None
 
     try:
-        response = requests.get(url)
+        response = http_client.get(url)
 
         if response.status_code == 200:
             data_json = response.json()
@@ -224,7 +224,7 @@ def http_get_extract_dataset_list():
     response = None
 
     try:
-        response = requests.get(url)
+        response = http_client.get(url)
 
         if response.status_code == 200:
             data_json = response.json()
@@ -248,7 +248,7 @@ def http_get_video_game_list():
     response = None
 
     try:
-        response = requests.get(url)
+        response = http_client.get(url)
 
         if response.status_code == 200:
             data_json = response.json()
@@ -273,7 +273,7 @@ def http_add_dataset(dataset_name: str, bucket_id: int):
     response = None
 
     try:
-        response = requests.post(url, headers=headers, params=params)
+        response = http_client.post(url, headers=headers, params=params)
 
         if response.status_code != 200:
             print(f"Request failed with status code: {response.status_code}: {response.content.decode('utf-8')}")
@@ -294,7 +294,7 @@ def http_delete_extract(image_hash: str):
     response = None
 
     try:
-        response = requests.delete(url)
+        response = http_client.delete(url)
 
         if response.status_code == 200:
             data_json = response.json()
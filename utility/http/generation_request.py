@@ -1,6 +1,6 @@
 # NOTE: don't add more imports here
 # this is also used by training workers
-import requests
+from utility.http import http_client
 import json
 from utility.http.http_request_utils import get_url_with_query_params, http_request
 
@@ -23,7 +23,8 @@ def http_get_job(worker_type: str = None, model_type: str = None):
         url += "?" + "&".join(query_params)
 
     try:
-        response = requests.get(url)
+        # the endpoint claims the job, a retry after a lost response claims another one
+        response = http_client.get(url, idempotent=False)
 
         if response.status_code == 200:
             job_json = response.json()
@@ -38,6 +39,34 @@ def http_get_job(worker_type: str = None, model_type: str = None):
 
     return None
 
+# Get request to claim up to count available jobs at once
+def http_claim_jobs(count: int, worker_type: str = None, model_type: str = None):
+    url = SERVER_ADDRESS + "/queue/image-generation/claim-jobs"
+    query_params = {
+        "count": count,
+        "task_type": worker_type,
+        "model_type": model_type
+    }
+    url = get_url_with_query_params(url, query_params)
+    response = None
+
+    try:
+        # the endpoint claims the jobs, a retry after a lost response claims another batch
+        response = http_client.get(url, idempotent=False)
+
+        if response.status_code == 200:
+            data_json = response.json()
+            return data_json["response"]["jobs"]
+
+    except Exception as e:
+        print('request exception ', e)
+
+    finally:
+        if response:
+            response.close()
+
+    return []
+
 # get the list by dataset
 def http_get_list_by_dataset(dataset:str, model_type:str, min_clip_sigma_socre:float, size:int):
     """
@@ -71,7 +100,7 @@ def http_add_job(job):
     response = None
     
     try:
-        response = requests.post(url, json=job, headers=headers)
+        response = http_client.post(url, json=job, headers=headers)
         if response.status_code != 201 and response.status_code != 200:
             print(f"POST request failed with status code: {response.status_code}")
 
@@ -96,7 +125,7 @@ def http_add_kandinsky_job(job, positive_embedding, negative_embedding):
         "negative_embedding": negative_embedding
     }
     try:
-        response = requests.post(url, json=data, headers=headers)
+        response = http_client.post(url, json=data, headers=headers)
         if response.status_code != 201 and response.status_code != 200:
             print(f"POST request failed with status code: {response.status_code}")
 
@@ -117,7 +146,7 @@ def http_update_job_completed(job):
     response = None
 
     try:
-        response = requests.put(url, json=job, headers=headers)
+        response = http_client.put(url, json=job, headers=headers)
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}")    
     except Exception as e:
@@ -134,7 +163,27 @@ def http_update_job_failed(job):
     response = None
 
     try:
-        response = requests.put(url, json=job, headers=headers)
+        response = http_client.put(url, json=job, headers=headers)
+        if response.status_code != 200:
+            print(f"request failed with status code: {response.status_code}")
+    except Exception as e:
+        print('request exception ', e)
+
+    finally:
+        if response:
+            response.close()
+
+
+# extends the lease of an in-progress job
+# jobs whose lease expires are moved back to the pending queue
+def http_renew_job_lease(job_uuid: str, lease_seconds: int = None):
+    url = SERVER_ADDRESS + "/queue/image-generation/renew-job-lease?uuid={}".format(job_uuid)
+    if lease_seconds is not None:
+        url += "&lease_seconds={}".format(lease_seconds)
+    response = None
+
+    try:
+        response = http_client.put(url)
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}")
     except Exception as e:
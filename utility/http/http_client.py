@@ -0,0 +1,269 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# shared http client of the utility.http requests
+#
+# a bare requests.get/post opens a new connection for every call and waits
+# forever on a stuck server. the requests go through one requests.Session
+# per process instead, keeping the connections to the api alive, with
+# default timeouts and retries with jittered exponential backoff
+#
+# nothing is created at import, the session is made on the first request,
+# and again in a forked process, the sockets of the parent are not shared.
+# high fanout callers send their requests from the thread pool of the client,
+# with submit() or map_requests(), or its asyncio variant. the pool has no
+# more threads than pooled connections, more threads would open connections
+# that are dropped after the request
+#
+# the defaults can be changed with configure_http_client()
+# or the environment variables below
+HTTP_CONNECT_TIMEOUT_ENV = "HTTP_CONNECT_TIMEOUT"
+HTTP_READ_TIMEOUT_ENV = "HTTP_READ_TIMEOUT"
+HTTP_MAX_RETRIES_ENV = "HTTP_MAX_RETRIES"
+HTTP_POOL_SIZE_ENV = "HTTP_POOL_SIZE"
+
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 300
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_POOL_SIZE = 32
+# the backoff of retry n is random in [0, min(max, base * 2^n)]
+RETRY_BACKOFF_BASE = 0.5
+RETRY_BACKOFF_MAX = 10
+RETRY_STATUS_CODES = [429, 502, 503, 504]
+# requests that can be sent again after a failure or a retry status,
+# others are only retried when the connection could not be made.
+# GET endpoints that change state, like the job claims, pass idempotent=False
+IDEMPOTENT_METHODS = ["GET", "HEAD", "OPTIONS", "PUT", "DELETE"]
+# timeout of the endpoints that run for a long time before they respond,
+# like the full listings and the large score uploads, only the connection
+# has a timeout and the response is waited for without a limit
+NO_READ_TIMEOUT = "no-read-timeout"
+
+
+def get_env_number(name, default, number_type):
+    value = os.environ.get(name)
+    if not value:
+        return default
+
+    return number_type(value)
+
+
+class HttpClient:
+    def __init__(self, connect_timeout=None, read_timeout=None, max_retries=None, pool_size=None):
+        self.connect_timeout = connect_timeout if connect_timeout is not None else get_env_number(HTTP_CONNECT_TIMEOUT_ENV, DEFAULT_CONNECT_TIMEOUT, float)
+        self.read_timeout = read_timeout if read_timeout is not None else get_env_number(HTTP_READ_TIMEOUT_ENV, DEFAULT_READ_TIMEOUT, float)
+        self.max_retries = max_retries if max_retries is not None else get_env_number(HTTP_MAX_RETRIES_ENV, DEFAULT_MAX_RETRIES, int)
+        self.pool_size = pool_size if pool_size is not None else get_env_number(HTTP_POOL_SIZE_ENV, DEFAULT_POOL_SIZE, int)
+
+        self.lock = threading.Lock()
+        self.session = None
+        self.executor = None
+        self.pid = None
+
+    def reset_if_forked(self):
+        # called with the lock
+        if self.pid == os.getpid():
+            return
+
+        self.session = None
+        self.executor = None
+        self.pid = os.getpid()
+
+    def get_session(self):
+        with self.lock:
+            self.reset_if_forked()
+            if self.session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self.session = session
+
+            return self.session
+
+    def get_executor(self):
+        with self.lock:
+            self.reset_if_forked()
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="http-client")
+
+            return self.executor
+
+    def get_timeout(self, timeout):
+        # timeout is seconds or (connect, read) like in requests,
+        # a read timeout of None waits for the response without a limit
+        if timeout is None:
+            return self.connect_timeout, self.read_timeout
+        if timeout == NO_READ_TIMEOUT:
+            return self.connect_timeout, None
+
+        return timeout
+
+    def get_backoff(self, attempt):
+        return random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * (2 ** attempt)))
+
+    def can_retry(self, method, idempotent, error=None, response=None):
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+
+        if error is not None:
+            # the request was not sent if the connection could not be made
+            if isinstance(error, requests.exceptions.ConnectTimeout):
+                return True
+            return idempotent and isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+        return idempotent and response.status_code in RETRY_STATUS_CODES
+
+    def request(self, method, url, timeout=None, retries=None, idempotent=None, **kwargs):
+        # returns the requests.Response of the last attempt, raises the requests
+        # exception of the last attempt if none got a response.
+        # idempotent overrides the method based retry decision,
+        # for example for a post that is an upsert
+        session = self.get_session()
+        timeout = self.get_timeout(timeout)
+        retries = self.max_retries if retries is None else retries
+
+        attempt = 0
+        while True:
+            try:
+                response = session.request(method, url, timeout=timeout, **kwargs)
+            except requests.exceptions.RequestException as e:
+                if attempt >= retries or not self.can_retry(method, idempotent, error=e):
+                    raise
+                print(f"{method} {url} failed, retrying: {e}")
+            else:
+                if attempt >= retries or not self.can_retry(method, idempotent, response=response):
+                    return response
+                print(f"{method} {url} returned {response.status_code}, retrying")
+                response.close()
+
+            time.sleep(self.get_backoff(attempt))
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+    def submit(self, function, *args, **kwargs):
+        # runs a request function on the pooled connections,
+        # returns a concurrent.futures.Future of its result
+        return self.get_executor().submit(function, *args, **kwargs)
+
+    def map(self, function, items):
+        # calls function(item) for every item on the pooled connections,
+        # returns the results in the order of items
+        return list(self.get_executor().map(function, items))
+
+    async def request_async(self, method, url, **kwargs):
+        # asyncio version of request, the number of requests in flight
+        # is bounded by the pool size
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.get_executor(), lambda: self.request(method, url, **kwargs))
+
+    async def get_async(self, url, **kwargs):
+        return await self.request_async("GET", url, **kwargs)
+
+    async def post_async(self, url, **kwargs):
+        return await self.request_async("POST", url, **kwargs)
+
+    async def put_async(self, url, **kwargs):
+        return await self.request_async("PUT", url, **kwargs)
+
+    async def map_async(self, function, items):
+        # asyncio version of map, function is a sync request function
+        loop = asyncio.get_running_loop()
+        executor = self.get_executor()
+        return await asyncio.gather(*[loop.run_in_executor(executor, function, item) for item in items])
+
+    def close(self):
+        with self.lock:
+            if self.session is not None and self.pid == os.getpid():
+                self.session.close()
+            if self.executor is not None and self.pid == os.getpid():
+                self.executor.shutdown(wait=False)
+            self.session = None
+            self.executor = None
+    
+
+default_client = HttpClient()
+
+
+def configure_http_client(connect_timeout=None, read_timeout=None, max_retries=None, pool_size=None):
+    # replaces the default client, the open connections are closed
+    global default_client
+
+    previous_client = default_client
+    default_client = HttpClient(connect_timeout, read_timeout, max_retries, pool_size)
+    previous_client.close()
+
+    return default_client
+
+
+def iterate_batches(items, batch_size):
+    # for the batch endpoints, lists of at most batch_size items
+    items = list(items)
+    for start in range(0, len(items), batch_size):
+        yield items[start:start + batch_size]
+
+
+def get(url, **kwargs):
+    return default_client.get(url, **kwargs)
+
+
+def post(url, **kwargs):
+    return default_client.post(url, **kwargs)
+
+
+def put(url, **kwargs):
+    return default_client.put(url, **kwargs)
+
+
+def delete(url, **kwargs):
+    return default_client.delete(url, **kwargs)
+
+
+def request(method, url, **kwargs):
+    return default_client.request(method, url, **kwargs)
+
+
+def get_pool_size():
+    return default_client.pool_size
+
+
+def submit(function, *args, **kwargs):
+    return default_client.submit(function, *args, **kwargs)
+
+
+def map_requests(function, items):
+    return default_client.map(function, items)
+
+
+async def get_async(url, **kwargs):
+    return await default_client.get_async(url, **kwargs)
+
+
+async def post_async(url, **kwargs):
+    return await default_client.post_async(url, **kwargs)
+
+
+async def put_async(url, **kwargs):
+    return await default_client.put_async(url, **kwargs)
+
+
+async def map_requests_async(function, items):
+    return await default_client.map_async(function, items)
@@ -1,4 +1,4 @@
-import requests
+from utility.http import http_client
 
 SERVER_ADDRESS = 'http://192.168.3.1:8111'
 
@@ -12,7 +12,8 @@ def http_get_job(worker_type: str = None):
         url = url + "?task_type={}".format(worker_type)
 
     try:
-        response = requests.get(url)
+        # the endpoint claims the job, a retry after a lost response claims another one
+        response = http_client.get(url, idempotent=False)
         if response.status_code == 200:
             job_json = response.json()
             return job_json
@@ -33,7 +34,7 @@ def http_add_job(job):
     response = None
 
     try:
-        response = requests.post(url, json=job, headers=headers)
+        response = http_client.post(url, json=job, headers=headers)
         if response.status_code != 201 and response.status_code != 200:
             print(f"POST request failed with status code: {response.status_code}")
     except Exception as e:
@@ -50,7 +51,7 @@ def http_update_job_completed(job):
     response = None
 
     try:
-        response = requests.put(url, json=job, headers=headers)
+        response = http_client.put(url, json=job, headers=headers)
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}")    
     except Exception as e:
@@ -69,7 +70,7 @@ def http_update_job_failed(job):
     response = None
 
     try:
-        response = requests.put(url, json=job, headers=headers)
+        response = http_client.put(url, json=job, headers=headers)
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}")
     except Exception as e:
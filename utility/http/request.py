@@ -1,15 +1,8 @@
 from datetime import datetime, timedelta
-import requests
+from utility.http import http_client
 import json
-from fastapi import Request
-from pymongo import MongoClient
-
-# Connect to the MongoDB database
-client = MongoClient('mongodb://192.168.3.1:32017/')
-db = client['orchestration-job-db']
-
-# Access the specific collection
-comleted_jobs_collection = db["completed-jobs"]
+import numpy as np
+from utility.msgpack_ndarray import packb
 
 # SERVER_ADDRESS = 'http://103.20.60.90:8764'
 SERVER_ADDRESS = 'http://192.168.3.1:8111'
@@ -20,7 +13,7 @@ def http_get_list_completed_jobs():
     response = None
 
     try:
-        response = requests.get(url)
+        response = http_client.get(url, timeout=http_client.NO_READ_TIMEOUT)
 
         if response.status_code == 200:
             job_json = response.json()
@@ -41,7 +34,7 @@ def http_get_sequential_id(dataset_name: str, limit: int):
     response = None
 
     try:
-        response = requests.get(url)
+        response = http_client.get(url)
         if response.status_code == 200:
             job_json = response.json()
             return job_json
@@ -61,7 +54,7 @@ def http_get_self_training_sequential_id(dataset_name: str):
     response = None
 
     try:
-        response = requests.get(url)
+        response = http_client.get(url)
         if response.status_code == 200:
             job_json = response.json()
             return job_json["sequential_id"]
@@ -82,7 +75,7 @@ def http_add_model(model_card):
     response = None
 
     try:
-        response = requests.post(url, data=model_card, headers=headers)
+        response = http_client.post(url, data=model_card, headers=headers)
 
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}")
@@ -103,7 +96,7 @@ def http_add_classifier_model(model_card):
     response = None
 
     try:
-        response = requests.post(url, data=model_card, headers=headers)
+        response = http_client.post(url, data=model_card, headers=headers)
 
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}")
@@ -123,7 +116,7 @@ def http_get_model_id(model_hash):
     response = None
 
     try:
-        response = requests.get(url)
+        response = http_client.get(url)
 
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}")
@@ -142,7 +135,7 @@ def http_get_classifier_model_list():
     url = SERVER_ADDRESS + "/pseudotag-classifiers/list-classifiers"
     response = None
     try:
-        response = requests.get(url)
+        response = http_client.get(url)
 
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}")
@@ -161,7 +154,7 @@ def http_get_rank_list():
     url = SERVER_ADDRESS + "/ab-rank/list-rank-models"
     response = None
     try:
-        response = requests.get(url)
+        response = http_client.get(url)
 
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}")
@@ -180,7 +173,7 @@ def http_get_ranking_model_list():
     url = SERVER_ADDRESS + "/ranking-models/list-ranking-models"
     response = None
     try:
-        response = requests.get(url)
+        response = http_client.get(url)
 
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}")
@@ -201,7 +194,7 @@ def http_add_ranking_model(model_data):
     response = None
 
     try:
-        response = requests.post(url, data=model_data, headers=headers)
+        response = http_client.post(url, data=model_data, headers=headers)
 
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}")
@@ -222,7 +215,7 @@ def http_add_score(score_data):
     response = None
 
     try:
-        response = requests.post(url, json=score_data, headers=headers)
+        response = http_client.post(url, json=score_data, headers=headers)
 
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}: {str(response.content)}")
@@ -242,7 +235,7 @@ def http_add_classifier_score(score_data, image_source= "generated_image"):
     response = None
     
     try:
-        response = requests.post(url, json=score_data, headers=headers, params=params)
+        response = http_client.post(url, json=score_data, headers=headers, params=params)
 
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}: {str(response.content)}")
@@ -260,12 +253,15 @@ def http_add_classifier_score_batch(scores_batch):
     url = SERVER_ADDRESS + "/pseudotag-classifier-scores/set-image-classifier-score-v2"
     headers = {"Content-type": "application/json"}  # Setting content type header to indicate sending JSON data
     response = None
-    
+    success = False
+
     try:
-        response = requests.post(url, json=scores_batch, headers=headers)
+        response = http_client.post(url, json=scores_batch, headers=headers, timeout=http_client.NO_READ_TIMEOUT)
 
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}: {str(response.content)}")
+        else:
+            success = True
     except Exception as e:
         print('request exception', e)
 
@@ -273,18 +269,22 @@ def http_add_classifier_score_batch(scores_batch):
         if response:
             response.close()
 
-    return None
+    # true if the scores were stored
+    return success
 
 def http_add_rank_score_batch(scores_batch):
     url = SERVER_ADDRESS + "/image-scores/scores/set-rank-score-batch"
     headers = {"Content-type": "application/json"}  # Setting content type header to indicate sending JSON data
     response = None
-    
+    success = False
+
     try:
-        response = requests.post(url, json=scores_batch, headers=headers)
+        response = http_client.post(url, json=scores_batch, headers=headers, timeout=http_client.NO_READ_TIMEOUT)
 
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}: {str(response.content)}")
+        else:
+            success = True
     except Exception as e:
         print('request exception', e)
 
@@ -292,7 +292,59 @@ def http_add_rank_score_batch(scores_batch):
         if response:
             response.close()
 
-    return None
+    # true if the scores were stored
+    return success
+
+def post_columnar_scores(url, scores_data):
+    headers = {"Content-type": "application/msgpack"}
+    response = None
+    success = False
+
+    try:
+        response = http_client.post(url, data=packb(scores_data), headers=headers, timeout=http_client.NO_READ_TIMEOUT)
+
+        if response.status_code != 200:
+            print(f"request failed with status code: {response.status_code}: {str(response.content)}")
+        else:
+            success = True
+    except Exception as e:
+        print('request exception', e)
+
+    finally:
+        if response:
+            response.close()
+
+    # true if the scores were stored
+    return success
+
+# scores is a (classifiers, images) array
+def http_add_classifier_scores_columnar(image_source, uuids, image_hashes, classifier_ids, tag_ids, scores):
+    url = SERVER_ADDRESS + "/pseudotag-classifier-scores/set-image-classifier-scores-columnar"
+    scores_data = {
+        "image_source": image_source,
+        "uuids": list(uuids),
+        "image_hashes": list(image_hashes),
+        "classifier_ids": list(classifier_ids),
+        "tag_ids": list(tag_ids),
+        "scores": np.asarray(scores, dtype=np.float32)
+    }
+
+    return post_columnar_scores(url, scores_data)
+
+# scores and sigma_scores are (ranking models, images) arrays
+def http_add_rank_scores_columnar(image_source, uuids, image_hashes, rank_model_ids, rank_ids, scores, sigma_scores):
+    url = SERVER_ADDRESS + "/image-scores/scores/set-rank-scores-columnar"
+    scores_data = {
+        "image_source": image_source,
+        "uuids": list(uuids),
+        "image_hashes": list(image_hashes),
+        "rank_model_ids": list(rank_model_ids),
+        "rank_ids": list(rank_ids),
+        "scores": np.asarray(scores, dtype=np.float32),
+        "sigma_scores": np.asarray(sigma_scores, dtype=np.float32)
+    }
+
+    return post_columnar_scores(url, scores_data)
 
 def http_add_sigma_score(sigma_score_data):
     url = SERVER_ADDRESS + "/sigma-score/set-image-rank-sigma-score"
@@ -300,7 +352,7 @@ def http_add_sigma_score(sigma_score_data):
     response = None
 
     try:
-        response = requests.post(url, json=sigma_score_data, headers=headers)
+        response = http_client.post(url, json=sigma_score_data, headers=headers)
 
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}: {str(response.content)}")
@@ -320,7 +372,7 @@ def http_add_residual(residual_data):
     response = None
 
     try:
-        response = requests.put(url, json=residual_data, headers=headers)
+        response = http_client.put(url, json=residual_data, headers=headers)
 
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}: {str(response.content)}")
@@ -340,7 +392,7 @@ def http_add_percentile(percentile_data):
     response = None
 
     try:
-        response = requests.post(url, json=percentile_data, headers=headers)
+        response = http_client.post(url, json=percentile_data, headers=headers)
 
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}: {str(response.content)}")
@@ -360,7 +412,7 @@ def http_add_residual_percentile(residual_percentile_data):
     response = None
 
     try:
-        response = requests.post(url, json=residual_percentile_data, headers=headers)
+        response = http_client.post(url, json=residual_percentile_data, headers=headers)
 
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}: {str(response.content)}")
@@ -380,7 +432,7 @@ def http_get_dataset_names():
     response = None
 
     try:
-        response = requests.get(url)
+        response = http_client.get(url)
 
         if response.status_code == 200:
             data_json = response.json()
@@ -402,7 +454,7 @@ def http_get_completed_job_by_image_hash(image_hash):
     response = None
 
     try:
-        response = requests.get(url)
+        response = http_client.get(url)
 
         if response.status_code == 200:
             data_json = response.json()
@@ -450,7 +502,7 @@ def http_add_score_attributes(model_type,
     response = None
 
     try:
-        response = requests.put(url, json=data, headers=headers)
+        response = http_client.put(url, json=data, headers=headers)
 
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}: {str(response.content)}")
@@ -469,9 +521,8 @@ def http_add_score_attributes_v1(model_type, img_hash, image_clip_score, image_c
                               text_embedding_sigma_score, image_clip_h_score, image_clip_h_percentile,
                               image_clip_h_sigma_score, delta_sigma_score):
     
-    query = {"task_output_file_dict.output_file_hash": img_hash}
-    job = comleted_jobs_collection.find_one(query)
-    
+    job = http_get_completed_job_by_image_hash(img_hash)
+
     if not job:
         print(f"Failed to fetch job data for image hash {img_hash}. Job not found.")
         return
@@ -516,7 +567,7 @@ def http_add_score_attributes_v1(model_type, img_hash, image_clip_score, image_c
     response = None
 
     try:
-        response = requests.put(url, json=data, headers=headers)
+        response = http_client.put(url, json=data, headers=headers)
 
         if response.status_code != 200:
             print(f"Request failed with status code: {response.status_code}: {str(response.content)}")
@@ -538,7 +589,7 @@ def http_update_ranking_delta_scores():
     response = None
 
     try:
-        response = requests.post(url, headers=headers)
+        response = http_client.post(url, headers=headers)
 
         if response.status_code != 200:
             print(f"request failed with status code: {response.status_code}: {str(response.content)}")
@@ -551,18 +602,18 @@ def http_update_ranking_delta_scores():
 
     return None
 
-# Get completed job
-def http_get_completed_job_by_uuid(job_uuid):
-    url = SERVER_ADDRESS + "/job/get-job/{}".format(job_uuid)
+# progress of the last delta scores calculation
+# datapoints is ranking_datapoints or image_pair_ranking, the collection of /calculate-delta-scores
+def http_get_delta_scores_progress(datapoints="image_pair_ranking"):
+    url = SERVER_ADDRESS + "/rank-training/get-delta-scores-progress?datapoints={}".format(datapoints)
     response = None
 
     try:
-        response = requests.get(url)
+        response = http_client.get(url)
 
         if response.status_code == 200:
-            data_json = response.json()
-            return data_json
-
+            return response.json()["response"]
+        print(f"request failed with status code: {response.status_code}: {str(response.content)}")
     except Exception as e:
         print('request exception ', e)
 
@@ -573,16 +624,16 @@ def http_get_completed_job_by_uuid(job_uuid):
     return None
 
 # Get completed job
-def http_get_completed_job_by_dataset(dataset, limit=9999999):
-    url = SERVER_ADDRESS + "/queue/image-generation/list-completed-jobs?dataset={}&limit={}".format(dataset, limit)
+def http_get_completed_job_by_uuid(job_uuid):
+    url = SERVER_ADDRESS + "/job/get-job/{}".format(job_uuid)
     response = None
 
     try:
-        response = requests.get(url)
+        response = http_client.get(url)
 
         if response.status_code == 200:
             data_json = response.json()
-            return data_json["response"]["jobs"]
+            return data_json
 
     except Exception as e:
         print('request exception ', e)
@@ -593,6 +644,48 @@ def http_get_completed_job_by_dataset(dataset, limit=9999999):
 
     return None
 
+# yields the documents of a list endpoint streamed as ndjson, one at a time
+# the server sends them from a cursor, so the first rows arrive right away
+# raises if the request fails
+def http_stream_ndjson(url, params=None):
+    params = dict(params or {})
+    params["stream"] = "true"
+    headers = {"Accept": "application/x-ndjson"}
+
+    # the server can take a while to send the first row
+    with http_client.get(url, params=params, headers=headers, stream=True, timeout=http_client.NO_READ_TIMEOUT) as response:
+        if response.status_code != 200:
+            raise Exception(f"request failed with status code: {response.status_code}: {str(response.content)}")
+
+        for line in response.iter_lines(chunk_size=64 * 1024):
+            if line:
+                yield json.loads(line)
+
+def http_stream_completed_jobs(dataset=None, task_type=None, limit=9999999):
+    url = SERVER_ADDRESS + "/queue/image-generation/list-completed-jobs"
+    params = {"limit": limit}
+    if dataset is not None:
+        params["dataset"] = dataset
+    if task_type is not None:
+        params["task_type"] = task_type
+
+    return http_stream_ndjson(url, params)
+
+def http_stream_all_image_hashes():
+    url = SERVER_ADDRESS + "/image-hashes/get-all-image-hashes-v1"
+
+    return http_stream_ndjson(url)
+
+# Get completed job
+def http_get_completed_job_by_dataset(dataset, limit=9999999):
+    try:
+        return list(http_stream_completed_jobs(dataset=dataset, limit=limit))
+
+    except Exception as e:
+        print('request exception ', e)
+
+    return None
+
 # Get completed jobs
 def http_get_completed_jobs_by_uuids(job_uuids):
     count = 0
@@ -608,7 +701,7 @@ def http_get_completed_jobs_by_uuids(job_uuids):
     response = None
 
     try:
-        response = requests.get(url)
+        response = http_client.get(url)
 
         if response.status_code == 200:
             data_json = response.json()
@@ -625,7 +718,7 @@ def http_get_completed_jobs_by_uuids(job_uuids):
 def http_get_tag_list():
     url = SERVER_ADDRESS + "/tags/list-tag-definitions"
     try:
-        response = requests.get(url)
+        response = http_client.get(url)
 
         if response.status_code == 200:
             data_json = response.json()
@@ -638,7 +731,7 @@ def http_get_tag_list():
 def http_get_tagged_images(tag_id):
     url = SERVER_ADDRESS + "/tags/get-images-by-tag-id/?tag_id={}".format(tag_id)
     try:
-        response = requests.get(url)
+        response = http_client.get(url, timeout=http_client.NO_READ_TIMEOUT)
 
         if response.status_code == 200:
             data_json = response.json()
@@ -651,7 +744,7 @@ def http_get_tagged_images(tag_id):
 def http_get_tagged_images_by_image_type(tag_id, image_type = "all_resolutions"):
     url = SERVER_ADDRESS + "/tags/get-images-by-image-type/?tag_id={}&image_type={}".format(tag_id, image_type)
     try:
-        response = requests.get(url)
+        response = http_client.get(url, timeout=http_client.NO_READ_TIMEOUT)
 
         if response.status_code == 200:
             data_json = response.json()
@@ -667,7 +760,7 @@ def http_get_tagged_images_by_resolution(tag_id, source = None):
     else:
         url = SERVER_ADDRESS + "/tags/get-images-by-resolution/?tag_id={}&source={}".format(tag_id, source)
     try:
-        response = requests.get(url)
+        response = http_client.get(url, timeout=http_client.NO_READ_TIMEOUT)
 
         if response.status_code == 200:
             data_json = response.json()
@@ -679,7 +772,7 @@ def http_get_tagged_images_by_resolution(tag_id, source = None):
 def http_get_tagged_extracts(tag_id):
     url = SERVER_ADDRESS + "/tags/get-images-by-tag-id-v1/?tag_id={}".format(tag_id)
     try:
-        response = requests.get(url)
+        response = http_client.get(url, timeout=http_client.NO_READ_TIMEOUT)
 
         if response.status_code == 200:
             data_json = response.json()
@@ -692,7 +785,7 @@ def http_get_tagged_extracts(tag_id):
 def http_get_random_image_list(dataset, size):
     url = SERVER_ADDRESS + "/image/get_random_image_list?dataset={}&size={}".format(dataset, size)
     try:
-        response = requests.get(url)
+        response = http_client.get(url, timeout=http_client.NO_READ_TIMEOUT)
 
         if response.status_code == 200:
             data_json = response.json()
@@ -712,7 +805,7 @@ def http_get_random_image_by_date(dataset, size, start_date=None, end_date=None)
 
     url = SERVER_ADDRESS + endpoint_url
     try:
-        response = requests.get(url)
+        response = http_client.get(url, timeout=http_client.NO_READ_TIMEOUT)
 
         if response.status_code == 200:
             data_json = response.json()
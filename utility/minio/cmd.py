@@ -1,7 +1,9 @@
 from minio import Minio
 import os
+import threading
 import requests
 from .progress import Progress
+from .local_cache import LocalObjectCache, CachedObjectResponse, DEFAULT_CACHE_MAX_SIZE_IN_BYTES
 from utility.utils_logger import logger
 
 # TODO: remove hardcode in the future
@@ -9,6 +11,15 @@ from utility.utils_logger import logger
 
 MINIO_ADDRESS = "192.168.3.5:9000"
 
+# opt-in local disk cache of the objects read with get_file_from_minio
+# and get_object_data, enabled with enable_local_cache()
+# or the MINIO_CACHE_DIRECTORY environment variable
+MINIO_CACHE_DIRECTORY_ENV = "MINIO_CACHE_DIRECTORY"
+MINIO_CACHE_MAX_SIZE_IN_GB_ENV = "MINIO_CACHE_MAX_SIZE_IN_GB"
+
+local_cache = None
+local_cache_lock = threading.Lock()
+
 
 def get_minio_client(minio_access_key, minio_secret_key, minio_ip_addr=None):
     global MINIO_ADDRESS
@@ -94,8 +105,63 @@ def download_dataset_from_minio(client, bucket_name, folder_name):
     return data
         
 
+def enable_local_cache(directory, max_size_in_bytes=DEFAULT_CACHE_MAX_SIZE_IN_BYTES):
+    global local_cache
+
+    with local_cache_lock:
+        local_cache = LocalObjectCache(directory, max_size_in_bytes)
+
+    return local_cache
+
+
+def disable_local_cache():
+    global local_cache
+
+    with local_cache_lock:
+        local_cache = None
+
+
+def get_local_cache():
+    global local_cache
+
+    if local_cache is not None:
+        return local_cache
+
+    directory = os.environ.get(MINIO_CACHE_DIRECTORY_ENV)
+    if not directory:
+        return None
+
+    with local_cache_lock:
+        if local_cache is None:
+            max_size_in_gb = float(os.environ.get(MINIO_CACHE_MAX_SIZE_IN_GB_ENV, 0))
+            max_size_in_bytes = DEFAULT_CACHE_MAX_SIZE_IN_BYTES
+            if max_size_in_gb > 0:
+                max_size_in_bytes = int(max_size_in_gb * 1024 * 1024 * 1024)
+            local_cache = LocalObjectCache(directory, max_size_in_bytes)
+
+    return local_cache
+
+
+def get_object_data(client, bucket_name, file_name):
+    # returns the bytes of the object, through the local cache if enabled
+    cache = get_local_cache()
+    if cache is not None:
+        return cache.get(client, bucket_name, file_name)
+
+    response = client.get_object(bucket_name, file_name)
+    try:
+        return response.data
+    finally:
+        response.close()
+        response.release_conn()
+
+
 def get_file_from_minio(client, bucket_name, file_name):
     try:
+        cache = get_local_cache()
+        if cache is not None:
+            return CachedObjectResponse(cache.get(client, bucket_name, file_name))
+
         # Get object data
         data = client.get_object(bucket_name, file_name)
 
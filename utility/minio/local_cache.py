@@ -0,0 +1,188 @@
+import os
+import hashlib
+import tempfile
+import threading
+from io import BytesIO
+from collections import OrderedDict
+
+DEFAULT_CACHE_DIRECTORY = "output/minio-cache"
+DEFAULT_CACHE_MAX_SIZE_IN_BYTES = 20 * 1024 * 1024 * 1024
+NUM_KEY_LOCKS = 64
+TEMP_FILE_SUFFIX = ".tmp"
+
+
+class CachedObjectResponse(BytesIO):
+    # stands in for the urllib3 response returned by minio get_object
+    # callers use .data, .read(), .close() and .release_conn()
+    def __init__(self, data):
+        super().__init__(data)
+        self.data = data
+
+    def stream(self, amt=64 * 1024):
+        while True:
+            chunk = self.read(amt)
+            if not chunk:
+                break
+            yield chunk
+
+    def release_conn(self):
+        pass
+
+
+# read-through disk cache of minio objects
+# entries are keyed by bucket, object name and etag, so an object that
+# is overwritten in minio is downloaded again instead of served stale
+# every read costs a stat_object, which is much cheaper than the download
+# of a clip vector, a model or a csv
+#
+# the least recently used entries are removed once the cache
+# is over max_size_in_bytes, the file mtime is the last use time
+# so the order survives restarts and is shared between processes
+#
+# entries are written to a temp file and renamed, so readers never see
+# a partial file, and one download per key is in flight in this process
+class LocalObjectCache:
+    def __init__(self, directory=DEFAULT_CACHE_DIRECTORY, max_size_in_bytes=DEFAULT_CACHE_MAX_SIZE_IN_BYTES):
+        self.directory = directory
+        self.max_size_in_bytes = max_size_in_bytes
+
+        self.lock = threading.Lock()
+        self.key_locks = [threading.Lock() for _ in range(NUM_KEY_LOCKS)]
+
+        # file name => size, least recently used first
+        self.entries = OrderedDict()
+        self.size_in_bytes = 0
+
+        self.num_hits = 0
+        self.num_misses = 0
+
+        self.load()
+
+    def load(self):
+        os.makedirs(self.directory, exist_ok=True)
+
+        files = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file() or entry.name.endswith(TEMP_FILE_SUFFIX):
+                continue
+            stat = entry.stat()
+            files.append((stat.st_mtime, entry.name, stat.st_size))
+
+        for _, file_name, size in sorted(files):
+            self.entries[file_name] = size
+            self.size_in_bytes += size
+
+        with self.lock:
+            self.evict()
+
+        print("Loaded minio cache {} with {} objects, {:.2f} MB".format(self.directory,
+                                                                        len(self.entries),
+                                                                        self.size_in_bytes / (1024 * 1024)))
+
+    @staticmethod
+    def get_file_name(bucket_name, object_name, etag):
+        key = "{}/{}/{}".format(bucket_name, object_name, etag)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def get_key_lock(self, file_name):
+        return self.key_locks[int(file_name[:8], 16) % NUM_KEY_LOCKS]
+
+    def read_entry(self, file_name):
+        path = os.path.join(self.directory, file_name)
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            # removed by another process
+            with self.lock:
+                size = self.entries.pop(file_name, None)
+                if size is not None:
+                    self.size_in_bytes -= size
+            return None
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+        with self.lock:
+            if file_name in self.entries:
+                self.entries.move_to_end(file_name)
+            else:
+                # written by another process
+                self.entries[file_name] = len(data)
+                self.size_in_bytes += len(data)
+            self.num_hits += 1
+
+        return data
+
+    def write_entry(self, file_name, data):
+        if len(data) > self.max_size_in_bytes:
+            return
+
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self.directory, suffix=TEMP_FILE_SUFFIX)
+        try:
+            with os.fdopen(file_descriptor, "wb") as file:
+                file.write(data)
+            os.replace(temp_path, os.path.join(self.directory, file_name))
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        with self.lock:
+            if file_name in self.entries:
+                self.size_in_bytes -= self.entries[file_name]
+            self.entries[file_name] = len(data)
+            self.entries.move_to_end(file_name)
+            self.size_in_bytes += len(data)
+            self.evict()
+
+    def evict(self):
+        # must be called with self.lock held
+        while self.size_in_bytes > self.max_size_in_bytes and len(self.entries) > 0:
+            file_name, size = self.entries.popitem(last=False)
+            self.size_in_bytes -= size
+            try:
+                os.remove(os.path.join(self.directory, file_name))
+            except FileNotFoundError:
+                pass
+
+    def get(self, client, bucket_name, object_name):
+        # returns the bytes of the object, raises like minio get_object
+        etag = client.stat_object(bucket_name, object_name).etag.strip('"')
+        file_name = self.get_file_name(bucket_name, object_name, etag)
+
+        data = self.read_entry(file_name)
+        if data is not None:
+            return data
+
+        with self.get_key_lock(file_name):
+            # another thread may have downloaded it while we waited
+            data = self.read_entry(file_name)
+            if data is not None:
+                return data
+
+            response = client.get_object(bucket_name, object_name)
+            try:
+                data = response.data
+                # the object can change between the stat and the download
+                # the entry is keyed by the etag of what was downloaded
+                downloaded_etag = response.headers.get("ETag", etag).strip('"')
+            finally:
+                response.close()
+                response.release_conn()
+
+            with self.lock:
+                self.num_misses += 1
+
+            if downloaded_etag != etag:
+                file_name = self.get_file_name(bucket_name, object_name, downloaded_etag)
+
+            try:
+                self.write_entry(file_name, data)
+            except Exception as e:
+                # a full or read only disk should not fail the read
+                print("Could not write {}/{} to the minio cache: {}".format(bucket_name, object_name, e))
+
+        return data
@@ -0,0 +1,94 @@
+import struct
+import msgpack
+import numpy as np
+
+# numpy arrays are packed as a msgpack extension type
+# the payload is a small header followed by the raw array bytes
+# so packing is a single memory copy and unpacking is a zero copy
+# np.frombuffer view on the msgpack buffer
+#
+# header, little endian:
+#   version     uint8
+#   ndim        uint8
+#   dtype size  uint8, length of the numpy dtype string ('<f4', '|u1'...)
+#   reserved    uint8
+#   dtype       ascii string
+#   shape       ndim x int64
+#   padding     zeros, so the array data is 16 byte aligned
+#
+# files written before this format store arrays as
+# {'__ndarray__': nested lists} or as plain nested lists
+# unpackb() decodes all of them
+NDARRAY_EXT_TYPE_CODE = 42
+NDARRAY_EXT_VERSION = 1
+NDARRAY_EXT_ALIGNMENT = 16
+
+LEGACY_NDARRAY_KEY = '__ndarray__'
+
+HEADER_FORMAT = '<BBBB'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+
+def get_padding(size):
+    return (NDARRAY_EXT_ALIGNMENT - size % NDARRAY_EXT_ALIGNMENT) % NDARRAY_EXT_ALIGNMENT
+
+
+def encode_ndarray(obj):
+    # default hook of msgpack.packb
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.hasobject:
+            # object arrays have no raw representation
+            return {LEGACY_NDARRAY_KEY: obj.tolist()}
+
+        array = obj
+        if not array.flags.c_contiguous:
+            array = array.copy(order='C')
+        dtype_string = array.dtype.str.encode('ascii')
+        header = struct.pack(HEADER_FORMAT, NDARRAY_EXT_VERSION, array.ndim, len(dtype_string), 0)
+        header += dtype_string
+        header += struct.pack('<{}q'.format(array.ndim), *array.shape)
+        header += b'\0' * get_padding(len(header))
+
+        return msgpack.ExtType(NDARRAY_EXT_TYPE_CODE, header + array.tobytes())
+
+    if isinstance(obj, np.generic):
+        return obj.item()
+
+    raise TypeError('can not serialize {}'.format(type(obj)))
+
+
+def decode_ndarray_ext(code, data):
+    # ext_hook of msgpack.unpackb
+    if code != NDARRAY_EXT_TYPE_CODE:
+        return msgpack.ExtType(code, data)
+
+    version, ndim, dtype_size, _ = struct.unpack_from(HEADER_FORMAT, data, 0)
+    if version != NDARRAY_EXT_VERSION:
+        raise ValueError('unsupported ndarray encoding version {}'.format(version))
+
+    offset = HEADER_SIZE
+    dtype = np.dtype(data[offset:offset + dtype_size].decode('ascii'))
+    offset += dtype_size
+    shape = struct.unpack_from('<{}q'.format(ndim), data, offset)
+    offset += 8 * ndim
+    offset += get_padding(offset)
+
+    # read only view on the msgpack buffer, no copy
+    return np.frombuffer(data, dtype=dtype, offset=offset).reshape(shape)
+
+
+def decode_legacy_ndarray(packed_obj):
+    # object_hook of msgpack.unpackb for the {'__ndarray__': list} format
+    if LEGACY_NDARRAY_KEY in packed_obj:
+        return np.array(packed_obj[LEGACY_NDARRAY_KEY])
+    return packed_obj
+
+
+def packb(obj):
+    # arrays keep their dtype in the ext type, plain floats are packed as doubles
+    return msgpack.packb(obj, default=encode_ndarray, use_bin_type=True)
+
+
+def unpackb(data):
+    # arrays of both formats are returned as numpy arrays
+    return msgpack.unpackb(data, ext_hook=decode_ndarray_ext, object_hook=decode_legacy_ndarray, raw=False)
@@ -0,0 +1,102 @@
+import numpy as np
+
+# weighted phrase sampling of the prompt generators
+#
+# the sampler of a phrase table is built once, it keeps the cumulative
+# weights of the phrases in a numpy array. phrases are drawn in batches,
+# with searchsorted on uniform numbers scaled to the total weight, so
+# the table does not need to be sorted. a prompt is packed with drawn
+# phrases until the token budget is reached, the phrases it already
+# uses are kept in a set and skipped when they are drawn again
+MAX_PROMPT_TOKEN_SIZE = 75
+COMMA_TOKEN_SIZE = 1
+# number of phrases drawn at once by PhraseDraws
+PHRASE_DRAW_BATCH_SIZE = 4096
+# draws taken at a time while packing a prompt, the ones left
+# when the prompt is full are dropped, the draws are independent
+PACK_DRAW_COUNT = 32
+# the packing of a prompt stops after this many draws in a row of used phrases,
+# when almost all the phrases with a weight are used
+MAX_REJECTED_DRAWS = 1000
+
+
+class WeightedPhraseSampler:
+    def __init__(self, weights, token_sizes, phrases=None):
+        # weights are >= 0, phrases with a weight of 0 are never drawn
+        # phrases is optional, the phrase of each index returned by get_phrases
+        self.cumulative_weights = np.cumsum(np.asarray(weights, dtype=np.float64))
+        self.total_weight = float(self.cumulative_weights[-1]) if len(self.cumulative_weights) > 0 else 0.0
+        # a list, reading one item is faster than from a numpy array
+        self.token_sizes = [int(token_size) for token_size in token_sizes]
+        self.phrases = phrases
+
+    @classmethod
+    def from_cumulative_weights(cls, cumulative_weights, token_sizes, phrases=None):
+        weights = np.diff(np.asarray(cumulative_weights, dtype=np.float64), prepend=0.0)
+        return cls(np.maximum(weights, 0.0), token_sizes, phrases)
+
+    def draw(self, count, rng):
+        # indexes of count phrases, drawn with replacement
+        if self.total_weight <= 0:
+            raise ValueError("The phrases have no weight to draw from.")
+
+        random_weights = rng.random(count) * self.total_weight
+        indexes = np.searchsorted(self.cumulative_weights, random_weights, side="right")
+
+        # rounding can give the total weight
+        return np.minimum(indexes, len(self.cumulative_weights) - 1)
+
+    def get_draws(self, rng=None, batch_size=PHRASE_DRAW_BATCH_SIZE):
+        return PhraseDraws(self, rng, batch_size)
+
+    def pack(self, draws, used_phrases, token_size=0,
+             max_token_size=MAX_PROMPT_TOKEN_SIZE, comma_token_size=COMMA_TOKEN_SIZE):
+        # adds drawn phrases that are not in used_phrases while the prompt is under max_token_size,
+        # the first drawn phrase that does not fit ends the prompt.
+        # token_size is the size of the prompt before the phrases, for a prefix
+        # returns the indexes of the phrases in order, they are added to used_phrases
+        phrase_indexes = []
+        num_rejected_draws = 0
+        token_sizes = self.token_sizes
+
+        while num_rejected_draws < MAX_REJECTED_DRAWS:
+            for index in draws.take(PACK_DRAW_COUNT):
+                if index in used_phrases:
+                    num_rejected_draws += 1
+                    continue
+                num_rejected_draws = 0
+
+                sum_token_size = token_size + token_sizes[index] + comma_token_size
+                if sum_token_size >= max_token_size:
+                    return phrase_indexes
+
+                used_phrases.add(index)
+                phrase_indexes.append(index)
+                token_size = sum_token_size
+
+        return phrase_indexes
+
+    def get_phrases(self, indexes):
+        return [self.phrases[index] for index in indexes]
+
+
+class PhraseDraws:
+    # the draws of a sampler, drawn in batches and taken in order
+    # not thread safe, each thread uses its own
+    def __init__(self, sampler, rng=None, batch_size=PHRASE_DRAW_BATCH_SIZE):
+        self.sampler = sampler
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.batch_size = batch_size
+        self.indexes = []
+        self.position = 0
+
+    def take(self, count):
+        # a list of count phrase indexes
+        if self.position + count > len(self.indexes):
+            self.indexes = self.sampler.draw(max(self.batch_size, count), self.rng).tolist()
+            self.position = 0
+
+        indexes = self.indexes[self.position:self.position + count]
+        self.position += count
+
+        return indexes
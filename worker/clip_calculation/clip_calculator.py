@@ -1,8 +1,10 @@
 import sys
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 from io import BytesIO
 import os
-import msgpack
 import numpy as np
 
 base_directory = "./"
@@ -11,23 +13,69 @@ sys.path.insert(0, base_directory)
 from utility.path import separate_bucket_and_file_path
 from worker.worker_state import WorkerState
 from worker.generation_task.generation_task import GenerationTask
+from utility.msgpack_ndarray import packb
 
+# batched clip calculation
+# the clip jobs of the same task type waiting in the job queue are processed
+# together, their images are downloaded and decoded in parallel on a thread
+# pool and the clip features are computed in batches on the gpu,
+# instead of one download, one decode and one forward pass per job
+CLIP_CALCULATION_BATCH_SIZE = 32
+NUM_IMAGE_DECODE_THREADS = 8
 
-def calculate_image_feature_vector(worker_state: WorkerState, input_file_path: str, input_file_hash: str):
-    # get image from minio server
-    # Get data of an object.
+image_decode_executor = None
+image_decode_executor_lock = threading.Lock()
+
+
+def get_image_decode_executor():
+    global image_decode_executor
+
+    with image_decode_executor_lock:
+        if image_decode_executor is None:
+            image_decode_executor = ThreadPoolExecutor(max_workers=NUM_IMAGE_DECODE_THREADS,
+                                                       thread_name_prefix='clip-image-decode')
+
+    return image_decode_executor
+
+
+def load_image(minio_client, input_file_path: str):
+    # get image from minio server and decode it
     bucket_name, file_path = separate_bucket_and_file_path(input_file_path)
+    response = minio_client.get_object(bucket_name, file_path)
     try:
-        response = worker_state.minio_client.get_object(bucket_name, file_path)
         image_data = BytesIO(response.data)
         img = Image.open(image_data)
         img = img.convert("RGB")
-    except Exception as e:
-        raise e
     finally:
         response.close()
         response.release_conn()
 
+    return img
+
+
+def get_clip_output_path(input_file_path: str, model_type: str):
+    output_path = os.path.splitext(input_file_path)[0]
+
+    if model_type == "kandinsky":
+        return output_path + "_clip_kandinsky.msgpack"
+
+    return output_path + "_clip.msgpack"
+
+
+def get_clip_feature_msgpack_buffer(clip_feature_vector):
+    clip_feature_dict = {"clip-feature-vector": clip_feature_vector}
+    clip_feature_msgpack = packb(clip_feature_dict)
+
+    clip_feature_msgpack_buffer = BytesIO()
+    clip_feature_msgpack_buffer.write(clip_feature_msgpack)
+    clip_feature_msgpack_buffer.seek(0)
+
+    return clip_feature_msgpack_buffer
+
+
+def calculate_image_feature_vector(worker_state: WorkerState, input_file_path: str, input_file_hash: str):
+    img = load_image(worker_state.minio_client, input_file_path)
+
     # get feature
     clip_feature_vector = worker_state.clip.get_image_features(img)
 
@@ -35,12 +83,10 @@ def calculate_image_feature_vector(worker_state: WorkerState, input_file_path: s
     clip_feature_vector = clip_feature_vector.cpu().detach()
 
     # convert to np array
+    # it is stored as raw float32 bytes, see utility/msgpack_ndarray.py
     clip_feature_vector_np_arr = np.array(clip_feature_vector, dtype=np.float32)
 
-    # convert to normal list
-    clip_feature_vector_arr = clip_feature_vector_np_arr.tolist()
-
-    return input_file_hash, clip_feature_vector_arr
+    return input_file_hash, clip_feature_vector_np_arr
 
 
 def run_clip_calculation_task(worker_state: WorkerState, generation_task: GenerationTask, model_type:str):
@@ -50,18 +96,67 @@ def run_clip_calculation_task(worker_state: WorkerState, generation_task: Genera
                                                                           input_file_hash=
                                                                           generation_task.task_input_dict[
                                                                               "input_file_hash"])
-    output_path = os.path.splitext(input_file_path)[0]
+    output_path = get_clip_output_path(input_file_path, model_type)
 
-    if model_type=="kandinsky":
-        output_path = output_path + "_clip_kandinsky.msgpack"
-    else:
-        output_path = output_path + "_clip.msgpack"
+    return output_path, input_file_hash, get_clip_feature_msgpack_buffer(clip_feature_vector)
 
-    clip_feature_dict = {"clip-feature-vector": clip_feature_vector}
-    clip_feature_msgpack = msgpack.packb(clip_feature_dict)
 
-    clip_feature_msgpack_buffer = BytesIO()
-    clip_feature_msgpack_buffer.write(clip_feature_msgpack)
-    clip_feature_msgpack_buffer.seek(0)
+def collect_jobs_of_task_type(job_queue, job, batch_size, deferred_jobs):
+    # returns job and the jobs of the same task type waiting in job_queue, up to batch_size jobs
+    # the other jobs taken from the queue are appended to deferred_jobs, in order
+    jobs = [job]
+    while len(jobs) < batch_size:
+        try:
+            next_job = job_queue.get_nowait()
+        except queue.Empty:
+            break
+
+        if next_job is None:
+            continue
+
+        if next_job['task_type'] == job['task_type']:
+            jobs.append(next_job)
+        else:
+            deferred_jobs.append(next_job)
+
+    return jobs
+
+
+def run_clip_calculation_tasks(worker_state: WorkerState, generation_tasks, model_type: str,
+                               batch_size: int = CLIP_CALCULATION_BATCH_SIZE):
+    # batched version of run_clip_calculation_task
+    # returns a result per task, (output_path, input_file_hash, clip_data) like
+    # run_clip_calculation_task, or the exception if the image could not be read.
+    # raises if the features of the batch could not be computed
+    executor = get_image_decode_executor()
+    image_futures = [executor.submit(load_image, worker_state.minio_client, generation_task.task_input_dict["input_file_path"])
+                     for generation_task in generation_tasks]
+
+    results = [None] * len(generation_tasks)
+    images = []
+    image_indexes = []
+    for index, image_future in enumerate(image_futures):
+        try:
+            images.append(image_future.result())
+            image_indexes.append(index)
+        except Exception as e:
+            results[index] = e
+
+    if len(images) == 0:
+        return results
+
+    clip_feature_vectors, _ = worker_state.clip.compute_feature_vectors(images, batch_size)
+
+    for index, clip_feature_vector in zip(image_indexes, clip_feature_vectors):
+        generation_task = generation_tasks[index]
+        input_file_path = generation_task.task_input_dict["input_file_path"]
+
+        # (1, feature size) like the features of a single image
+        # it is stored as raw float32 bytes, see utility/msgpack_ndarray.py
+        clip_feature_vector = np.array(clip_feature_vector.cpu().detach().unsqueeze(0), dtype=np.float32)
+
+        results[index] = (get_clip_output_path(input_file_path, model_type),
+                          generation_task.task_input_dict["input_file_hash"],
+                          get_clip_feature_msgpack_buffer(clip_feature_vector))
 
-    return output_path, input_file_hash, clip_feature_msgpack_buffer
+    return results
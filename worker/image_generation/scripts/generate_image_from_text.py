@@ -9,12 +9,20 @@ sys.path.insert(0, os.getcwd())
 
 
 from stable_diffusion.utils_image import save_images_to_minio, save_image_data_to_minio, save_image_embedding_to_minio, get_image_data
+from utility.clip.prompt_embedding_cache import PromptEmbeddingCache
 
 
 def generate_image_from_text(minio_client, txt2img, clip_text_embedder, job_uuid, dataset, sampler, sampler_steps,
-                             positive_prompts, negative_prompts, cfg_strength, seed, image_width, image_height, output_path):
-    embedded_prompts = clip_text_embedder(positive_prompts)
-    negative_embedded_prompts = clip_text_embedder(negative_prompts)
+                             positive_prompts, negative_prompts, cfg_strength, seed, image_width, image_height, output_path,
+                             prompt_embedding_cache=None):
+    if prompt_embedding_cache is None:
+        prompt_embedding_cache = PromptEmbeddingCache(clip_text_embedder.forward_return_all, max_size=0)
+
+    # the last hidden state is the conditioning
+    # the attention masks are kept for the prompt embeddings of the job
+    embedded_prompts, _, positive_attention_mask = prompt_embedding_cache.encode(positive_prompts)
+    negative_embedded_prompts, _, negative_attention_mask = prompt_embedding_cache.get(negative_prompts)
+    text_conditioning = (embedded_prompts, positive_attention_mask, negative_embedded_prompts, negative_attention_mask)
 
     prompt_scoring_model = 'N/A'
     prompt_score = 'N/A'
@@ -35,5 +43,5 @@ def generate_image_from_text(minio_client, txt2img, clip_text_embedder, job_uuid
     output_file_path = output_path
     output_file_hash, img_data = get_image_data(images)
 
-    return output_file_path, output_file_hash, img_data, latent
+    return output_file_path, output_file_hash, img_data, latent, text_conditioning
 
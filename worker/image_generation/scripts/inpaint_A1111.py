@@ -33,6 +33,7 @@ from stable_diffusion.sampler.diffusion import DiffusionSampler
 from stable_diffusion.latent_diffusion import LatentDiffusion
 from stable_diffusion.utils_backend import get_device, torch_gc, without_autocast, get_autocast
 from stable_diffusion import StableDiffusion, CLIPTextEmbedder
+from utility.clip.prompt_embedding_cache import PromptEmbeddingCache
 from stable_diffusion.model_paths import (SDconfigs, CLIPconfigs)
 
 # NOTE: It's just for the prompt embedder. Later refactor
@@ -176,6 +177,8 @@ class StableDiffusionProcessing:
 
     c: tuple = field(default=None, init=False)
     uc: tuple = field(default=None, init=False)
+    c_attention_mask: torch.Tensor = field(default=None, init=False)
+    uc_attention_mask: torch.Tensor = field(default=None, init=False)
 
     rng: ImageRNG = field(default=None, init=False)
     color_corrections: list = field(default=None, init=False)
@@ -196,18 +199,31 @@ class StableDiffusionProcessing:
     sd: StableDiffusion = None
     model: LatentDiffusion = None
     clip_text_embedder: CLIPTextEmbedder = None
+    prompt_embedding_cache: PromptEmbeddingCache = None
     n_steps: int = 50
     ddim_eta: float = 0.0
 
-    def prompt_embedding_vectors(self, prompt_array):
+    def prompt_embedding_vectors(self, prompt_array, use_cache=False):
+        # returns the embeddings and their attention masks
+        # the masks are kept so the job's prompt embeddings
+        # can reuse these instead of encoding the prompts again
+        if self.prompt_embedding_cache is None:
+            self.prompt_embedding_cache = PromptEmbeddingCache(self.clip_text_embedder.forward_return_all, max_size=0)
+
         embedded_prompts = []
+        attention_masks = []
         for prompt in prompt_array:
-            prompt_embedding = self.clip_text_embedder.forward(prompt)
+            if use_cache:
+                prompt_embedding, _, attention_mask = self.prompt_embedding_cache.get(prompt)
+            else:
+                prompt_embedding, _, attention_mask = self.prompt_embedding_cache.encode(prompt)
             embedded_prompts.append(prompt_embedding)
+            attention_masks.append(attention_mask)
 
         embedded_prompts = torch.stack(embedded_prompts)
+        attention_masks = torch.stack(attention_masks)
 
-        return embedded_prompts
+        return embedded_prompts, attention_masks
 
     def __post_init__(self):
         if self.styles is None:
@@ -303,8 +319,14 @@ class StableDiffusionProcessing:
         negative_prompts = prompt_parser.SdConditioning(self.negative_prompts, width=self.width, height=self.height,
                                                         is_negative_prompt=True)
 
-        self.uc = self.prompt_embedding_vectors(negative_prompts)[0]
-        self.c = self.prompt_embedding_vectors(prompts)[0]
+        # negative prompts are shared between jobs, so they are cached
+        uc, uc_attention_mask = self.prompt_embedding_vectors(negative_prompts, use_cache=True)
+        c, c_attention_mask = self.prompt_embedding_vectors(prompts)
+
+        self.uc = uc[0]
+        self.uc_attention_mask = uc_attention_mask[0]
+        self.c = c[0]
+        self.c_attention_mask = c_attention_mask[0]
 
 
 @dataclass(repr=False)
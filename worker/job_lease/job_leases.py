@@ -0,0 +1,55 @@
+import sys
+import time
+import threading
+
+base_directory = "./"
+sys.path.insert(0, base_directory)
+
+from utility.http import generation_request
+
+# a claimed job has a lease, the api moves it back to the pending queue
+# when the lease expires before the job is completed or failed
+# the workers renew the lease when they start processing a job and before
+# uploading its results, but only once JOB_LEASE_RENEWAL_INTERVAL_SECONDS
+# passed since the claim or the last renewal, so most jobs are never renewed
+# the times are measured on the worker, the clocks of the api and
+# the worker do not have to agree
+JOB_LEASE_DURATION_SECONDS = 60 * 60
+JOB_LEASE_RENEWAL_INTERVAL_SECONDS = 15 * 60
+
+
+class JobLeases:
+    def __init__(self,
+                 lease_seconds=JOB_LEASE_DURATION_SECONDS,
+                 renewal_interval_seconds=JOB_LEASE_RENEWAL_INTERVAL_SECONDS):
+        self.lease_seconds = lease_seconds
+        self.renewal_interval_seconds = renewal_interval_seconds
+        self.lock = threading.Lock()
+        # job uuid => time of the claim or the last renewal
+        # completed jobs are dropped once their lease would have expired
+        self.lease_times = {}
+
+    def add(self, jobs):
+        # called when the jobs are claimed
+        now = time.monotonic()
+        with self.lock:
+            # the jobs whose lease expired are requeued by the api, they are not tracked anymore
+            self.lease_times = {job_uuid: lease_time for job_uuid, lease_time in self.lease_times.items()
+                                if now - lease_time < self.lease_seconds}
+            for job in jobs:
+                self.lease_times[job["uuid"]] = now
+
+    def renew(self, jobs):
+        now = time.monotonic()
+        with self.lock:
+            jobs_to_renew = []
+            for job in jobs:
+                # jobs that were not added are renewed
+                lease_time = self.lease_times.get(job["uuid"])
+                if lease_time is None or now - lease_time >= self.renewal_interval_seconds:
+                    jobs_to_renew.append(job)
+            for job in jobs_to_renew:
+                self.lease_times[job["uuid"]] = now
+
+        for job in jobs_to_renew:
+            generation_request.http_renew_job_lease(job["uuid"], self.lease_seconds)
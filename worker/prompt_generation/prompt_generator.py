@@ -2,7 +2,6 @@ import random
 import tiktoken
 import sys
 import os
-import math
 import csv
 import uuid
 from tqdm import tqdm
@@ -12,6 +11,7 @@ sys.path.insert(0, base_directory)
 
 from utility.http import generation_request
 from utility.http import request
+from utility.weighted_phrase_sampler import WeightedPhraseSampler
 from worker.generation_task.generation_task import GenerationTask
 
 
@@ -40,7 +40,7 @@ class GeneratedPrompt:
     def to_json(self):
         return {'positive-prompt-str': self.positive_prompt_str,
                 'negative-prompt-str': self.negative_prompt_str,
-                'prompt-vector': self.prompt_vector,
+                'prompt-vector': list(self.prompt_vector),
                 'num-topics': self.num_topics,
                 'num-modifiers': self.num_modifiers,
                 'num-styles': self.num_styles,
@@ -48,6 +48,27 @@ class GeneratedPrompt:
                 }
 
 
+class SparsePromptVector:
+    # prompt vector of a generated prompt, only the indexes of the used phrases are stored
+    def __init__(self, size, positive_indexes, negative_indexes):
+        self.size = size
+        self.positive_indexes = set(positive_indexes)
+        self.negative_indexes = set(negative_indexes)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        if index in self.positive_indexes:
+            return 1
+        if index in self.negative_indexes:
+            return -1
+        return 0
+
+    def __iter__(self):
+        return (self[index] for index in range(self.size))
+
+
 class PromptData:
     def __init__(self, index: int, phrase: str):
         self.Index = index
@@ -173,28 +194,6 @@ def initialize_prompt_list_from_csv(csv_dataset_path, csv_phrase_limit=0):
     return prompt_list.Prompts, phrase_token_size_list, positive_count_list, negative_count_list
 
 
-def get_sorted_list_with_cumulative(phrases, phrases_token_size, count_list):
-    # sort by count
-    sorted_phrases = []
-    sorted_token_size = []
-    sorted_count = []
-    sorted_cumulative_sum = []
-    sorted_indexes = sorted(range(len(count_list)), key=lambda x: count_list[x], reverse=True)
-
-    prev_sum = 0
-    for i in sorted_indexes:
-        sorted_phrases.append(phrases[i])
-        sorted_token_size.append(phrases_token_size[i])
-        sorted_count.append(count_list[i])
-
-        # add cumulative sum
-        cumulative_sum = prev_sum + count_list[i]
-        sorted_cumulative_sum.append(cumulative_sum)
-        prev_sum = cumulative_sum
-
-    return sorted_phrases, sorted_token_size, sorted_count, sorted_cumulative_sum
-
-
 def count_number_of_digits(num):
     count = 0
     while (num > 0):
@@ -203,143 +202,67 @@ def count_number_of_digits(num):
     return count
 
 
-# find the first element, whose cumulative total is more than the random number
-def find_first_element_binary_search(cumulative_total_arr, random_num):
-    low = 0
-    high = len(cumulative_total_arr) - 1
-    mid = 0
+def get_proportional_phrase_samplers(phrases, phrases_token_size, positive_count_list, negative_count_list):
+    # the samplers of the positive and negative prompts, the phrases are drawn
+    # in proportion to their count. build them once per phrase list
+    positive_sampler = WeightedPhraseSampler(positive_count_list, phrases_token_size, phrases)
+    negative_sampler = WeightedPhraseSampler(negative_count_list, phrases_token_size, phrases)
 
-    while low <= high:
-        mid = (high + low) / 2
-        mid = math.floor(mid)
+    return positive_sampler, negative_sampler
 
-        # If random_num is greater, ignore left half
-        if cumulative_total_arr[mid] < random_num:
-            low = mid + 1
-        # If random_num is smaller, ignore right half
-        elif cumulative_total_arr[mid] > random_num:
-            high = mid - 1
-        # means random_num is present at mid
-        else:
-            return mid
 
-        # use this index since sometimes the exact
-        # random num is not in the list
-        if low == high:
-            return low
+def get_prompt_token_size(prompt_str, encoder):
+    if prompt_str == "":
+        return 0
 
-    # If we reach here, then the element was not present
-    return -1
+    return len(encoder.encode(prompt_str))
 
 
-def generate_prompts_from_csv_proportional_selection(csv_dataset_path,
-                                                     prompt_count,
-                                                     csv_phrase_limit=0,
-                                                     positive_prefix=""):
-    generated_prompts = []
-    max_token_size = 75
-    comma_token_size = 1
-
-    phrases, \
-        phrases_token_size,\
-        positive_count_list,\
-        negative_count_list = initialize_prompt_list_from_csv(csv_dataset_path, csv_phrase_limit)
+def generate_proportional_prompt(positive_sampler,
+                                 negative_sampler,
+                                 positive_draws,
+                                 negative_draws,
+                                 positive_prefix="",
+                                 positive_prefix_token_size=0):
+    # a phrase is used at most once per prompt, positive or negative
+    used_phrases = set()
+    positive_indexes = positive_sampler.pack(positive_draws, used_phrases, token_size=positive_prefix_token_size)
+    negative_indexes = negative_sampler.pack(negative_draws, used_phrases)
 
-    total_len_phrases = len(phrases)
+    positive_prompt = positive_sampler.get_phrases(positive_indexes)
+    negative_prompt = negative_sampler.get_phrases(negative_indexes)
 
-    positive_phrases, \
-        positive_token_size, \
-        positive_count, \
-        positive_cumulative_sum = get_sorted_list_with_cumulative(phrases, phrases_token_size, positive_count_list)
-
-    positive_total_cumulative = positive_cumulative_sum[-1]
-
-    negative_phrases, \
-        negative_token_size, \
-        negative_count, \
-        negative_cumulative_sum = get_sorted_list_with_cumulative(phrases, phrases_token_size, negative_count_list)
-
-    negative_total_cumulative = negative_cumulative_sum[-1]
-
-    # del unused var at this point
-    del phrases
-    del phrases_token_size
-    del positive_count_list
-    del negative_count_list
-
-    positive_prefix_token_size = 0
+    positive_prompt_str = ', '.join([prompt.Phrase for prompt in positive_prompt])
     if positive_prefix != "":
-        # get token size for prefix
-        enc = tiktoken.get_encoding("cl100k_base")
-        positive_prefix_prompt_tokens = enc.encode(positive_prefix)
-        positive_prefix_token_size = len(positive_prefix_prompt_tokens)
-
-    print("Generating {} prompts...".format(prompt_count))
-    for i in tqdm(range(0, prompt_count)):
-        positive_prompt_total_token_size = positive_prefix_token_size
-        negative_prompt_total_token_size = 0
-        positive_prompt = []
-        negative_prompt = []
-        prompt_vector = [0] * total_len_phrases
-
-        # positive prompt
-        while positive_prompt_total_token_size < max_token_size:
-            random_int = random.randint(0, positive_total_cumulative)
-            random_index = find_first_element_binary_search(positive_cumulative_sum, random_int)
-            if prompt_vector[random_index] != 0:
-                continue
-
-            prompt_index = random_index
-            random_prompt = positive_phrases[prompt_index]
-
-            chosen_phrase_size = positive_token_size[prompt_index]
-            sum_token_size = positive_prompt_total_token_size + chosen_phrase_size + comma_token_size
-            if sum_token_size < max_token_size:
-                # update used array
-                prompt_vector[prompt_index] = 1
-                positive_prompt.append(random_prompt)
-                positive_prompt_total_token_size = sum_token_size
-            else:
-                break
-
-        # negative prompt
-        while negative_prompt_total_token_size < max_token_size:
-            random_int = random.randint(0, negative_total_cumulative)
-            random_index = find_first_element_binary_search(negative_cumulative_sum, random_int)
-
-            if prompt_vector[random_index] != 0:
-                continue
+        positive_prompt_str = "{}, {}".format(positive_prefix, positive_prompt_str)
+    negative_prompt_str = ', '.join([prompt.Phrase for prompt in negative_prompt])
 
-            prompt_index = random_index
-            random_prompt = negative_phrases[prompt_index]
+    num_topics = len([prompt.Phrase for prompt in positive_prompt if "topic" in prompt.Types])
+    num_modifiers = len([prompt.Phrase for prompt in positive_prompt if "modifier" in prompt.Types])
+    num_styles = len([prompt.Phrase for prompt in positive_prompt if "style" in prompt.Types])
+    num_constraints = len([prompt.Phrase for prompt in positive_prompt if "constraint" in prompt.Types])
 
-            chosen_phrase_size = negative_token_size[prompt_index]
-            sum_token_size = negative_prompt_total_token_size + chosen_phrase_size + comma_token_size
-            if sum_token_size < max_token_size:
-                # update used array
-                prompt_vector[prompt_index] = -1
-                negative_prompt.append(random_prompt)
-                negative_prompt_total_token_size = sum_token_size
-            else:
-                break
-
-        positive_prompt_str = ', '.join([prompt.Phrase for prompt in positive_prompt])
-        if positive_prefix != "":
-            positive_prompt_str = "{}, {}".format(positive_prefix, positive_prompt_str)
-        negative_prompt_str = ', '.join([prompt.Phrase for prompt in negative_prompt])
+    prompt_vector = SparsePromptVector(len(positive_sampler.token_sizes), positive_indexes, negative_indexes)
 
-        num_topics = len([prompt.Phrase for prompt in positive_prompt if "topic" in prompt.Types])
-        num_modifiers = len([prompt.Phrase for prompt in positive_prompt if "modifier" in prompt.Types])
-        num_styles = len([prompt.Phrase for prompt in positive_prompt if "style" in prompt.Types])
-        num_constraints = len([prompt.Phrase for prompt in positive_prompt if "constraint" in prompt.Types])
+    return GeneratedPrompt(positive_prompt_str, negative_prompt_str, num_topics, num_modifiers,
+                           num_styles, num_constraints, prompt_vector)
 
-        prompt = GeneratedPrompt(positive_prompt_str, negative_prompt_str, num_topics, num_modifiers,
-                            num_styles, num_constraints, prompt_vector)
 
-        # save prompt json
-        generated_prompts.append(prompt)
+def generate_prompts_from_csv_proportional_selection(csv_dataset_path,
+                                                     prompt_count,
+                                                     csv_phrase_limit=0,
+                                                     positive_prefix=""):
+    phrases, \
+        phrases_token_size,\
+        positive_count_list,\
+        negative_count_list = initialize_prompt_list_from_csv(csv_dataset_path, csv_phrase_limit)
 
-    return generated_prompts
+    return generate_prompts_proportional_selection(phrases,
+                                                   phrases_token_size,
+                                                   positive_count_list,
+                                                   negative_count_list,
+                                                   prompt_count,
+                                                   positive_prefix)
 
 
 def generate_prompts_from_csv_with_base_prompt_prefix(csv_dataset_path,
@@ -347,215 +270,76 @@ def generate_prompts_from_csv_with_base_prompt_prefix(csv_dataset_path,
                                                      prompt_count,
                                                      csv_phrase_limit=0):
     generated_prompts = []
-    max_token_size = 75
-    comma_token_size = 1
 
     phrases, \
         phrases_token_size,\
         positive_count_list,\
         negative_count_list = initialize_prompt_list_from_csv(csv_dataset_path, csv_phrase_limit)
 
-    total_len_phrases = len(phrases)
-
-    positive_phrases, \
-        positive_token_size, \
-        positive_count, \
-        positive_cumulative_sum = get_sorted_list_with_cumulative(phrases, phrases_token_size, positive_count_list)
-
-    positive_total_cumulative = positive_cumulative_sum[-1]
+    positive_sampler, negative_sampler = get_proportional_phrase_samplers(phrases,
+                                                                          phrases_token_size,
+                                                                          positive_count_list,
+                                                                          negative_count_list)
+    positive_draws = positive_sampler.get_draws()
+    negative_draws = negative_sampler.get_draws()
 
-    negative_phrases, \
-        negative_token_size, \
-        negative_count, \
-        negative_cumulative_sum = get_sorted_list_with_cumulative(phrases, phrases_token_size, negative_count_list)
-
-    negative_total_cumulative = negative_cumulative_sum[-1]
-
-    # del unused var at this point
-    del phrases
-    del phrases_token_size
-    del positive_count_list
-    del negative_count_list
+    base_prompt_population = load_base_prompts(csv_base_prompts_path)
+    choose_probability = [0.1, 0.3, 0.3, 0.2, 0.1]
+    enc = tiktoken.get_encoding("cl100k_base")
 
     print("Generating {} prompts...".format(prompt_count))
     for i in tqdm(range(0, prompt_count)):
         # generating base prompts to add as prefix to the generated prompt
-        base_prompt_population = load_base_prompts(csv_base_prompts_path)
-        choose_probability = [0.1, 0.3, 0.3, 0.2, 0.1]
         base_prompt_list = generate_base_prompts(base_prompt_population, choose_probability)
         base_prompts = ", ".join(base_prompt_list)
 
-        positive_prompt_total_token_size = 0
-        if base_prompts != "":
-            # get token size for prefix
-            enc = tiktoken.get_encoding("cl100k_base")
-            positive_prefix_prompt_tokens = enc.encode(base_prompts)
-            positive_prompt_total_token_size = len(positive_prefix_prompt_tokens)
-
-        negative_prompt_total_token_size = 0
-        positive_prompt = []
-        negative_prompt = []
-        prompt_vector = [0] * total_len_phrases
-
-        # positive prompt
-        while positive_prompt_total_token_size < max_token_size:
-            random_int = random.randint(0, positive_total_cumulative)
-            random_index = find_first_element_binary_search(positive_cumulative_sum, random_int)
-            if prompt_vector[random_index] != 0:
-                continue
-
-            prompt_index = random_index
-            random_prompt = positive_phrases[prompt_index]
-
-            chosen_phrase_size = positive_token_size[prompt_index]
-            sum_token_size = positive_prompt_total_token_size + chosen_phrase_size + comma_token_size
-            if sum_token_size < max_token_size:
-                # update used array
-                prompt_vector[prompt_index] = 1
-                positive_prompt.append(random_prompt)
-                positive_prompt_total_token_size = sum_token_size
-            else:
-                break
-
-        # negative prompt
-        while negative_prompt_total_token_size < max_token_size:
-            random_int = random.randint(0, negative_total_cumulative)
-            random_index = find_first_element_binary_search(negative_cumulative_sum, random_int)
-
-            if prompt_vector[random_index] != 0:
-                continue
-
-            prompt_index = random_index
-            random_prompt = negative_phrases[prompt_index]
-
-            chosen_phrase_size = negative_token_size[prompt_index]
-            sum_token_size = negative_prompt_total_token_size + chosen_phrase_size + comma_token_size
-            if sum_token_size < max_token_size:
-                # update used array
-                prompt_vector[prompt_index] = -1
-                negative_prompt.append(random_prompt)
-                negative_prompt_total_token_size = sum_token_size
-            else:
-                break
-
-        positive_prompt_str = ', '.join([prompt.Phrase for prompt in positive_prompt])
-        if base_prompts != "":
-            positive_prompt_str = "{}, {}".format(base_prompts, positive_prompt_str)
-        negative_prompt_str = ', '.join([prompt.Phrase for prompt in negative_prompt])
-
-        num_topics = len([prompt.Phrase for prompt in positive_prompt if "topic" in prompt.Types])
-        num_modifiers = len([prompt.Phrase for prompt in positive_prompt if "modifier" in prompt.Types])
-        num_styles = len([prompt.Phrase for prompt in positive_prompt if "style" in prompt.Types])
-        num_constraints = len([prompt.Phrase for prompt in positive_prompt if "constraint" in prompt.Types])
-
-        prompt = GeneratedPrompt(positive_prompt_str, negative_prompt_str, num_topics, num_modifiers,
-                            num_styles, num_constraints, prompt_vector)
+        prompt = generate_proportional_prompt(positive_sampler,
+                                              negative_sampler,
+                                              positive_draws,
+                                              negative_draws,
+                                              positive_prefix=base_prompts,
+                                              positive_prefix_token_size=get_prompt_token_size(base_prompts, enc))
 
         # save prompt json
         generated_prompts.append(prompt)
 
     return generated_prompts
 
+
 def generate_prompts_proportional_selection(phrases,
                                             phrases_token_size,
                                             positive_count_list,
                                             negative_count_list,
                                             prompt_count,
-                                            positive_prefix=""):
+                                            positive_prefix="",
+                                            phrase_samplers=None):
+    # phrase_samplers are the samplers of get_proportional_phrase_samplers for these phrases,
+    # they are built if not given
     generated_prompts = []
-    max_token_size = 75
-    comma_token_size = 1
-
-    total_len_phrases = len(phrases)
 
-    positive_phrases, \
-        positive_token_size, \
-        positive_count, \
-        positive_cumulative_sum = get_sorted_list_with_cumulative(phrases, phrases_token_size, positive_count_list)
-
-    positive_total_cumulative = positive_cumulative_sum[-1]
-
-    negative_phrases, \
-        negative_token_size, \
-        negative_count, \
-        negative_cumulative_sum = get_sorted_list_with_cumulative(phrases, phrases_token_size, negative_count_list)
-
-    negative_total_cumulative = negative_cumulative_sum[-1]
-
-    # del unused var at this point
-    del phrases
-    del phrases_token_size
-    del positive_count_list
-    del negative_count_list
+    if phrase_samplers is None:
+        phrase_samplers = get_proportional_phrase_samplers(phrases,
+                                                           phrases_token_size,
+                                                           positive_count_list,
+                                                           negative_count_list)
+    positive_sampler, negative_sampler = phrase_samplers
+    positive_draws = positive_sampler.get_draws()
+    negative_draws = negative_sampler.get_draws()
 
     positive_prefix_token_size = 0
     if positive_prefix != "":
         # get token size for prefix
         enc = tiktoken.get_encoding("cl100k_base")
-        positive_prefix_prompt_tokens = enc.encode(positive_prefix)
-        positive_prefix_token_size = len(positive_prefix_prompt_tokens)
+        positive_prefix_token_size = get_prompt_token_size(positive_prefix, enc)
 
     print("Generating {} prompts...".format(prompt_count))
     for i in tqdm(range(0, prompt_count)):
-        positive_prompt_total_token_size = positive_prefix_token_size
-        negative_prompt_total_token_size = 0
-        positive_prompt = []
-        negative_prompt = []
-        prompt_vector = [0] * total_len_phrases
-
-        # positive prompt
-        while positive_prompt_total_token_size < max_token_size:
-            random_int = random.randint(0, positive_total_cumulative)
-            random_index = find_first_element_binary_search(positive_cumulative_sum, random_int)
-            if prompt_vector[random_index] != 0:
-                continue
-
-            prompt_index = random_index
-            random_prompt = positive_phrases[prompt_index]
-
-            chosen_phrase_size = positive_token_size[prompt_index]
-            sum_token_size = positive_prompt_total_token_size + chosen_phrase_size + comma_token_size
-            if sum_token_size < max_token_size:
-                # update used array
-                prompt_vector[prompt_index] = 1
-                positive_prompt.append(random_prompt)
-                positive_prompt_total_token_size = sum_token_size
-            else:
-                break
-
-        # negative prompt
-        while negative_prompt_total_token_size < max_token_size:
-            random_int = random.randint(0, negative_total_cumulative)
-            random_index = find_first_element_binary_search(negative_cumulative_sum, random_int)
-
-            if prompt_vector[random_index] != 0:
-                continue
-
-            prompt_index = random_index
-            random_prompt = negative_phrases[prompt_index]
-
-            chosen_phrase_size = negative_token_size[prompt_index]
-            sum_token_size = negative_prompt_total_token_size + chosen_phrase_size + comma_token_size
-            if sum_token_size < max_token_size:
-                # update used array
-                prompt_vector[prompt_index] = -1
-                negative_prompt.append(random_prompt)
-                negative_prompt_total_token_size = sum_token_size
-            else:
-                break
-
-        positive_prompt_str = ', '.join([prompt.Phrase for prompt in positive_prompt])
-        if positive_prefix != "":
-            positive_prompt_str = "{}, {}".format(positive_prefix, positive_prompt_str)
-        negative_prompt_str = ', '.join([prompt.Phrase for prompt in negative_prompt])
-
-        num_topics = len([prompt.Phrase for prompt in positive_prompt if "topic" in prompt.Types])
-        num_modifiers = len([prompt.Phrase for prompt in positive_prompt if "modifier" in prompt.Types])
-        num_styles = len([prompt.Phrase for prompt in positive_prompt if "style" in prompt.Types])
-        num_constraints = len([prompt.Phrase for prompt in positive_prompt if "constraint" in prompt.Types])
-
-        prompt = GeneratedPrompt(positive_prompt_str, negative_prompt_str, num_topics, num_modifiers,
-                            num_styles, num_constraints, prompt_vector)
+        prompt = generate_proportional_prompt(positive_sampler,
+                                              negative_sampler,
+                                              positive_draws,
+                                              negative_draws,
+                                              positive_prefix=positive_prefix,
+                                              positive_prefix_token_size=positive_prefix_token_size)
 
         # save prompt json
         generated_prompts.append(prompt)
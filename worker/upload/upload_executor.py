@@ -0,0 +1,145 @@
+import sys
+import time
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait
+
+base_directory = "./"
+sys.path.insert(0, base_directory)
+
+from utility.minio import cmd
+
+# max number of jobs whose uploads can be in flight
+# the job processor blocks when this many jobs are pending
+MAX_PENDING_UPLOAD_JOBS = 16
+# number of artifacts uploaded in parallel, across all jobs
+NUM_ARTIFACT_UPLOAD_THREADS = 8
+MAX_UPLOAD_RETRIES = 3
+UPLOAD_RETRY_DELAY_IN_SECONDS = 1
+
+
+def upload_data_artifact(minio_client, bucket_name, file_path, data):
+    # the buffer is rewound before every attempt
+    # so a failed upload can be retried
+    def upload():
+        data.seek(0)
+        cmd.upload_data(minio_client, bucket_name, file_path, data)
+
+    return upload
+
+
+# shared upload executor of the generation workers
+# every job submits its artifacts (image, image data, latent, embedding...)
+# the artifacts are uploaded in parallel on a fixed size thread pool
+# and retried on failure; once all of them are uploaded
+# the job's on_uploaded callback updates the job status
+# the number of pending jobs is bounded, submit() blocks when it is reached
+# so a slow minio slows down the worker instead of spawning more threads
+class UploadExecutor:
+    def __init__(self,
+                 max_pending_jobs=MAX_PENDING_UPLOAD_JOBS,
+                 num_artifact_upload_threads=NUM_ARTIFACT_UPLOAD_THREADS,
+                 max_retries=MAX_UPLOAD_RETRIES,
+                 retry_delay_in_seconds=UPLOAD_RETRY_DELAY_IN_SECONDS):
+        self.max_retries = max_retries
+        self.retry_delay_in_seconds = retry_delay_in_seconds
+
+        self.pending_jobs_semaphore = threading.BoundedSemaphore(max_pending_jobs)
+        # one thread per pending job, it only waits for the artifacts
+        # and runs the job callbacks
+        self.job_executor = ThreadPoolExecutor(max_workers=max_pending_jobs,
+                                               thread_name_prefix='upload-job')
+        self.artifact_executor = ThreadPoolExecutor(max_workers=num_artifact_upload_threads,
+                                                    thread_name_prefix='upload-artifact')
+
+        self.lock = threading.Lock()
+        self.num_pending_jobs = 0
+        self.num_completed_jobs = 0
+        self.num_failed_jobs = 0
+        self.is_shutdown = False
+
+    def submit(self, job_uuid, artifact_list, on_uploaded, on_failed=None):
+        # artifact_list is a list of (artifact_name, upload_function)
+        # on_uploaded() is called once all the artifacts are uploaded
+        # on_failed(exception) is called if an artifact failed all its retries
+        if self.is_shutdown:
+            raise RuntimeError("upload executor is shut down")
+
+        # blocks while max_pending_jobs jobs are being uploaded
+        self.pending_jobs_semaphore.acquire()
+        with self.lock:
+            self.num_pending_jobs += 1
+
+        try:
+            return self.job_executor.submit(self.run_job, job_uuid, artifact_list, on_uploaded, on_failed)
+        except Exception:
+            self.release_job()
+            raise
+
+    def release_job(self):
+        with self.lock:
+            self.num_pending_jobs -= 1
+        self.pending_jobs_semaphore.release()
+
+    def get_num_pending_jobs(self):
+        with self.lock:
+            return self.num_pending_jobs
+
+    def upload_artifact(self, job_uuid, artifact_name, upload_function):
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                return upload_function()
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+
+                print("Upload of {} for job {} failed (attempt {}/{}): {}, retrying".format(
+                    artifact_name, job_uuid, attempt, self.max_retries, e))
+                time.sleep(self.retry_delay_in_seconds * attempt)
+
+    def run_job(self, job_uuid, artifact_list, on_uploaded, on_failed):
+        start_time = time.time()
+
+        try:
+            futures = [self.artifact_executor.submit(self.upload_artifact, job_uuid, artifact_name, upload_function)
+                       for artifact_name, upload_function in artifact_list]
+            # wait for all the artifacts, even if one of them failed
+            # so a retried job never races with its own uploads
+            wait(futures)
+
+            exception = None
+            for (artifact_name, _), future in zip(artifact_list, futures):
+                if future.exception() is not None:
+                    print("Upload of {} for job {} failed: {}".format(artifact_name, job_uuid, future.exception()))
+                    exception = future.exception()
+
+            if exception is not None:
+                with self.lock:
+                    self.num_failed_jobs += 1
+                if on_failed is not None:
+                    on_failed(exception)
+                return
+
+            print("Upload for job {} completed".format(job_uuid))
+            print("Upload time elapsed: {:.4f}s".format(time.time() - start_time))
+
+            with self.lock:
+                self.num_completed_jobs += 1
+            on_uploaded()
+
+        except Exception:
+            print("Upload for job {} failed: {}".format(job_uuid, traceback.format_exc()))
+        finally:
+            self.release_job()
+
+    def shutdown(self, wait_for_uploads=True):
+        # stops accepting jobs and drains the pending uploads
+        self.is_shutdown = True
+        if wait_for_uploads:
+            print("Waiting for {} pending upload jobs".format(self.get_num_pending_jobs()))
+
+        self.job_executor.shutdown(wait=wait_for_uploads)
+        self.artifact_executor.shutdown(wait=wait_for_uploads)
+
+        print("Upload executor stopped, {} jobs uploaded, {} jobs failed".format(
+            self.num_completed_jobs, self.num_failed_jobs))
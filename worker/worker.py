@@ -26,8 +26,10 @@ from utility.path import separate_bucket_and_file_path
 from utility.minio import cmd
 from stable_diffusion.utils_image import save_images_to_minio, save_image_data_to_minio, save_latent_to_minio, save_image_embedding_to_minio, \
     get_image_data, get_embeddings
-from worker.clip_calculation.clip_calculator import run_clip_calculation_task
+from worker.clip_calculation.clip_calculator import run_clip_calculation_tasks, collect_jobs_of_task_type, \
+    CLIP_CALCULATION_BATCH_SIZE
 from worker.generation_task.generation_task import GenerationTask
+from worker.upload.upload_executor import upload_data_artifact
 
 
 class ThreadState:
@@ -66,7 +68,7 @@ def run_image_generation_task(worker_state, generation_task):
     else:
         seed = generation_task.task_input_dict["seed"]
 
-    output_file_path, output_file_hash, img_data, latent = generate_image_from_text(
+    output_file_path, output_file_hash, img_data, latent, text_conditioning = generate_image_from_text(
         worker_state.minio_client,
         worker_state.txt2img,
         worker_state.clip_text_embedder,
@@ -85,9 +87,10 @@ def run_image_generation_task(worker_state, generation_task):
                                  generation_task.task_input_dict[
                                      "dataset"],
                                  generation_task.task_input_dict[
-                                     "file_path"]))
+                                     "file_path"]),
+        prompt_embedding_cache=worker_state.prompt_embedding_cache)
 
-    return output_file_path, output_file_hash, img_data, latent, seed
+    return output_file_path, output_file_hash, img_data, latent, seed, text_conditioning
 
 
 def run_inpainting_generation_task(worker_state, generation_task: GenerationTask):
@@ -128,6 +131,7 @@ def run_inpainting_generation_task(worker_state, generation_task: GenerationTask
         inpaint_full_res_padding=generation_task.task_input_dict["inpaint_full_res_padding"],
         inpainting_mask_invert=generation_task.task_input_dict["inpainting_mask_invert"],
         clip_text_embedder=worker_state.clip_text_embedder,
+        prompt_embedding_cache=worker_state.prompt_embedding_cache,
         device=worker_state.device
     )
 
@@ -143,6 +147,12 @@ def run_inpainting_generation_task(worker_state, generation_task: GenerationTask
     # Access the latent vector
     inpainting_latent = inpainting_processor.init_latent
 
+    # conditioning used for the generation, reused for the prompt embeddings
+    text_conditioning = (inpainting_processor.c,
+                         inpainting_processor.c_attention_mask,
+                         inpainting_processor.uc,
+                         inpainting_processor.uc_attention_mask)
+
     # convert image to png from RGB
     output_file_hash, img_byte_arr = inpainting_processor.convert_image_to_png(image)
     
@@ -151,7 +161,14 @@ def run_inpainting_generation_task(worker_state, generation_task: GenerationTask
     generation_task.task_input_dict["seed"] = seed
 
     # Return the latent vector along with other values
-    return output_file_path, output_file_hash, img_byte_arr, seed, inpainting_latent
+    return output_file_path, output_file_hash, img_byte_arr, seed, inpainting_latent, text_conditioning
+
+# backoff of the job fetcher when there are no jobs
+MIN_JOB_FETCH_SLEEP_TIME_IN_SECONDS = 0.1
+MAX_JOB_FETCH_SLEEP_TIME_IN_SECONDS = 5
+# sleep of the job fetcher while the job queue is full
+QUEUE_FULL_SLEEP_TIME_IN_SECONDS = 0.1
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Worker for image generation")
@@ -165,45 +182,57 @@ def parse_args():
                         help="The minio secret key to use so worker can upload files to minio server")
     parser.add_argument("--worker-type", type=str, default="",
                         help="The task types the worker will accept and do. If blank then worker will accept all task types.")
+    parser.add_argument("--clip-batch-size", type=int, default=CLIP_CALCULATION_BATCH_SIZE,
+                        help="Max number of clip calculation jobs processed together in one batch")
 
     return parser.parse_args()
 
 
-def get_job_if_exist(worker_type_list):
-    job = None
+def get_jobs_if_exist(worker_type_list, count):
+    # claims up to count jobs, trying the worker types in order
+    jobs = []
     for worker_type in worker_type_list:
+        num_jobs_to_claim = count - len(jobs)
         if worker_type == "":
-            job = generation_request.http_get_job(model_type="sd_1_5")
+            jobs.extend(generation_request.http_claim_jobs(num_jobs_to_claim, model_type="sd_1_5"))
         else:
-            job = generation_request.http_get_job(worker_type, model_type="sd_1_5")
+            jobs.extend(generation_request.http_claim_jobs(num_jobs_to_claim, worker_type, model_type="sd_1_5"))
 
-        if job is not None:
+        if len(jobs) >= count:
             break
 
-    return job
+    return jobs
 
 
-def upload_data_and_update_job_status(job, output_file_path, output_file_hash, data, minio_client):
-    start_time = time.time()
+def upload_data_and_update_job_status(worker_state, job, output_file_path, output_file_hash, data, minio_client):
     bucket_name, file_path = separate_bucket_and_file_path(output_file_path)
 
-    cmd.upload_data(minio_client, bucket_name, file_path, data)
+    artifact_list = [
+        ("clip data", upload_data_artifact(minio_client, bucket_name, file_path, data))
+    ]
 
-    info_v2("Upload for job {} completed".format(job["uuid"]))
-    info_v2("Upload time elapsed: {:.4f}s".format(time.time() - start_time))
+    def on_uploaded():
+        # update job info
+        job['task_completion_time'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        job['task_output_file_dict'] = {
+            'output_file_path': output_file_path,
+            'output_file_hash': output_file_hash
+        }
+        info_v2("output file path: " + output_file_path)
+        info_v2("output file hash: " + output_file_hash)
+        info_v2("job completed: " + job["uuid"])
 
-    # update job info
-    job['task_completion_time'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    job['task_output_file_dict'] = {
-        'output_file_path': output_file_path,
-        'output_file_hash': output_file_hash
-    }
-    info_v2("output file path: " + output_file_path)
-    info_v2("output file hash: " + output_file_hash)
-    info_v2("job completed: " + job["uuid"])
+        # update status
+        generation_request.http_update_job_completed(job)
 
-    # update status
-    generation_request.http_update_job_completed(job)
+    def on_failed(e):
+        job['task_error_str'] = "upload failed: " + str(e)
+        generation_request.http_update_job_failed(job)
+
+    # the job can wait a while for a free upload slot
+    worker_state.job_leases.renew([job])
+    # blocks while too many jobs are being uploaded
+    worker_state.upload_executor.submit(job["uuid"], artifact_list, on_uploaded, on_failed)
 
 
 def upload_image_data_and_update_job_status(worker_state,
@@ -219,7 +248,6 @@ def upload_image_data_and_update_job_status(worker_state,
                                             prompt_embedding_average_pooled,
                                             prompt_embedding_max_pooled,
                                             prompt_embedding_signed_max_pooled):
-    start_time = time.time()
     bucket_name, file_path = separate_bucket_and_file_path(output_file_path)
 
     minio_client = worker_state.minio_client
@@ -239,89 +267,126 @@ def upload_image_data_and_update_job_status(worker_state,
     prompt_generation_policy = generation_task.prompt_generation_data["prompt_generation_policy"]
     top_k = generation_task.prompt_generation_data["top_k"]
 
-    cmd.upload_data(minio_client, bucket_name, file_path, data)
-
-    # save image meta data
-    save_image_data_to_minio(minio_client,
-                             generation_task.uuid,
-                             job_completion_time,
-                             dataset,
-                             output_file_path,
-                             output_file_hash,
-                             positive_prompts,
-                             negative_prompts,
-                             cfg_strength,
-                             seed,
-                             image_width,
-                             image_height,
-                             sampler,
-                             sampler_steps,
-                             prompt_scoring_model,
-                             prompt_score,
-                             prompt_generation_policy,
-                             top_k)
-
-    save_latent_to_minio(minio_client, 
-                         bucket_name, 
-                         generation_task.uuid, 
-                         output_file_hash, 
-                         latent, 
-                         output_file_path)
-    
-    # save image embedding data
-    save_image_embedding_to_minio(minio_client,
-                                  dataset,
-                                  output_file_path,
-                                  prompt_embedding,
-                                  prompt_embedding_average_pooled,
-                                  prompt_embedding_max_pooled,
-                                  prompt_embedding_signed_max_pooled)
-
-    info_v2("Upload for job {} completed".format(generation_task.uuid))
-    info_v2("Upload time elapsed: {:.4f}s".format(time.time() - start_time))
-
-    # update job info
-    job['task_completion_time'] = job_completion_time
-    job['task_output_file_dict'] = {
-        'output_file_path': output_file_path,
-        'output_file_hash': output_file_hash
-    }
-    info_v2("output file path: " + output_file_path)
-    info_v2("output file hash: " + output_file_hash)
-    info_v2("job completed: " + generation_task.uuid)
-
-    # update status
-    generation_request.http_update_job_completed(job)
-
-    # add clip calculation tasks
-    kandinsky_clip_calculation_job = {"uuid": "",
-                            "task_type": "clip_calculation_task_kandinsky",
-                            "task_input_dict": {
-                                "input_file_path": output_file_path,
-                                "input_file_hash": output_file_hash
-                            },
-                            }
-    
-    sd_clip_calculation_job = {"uuid": "",
-                            "task_type": "clip_calculation_task_sd_1_5",
-                            "task_input_dict": {
-                                "input_file_path": output_file_path,
-                                "input_file_hash": output_file_hash
-                            },
-                            }
+    # the artifacts are uploaded in parallel by the upload executor
+    artifact_list = [
+        ("image", upload_data_artifact(minio_client, bucket_name, file_path, data)),
+        # save image meta data
+        ("image data", lambda: save_image_data_to_minio(minio_client,
+                                                        generation_task.uuid,
+                                                        job_completion_time,
+                                                        dataset,
+                                                        output_file_path,
+                                                        output_file_hash,
+                                                        positive_prompts,
+                                                        negative_prompts,
+                                                        cfg_strength,
+                                                        seed,
+                                                        image_width,
+                                                        image_height,
+                                                        sampler,
+                                                        sampler_steps,
+                                                        prompt_scoring_model,
+                                                        prompt_score,
+                                                        prompt_generation_policy,
+                                                        top_k)),
+        ("latent", lambda: save_latent_to_minio(minio_client,
+                                                bucket_name,
+                                                generation_task.uuid,
+                                                output_file_hash,
+                                                latent,
+                                                output_file_path)),
+        # save image embedding data
+        ("image embedding", lambda: save_image_embedding_to_minio(minio_client,
+                                                                  dataset,
+                                                                  output_file_path,
+                                                                  prompt_embedding,
+                                                                  prompt_embedding_average_pooled,
+                                                                  prompt_embedding_max_pooled,
+                                                                  prompt_embedding_signed_max_pooled))
+    ]
+
+    def on_uploaded():
+        # update job info
+        job['task_completion_time'] = job_completion_time
+        job['task_output_file_dict'] = {
+            'output_file_path': output_file_path,
+            'output_file_hash': output_file_hash
+        }
+        info_v2("output file path: " + output_file_path)
+        info_v2("output file hash: " + output_file_hash)
+        info_v2("job completed: " + generation_task.uuid)
+
+        # update status
+        generation_request.http_update_job_completed(job)
+
+        # add clip calculation tasks
+        kandinsky_clip_calculation_job = {"uuid": "",
+                                "task_type": "clip_calculation_task_kandinsky",
+                                "task_input_dict": {
+                                    "input_file_path": output_file_path,
+                                    "input_file_hash": output_file_hash
+                                },
+                                }
+
+        sd_clip_calculation_job = {"uuid": "",
+                                "task_type": "clip_calculation_task_sd_1_5",
+                                "task_input_dict": {
+                                    "input_file_path": output_file_path,
+                                    "input_file_hash": output_file_hash
+                                },
+                                }
+
+        generation_request.http_add_job(kandinsky_clip_calculation_job)
+        generation_request.http_add_job(sd_clip_calculation_job)
+
+    def on_failed(e):
+        job['task_error_str'] = "upload failed: " + str(e)
+        generation_request.http_update_job_failed(job)
+
+    # the job can wait a while for a free upload slot
+    worker_state.job_leases.renew([job])
+    # blocks while too many jobs are being uploaded
+    worker_state.upload_executor.submit(generation_task.uuid, artifact_list, on_uploaded, on_failed)
+
+
+def process_clip_calculation_jobs(worker_state, thread_state, jobs, model_type, batch_size):
+    # the jobs whose image could not be read fail alone
+    # if the batch could not be computed all its jobs fail
+    info(thread_state, f"Processing {len(jobs)} clip calculation jobs in a batch")
+    generation_tasks = [GenerationTask.from_dict(job) for job in jobs]
+
+    try:
+        results = run_clip_calculation_tasks(worker_state, generation_tasks, model_type, batch_size)
+    except Exception as e:
+        error(thread_state, f"clip calculation batch failed: {traceback.format_exc()}")
+        results = [e] * len(jobs)
+
+    for job, result in zip(jobs, results):
+        if isinstance(result, Exception):
+            job['task_error_str'] = str(result)
+            generation_request.http_update_job_failed(job)
+            continue
 
-    generation_request.http_add_job(kandinsky_clip_calculation_job)
-    generation_request.http_add_job(sd_clip_calculation_job)
+        output_file_path, output_file_hash, clip_data = result
+        # queue upload data and update job on the upload executor
+        upload_data_and_update_job_status(
+            worker_state, job, output_file_path, output_file_hash, clip_data, worker_state.minio_client)
 
 
-def process_jobs(worker_state):
+def process_jobs(worker_state, clip_batch_size=CLIP_CALCULATION_BATCH_SIZE):
     thread_state = ThreadState(1, "Job Processor")
     last_job_time = time.time()
+    deferred_jobs = worker_state.deferred_jobs
 
     while True:
-        job = worker_state.job_queue.get()
+        if len(deferred_jobs) > 0:
+            job = deferred_jobs.popleft()
+        else:
+            job = worker_state.job_queue.get()
 
         if job is not None:
+            # the job may have waited in the queue since it was claimed
+            worker_state.job_leases.renew([job])
             task_type = job['task_type']
 
             print('\n\n')
@@ -336,8 +401,8 @@ def process_jobs(worker_state):
 
             try:
                 if task_type == 'inpainting_sd_1_5':
-                    output_file_path, output_file_hash, img_data, seed, inpainting_latent = run_inpainting_generation_task(worker_state,
-                                                                                                  generation_task)
+                    output_file_path, output_file_hash, img_data, seed, inpainting_latent, text_conditioning = run_inpainting_generation_task(worker_state,
+                                                                                                                     generation_task)
 
                     job_completion_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
@@ -353,17 +418,17 @@ def process_jobs(worker_state):
                                                                               "positive_prompt"],
                                                                           generation_task.task_input_dict[
                                                                               "negative_prompt"],
-                                                                          worker_state.clip_text_embedder)
-                    # spawn upload data and update job thread
-                    thread = threading.Thread(target=upload_image_data_and_update_job_status, args=(
+                                                                          worker_state.clip_text_embedder,
+                                                                          text_conditioning=text_conditioning)
+                    # queue upload data and update job on the upload executor
+                    upload_image_data_and_update_job_status(
                         worker_state, job, generation_task, -1, inpainting_latent, output_file_path, output_file_hash, job_completion_time,
                         img_data, prompt_embedding, prompt_embedding_average_pooled, prompt_embedding_max_pooled,
-                        prompt_embedding_signed_max_pooled,))
-                    thread.start()
+                        prompt_embedding_signed_max_pooled)
 
                 elif task_type == 'image_generation_sd_1_5':
-                    output_file_path, output_file_hash, img_data, latent, seed = run_image_generation_task(worker_state,
-                                                                                                   generation_task)
+                    output_file_path, output_file_hash, img_data, latent, seed, text_conditioning = run_image_generation_task(worker_state,
+                                                                                                                      generation_task)
 
                     job_completion_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
@@ -379,24 +444,22 @@ def process_jobs(worker_state):
                                                                               "positive_prompt"],
                                                                           generation_task.task_input_dict[
                                                                               "negative_prompt"],
-                                                                          worker_state.clip_text_embedder)
+                                                                          worker_state.clip_text_embedder,
+                                                                          text_conditioning=text_conditioning)
 
-                    # spawn upload data and update job thread
-                    thread = threading.Thread(target=upload_image_data_and_update_job_status, args=(
+                    # queue upload data and update job on the upload executor
+                    upload_image_data_and_update_job_status(
                         worker_state, job, generation_task, seed, latent, output_file_path, output_file_hash,
                         job_completion_time, img_data, prompt_embedding, prompt_embedding_average_pooled,
-                        prompt_embedding_max_pooled, prompt_embedding_signed_max_pooled,))
-                    thread.start()
+                        prompt_embedding_max_pooled, prompt_embedding_signed_max_pooled)
 
                 elif task_type == 'clip_calculation_task_sd_1_5':
-                    output_file_path, output_file_hash, clip_data = run_clip_calculation_task(worker_state,
-                                                                                              generation_task,
-                                                                                              model_type="sd_1_5")
+                    jobs = collect_jobs_of_task_type(worker_state.job_queue, job, clip_batch_size, deferred_jobs)
+                    worker_state.job_leases.renew(jobs)
+                    for batch_job in jobs[1:]:
+                        batch_job['task_start_time'] = job['task_start_time']
 
-                    # spawn upload data and update job thread
-                    thread = threading.Thread(target=upload_data_and_update_job_status, args=(
-                        job, output_file_path, output_file_hash, clip_data, worker_state.minio_client,))
-                    thread.start()
+                    process_clip_calculation_jobs(worker_state, thread_state, jobs, "sd_1_5", clip_batch_size)
 
                 elif task_type == "generate_image_generation_task":
                     # run generate image generation task
@@ -439,6 +502,37 @@ def get_worker_type_list(worker_type: str):
     return worker_type_list
 
 
+def fetch_jobs(worker_state, worker_type_list, thread_state):
+    sleep_time_in_seconds = MIN_JOB_FETCH_SLEEP_TIME_IN_SECONDS
+    while True:
+        # claim enough jobs to fill the queue
+        # nothing is claimed while the queue is full, a claimed job
+        # would wait in put() with its lease running
+        num_jobs_to_claim = worker_state.queue_size - worker_state.job_queue.qsize() - len(worker_state.deferred_jobs)
+        if num_jobs_to_claim <= 0:
+            time.sleep(QUEUE_FULL_SLEEP_TIME_IN_SECONDS)
+            continue
+
+        # try to find jobs
+        # if jobs exist add them to job queue
+        # if not back off exponentially
+        jobs = get_jobs_if_exist(worker_type_list, num_jobs_to_claim)
+        if len(jobs) != 0:
+            info(thread_state, 'Found {} jobs ! '.format(len(jobs)))
+            sleep_time_in_seconds = MIN_JOB_FETCH_SLEEP_TIME_IN_SECONDS
+
+            worker_state.job_leases.add(jobs)
+            for job in jobs:
+                # blocks while the queue is full
+                worker_state.job_queue.put(job)
+            info(thread_state, 'Queue size ' + str(worker_state.job_queue.qsize()))
+
+        else:
+            info(thread_state, "Did not find job, going to sleep for " + f"{sleep_time_in_seconds:.4f}" + " seconds")
+            time.sleep(sleep_time_in_seconds)
+            sleep_time_in_seconds = min(sleep_time_in_seconds * 2, MAX_JOB_FETCH_SLEEP_TIME_IN_SECONDS)
+
+
 def main():
     args = parse_args()
 
@@ -452,6 +546,11 @@ def main():
     if 'clip_calculation_task_sd_1_5' in worker_type_list or len(worker_type_list) == 0:
         load_clip = True
 
+    # a worker that only does clip calculations claims enough jobs to fill a batch
+    # other workers would claim generation jobs that wait in the queue
+    if set(worker_type_list) == {'clip_calculation_task_sd_1_5'}:
+        queue_size = max(queue_size, args.clip_batch_size)
+
     # Initialize worker state
     worker_state = WorkerState(args.device, args.minio_access_key, args.minio_secret_key, queue_size, load_clip)
     # Loading models
@@ -461,30 +560,16 @@ def main():
     info(thread_state, "Worker type: {} ".format(worker_type_list))
 
     # spawning worker thread
-    thread = threading.Thread(target=process_jobs, args=(worker_state,))
+    # daemon, so the worker can exit once the uploads are drained
+    # the lease of an interrupted job expires and it is requeued
+    thread = threading.Thread(target=process_jobs, args=(worker_state, args.clip_batch_size), daemon=True)
     thread.start()
 
-    while True:
-        # if we have more than n jobs in queue
-        # sleep for a while
-        if worker_state.job_queue.qsize() >= worker_state.queue_size:
-            sleep_time_in_seconds = 0.001
-            time.sleep(sleep_time_in_seconds)
-            continue
-
-        # try to find a job
-        # if job exists add it to job queue
-        # if not sleep for a while
-        job = get_job_if_exist(worker_type_list)
-        if job != None:
-            info(thread_state, 'Found job ! ')
-            worker_state.job_queue.put(job)
-            info(thread_state, 'Queue size ' + str(worker_state.job_queue.qsize()))
-
-        else:
-            sleep_time_in_seconds = 5
-            info(thread_state, "Did not find job, going to sleep for " + f"{sleep_time_in_seconds:.4f}" + " seconds")
-            time.sleep(sleep_time_in_seconds)
+    try:
+        fetch_jobs(worker_state, worker_type_list, thread_state)
+    finally:
+        # drain the pending uploads before exiting
+        worker_state.upload_executor.shutdown()
 
 
 if __name__ == '__main__':
@@ -1,6 +1,7 @@
 
 import queue
 import sys
+from collections import deque
 
 base_directory = "./"
 sys.path.insert(0, base_directory)
@@ -11,16 +12,28 @@ from configs.model_config import ModelPathConfig
 from stable_diffusion.model_paths import (SDconfigs, CLIPconfigs)
 from worker.image_generation.scripts.stable_diffusion_base_script import StableDiffusionBaseScript
 from utility.clip import clip
+from worker.upload.upload_executor import UploadExecutor
+from worker.job_lease.job_leases import JobLeases
+from utility.clip.prompt_embedding_cache import PromptEmbeddingCache
 class WorkerState:
     def __init__(self, device, minio_access_key, minio_secret_key, queue_size, load_clip):
         self.device = device
         self.config = ModelPathConfig()
         self.stable_diffusion = None
         self.clip_text_embedder = None
+        self.prompt_embedding_cache = None
         self.txt2img = None
         self.minio_client = get_minio_client(minio_access_key, minio_secret_key)
         self.queue_size = queue_size
-        self.job_queue = queue.Queue()
+        # bounded, so the job fetcher blocks when the queue is full
+        self.job_queue = queue.Queue(maxsize=queue_size)
+        # jobs taken from the queue while collecting a clip calculation batch
+        # they are processed next, the fetcher counts them in the queued jobs
+        self.deferred_jobs = deque()
+        # uploads the generated artifacts and updates the job status
+        self.upload_executor = UploadExecutor()
+        # renews the leases of the claimed jobs
+        self.job_leases = JobLeases()
         self.load_clip = load_clip
         if load_clip:
             self.clip = clip.ClipModel(device=device)
@@ -38,6 +51,8 @@ class WorkerState:
             tokenizer_path=self.config.get_model_folder_path(CLIPconfigs.TXT_EMB_TOKENIZER),
             transformer_path=self.config.get_model_folder_path(CLIPconfigs.TXT_EMB_TEXT_MODEL)
         )
+        # negative prompts are encoded once and reused across jobs
+        self.prompt_embedding_cache = PromptEmbeddingCache(self.clip_text_embedder.forward_return_all)
 
         # Starts the text2img
         self.txt2img = StableDiffusionBaseScript(